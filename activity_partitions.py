@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+activity_partitions.py
+Lifecycle of the monthly activity_logs partitions (migration v7) and the rollup tables.
+
+maintain() runs one cycle, in this order:
+- ensure_partitions : create activity_logs_pYYYYMM for the current month and the next
+                      ACTIVITY_PARTITION_PREMAKE_MONTHS; rows that already landed in
+                      activity_logs_default for that month are moved into the new partition
+- refresh_rollups   : recount activity_rollup_hourly from the last rolled-up hour (minus
+                      ACTIVITY_ROLLUP_LOOKBACK_HOURS for late events) and the days it touches in
+                      activity_rollup_daily; hourly buckets older than ACTIVITY_ROLLUP_HOURLY_DAYS
+                      are deleted, daily buckets are kept
+- apply_retention   : drop (or detach, ACTIVITY_RETENTION_MODE=detach) monthly partitions that
+                      ended more than ACTIVITY_RETENTION_MONTHS ago (0 keeps everything); a
+                      partition is never removed before it has been rolled up
+
+A cycle holds a transaction-scoped advisory lock, so only one instance does the work when several
+run the thread. start() runs maintain() every ACTIVITY_MAINTENANCE_INTERVAL_SEC in a daemon thread
+(main.init_db_pool); `python activity_partitions.py maintain|status` does the same from cron.
+All boundaries are UTC.
+"""
+
+from __future__ import annotations
+import os
+import re
+import sys
+import time
+import logging
+import datetime
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("pf.activity")
+
+ACTIVITY_PARTITION_PREMAKE_MONTHS = int(os.getenv("ACTIVITY_PARTITION_PREMAKE_MONTHS", "2"))
+ACTIVITY_RETENTION_MONTHS = int(os.getenv("ACTIVITY_RETENTION_MONTHS", "12"))
+ACTIVITY_RETENTION_MODE = os.getenv("ACTIVITY_RETENTION_MODE", "drop").lower()
+ACTIVITY_ROLLUP_LOOKBACK_HOURS = int(os.getenv("ACTIVITY_ROLLUP_LOOKBACK_HOURS", "2"))
+ACTIVITY_ROLLUP_HOURLY_DAYS = int(os.getenv("ACTIVITY_ROLLUP_HOURLY_DAYS", "90"))
+ACTIVITY_MAINTENANCE_INTERVAL_SEC = int(os.getenv("ACTIVITY_MAINTENANCE_INTERVAL_SEC", "900"))
+
+RETENTION_MODES = ("drop", "detach")
+PARENT = "activity_logs"
+DEFAULT_PARTITION = "activity_logs_default"
+PARTITION_RE = re.compile(r"^activity_logs_p(\d{4})(\d{2})$")
+
+# "PF" + "ACTV"; separate from the migrations lock
+ADVISORY_LOCK_KEY = 0x5046_4143
+
+UTC = datetime.timezone.utc
+
+
+def month_start(dt: datetime.datetime) -> datetime.datetime:
+    dt = dt.astimezone(UTC) if dt.tzinfo else dt.replace(tzinfo=UTC)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime.datetime, n: int) -> datetime.datetime:
+    index = month.year * 12 + (month.month - 1) + n
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f"{PARENT}_p{month:%Y%m}"
+
+# ---------------------------------------------------------------------------
+# Partitions
+# ---------------------------------------------------------------------------
+def list_partitions(cur) -> List[Tuple[str, datetime.datetime]]:
+    """Attached monthly partitions as (name, month start), oldest first. The default partition is excluded."""
+    cur.execute(
+        """
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        """,
+        (PARENT,),
+    )
+    out = []
+    for (name,) in cur.fetchall():
+        m = PARTITION_RE.match(name)
+        if m:
+            out.append((name, datetime.datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=UTC)))
+    return sorted(out, key=lambda p: p[1])
+
+
+def is_partitioned(cur) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (DEFAULT_PARTITION,))
+    return bool(cur.fetchone()[0])
+
+
+def create_partition(cur, month: datetime.datetime) -> str:
+    """
+    Create and attach the partition for `month`. Built detached, filled with any rows the default
+    partition caught for that month, then attached (ATTACH re-checks the default partition).
+    """
+    name, lo, hi = partition_name(month), month, add_months(month, 1)
+    cur.execute(f'CREATE TABLE "{name}" (LIKE {PARENT} INCLUDING DEFAULTS)')
+    cur.execute(
+        f"""
+        WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE ts >= %s AND ts < %s RETURNING *)
+        INSERT INTO "{name}" SELECT * FROM moved
+        """,
+        (lo, hi),
+    )
+    moved = cur.rowcount
+    cur.execute(f'ALTER TABLE {PARENT} ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', (lo, hi))
+    if moved:
+        log.info("activity partition %s created (%s rows moved from default)", name, moved)
+    return name
+
+
+def ensure_partitions(cur, now: datetime.datetime, ahead: int = ACTIVITY_PARTITION_PREMAKE_MONTHS) -> List[str]:
+    """Make sure the current month and the next `ahead` months have partitions; returns the names created."""
+    existing = {name for name, _ in list_partitions(cur)}
+    created = []
+    current = month_start(now)
+    for i in range(max(0, ahead) + 1):
+        month = add_months(current, i)
+        if partition_name(month) not in existing:
+            created.append(create_partition(cur, month))
+    return created
+
+
+def apply_retention(cur, now: datetime.datetime, months: int = ACTIVITY_RETENTION_MONTHS,
+                    mode: str = ACTIVITY_RETENTION_MODE,
+                    rolled_through: Optional[datetime.datetime] = None) -> List[str]:
+    """
+    Drop / detach partitions whose whole month is older than `months` full months before the current
+    one. Partitions extending past `rolled_through` are kept so no raw row is lost un-counted.
+    Returns the affected partition names.
+    """
+    if months <= 0:
+        return []
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"Unknown retention mode '{mode}' (expected one of {RETENTION_MODES})")
+    cutoff = add_months(month_start(now), -months)
+    if rolled_through is not None:
+        cutoff = min(cutoff, rolled_through)
+    affected = []
+    for name, month in list_partitions(cur):
+        if add_months(month, 1) > cutoff:
+            break
+        if mode == "detach":
+            cur.execute(f'ALTER TABLE {PARENT} DETACH PARTITION "{name}"')
+        else:
+            cur.execute(f'DROP TABLE "{name}"')
+        affected.append(name)
+    if mode == "drop":
+        cur.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE ts < %s", (cutoff,))
+    if affected:
+        log.info("activity retention (%s): %s", mode, ", ".join(affected))
+    return affected
+
+# ---------------------------------------------------------------------------
+# Rollups
+# ---------------------------------------------------------------------------
+def refresh_rollups(cur, now: datetime.datetime, lookback_hours: int = ACTIVITY_ROLLUP_LOOKBACK_HOURS,
+                    hourly_days: int = ACTIVITY_ROLLUP_HOURLY_DAYS) -> Optional[datetime.datetime]:
+    """
+    Recount the hourly buckets from the last rolled-up hour (minus `lookback_hours`) up to `now`,
+    then the daily buckets of the days touched. Bucket counts are recomputed, not incremented, so
+    re-running is harmless. Returns the start of the oldest hour recounted (None when there is nothing).
+    """
+    cur.execute("SELECT MAX(bucket) FROM activity_rollup_hourly")
+    last = cur.fetchone()[0]
+    if last is None:
+        cur.execute(f"SELECT MIN(ts) FROM {PARENT}")
+        first = cur.fetchone()[0]
+        if first is None:
+            return None
+        since = first.astimezone(UTC).replace(minute=0, second=0, microsecond=0)
+    else:
+        # psycopg2 returns it in the session TimeZone; the day boundary below must be UTC midnight
+        since = last.astimezone(UTC) - datetime.timedelta(hours=max(0, lookback_hours))
+    cur.execute(
+        f"""
+        INSERT INTO activity_rollup_hourly (bucket, actor, action, events)
+        SELECT date_trunc('hour', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', COALESCE(actor, ''), COALESCE(action, ''), COUNT(*)
+        FROM {PARENT}
+        WHERE ts >= %s AND ts < %s
+        GROUP BY 1, 2, 3
+        ON CONFLICT (bucket, actor, action) DO UPDATE SET events = EXCLUDED.events
+        """,
+        (since, now),
+    )
+    day = since.replace(hour=0)
+    cur.execute(
+        """
+        INSERT INTO activity_rollup_daily (bucket, actor, action, events)
+        SELECT date_trunc('day', bucket AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', actor, action, SUM(events)
+        FROM activity_rollup_hourly
+        WHERE bucket >= %s
+        GROUP BY 1, 2, 3
+        ON CONFLICT (bucket, actor, action) DO UPDATE SET events = EXCLUDED.events
+        """,
+        (day,),
+    )
+    if hourly_days > 0:
+        cur.execute("DELETE FROM activity_rollup_hourly WHERE bucket < %s",
+                    (min(day, now - datetime.timedelta(days=hourly_days)),))
+    return since
+
+
+def rolled_through(cur) -> Optional[datetime.datetime]:
+    """End of the newest rolled-up hour; raw rows before it are counted in the rollups."""
+    cur.execute("SELECT MAX(bucket) FROM activity_rollup_hourly")
+    last = cur.fetchone()[0]
+    return last + datetime.timedelta(hours=1) if last is not None else None
+
+# ---------------------------------------------------------------------------
+# Maintenance cycle
+# ---------------------------------------------------------------------------
+def maintain(conn, now: Optional[datetime.datetime] = None) -> Dict[str, Any]:
+    """One maintenance cycle in one transaction. Skips when another instance holds the lock."""
+    now = now or datetime.datetime.now(UTC)
+    t0 = time.perf_counter()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ADVISORY_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return {"skipped": "locked"}
+        if not is_partitioned(cur):
+            conn.rollback()
+            return {"skipped": "activity_logs is not partitioned (migration 7 pending)"}
+        created = ensure_partitions(cur, now)
+        refresh_rollups(cur, now)
+        # Rows in the last recounted hour may still grow; everything before `now` is counted
+        removed = apply_retention(cur, now, rolled_through=now)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return {"created": created, "removed": removed, "mode": ACTIVITY_RETENTION_MODE,
+            "elapsed_ms": round((time.perf_counter() - t0) * 1000.0, 2)}
+
+
+class Maintainer:
+    def __init__(self, connection: Callable[[], Any], interval: int = ACTIVITY_MAINTENANCE_INTERVAL_SEC):
+        self._connection = connection
+        self.interval = max(1, interval)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Any] = {"runs": 0, "errors": 0, "last_run": None, "last_report": None}
+
+    def start(self) -> "Maintainer":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="activity-maintenance", daemon=True)
+            self._thread.start()
+        return self
+
+    def run_once(self) -> Optional[Dict[str, Any]]:
+        try:
+            with self._connection() as conn:
+                report = maintain(conn)
+        except Exception as e:
+            log.warning("activity maintenance failed: %s", e)
+            with self._lock:
+                self._stats["errors"] += 1
+            return None
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["last_run"] = datetime.datetime.now(UTC).isoformat()
+            self._stats["last_report"] = report
+        return report
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "interval_sec": self.interval}
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
+
+
+maintainer: Optional[Maintainer] = None
+_start_lock = threading.Lock()
+
+
+def start(connection: Callable[[], Any]) -> Optional[Maintainer]:
+    """Start the process-wide maintenance thread (idempotent). ACTIVITY_MAINTENANCE_INTERVAL_SEC=0 disables it."""
+    global maintainer
+    if ACTIVITY_MAINTENANCE_INTERVAL_SEC <= 0:
+        return None
+    with _start_lock:
+        if maintainer is None:
+            maintainer = Maintainer(connection).start()
+    return maintainer
+
+
+def stats() -> Optional[Dict[str, Any]]:
+    return maintainer.stats() if maintainer is not None else None
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+def main(argv: Optional[List[str]] = None) -> int:
+    import migrations
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    cmd = argv[0] if argv else "status"
+    if cmd not in ("status", "maintain"):
+        print("usage: python activity_partitions.py [status|maintain]", file=sys.stderr)
+        return 2
+    dsn = migrations._dsn_from_env()
+    if not dsn:
+        print("Database configuration is incomplete (set DATABASE_URL or DB_* env vars).", file=sys.stderr)
+        return 1
+
+    import psycopg2
+    conn: Any = psycopg2.connect(dsn)
+    try:
+        migrations.ensure_migrated(conn)
+        if cmd == "maintain":
+            print(maintain(conn))
+            return 0
+        cur = conn.cursor()
+        for name, month in list_partitions(cur):
+            print(f"{name}  {month:%Y-%m}")
+        print(f"rolled through: {rolled_through(cur) or '-'}")
+        conn.rollback()
+        cur.close()
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+activity_writer.py
+Buffered, batched writer for activity_logs.
+
+Request threads call submit() and return immediately; one background thread drains a bounded
+queue and writes each batch with a single multi-row INSERT (execute_values) on a pooled
+connection, every ACTIVITY_BATCH_SIZE events or ACTIVITY_FLUSH_MS milliseconds, whichever
+comes first. The timestamp is taken at submit() time, so batching does not skew `ts`.
+
+When the queue is full the overflow policy decides:
+- drop   : discard the new event (counted)
+- sample : above 80% full keep 1 in ACTIVITY_SAMPLE_RATE events; discard when full
+- block  : wait up to ACTIVITY_BLOCK_TIMEOUT_MS for space, then discard
+
+close() (registered with atexit, so it runs on gunicorn worker shutdown) flushes what is
+queued. Events that must commit with the surrounding transaction (e.g. webhook_paid) bypass
+this writer: main._log_activity(..., sync=True) inserts on the request's cursor instead.
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import datetime
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("pf.activity")
+
+ACTIVITY_ASYNC = os.getenv("ACTIVITY_ASYNC", "1") == "1"
+ACTIVITY_BATCH_SIZE = int(os.getenv("ACTIVITY_BATCH_SIZE", "200"))
+ACTIVITY_FLUSH_MS = int(os.getenv("ACTIVITY_FLUSH_MS", "500"))
+ACTIVITY_QUEUE_MAX = int(os.getenv("ACTIVITY_QUEUE_MAX", "10000"))
+ACTIVITY_OVERFLOW_POLICY = os.getenv("ACTIVITY_OVERFLOW_POLICY", "drop").lower()
+ACTIVITY_SAMPLE_RATE = max(1, int(os.getenv("ACTIVITY_SAMPLE_RATE", "10")))
+ACTIVITY_BLOCK_TIMEOUT_MS = int(os.getenv("ACTIVITY_BLOCK_TIMEOUT_MS", "50"))
+
+POLICIES = ("drop", "sample", "block")
+COLUMNS = ("ts", "actor", "action", "details", "ip", "user_agent")
+
+Event = Tuple[datetime.datetime, str, str, str, str, str]
+
+_STOP = object()
+
+
+def make_event(actor: Optional[str], action: Optional[str], details: Any, ip: str = "", user_agent: str = "") -> Event:
+    return (
+        datetime.datetime.now(datetime.timezone.utc),
+        actor or "system",
+        action or "event",
+        json.dumps(details or {}),
+        ip or "",
+        user_agent or "",
+    )
+
+
+def insert_events(cur, events: List[Event]) -> None:
+    """One multi-row INSERT for the whole batch."""
+    from psycopg2.extras import execute_values
+    execute_values(
+        cur,
+        f"INSERT INTO activity_logs ({', '.join(COLUMNS)}) VALUES %s",
+        events,
+        template="(%s, %s, %s, %s::jsonb, %s, %s)",
+        page_size=max(len(events), 1),
+    )
+
+
+class ActivityWriter:
+    def __init__(
+        self,
+        connection: Callable[[], Any],
+        batch_size: int = ACTIVITY_BATCH_SIZE,
+        flush_ms: int = ACTIVITY_FLUSH_MS,
+        max_queue: int = ACTIVITY_QUEUE_MAX,
+        policy: str = ACTIVITY_OVERFLOW_POLICY,
+        sample_rate: int = ACTIVITY_SAMPLE_RATE,
+        block_timeout_ms: int = ACTIVITY_BLOCK_TIMEOUT_MS,
+        writer: Callable[[Any, List[Event]], None] = insert_events,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}' (expected one of {POLICIES})")
+        self._connection = connection
+        self._write = writer
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(1, flush_ms) / 1000.0
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.sample_rate = max(1, sample_rate)
+        self.block_timeout = block_timeout_ms / 1000.0
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0  # queued + being written
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._counters = {"submitted": 0, "written": 0, "dropped": 0, "sampled_out": 0,
+                          "batches": 0, "write_errors": 0}
+        self._last_flush_ms = 0.0
+
+    # ------------------------------------------------------------------
+    def start(self) -> "ActivityWriter":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="activity-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, event: Event) -> bool:
+        """Queue one event. Returns False when the overflow policy discarded it."""
+        if self._closed:
+            return False
+        if self.policy == "sample" and self._queue.qsize() >= 0.8 * self.max_queue:
+            if random.randrange(self.sample_rate) != 0:
+                self._count("sampled_out")
+                return False
+        with self._lock:
+            self._pending += 1
+        try:
+            if self.policy == "block":
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self._pending -= 1
+            self._count("dropped")
+            return False
+        self._count("submitted")
+        return True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Write everything queued so far; True when the queue drained within `timeout`."""
+        self._flush_requested.set()
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "queue_depth": self._queue.qsize(), "max_queue": self.max_queue,
+                    "policy": self.policy, "last_flush_ms": round(self._last_flush_ms, 2)}
+
+    # ------------------------------------------------------------------
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch: List[Event] = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if self._flush_requested.is_set():
+                    timeout = 0
+                try:
+                    item = self._queue.get(timeout=max(0.0, timeout)) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    # drain whatever arrived before the stop marker
+                    while True:
+                        try:
+                            rest = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if rest is not _STOP:
+                            batch.append(rest)
+                    break
+                batch.append(item)
+            if self._queue.empty():
+                self._flush_requested.clear()
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Event]) -> None:
+        t0 = time.perf_counter()
+        ok = False
+        for attempt in (1, 2):
+            try:
+                with self._connection() as conn:
+                    cur = conn.cursor()
+                    try:
+                        self._write(cur, batch)
+                        conn.commit()
+                    finally:
+                        cur.close()
+                ok = True
+                break
+            except Exception as e:
+                self._count("write_errors")
+                log.warning("activity batch write failed (attempt %s, %s events): %s", attempt, len(batch), e)
+                time.sleep(0.05 * attempt)
+        with self._idle:
+            if ok:
+                self._counters["written"] += len(batch)
+                self._counters["batches"] += 1
+            else:
+                self._counters["dropped"] += len(batch)
+            self._pending -= len(batch)
+            self._last_flush_ms = (time.perf_counter() - t0) * 1000.0
+            self._idle.notify_all()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+
+writer: Optional[ActivityWriter] = None
+_start_lock = threading.Lock()
+
+
+def start(connection: Callable[[], Any]) -> Optional[ActivityWriter]:
+    """Start the process-wide writer (idempotent). Returns None when ACTIVITY_ASYNC=0."""
+    global writer
+    if not ACTIVITY_ASYNC:
+        return None
+    with _start_lock:
+        if writer is None:
+            writer = ActivityWriter(connection).start()
+            atexit.register(shutdown)
+            log.info("activity writer started (batch=%s, flush=%sms, queue=%s, policy=%s)",
+                     ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_MS, ACTIVITY_QUEUE_MAX, ACTIVITY_OVERFLOW_POLICY)
+    return writer
+
+
+def shutdown() -> None:
+    global writer
+    w = writer
+    if w is not None:
+        w.close()
+        writer = None
+
+
+def stats() -> Optional[Dict[str, Any]]:
+    return writer.stats() if writer is not None else None
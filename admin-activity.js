@@ -3,7 +3,7 @@
 // - English-only code & messages.
 // - Backward-compatible: exposes window.PFActivity.fetchActivity(reset?)
 // - Date parsing supports "dd/mm/yyyy[ HH:MM]" and ISO/`yyyy-mm-dd`.
-// - Keeps original behavior: header X-Admin-Password, limit/offset pagination.
+// - Header X-Admin-Password; keyset pagination via opaque next/prev cursors (constant time at any depth).
 
 (function(){
   "use strict";
@@ -31,9 +31,11 @@
   const untilInput = document.getElementById("untilInput");
   const sortSelect = document.getElementById("sortSelect");
 
-  let offset = 0;
   const limit = 50;
-  let lastFetched = 0;
+  let cursor = null;       // cursor of the page being requested (null = first page)
+  let nextCursor = null;
+  let prevCursor = null;
+  let total = null;        // from the first page; later pages skip counting
 
   // ----- Date parsing -----
   function toISO(raw){
@@ -86,9 +88,15 @@
     });
   }
 
+  function renderTotal(){
+    const el = document.getElementById("activityTotal");
+    if(!el) return;
+    el.textContent = total == null ? "" : (total.estimate ? `~${total.value}` : String(total.value));
+  }
+
   async function fetchActivity(reset=false){
     try{
-      if(reset){ offset = 0; }
+      if(reset){ cursor = null; total = null; }
 
       const adminPw = window.__adminPassword || "";
       if(!adminPw) throw new Error("Missing admin password");
@@ -106,7 +114,7 @@
       if(untilISO) params.set("until", untilISO);
       params.set("sort", sort);
       params.set("limit", String(limit));
-      params.set("offset", String(offset));
+      if(cursor) params.set("cursor", cursor);
 
       const res = await window.apiFetch(`/admin/activity?${params.toString()}`, {
         method: "GET",
@@ -119,8 +127,13 @@
       }
 
       const data = await res.json().catch(()=>({ items: [] }));
-      lastFetched = (data.items || []).length;
+      nextCursor = data.next_cursor || null;
+      prevCursor = data.prev_cursor || null;
+      if(data.total != null) total = { value: data.total, estimate: !!data.total_is_estimate };
       renderRows(data.items || []);
+      renderTotal();
+      if(prevBtn) prevBtn.disabled = !prevCursor;
+      if(nextBtn) nextBtn.disabled = !nextCursor;
     }catch(err){
       console.error("[PF][admin-activity] fetchActivity error:", err);
       renderRows([]);
@@ -133,12 +146,13 @@
   // events
   loadBtn && loadBtn.addEventListener("click", ()=> fetchActivity(true));
   prevBtn && prevBtn.addEventListener("click", ()=>{
-    offset = Math.max(0, offset - limit);
+    if(!prevCursor) return;
+    cursor = prevCursor;
     fetchActivity(false);
   });
   nextBtn && nextBtn.addEventListener("click", ()=>{
-    if(lastFetched < limit) return;
-    offset += limit;
+    if(!nextCursor) return;
+    cursor = nextCursor;
     fetchActivity(false);
   });
 })();
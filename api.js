@@ -85,6 +85,70 @@
     return await res.json();
   }
 
+  // Read an NDJSON streaming response (`?stream=ndjson`), calling onEvent(event, data) per line
+  async function readEventStream(res, onEvent) {
+    const ct = (res.headers.get('content-type') || '').toLowerCase();
+    if (!res.body || !ct.includes('application/x-ndjson')) return false;
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, { stream: true });
+      let nl;
+      while ((nl = buf.indexOf('\n')) >= 0) {
+        const line = buf.slice(0, nl).trim();
+        buf = buf.slice(nl + 1);
+        if (!line) continue;
+        try { const msg = JSON.parse(line); onEvent(msg.event, msg.data); } catch (e) { /* ignore partial/garbled line */ }
+      }
+    }
+    return true;
+  }
+
+  // Buffered activity events: flushed to /activity/log/batch every few seconds or when the buffer
+  // fills; on page hide the remainder goes out with navigator.sendBeacon (text/plain NDJSON, so no
+  // CORS preflight is needed and the request survives navigation).
+  const TRACK_FLUSH_MS = 5000;
+  const TRACK_MAX_BUFFER = 20;
+  let trackBuffer = [];
+  let trackTimer = null;
+
+  function flushTrack(useBeacon) {
+    if (trackTimer) { clearTimeout(trackTimer); trackTimer = null; }
+    if (!trackBuffer.length || !API_BASE) return;
+    const events = trackBuffer;
+    trackBuffer = [];
+    const url = API_BASE + '/activity/log/batch';
+    const body = events.map((e) => JSON.stringify(e)).join('\n');
+    try {
+      if (useBeacon && navigator.sendBeacon &&
+          navigator.sendBeacon(url, new Blob([body], { type: 'text/plain' }))) return;
+      fetch(url, { method: 'POST', body, keepalive: true, credentials: 'omit',
+                   headers: { 'Content-Type': 'text/plain' } }).catch(() => {});
+    } catch (e) { /* ignore logging errors */ }
+  }
+
+  function track(action, details, actor) {
+    trackBuffer.push({ actor: actor || 'web', action, details: details || {} });
+    if (trackBuffer.length >= TRACK_MAX_BUFFER) flushTrack(false);
+    else if (!trackTimer) trackTimer = setTimeout(() => flushTrack(false), TRACK_FLUSH_MS);
+  }
+
+  try {
+    window.addEventListener('pagehide', () => flushTrack(true));
+    document.addEventListener('visibilitychange', () => {
+      if (document.visibilityState === 'hidden') flushTrack(true);
+    });
+  } catch (e) {}
+
+  // One Idempotency-Key per checkout: a re-sent /create-bill with the same key returns the same bill
+  function newIdempotencyKey() {
+    try { if (crypto && crypto.randomUUID) return crypto.randomUUID(); } catch (e) {}
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+  }
+
   try { window.API_BASE = API_BASE; } catch (e) {}
   try { window.apiFetch = apiFetch; } catch (e) {}
   try { window.PF_apiFetch = apiFetch; } catch (e) {}
@@ -92,6 +156,9 @@
   try { window.ensureProjectId = ensureProjectId; } catch (e) {}
   try { window.clearProjectId = clearProjectId; } catch (e) {}
   try { window.apiJson = apiJson; } catch (e) {}
+  try { window.PF_readEventStream = readEventStream; } catch (e) {}
+  try { window.pfTrack = track; window.pfTrackFlush = flushTrack; } catch (e) {}
+  try { window.pfIdempotencyKey = newIdempotencyKey; } catch (e) {}
   try {
     // Legacy global alias (best-effort)
     if (typeof apiFetch === 'undefined') {
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+appendix.py
+The director's appendix library (appendix_library.json) as a versioned, hot-reloadable snapshot.
+
+A Library snapshot is built once per file version and never changes afterwards:
+- body / etag / version: the serialized JSON served by GET /v1/director/library, its strong ETag
+  and a short content hash (blueprint memo keys, X-Library-Version)
+- indexes derived from the lists, so a chat turn does not rescan them: platforms by id and by
+  lower-case label, durations per platform, every duration, tone / style sets, goal labels,
+  narrative templates by id
+
+current() returns the live snapshot. The file's mtime is checked at most every
+APPENDIX_CHECK_SEC seconds and a changed file is reloaded in place; SIGHUP (install_sighup(),
+`kill -HUP <worker pid>`) forces a reload on the next call. A file that fails to parse keeps the
+previous snapshot. Without any file the built-in FALLBACK library is used.
+
+Env: APPENDIX_LIBRARY_PATH (probed before the default locations), APPENDIX_CHECK_SEC (2).
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import signal
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+log = logging.getLogger("pf.appendix")
+
+APPENDIX_LIBRARY_PATH = os.getenv("APPENDIX_LIBRARY_PATH", "").strip()
+APPENDIX_CHECK_SEC = float(os.getenv("APPENDIX_CHECK_SEC", "2"))
+
+SEARCH_PATHS = [
+    os.path.join(os.getcwd(), "appendix_library.json"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "appendix_library.json"),
+    "/workspace/appendix_library.json",
+]
+
+FALLBACK: Dict[str, Any] = {
+    "goals": [{"id": "awareness", "label": "Brand awareness"}, {"id": "conversions", "label": "Drive conversions"}],
+    "tones": ["playful", "energetic"],
+    "styles": ["cinematic", "ugc"],
+    "platforms": [{"id": "tiktok", "label": "TikTok", "durations_sec": [15, 30, 60], "aspect_ratio": "9:16"}],
+    "comedy_substyles": ["slapstick", "situational"],
+    "camera_moves": ["push-in", "dolly"],
+    "narrative_templates": [{"id": "hook-build-payoff", "label": "Hook → Build → Payoff",
+                             "beats": [{"name": "Hook"}, {"name": "Build"}, {"name": "Payoff"}]}],
+    "veo_blueprint_rules": {"text_free": True, "language": "English", "negative_prompt": ["no on-screen text"]},
+}
+
+
+class Library:
+    """One loaded version of the library: the data, its serialized form and derived indexes."""
+
+    def __init__(self, data: Mapping[str, Any], path: Optional[str] = None, mtime: Optional[float] = None):
+        self.data = dict(data)
+        self.path = path
+        self.mtime = mtime
+        self.body = json.dumps(self.data, ensure_ascii=False).encode("utf-8")
+        digest = hashlib.sha256(self.body).hexdigest()
+        self.etag = digest[:32]
+        self.version = digest[:12]
+        self.loaded_at = time.time()
+
+        platforms = [p for p in self.data.get("platforms") or [] if isinstance(p, dict) and p.get("id")]
+        self.platforms_by_id: Dict[str, Dict[str, Any]] = {p["id"]: p for p in platforms}
+        self.platforms_by_label: Dict[str, Dict[str, Any]] = {
+            str(p.get("label") or p["id"]).lower(): p for p in platforms}
+        self.platform_labels: Tuple[str, ...] = tuple(p.get("label") or p["id"] for p in platforms)
+        self.durations_by_platform: Dict[str, Tuple[int, ...]] = {
+            p["id"]: tuple(sorted({int(d) for d in p.get("durations_sec") or []})) for p in platforms}
+        self.durations: Tuple[int, ...] = tuple(sorted({d for ds in self.durations_by_platform.values() for d in ds}))
+        self.tones: Tuple[str, ...] = tuple(self.data.get("tones") or ())
+        self.styles: Tuple[str, ...] = tuple(self.data.get("styles") or ())
+        self.tone_set = frozenset(t.lower() for t in self.tones)
+        self.style_set = frozenset(s.lower() for s in self.styles)
+        self.goal_labels: Tuple[str, ...] = tuple(
+            g.get("label") for g in self.data.get("goals") or [] if isinstance(g, dict) and g.get("label"))
+        self.templates_by_id: Dict[str, Dict[str, Any]] = {
+            t["id"]: t for t in self.data.get("narrative_templates") or [] if isinstance(t, dict) and t.get("id")}
+
+    def platform(self, name: str) -> Optional[Dict[str, Any]]:
+        """Platform entry by id or label (case-insensitive)."""
+        if not name:
+            return None
+        return self.platforms_by_id.get(name) or self.platforms_by_label.get(name.lower())
+
+
+def find_path() -> Optional[str]:
+    for p in ([APPENDIX_LIBRARY_PATH] if APPENDIX_LIBRARY_PATH else []) + SEARCH_PATHS:
+        if os.path.isfile(p):
+            return p
+    return None
+
+
+def _mtime(path: Optional[str]) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+class LibraryService:
+    def __init__(self, paths: Optional[List[str]] = None, check_interval: float = APPENDIX_CHECK_SEC):
+        self.paths = paths
+        self.check_interval = check_interval
+        self._lib: Optional[Library] = None
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._force = False
+        self._counters = {"reloads": 0, "reload_errors": 0}
+
+    def _find(self) -> Optional[str]:
+        if self.paths is None:
+            return find_path()
+        return next((p for p in self.paths if os.path.isfile(p)), None)
+
+    def _load(self) -> None:
+        path = self._find()
+        mtime = _mtime(path)
+        if self._lib is not None and path == self._lib.path and mtime == self._lib.mtime:
+            return
+        if path is None:
+            lib = Library(FALLBACK)
+            if self._lib is None or self._lib.path is not None:
+                log.warning("appendix_library.json not found; using the built-in library")
+        else:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lib = Library(json.load(f), path, mtime)
+            except (OSError, ValueError) as e:
+                self._counters["reload_errors"] += 1
+                log.error("appendix library %s unreadable, keeping version %s: %s",
+                          path, self._lib.version if self._lib else None, e)
+                if self._lib is not None:
+                    return
+                lib = Library(FALLBACK)
+        if self._lib is not None and lib.etag != self._lib.etag:
+            self._counters["reloads"] += 1
+            log.info("appendix library reloaded: %s -> %s", self._lib.version, lib.version)
+        self._lib = lib
+
+    def current(self) -> Library:
+        """The live snapshot, reloaded first when the file changed or a reload was requested."""
+        now = time.monotonic()
+        lib = self._lib
+        if lib is not None and not self._force and now < self._next_check:
+            return lib
+        with self._lock:
+            if self._lib is None or self._force or now >= self._next_check:
+                self._force = False
+                self._next_check = now + self.check_interval
+                self._load()
+            return self._lib
+
+    def request_reload(self) -> None:
+        """Reload on the next current() call (safe to call from a signal handler)."""
+        self._force = True
+
+    def reload(self) -> Library:
+        self.request_reload()
+        return self.current()
+
+    def stats(self) -> Dict[str, Any]:
+        lib = self._lib
+        return {**self._counters, "version": lib.version if lib else None,
+                "path": lib.path if lib else None, "loaded_at": lib.loaded_at if lib else None}
+
+
+service = LibraryService()
+
+
+def current() -> Library:
+    return service.current()
+
+
+def stats() -> Dict[str, Any]:
+    return service.stats()
+
+
+def install_sighup() -> bool:
+    """Reload the library on SIGHUP, unless the process already handles SIGHUP (or this is not the main thread)."""
+    if not hasattr(signal, "SIGHUP"):
+        return False
+    try:
+        if signal.getsignal(signal.SIGHUP) not in (signal.SIG_DFL, None):
+            return False
+        signal.signal(signal.SIGHUP, lambda signum, frame: service.request_reload())
+        return True
+    except ValueError:  # not the main thread
+        return False
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+auth.py
+JWT issue / verify with a decoded-token cache and revocation.
+
+- Verified tokens are kept in a bounded LRU keyed by sha256(token), so a hot token costs one hash
+  and a dict lookup instead of an HS256 verify; an entry is served only until the token's `exp`
+- Tokens carry `jti` (revoke one token) and `ver` (the user's token_version at issue time; bumping
+  users.token_version revokes every older token of that user). Tokens issued before this module
+  have neither and count as version 0.
+- Revocation state (unexpired revoked_tokens rows + users with token_version > 0) is loaded with
+  one query and refreshed at most every AUTH_REVOCATION_TTL_SEC per process, by whichever request
+  finds it stale; other requests keep using the previous snapshot meanwhile. Revocations made by
+  this process apply immediately, other instances pick them up within the TTL.
+- Until attach(connection) is called (main.init_db_pool) only signature and expiry are checked.
+- require_auth replaces the per-route `_jwt_decode` block: the payload is in `flask.g.jwt`.
+
+Env: AUTH_TOKEN_CACHE_SIZE (10000), AUTH_REVOCATION_TTL_SEC (30).
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import jwt
+from flask import current_app, g, request
+
+log = logging.getLogger("pf.auth")
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_REVOCATION_TTL_SEC = float(os.getenv("AUTH_REVOCATION_TTL_SEC", "30"))
+TOKEN_LIFETIME = datetime.timedelta(days=30)
+ALGORITHM = "HS256"
+
+
+def token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+# ---------------------------------------------------------------------------
+# Decoded-token LRU
+# ---------------------------------------------------------------------------
+class TokenCache:
+    def __init__(self, max_entries: int = AUTH_TOKEN_CACHE_SIZE):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key: bytes, now: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            exp, payload = entry
+            if exp <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key: bytes, payload: Dict[str, Any]) -> None:
+        exp = payload.get("exp")
+        if not isinstance(exp, (int, float)):
+            return  # no expiry: always verify
+        with self._lock:
+            self._entries[key] = (float(exp), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# ---------------------------------------------------------------------------
+# Revocation snapshot
+# ---------------------------------------------------------------------------
+def load_revocations(connection: Callable[[], Any]) -> Tuple[Set[str], Dict[str, int]]:
+    """(revoked jtis, {username: token_version}) for unexpired revocations / bumped users."""
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT jti FROM revoked_tokens WHERE expires_at > NOW()")
+            jtis = {r[0] for r in cur.fetchall()}
+            cur.execute("SELECT username, token_version FROM users WHERE token_version > 0")
+            versions = {r[0]: int(r[1]) for r in cur.fetchall()}
+            conn.commit()
+        finally:
+            cur.close()
+    return jtis, versions
+
+
+class RevocationCache:
+    def __init__(self, loader: Callable[[], Tuple[Set[str], Dict[str, int]]], ttl: float = AUTH_REVOCATION_TTL_SEC):
+        self._loader = loader
+        self.ttl = ttl
+        self._jtis: Set[str] = set()
+        self._versions: Dict[str, int] = {}
+        self._loaded_at = 0.0
+        self._refreshing = threading.Lock()
+        self.refreshes = 0
+        self.errors = 0
+
+    def is_revoked(self, payload: Dict[str, Any]) -> bool:
+        if time.monotonic() - self._loaded_at >= self.ttl:
+            self.refresh(blocking=self._loaded_at == 0.0)
+        if payload.get("jti") in self._jtis:
+            return True
+        user = payload.get("username") or payload.get("user_id")
+        current = self._versions.get(user, 0)
+        return current > int(payload.get("ver") or 0)
+
+    def refresh(self, blocking: bool = True) -> None:
+        if not self._refreshing.acquire(blocking=blocking):
+            return  # another request is already refreshing; use the current snapshot
+        try:
+            jtis, versions = self._loader()
+            self._jtis, self._versions = jtis, versions
+            self.refreshes += 1
+        except Exception as e:
+            self.errors += 1
+            log.warning("revocation refresh failed (keeping previous snapshot): %s", e)
+        finally:
+            # A failed load is retried after the TTL too, not on every request
+            self._loaded_at = time.monotonic()
+            self._refreshing.release()
+
+    def add_jti(self, jti: str) -> None:
+        self._jtis = self._jtis | {jti}
+
+    def set_version(self, username: str, version: int) -> None:
+        self._versions = {**self._versions, username: version}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"revoked_jtis": len(self._jtis), "bumped_users": len(self._versions),
+                "refreshes": self.refreshes, "errors": self.errors}
+
+# ---------------------------------------------------------------------------
+# Authenticator
+# ---------------------------------------------------------------------------
+class Authenticator:
+    def __init__(self, secret: str, cache_size: int = AUTH_TOKEN_CACHE_SIZE):
+        self.secret = secret
+        self.tokens = TokenCache(cache_size)
+        self.revocations: Optional[RevocationCache] = None
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "invalid": 0, "revoked": 0}
+
+    def attach(self, connection: Callable[[], Any], ttl: float = AUTH_REVOCATION_TTL_SEC) -> None:
+        """Enable revocation checks, loading state through `connection` (a context-manager factory)."""
+        if self.revocations is None:
+            self.revocations = RevocationCache(lambda: load_revocations(connection), ttl)
+
+    def issue(self, username: str, version: int = 0, claims: Optional[Dict[str, Any]] = None) -> str:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        payload = {
+            **(claims or {}),
+            "username": username,
+            "iat": int(now.timestamp()),
+            "exp": int((now + TOKEN_LIFETIME).timestamp()),
+            "jti": uuid.uuid4().hex,
+            "ver": int(version or 0),
+        }
+        tok = jwt.encode(payload, self.secret, algorithm=ALGORITHM)
+        return tok.decode() if isinstance(tok, bytes) else tok
+
+    def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """Decoded payload, or None when the token is invalid, expired or revoked."""
+        if not token:
+            return None
+        key = token_key(token)
+        payload = self.tokens.get(key, time.time())
+        if payload is not None:
+            self._count("hits")
+        else:
+            try:
+                payload = jwt.decode(token, self.secret, algorithms=[ALGORITHM])
+            except Exception as e:
+                self._count("invalid")
+                log.debug("jwt rejected: %s", e)
+                return None
+            self._count("misses")
+            self.tokens.set(key, payload)
+        if self.revocations is not None and self.revocations.is_revoked(payload):
+            self._count("revoked")
+            return None
+        return payload
+
+    def verify_request(self, req) -> Optional[Dict[str, Any]]:
+        ah = req.headers.get("Authorization", "")
+        if not ah.startswith("Bearer "):
+            return None
+        return self.verify(ah.split(" ", 1)[1].strip())
+
+    def revoke(self, cur, payload: Dict[str, Any]) -> bool:
+        """Revoke one token (by jti) on the caller's cursor; commit is the caller's. False if it has no jti."""
+        jti = payload.get("jti")
+        if not jti:
+            return False
+        exp = datetime.datetime.fromtimestamp(int(payload.get("exp") or time.time()), datetime.timezone.utc)
+        cur.execute(
+            "INSERT INTO revoked_tokens (jti, username, expires_at) VALUES (%s, %s, %s) ON CONFLICT (jti) DO NOTHING",
+            (jti, payload.get("username") or "", exp),
+        )
+        if self.revocations is not None:
+            self.revocations.add_jti(jti)
+        return True
+
+    def revoke_all(self, cur, username: str) -> Optional[int]:
+        """Invalidate every token issued to `username` so far. Returns the new version (None: no such user)."""
+        cur.execute("UPDATE users SET token_version = token_version + 1 WHERE username=%s RETURNING token_version",
+                    (username,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        if self.revocations is not None:
+            self.revocations.set_version(username, int(row[0]))
+        return int(row[0])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._counters)
+        out["cached_tokens"] = len(self.tokens)
+        out["evictions"] = self.tokens.evictions
+        out["revocation"] = self.revocations.stats() if self.revocations is not None else None
+        return out
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+authenticator: Optional[Authenticator] = None
+
+
+def configure(secret: str) -> Authenticator:
+    global authenticator
+    authenticator = Authenticator(secret)
+    return authenticator
+
+
+def require_auth(view):
+    """Reject with 401 unless the request has a valid Bearer token; the payload is put in `g.jwt`."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == "OPTIONS":
+            return ("", 204)
+        payload = authenticator.verify_request(request) if authenticator is not None else None
+        if not payload:
+            return current_app.response_class(json.dumps({"error": "Invalid token"}), status=401,
+                                              mimetype="application/json")
+        g.jwt = payload
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+blueprint.py
+The director's VEO blueprint, built from the session slots and the appendix library.
+
+Both /v1/director/blueprint and the "generate blueprint" turn of the director chat call build();
+the result is a typed, immutable Blueprint whose to_dict() is the JSON the routes return:
+
+    {"meta": {platform, duration_sec, tone, style, text_free, template},
+     "overview": "Goal: ... Key message: ... CTA: ... Text-free policy enforced.",
+     "beats": [{"name", "secs", "direction"}, ...],
+     "negative_prompt": [...]}
+
+- any of the library's narrative_templates can be used (slot "narrative_template" or the
+  template_id argument, by id; the first template otherwise), with any number of beats
+- timing keeps the 20/60/20 split: the first and last beats get 20% of the runtime each (at
+  least MIN_EDGE_SEC), the beats in between share the rest; a one-beat template gets all of it
+- results are memoized by a hash of the normalized slots, the library version and the template,
+  so a repeated request for an unchanged brief is a dictionary lookup
+"""
+
+from __future__ import annotations
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+BLUEPRINT_CACHE_ENTRIES = int(os.getenv("BLUEPRINT_CACHE_ENTRIES", "1024"))
+
+MIN_DURATION_SEC = 15
+MIN_EDGE_SEC = 3
+MIN_MIDDLE_SEC = 6
+EDGE_SHARE = 0.2
+
+DEFAULTS: Dict[str, Any] = {
+    "goal": "Brand awareness",
+    "platform": "tiktok",
+    "duration_sec": 30,
+    "tone": "playful",
+    "style": "ugc",
+    "key_message": "Strong hook in first 2s",
+    "cta": "DM us",
+}
+DEFAULT_BEATS = [{"name": "Hook"}, {"name": "Build"}, {"name": "Payoff"}]
+# Directions for the standard beat names; other beats use the template's guideline
+DIRECTIONS: Dict[str, str] = {
+    "hook": "Grab attention visually in 2s; no on-screen text.",
+    "build": "Escalate the premise; include product claim or gag.",
+    "payoff": "Punchline + CTA ('{cta}').",
+}
+
+
+class Beat(NamedTuple):
+    name: str
+    secs: int
+    direction: str
+
+
+class Meta(NamedTuple):
+    platform: str
+    duration_sec: int
+    tone: str
+    style: str
+    text_free: bool
+    template: str
+
+
+class Blueprint(NamedTuple):
+    meta: Meta
+    overview: str
+    beats: Tuple[Beat, ...]
+    negative_prompt: Tuple[str, ...]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "meta": self.meta._asdict(),
+            "overview": self.overview,
+            "beats": [b._asdict() for b in self.beats],
+            "negative_prompt": list(self.negative_prompt),
+        }
+
+
+def _text(value: Any, default: str) -> str:
+    value = str(value).strip() if value is not None else ""
+    return value or default
+
+
+def normalize_slots(slots: Optional[Mapping[str, Any]]) -> Dict[str, Any]:
+    """The slot values a blueprint depends on, with defaults applied (everything else is ignored)."""
+    slots = slots or {}
+    out = {k: _text(slots.get(k), v) for k, v in DEFAULTS.items() if k != "duration_sec"}
+    try:
+        out["duration_sec"] = int(slots.get("duration_sec") or DEFAULTS["duration_sec"])
+    except (TypeError, ValueError):
+        out["duration_sec"] = DEFAULTS["duration_sec"]
+    out["narrative_template"] = _text(slots.get("narrative_template"), "")
+    return out
+
+
+def split_seconds(total: int, n: int) -> List[int]:
+    """Per-beat seconds for `n` beats: 20% for the first and the last, the rest shared by the middle."""
+    if n <= 0:
+        return []
+    if n == 1:
+        return [total]
+    edge = max(int(total * EDGE_SHARE), MIN_EDGE_SEC)
+    if n == 2:
+        return [edge, max(total - edge, MIN_EDGE_SEC)]
+    middle = n - 2
+    rest = max(total - 2 * edge, MIN_MIDDLE_SEC, MIN_EDGE_SEC * middle)
+    share, extra = divmod(rest, middle)
+    return [edge] + [share + (1 if i < extra else 0) for i in range(middle)] + [edge]
+
+
+def pick_template(library: Mapping[str, Any], template_id: str = "") -> Dict[str, Any]:
+    templates = [t for t in library.get("narrative_templates") or [] if isinstance(t, dict)]
+    for t in templates:
+        if template_id and t.get("id") == template_id:
+            return t
+    return templates[0] if templates else {"id": "", "beats": DEFAULT_BEATS}
+
+
+def _direction(beat: Mapping[str, Any], last: bool, cta: str) -> str:
+    name = _text(beat.get("name"), "").lower()
+    if name in DIRECTIONS:
+        return DIRECTIONS[name].format(cta=cta)
+    direction = _text(beat.get("guideline"), "")
+    if last and cta.lower() not in direction.lower():
+        direction = f"{direction} CTA ('{cta}').".strip()
+    return direction
+
+
+def _build(slots: Dict[str, Any], library: Mapping[str, Any], template: Mapping[str, Any]) -> Blueprint:
+    rules = library.get("veo_blueprint_rules") or {}
+    beats = template.get("beats") or DEFAULT_BEATS
+    total = max(slots["duration_sec"], MIN_DURATION_SEC)
+    secs = split_seconds(total, len(beats))
+    cta = slots["cta"]
+    return Blueprint(
+        meta=Meta(
+            platform=slots["platform"],
+            duration_sec=total,
+            tone=slots["tone"],
+            style=slots["style"],
+            text_free=bool(rules.get("text_free", True)),
+            template=template.get("id") or "",
+        ),
+        overview=f"Goal: {slots['goal']}. Key message: {slots['key_message']}. CTA: {cta}. Text-free policy enforced.",
+        beats=tuple(
+            Beat(_text(b.get("name"), f"Beat {i + 1}"), s, _direction(b, i == len(beats) - 1, cta))
+            for i, (b, s) in enumerate(zip(beats, secs))
+        ),
+        negative_prompt=tuple(rules.get("negative_prompt") or ()),
+    )
+
+
+_versions: Dict[int, Tuple[Mapping[str, Any], str]] = {}
+_memo: "OrderedDict[str, Blueprint]" = OrderedDict()
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0}
+
+
+def library_version(library: Mapping[str, Any]) -> str:
+    """Content hash of the library; computed once per library object (the loader reuses its dict)."""
+    with _lock:
+        known = _versions.get(id(library))
+        if known is not None and known[0] is library:
+            return known[1]
+    version = hashlib.sha256(json.dumps(library, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    with _lock:
+        if len(_versions) >= 8:
+            _versions.clear()
+        _versions[id(library)] = (library, version)
+    return version
+
+
+def build(slots: Optional[Mapping[str, Any]], library: Mapping[str, Any], template_id: Optional[str] = None) -> Blueprint:
+    """Blueprint for a brief; `template_id` overrides the session's narrative_template slot."""
+    norm = normalize_slots(slots)
+    template = pick_template(library, template_id or norm["narrative_template"])
+    norm["narrative_template"] = template.get("id") or ""
+    key = hashlib.sha256(
+        f"{library_version(library)}\0{json.dumps(norm, sort_keys=True)}".encode("utf-8")
+    ).hexdigest()
+    with _lock:
+        hit = _memo.get(key)
+        if hit is not None:
+            _memo.move_to_end(key)
+            _counters["hits"] += 1
+            return hit
+    bp = _build(norm, library, template)
+    with _lock:
+        _counters["misses"] += 1
+        _memo[key] = bp
+        while len(_memo) > BLUEPRINT_CACHE_ENTRIES:
+            _memo.popitem(last=False)
+    return bp
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {**_counters, "entries": len(_memo), "max_entries": BLUEPRINT_CACHE_ENTRIES}
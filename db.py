@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+db.py
+Thread-safe, bounded PostgreSQL connection pool.
+
+Replaces psycopg2.pool.SimpleConnectionPool (not thread-safe, fails fast when empty) for the
+gunicorn --threads deployment:
+- getconn() waits up to `timeout` seconds for a free slot instead of raising immediately
+- connections are validated before hand-out (closed socket / broken transaction / idle ping)
+  and recycled after `max_lifetime` seconds
+- every checkout is tracked per thread; reclaim_thread() returns whatever the current thread
+  forgot to put back (called from Flask teardown), and checkouts held by dead threads are
+  reclaimed automatically when the pool runs dry
+- connection() is a context manager that always returns the connection
+- stats() exposes in-use / idle / waiters and a wait-time histogram
+
+as_uuid() is the typed lookup helper: it parses ids into uuid.UUID, which psycopg2 binds as
+'...'::uuid, so `WHERE id = %s` hits the primary-key / FK indexes (an `id::text = %s` cast cannot).
+
+UnitOfWork wraps one borrowed connection for a request: a single transaction, deferred writes
+flushed in one round-trip, one COMMIT.
+"""
+
+from __future__ import annotations
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+log = logging.getLogger("pf.db")
+
+try:
+    import psycopg2.extras
+    psycopg2.extras.register_uuid()
+except ImportError:  # pragma: no cover - psycopg2 is a hard dependency in production
+    pass
+
+# Upper bounds (ms) of the wait-time histogram buckets; the last bucket is +inf
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def as_uuid(value: Any) -> Optional[uuid.UUID]:
+    """Parse `value` into a UUID for index-friendly binding; None when it is not a valid UUID."""
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(str(value).strip())
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no connection became available within the wait timeout."""
+
+
+class _Entry:
+    __slots__ = ("conn", "created_at", "last_used", "checked_out_at", "owner")
+
+    def __init__(self, conn: Any):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+        self.checked_out_at = 0.0
+        self.owner = 0
+
+
+def _default_connect(dsn: str) -> Callable[[], Any]:
+    def connect():
+        import psycopg2
+        return psycopg2.connect(dsn)
+    return connect
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        minconn: int = 1,
+        maxconn: int = 10,
+        timeout: float = 10.0,
+        max_lifetime: float = 1800.0,
+        validate_after: float = 30.0,
+        connect: Optional[Callable[[], Any]] = None,
+    ):
+        if connect is None:
+            if not dsn:
+                raise ValueError("dsn or connect is required")
+            connect = _default_connect(dsn)
+        self._connect = connect
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.timeout = float(timeout)
+        self.max_lifetime = float(max_lifetime)
+        self.validate_after = float(validate_after)
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle: Deque[_Entry] = deque()
+        self._in_use: Dict[int, _Entry] = {}
+        self._opening = 0
+        self._waiters = 0
+        self._closed = False
+        self._counters = {"created": 0, "recycled": 0, "invalid": 0, "reclaimed": 0, "timeouts": 0}
+        self._wait_hist = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self._wait_total_ms = 0.0
+        self._wait_count = 0
+
+        for _ in range(self.minconn):
+            self._idle.append(self._open())
+
+    # ------------------------------------------------------------------
+    # checkout / return
+    # ------------------------------------------------------------------
+    def getconn(self, timeout: Optional[float] = None) -> Any:
+        timeout = self.timeout if timeout is None else float(timeout)
+        started = time.monotonic()
+        deadline = started + timeout
+        entry: Optional[_Entry] = None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+            self._waiters += 1
+            try:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()  # LIFO keeps hot connections hot
+                        break
+                    if self._size() < self.maxconn:
+                        self._opening += 1
+                        break
+                    if self._reclaim_dead_owners():
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(f"no DB connection available within {timeout:.1f}s")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+            self._record_wait((time.monotonic() - started) * 1000.0)
+
+        try:
+            if entry is None:
+                try:
+                    entry = self._open()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+            else:
+                entry = self._validated(entry)
+        except Exception:
+            with self._cond:
+                self._cond.notify()
+            raise
+
+        entry.checked_out_at = time.monotonic()
+        entry.owner = threading.get_ident()
+        with self._cond:
+            self._in_use[id(entry.conn)] = entry
+        return entry.conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        if conn is None:
+            return
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            log.warning("putconn: connection does not belong to this pool (or was returned twice)")
+            return
+        try:
+            if discard or self._closed or self._is_broken(conn) or self._expired(entry):
+                self._close(conn)
+                entry = None
+            else:
+                self._reset(conn)
+                entry.last_used = time.monotonic()
+                entry.owner = 0
+        except Exception as e:
+            log.warning("putconn: dropping connection after reset failure: %s", e)
+            self._close(conn)
+            entry = None
+        with self._cond:
+            if entry is not None:
+                self._idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """Check out a connection and always return it, even on error."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    # ------------------------------------------------------------------
+    # leak handling
+    # ------------------------------------------------------------------
+    def reclaim_thread(self, thread_id: Optional[int] = None) -> int:
+        """Return every connection still checked out by `thread_id` (default: current thread)."""
+        owner = threading.get_ident() if thread_id is None else thread_id
+        with self._cond:
+            leaked = [e.conn for e in self._in_use.values() if e.owner == owner]
+        for conn in leaked:
+            log.warning("Reclaiming DB connection leaked by thread %s", owner)
+            with self._cond:
+                self._counters["reclaimed"] += 1
+            self.putconn(conn)
+        return len(leaked)
+
+    def _reclaim_dead_owners(self) -> bool:
+        # Called with the lock held: connections whose owning thread has exited can never be returned.
+        alive = {t.ident for t in threading.enumerate()}
+        dead = [e for e in self._in_use.values() if e.owner not in alive]
+        for e in dead:
+            del self._in_use[id(e.conn)]
+            self._counters["reclaimed"] += 1
+            log.warning("Reclaiming DB connection leaked by exited thread %s", e.owner)
+            self._close(e.conn)
+        return bool(dead)
+
+    # ------------------------------------------------------------------
+    # stats / shutdown
+    # ------------------------------------------------------------------
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            hist: List[Dict[str, Any]] = []
+            for i, n in enumerate(self._wait_hist):
+                le = WAIT_BUCKETS_MS[i] if i < len(WAIT_BUCKETS_MS) else "+Inf"
+                hist.append({"le_ms": le, "count": n})
+            return {
+                "max": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "waiters": self._waiters,
+                "wait_ms_avg": round(self._wait_total_ms / self._wait_count, 3) if self._wait_count else 0.0,
+                "wait_ms_histogram": hist,
+                **self._counters,
+            }
+
+    def dedicated(self) -> Any:
+        """A new connection outside the pool, owned by the caller (LISTEN sessions and the like)."""
+        return self._connect()
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            entries = list(self._idle) + list(self._in_use.values())
+            self._idle.clear()
+            self._in_use.clear()
+            self._cond.notify_all()
+        for e in entries:
+            self._close(e.conn)
+
+    # ------------------------------------------------------------------
+    # internals
+    # ------------------------------------------------------------------
+    def _size(self) -> int:
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _record_wait(self, ms: float) -> None:
+        for i, bound in enumerate(WAIT_BUCKETS_MS):
+            if ms <= bound:
+                self._wait_hist[i] += 1
+                break
+        else:
+            self._wait_hist[-1] += 1
+        self._wait_total_ms += ms
+        self._wait_count += 1
+
+    def _open(self) -> _Entry:
+        conn = self._connect()
+        with self._cond:
+            self._counters["created"] += 1
+        return _Entry(conn)
+
+    def _validated(self, entry: _Entry) -> _Entry:
+        """Return a usable entry: the given one if healthy, otherwise a freshly opened one."""
+        if self._expired(entry):
+            with self._cond:
+                self._counters["recycled"] += 1
+            self._close(entry.conn)
+            return self._open()
+        healthy = not self._is_broken(entry.conn)
+        if healthy and time.monotonic() - entry.last_used >= self.validate_after:
+            healthy = self._ping(entry.conn)
+        if not healthy:
+            with self._cond:
+                self._counters["invalid"] += 1
+            self._close(entry.conn)
+            return self._open()
+        return entry
+
+    def _expired(self, entry: _Entry) -> bool:
+        return self.max_lifetime > 0 and time.monotonic() - entry.created_at >= self.max_lifetime
+
+    @staticmethod
+    def _is_broken(conn: Any) -> bool:
+        if getattr(conn, "closed", 0):
+            return True
+        status = getattr(conn, "get_transaction_status", None)
+        if status is not None:
+            try:
+                from psycopg2 import extensions
+                return status() == extensions.TRANSACTION_STATUS_UNKNOWN
+            except ImportError:
+                return False
+        return False
+
+    @staticmethod
+    def _ping(conn: Any) -> bool:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            log.warning("DB connection failed validation: %s", e)
+            return False
+
+    @staticmethod
+    def _reset(conn: Any) -> None:
+        # Never hand a connection with an open transaction to the next borrower
+        status = getattr(conn, "get_transaction_status", None)
+        if status is not None:
+            from psycopg2 import extensions
+            if status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        else:
+            conn.rollback()
+        if getattr(conn, "autocommit", False):
+            conn.autocommit = False
+
+    @staticmethod
+    def _close(conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class UnitOfWork:
+    """
+    One transaction for a whole request.
+
+    Reads go straight through `cursor`. Writes registered with defer()/add_rows() are queued and
+    sent to the server as a single multi-statement round-trip by commit(), immediately followed by
+    the one COMMIT. Use as a context manager: commit on success, rollback on error.
+    """
+
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self._pending: List[bytes] = []
+        self._rows: Dict[tuple, List[tuple]] = {}
+
+    def defer(self, sql: str, params: Any = None) -> None:
+        self._pending.append(self.cursor.mogrify(sql, params))
+
+    def add_rows(self, table: str, columns: tuple, row: tuple) -> None:
+        """Queue one row; rows for the same table/columns are flushed as one multi-row INSERT."""
+        self._rows.setdefault((table, tuple(columns)), []).append(tuple(row))
+
+    def flush(self) -> None:
+        statements = list(self._pending)
+        for (table, columns), rows in self._rows.items():
+            placeholder = "(" + ",".join(["%s"] * len(columns)) + ")"
+            values = b",".join(self.cursor.mogrify(placeholder, r) for r in rows)
+            statements.append(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ".encode("utf-8") + values
+            )
+        self._pending.clear()
+        self._rows.clear()
+        if statements:
+            self.cursor.execute(b";\n".join(statements))
+
+    def commit(self) -> None:
+        self.flush()
+        self.conn.commit()
+
+    def rollback(self) -> None:
+        self._pending.clear()
+        self._rows.clear()
+        self.conn.rollback()
+
+    def close(self) -> None:
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+
+    def __enter__(self) -> "UnitOfWork":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+        return False
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+entitlements.py
+Subscription lookups for /get-user-status without a database round-trip in the common case.
+
+Resolution order for a user:
+1. the in-process cache (ENTITLEMENT_CACHE_TTL_SEC)
+2. the token's `sub_exp` claim (subscription expiry at login), trusted only when this process has
+   been LISTENing since before the token was issued and has seen no change for that user since
+3. the users row, which is then cached
+
+Writers of subscription_expires_at (webhook_billplz, admin_add_sub_time, admin_delete_user) call
+notify() inside their transaction; Postgres delivers the NOTIFY on commit to every instance's
+listener thread, which drops the cached entry and marks the user changed (so older claims are no
+longer trusted). If the listener loses its connection the cache is cleared and no claim is trusted
+until it is back, because notifications may have been missed in between.
+
+Env: ENTITLEMENT_CACHE_TTL_SEC (30), ENTITLEMENT_CACHE_SIZE (10000), ENTITLEMENT_LISTEN (1).
+"""
+
+from __future__ import annotations
+import os
+import time
+import select
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+log = logging.getLogger("pf.entitlements")
+
+ENTITLEMENT_CACHE_TTL_SEC = float(os.getenv("ENTITLEMENT_CACHE_TTL_SEC", "30"))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+ENTITLEMENT_LISTEN = os.getenv("ENTITLEMENT_LISTEN", "1") == "1"
+
+CHANNEL = "pf_entitlements"
+
+# (user exists, subscription_expires_at)
+Entitlement = Tuple[bool, Optional[datetime.datetime]]
+
+
+def to_claim(expires_at: Optional[datetime.datetime]) -> Optional[int]:
+    return int(expires_at.timestamp()) if expires_at is not None else None
+
+
+def from_claim(value: Any) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(int(value), datetime.timezone.utc)
+
+
+def notify(cur, username: str) -> None:
+    """Queue an invalidation for `username`; delivered to all instances when the transaction commits."""
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, username))
+
+
+class EntitlementCache:
+    def __init__(self, ttl: float = ENTITLEMENT_CACHE_TTL_SEC, max_entries: int = ENTITLEMENT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Entitlement]]" = OrderedDict()
+        self._changed_at: Dict[str, float] = {}
+        self._listening_since: Optional[float] = None
+        self._counters = {"cache": 0, "token": 0, "db": 0, "invalidations": 0}
+
+    # -- cache ------------------------------------------------------------
+    def get(self, username: str) -> Optional[Entitlement]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return value
+
+    def put(self, username: str, value: Entitlement) -> None:
+        with self._lock:
+            self._entries[username] = (time.monotonic(), value)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        with self._lock:
+            self._entries.pop(username, None)
+            self._changed_at[username] = time.time()
+            self._counters["invalidations"] += 1
+
+    # -- listener state ---------------------------------------------------
+    def listening(self, active: bool) -> None:
+        with self._lock:
+            if active:
+                self._listening_since = time.time()
+            else:
+                self._listening_since = None
+                self._entries.clear()
+                self._changed_at.clear()
+
+    def claim_trusted(self, username: str, issued_at: Any) -> bool:
+        """True when every change to `username` since `issued_at` would have reached this process."""
+        try:
+            iat = float(issued_at)
+        except (TypeError, ValueError):
+            return False
+        with self._lock:
+            since = self._listening_since
+            return since is not None and since <= iat and self._changed_at.get(username, 0.0) < iat
+
+    # -- lookup -----------------------------------------------------------
+    def lookup(self, username: str, claims: Mapping[str, Any],
+               load: Callable[[str], Entitlement]) -> Tuple[Entitlement, str]:
+        """(entitlement, source) where source is "cache", "token" or "db"."""
+        value = self.get(username)
+        source = "cache"
+        if value is None and "sub_exp" in claims and self.claim_trusted(username, claims.get("iat")):
+            value, source = (True, from_claim(claims.get("sub_exp"))), "token"
+        if value is None:
+            started = time.time()
+            value, source = load(username), "db"
+            with self._lock:
+                stale = self._changed_at.get(username, 0.0) >= started
+            if not stale:  # an invalidation raced the read; let the next lookup reload
+                self.put(username, value)
+        with self._lock:
+            self._counters[source] += 1
+        return value, source
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "entries": len(self._entries), "ttl_sec": self.ttl,
+                    "listening": self._listening_since is not None}
+
+
+class Listener:
+    """LISTEN on CHANNEL over a dedicated connection; reconnects with backoff."""
+
+    def __init__(self, connect: Callable[[], Any], cache: EntitlementCache, poll_timeout: float = 5.0):
+        self._connect = connect
+        self.cache = cache
+        self.poll_timeout = poll_timeout
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "Listener":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="entitlement-listener", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {CHANNEL}")
+                self.cache.listening(True)
+                backoff = 1.0
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.cache.invalidate(conn.notifies.pop(0).payload)
+            except Exception as e:
+                log.warning("entitlement listener disconnected: %s", e)
+            finally:
+                self.cache.listening(False)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+
+cache = EntitlementCache()
+listener: Optional[Listener] = None
+_start_lock = threading.Lock()
+
+
+def start_listener(connect: Callable[[], Any]) -> Optional[Listener]:
+    """Start the process-wide listener (idempotent). Returns None when ENTITLEMENT_LISTEN=0."""
+    global listener
+    if not ENTITLEMENT_LISTEN:
+        return None
+    with _start_lock:
+        if listener is None:
+            listener = Listener(connect, cache).start()
+    return listener
+
+
+def stats() -> Dict[str, Any]:
+    return cache.stats()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+export_store.py
+Built export packages kept in object storage, so a repeat download is a redirect.
+
+Objects are keyed by the archive's content hash (ZipStream.etag, derived from the project,
+storyboard and readme inputs): `exports/<project_id>/<etag>.zip`. A download whose key already
+exists is answered with a redirect to a time-limited URL; otherwise the archive is streamed to
+the client and written to the store on the way (committed only when the whole archive went out,
+so an aborted download never leaves a partial object). A new storyboard changes the key, which
+is the only thing that triggers a rebuild.
+
+Backends (EXPORT_STORE):
+- "gcs": bucket EXPORT_GCS_BUCKET; V4 signed GET URLs. On Cloud Run, where the credentials carry
+  no private key, signing goes through the IAM signBlob API with the runtime service account
+- "local": files under EXPORT_STORE_DIR, served by main.py's /exports/<key> route with an
+  HMAC-signed, expiring query string (tests, offline use)
+- "" (default): no store; exports stream from the workers as before
+
+Env: EXPORT_STORE, EXPORT_GCS_BUCKET, EXPORT_STORE_DIR (/tmp/pf-exports), EXPORT_URL_TTL_SEC (900),
+EXPORT_URL_SECRET (defaults to the secret passed to configure()).
+"""
+
+from __future__ import annotations
+import os
+import abc
+import hmac
+import time
+import uuid
+import hashlib
+import tempfile
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, Optional
+from urllib.parse import quote, urlencode
+
+log = logging.getLogger("pf.exports")
+
+EXPORT_STORE = os.getenv("EXPORT_STORE", "").strip().lower()
+EXPORT_GCS_BUCKET = os.getenv("EXPORT_GCS_BUCKET", "").strip()
+EXPORT_STORE_DIR = os.getenv("EXPORT_STORE_DIR", "/tmp/pf-exports")
+EXPORT_URL_TTL_SEC = int(os.getenv("EXPORT_URL_TTL_SEC", "900"))
+EXPORT_URL_SECRET = os.getenv("EXPORT_URL_SECRET", "")
+
+PREFIX = "exports"
+CONTENT_TYPE = "application/zip"
+
+
+def key_for(project_id: str, content_hash: str) -> str:
+    return f"{PREFIX}/{project_id}/{content_hash}.zip"
+
+
+class Writer(abc.ABC):
+    """Receives the archive chunk by chunk; commit() publishes it, abort() discards it."""
+
+    @abc.abstractmethod
+    def write(self, chunk: bytes) -> None: ...
+
+    @abc.abstractmethod
+    def commit(self) -> None: ...
+
+    @abc.abstractmethod
+    def abort(self) -> None: ...
+
+
+class ExportStore(abc.ABC):
+    name = "base"
+
+    def __init__(self):
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stored": 0, "aborted": 0}
+
+    # -- backend hooks ----------------------------------------------------
+    @abc.abstractmethod
+    def _exists(self, key: str) -> bool: ...
+
+    @abc.abstractmethod
+    def writer(self, key: str, filename: str) -> Writer: ...
+
+    @abc.abstractmethod
+    def url(self, key: str, filename: str, ttl: int = EXPORT_URL_TTL_SEC) -> str: ...
+
+    # -- shared -----------------------------------------------------------
+    def exists(self, key: str) -> bool:
+        """Whether `key` is stored; positive answers are remembered (objects are immutable)."""
+        with self._lock:
+            if key in self._known:
+                self._known.move_to_end(key)
+                self._counters["hits"] += 1
+                return True
+        found = self._exists(key)
+        if found:
+            self._remember(key)
+        with self._lock:
+            self._counters["hits" if found else "misses"] += 1
+        return found
+
+    def tee(self, key: str, filename: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Yield `chunks` and store them under `key`; stored only if every chunk was consumed."""
+        try:
+            w = self.writer(key, filename)
+        except Exception as e:
+            log.warning("export store unavailable, streaming only: %s", e)
+            yield from chunks
+            return
+        done = False
+        try:
+            for chunk in chunks:
+                w.write(chunk)
+                yield chunk
+            done = True
+        finally:
+            try:
+                if done:
+                    w.commit()
+                    self._remember(key)
+                    self._count("stored")
+                else:
+                    w.abort()
+                    self._count("aborted")
+            except Exception as e:
+                log.warning("export store write failed for %s: %s", key, e)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "backend": self.name, "known": len(self._known)}
+
+    def _remember(self, key: str) -> None:
+        with self._lock:
+            self._known[key] = None
+            self._known.move_to_end(key)
+            while len(self._known) > 4096:
+                self._known.popitem(last=False)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+# ---------------------------------------------------------------------------
+# Local filesystem
+# ---------------------------------------------------------------------------
+class _FileWriter(Writer):
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{uuid.uuid4().hex}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.f = open(self.tmp, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self.f.write(chunk)
+
+    def commit(self) -> None:
+        self.f.close()
+        os.replace(self.tmp, self.path)  # atomic: readers see the old state or the whole file
+
+    def abort(self) -> None:
+        self.f.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+class LocalStore(ExportStore):
+    name = "local"
+
+    def __init__(self, root: str, secret: str, url_prefix: str = "/exports/"):
+        super().__init__()
+        if not secret:
+            raise ValueError("local export store needs a signing secret")
+        self.root = os.path.abspath(root)
+        self.secret = secret.encode("utf-8")
+        self.url_prefix = url_prefix
+
+    def path(self, key: str) -> Optional[str]:
+        """Filesystem path for `key`, or None when it would escape the store root."""
+        p = os.path.abspath(os.path.join(self.root, key))
+        return p if p.startswith(self.root + os.sep) else None
+
+    def _exists(self, key: str) -> bool:
+        p = self.path(key)
+        return bool(p) and os.path.isfile(p)
+
+    def writer(self, key: str, filename: str) -> Writer:
+        p = self.path(key)
+        if p is None:
+            raise ValueError(f"invalid export key: {key!r}")
+        return _FileWriter(p)
+
+    def _sign(self, key: str, expires: int, filename: str) -> str:
+        msg = f"{key}\n{expires}\n{filename}".encode("utf-8")
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()
+
+    def url(self, key: str, filename: str, ttl: int = EXPORT_URL_TTL_SEC) -> str:
+        expires = int(time.time()) + ttl
+        qs = urlencode({"exp": expires, "name": filename, "sig": self._sign(key, expires, filename)})
+        return f"{self.url_prefix}{quote(key)}?{qs}"
+
+    def verify(self, key: str, expires: Any, filename: str, sig: str) -> bool:
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._sign(key, expires, filename or ""), sig or "")
+
+# ---------------------------------------------------------------------------
+# Google Cloud Storage
+# ---------------------------------------------------------------------------
+def _import_storage():
+    from google.cloud import storage  # type: ignore
+    return storage
+
+
+class _BlobWriter(Writer):
+    """Spools to a temp file and uploads on commit, so an aborted download never creates an object."""
+
+    def __init__(self, blob: Any):
+        self.blob = blob
+        self.f = tempfile.TemporaryFile()
+
+    def write(self, chunk: bytes) -> None:
+        self.f.write(chunk)
+
+    def commit(self) -> None:
+        try:
+            self.f.seek(0)
+            # if_generation_match=0: a concurrent upload of the same key wins, this one is a no-op
+            self.blob.upload_from_file(self.f, content_type=CONTENT_TYPE, if_generation_match=0)
+        except Exception as e:
+            if getattr(e, "code", None) != 412:
+                raise
+        finally:
+            self.f.close()
+
+    def abort(self) -> None:
+        self.f.close()
+
+
+class GCSStore(ExportStore):
+    name = "gcs"
+
+    def __init__(self, bucket: str, client: Any = None):
+        super().__init__()
+        if not bucket:
+            raise ValueError("EXPORT_GCS_BUCKET is not set")
+        self.client = client or _import_storage().Client()
+        self.bucket = self.client.bucket(bucket)
+
+    def _exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+    def writer(self, key: str, filename: str) -> Writer:
+        blob = self.bucket.blob(key)
+        blob.content_disposition = f'attachment; filename="{filename}"'
+        blob.cache_control = "private, max-age=31536000, immutable"
+        return _BlobWriter(blob)
+
+    def url(self, key: str, filename: str, ttl: int = EXPORT_URL_TTL_SEC) -> str:
+        kw: Dict[str, Any] = {}
+        creds = getattr(self.client, "_credentials", None)
+        if creds is not None and not hasattr(creds, "sign_bytes"):
+            # Metadata-server credentials cannot sign locally; use IAM signBlob via the token
+            import google.auth.transport.requests  # type: ignore
+            creds.refresh(google.auth.transport.requests.Request())
+            kw = {"service_account_email": creds.service_account_email, "access_token": creds.token}
+        return self.bucket.blob(key).generate_signed_url(
+            version="v4", method="GET", expiration=datetime.timedelta(seconds=ttl),
+            response_disposition=f'attachment; filename="{filename}"', **kw)
+
+
+_store: Optional[ExportStore] = None
+_store_lock = threading.Lock()
+
+
+def configure(secret: str = "") -> Optional[ExportStore]:
+    """Create the process-wide store from the environment (None when EXPORT_STORE is unset)."""
+    global _store
+    with _store_lock:
+        _store = None
+        try:
+            if EXPORT_STORE == "gcs":
+                _store = GCSStore(EXPORT_GCS_BUCKET)
+            elif EXPORT_STORE == "local":
+                _store = LocalStore(EXPORT_STORE_DIR, EXPORT_URL_SECRET or secret)
+            elif EXPORT_STORE:
+                log.warning("unknown EXPORT_STORE=%r; exports are not stored", EXPORT_STORE)
+        except Exception as e:
+            log.warning("export store %r unavailable, streaming exports instead: %s", EXPORT_STORE, e)
+    return _store
+
+
+def store() -> Optional[ExportStore]:
+    return _store
+
+
+def stats() -> Optional[Dict[str, Any]]:
+    return _store.stats() if _store is not None else None
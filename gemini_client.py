@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+gemini_client.py
+Process-wide registry of Gemini model clients.
+
+google.generativeai is imported and configured once (lazily, on first use) and GenerativeModel
+objects are reused across requests, keyed by (model name, system instruction, generation config).
+Callers: main.call_gemini and services._call_gemini_for_json.
+
+- get_model() raises ImportError when the SDK or GEMINI_API_KEY is missing, which the routes
+  already map to 503 "AI unavailable"
+- stats() reports hit/miss counts for /healthz/gemini
+"""
+
+from __future__ import annotations
+import os
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+log = logging.getLogger("pf.gemini")
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "").strip()
+
+
+def _import_genai():
+    import google.generativeai as genai  # type: ignore
+    return genai
+
+
+def _freeze(config: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(config or {}, sort_keys=True, default=str)
+
+
+class ModelRegistry:
+    def __init__(self, api_key: Optional[str] = None, loader: Optional[Callable[[], Any]] = None):
+        self._api_key = GEMINI_API_KEY if api_key is None else api_key
+        self._loader = loader or _import_genai
+        self._lock = threading.Lock()
+        self._genai: Any = None
+        self._models: Dict[Tuple[str, str, str], Any] = {}
+        self._hits = 0
+        self._misses = 0
+
+    def sdk(self) -> Any:
+        """Import and configure the SDK exactly once."""
+        if self._genai is not None:
+            return self._genai
+        with self._lock:
+            if self._genai is None:
+                if not self._api_key:
+                    raise ImportError("Gemini SDK/API key is not configured")
+                try:
+                    genai = self._loader()
+                except Exception as e:
+                    raise ImportError(f"google.generativeai not available: {e}")
+                genai.configure(api_key=self._api_key)
+                self._genai = genai
+                log.info("Gemini SDK configured")
+        return self._genai
+
+    def get_model(
+        self,
+        model_name: str,
+        system_instruction: Optional[str] = None,
+        generation_config: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        key = (model_name, system_instruction or "", _freeze(generation_config))
+        model = self._models.get(key)
+        if model is not None:
+            self._hits += 1
+            return model
+        genai = self.sdk()
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self._misses += 1
+                kwargs: Dict[str, Any] = {"system_instruction": system_instruction}
+                if generation_config:
+                    kwargs["generation_config"] = generation_config
+                model = genai.GenerativeModel(model_name, **kwargs)
+                self._models[key] = model
+            else:
+                self._hits += 1
+        return model
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": self._genai is not None,
+            "models": len(self._models),
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+
+registry = ModelRegistry()
+
+
+def get_model(model_name: str, system_instruction: Optional[str] = None,
+              generation_config: Optional[Dict[str, Any]] = None) -> Any:
+    return registry.get_model(model_name, system_instruction, generation_config)
+
+
+def stats() -> Dict[str, Any]:
+    return registry.stats()
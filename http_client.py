@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+http_client.py
+Outbound HTTP for third-party APIs (Billplz today), on the standard library only.
+
+- HTTPClient keeps a bounded pool of keep-alive connections per origin; a connection goes back to
+  the pool once its response has been read in full and the server did not ask to close it
+- HTTPS connections resume the last TLS session for the origin (ssl session reuse), so a new
+  connection skips the full handshake as long as the server still honours the ticket
+- requests are retried with full-jitter exponential backoff (Retry-After is honoured, capped) when
+  that is safe: connect failures and 429 always; 502/503/504 and read errors / timeouts only for
+  idempotent requests, i.e. GET/HEAD/PUT/DELETE/OPTIONS, or a request carrying an idempotency key
+  (sent as the Idempotency-Key header) when the client was built with honours_idempotency_key,
+  meaning the upstream deduplicates on that header. Billplz does not, so its POSTs are only
+  retried when they never reached it
+- a CircuitBreaker per client fails fast with CircuitOpen after `failure_threshold` consecutive
+  failed calls, then lets a single probe through after `reset_timeout` seconds
+- stats() (connections opened / reused, TLS resumptions, retries, breaker state) for health checks
+- IdempotencyMemo: remembers the successful response per idempotency key for a while, so a
+  double-submitted action (two clicks, a client retry) makes one upstream call and both callers
+  get the same answer; concurrent callers with the same key wait for the first one
+
+Usage:
+    client = HTTPClient("https://www.billplz.com", name="billplz")
+    resp = client.request("POST", "/api/v3/bills", json_body={...}, idempotency_key=key)
+    resp.status, resp.json()
+"""
+
+from __future__ import annotations
+import ssl
+import json
+import time
+import random
+import logging
+import threading
+import http.client
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from typing import Any, Callable, Deque, Dict, Mapping, Optional, Tuple
+
+log = logging.getLogger("pf.http")
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Failures the breaker counts: no response at all, or the upstream saying it is unwell
+BREAKER_STATUSES = frozenset({500, 502, 503, 504})
+
+
+class HTTPClientError(RuntimeError):
+    """The request could not be completed (after retries)."""
+
+
+class CircuitOpen(HTTPClientError):
+    """Fail-fast: the upstream has been failing; no request was sent."""
+
+
+class Response:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int, headers: Mapping[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.body.decode("utf-8"))
+
+# ---------------------------------------------------------------------------
+# Circuit breaker
+# ---------------------------------------------------------------------------
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current()
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._current()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self._state, self._failures, self._probing = self.CLOSED, 0, False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    log.warning("circuit opened after %s consecutive failures", self._failures)
+                self._state, self._opened_at, self._probing = self.OPEN, time.monotonic(), False
+
+    def _current(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+# ---------------------------------------------------------------------------
+# Connections
+# ---------------------------------------------------------------------------
+class _TLSSessionCache:
+    def __init__(self):
+        self.session: Optional[ssl.SSLSession] = None
+        self.resumed = 0
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that offers the origin's last TLS session when it connects."""
+
+    def __init__(self, host: str, port: Optional[int], timeout: float, context: ssl.SSLContext, tls: _TLSSessionCache):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._tls = tls
+
+    def connect(self) -> None:
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self._tls.session)
+        if self.sock.session_reused:
+            self._tls.resumed += 1
+        self.remember_session(self.sock)
+
+    def remember_session(self, sock: ssl.SSLSocket) -> None:
+        # TLS 1.3 tickets arrive after the handshake, so this is called again once response headers
+        # are in (before the body is read: a Connection: close response drops conn.sock by then)
+        session = sock.session
+        if session is not None:
+            self._tls.session = session
+
+
+class _ConnectError(Exception):
+    def __init__(self, cause: BaseException):
+        super().__init__(str(cause))
+        self.cause = cause
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+class HTTPClient:
+    def __init__(
+        self,
+        base_url: str,
+        name: str = "",
+        max_connections: int = 4,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        breaker: Optional[CircuitBreaker] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        honours_idempotency_key: bool = False,
+    ):
+        parts = urlsplit(base_url.rstrip("/"))
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Unsupported base URL: {base_url!r}")
+        self.name = name or parts.hostname
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = max(0, retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker(failure_threshold, reset_timeout)
+        self.default_headers = dict(headers or {})
+        self.honours_idempotency_key = honours_idempotency_key
+        self._ssl_context = ssl_context or (ssl.create_default_context() if self.scheme == "https" else None)
+        self._tls = _TLSSessionCache()
+        self._idle: Deque[http.client.HTTPConnection] = deque()
+        self._slots = threading.BoundedSemaphore(max(1, max_connections))
+        self._lock = threading.Lock()
+        self._closed = False
+        self._counters = {"requests": 0, "retries": 0, "opened": 0, "reused": 0, "failures": 0}
+
+    # ------------------------------------------------------------------
+    def request(
+        self,
+        method: str,
+        path: str,
+        json_body: Any = None,
+        body: Optional[bytes] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        idempotency_key: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Response:
+        """
+        Send one request (plus retries). Returns the final Response, whatever its status;
+        raises CircuitOpen / HTTPClientError when no response could be obtained.
+        """
+        method = method.upper()
+        hdrs = {**self.default_headers, **(headers or {})}
+        if json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+            hdrs.setdefault("Content-Type", "application/json")
+        if idempotency_key:
+            hdrs["Idempotency-Key"] = idempotency_key
+        idempotent = method in IDEMPOTENT_METHODS or bool(idempotency_key and self.honours_idempotency_key)
+        url = self.base_path + (path if path.startswith("/") else "/" + path)
+
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name}: circuit open, not calling upstream")
+        self._count("requests")
+        attempt = 0
+        while True:
+            retry_after: Optional[float] = None
+            try:
+                resp = self._send(method, url, body, hdrs, timeout or self.read_timeout)
+            except _ConnectError as e:
+                error: Optional[BaseException] = e.cause
+                retryable = True  # nothing reached the server
+            except (OSError, http.client.HTTPException) as e:
+                error, retryable = e, idempotent
+            else:
+                error = None
+                retryable = idempotent and resp.status in RETRY_STATUSES
+                if resp.status in (429, 503):
+                    retry_after = _retry_after(resp.headers.get("Retry-After"))
+                    retryable = retryable or resp.status == 429  # 429: rejected before processing
+                if not retryable or attempt >= self.retries:
+                    if resp.status in BREAKER_STATUSES:
+                        self._failed()
+                    else:
+                        self.breaker.success()
+                    return resp
+
+            if not retryable or attempt >= self.retries:
+                self._failed()
+                raise HTTPClientError(f"{self.name}: {method} {url} failed: {error}") from error
+            attempt += 1
+            self._count("retries")
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.backoff_max))
+            log.info("%s: retrying %s %s in %.2fs (attempt %s, %s)", self.name, method, url, delay, attempt,
+                     error or f"status {resp.status}")
+            time.sleep(delay)
+
+    def get(self, path: str, **kw: Any) -> Response:
+        return self.request("GET", path, **kw)
+
+    def post(self, path: str, **kw: Any) -> Response:
+        return self.request("POST", path, **kw)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            conns, self._idle = list(self._idle), deque()
+        for c in conns:
+            c.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "idle": len(self._idle), "tls_resumed": self._tls.resumed,
+                    "breaker": self.breaker.state, "breaker_rejected": self.breaker.rejected}
+
+    # ------------------------------------------------------------------
+    def _send(self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str], timeout: float) -> Response:
+        if not self._slots.acquire(timeout=self.connect_timeout + timeout):
+            raise _ConnectError(TimeoutError(f"{self.name}: no free connection"))
+        conn = None
+        try:
+            conn, reused = self._checkout()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+            except OSError as e:
+                conn.close()
+                conn = None
+                raise _ConnectError(e)
+            sock = conn.sock
+            sock.settimeout(timeout)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                raw = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                conn = None
+                if reused:
+                    # The server dropped an idle keep-alive connection before reading the request
+                    raise _ConnectError(e)
+                raise
+            if isinstance(conn, _HTTPSConnection) and sock is not None:
+                conn.remember_session(sock)
+            data = raw.read()
+            resp = Response(raw.status, {k.title(): v for k, v in raw.getheaders()}, data)
+            if raw.will_close:
+                conn.close()
+                conn = None
+            return resp
+        except BaseException:
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                self._counters["reused"] += 1
+                return self._idle.pop(), True
+            self._counters["opened"] += 1
+        if self.scheme == "https":
+            return _HTTPSConnection(self.host, self.port, self.connect_timeout, self._ssl_context, self._tls), False
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout), False
+
+    def _checkin(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if not self._closed:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _failed(self) -> None:
+        self._count("failures")
+        self.breaker.failure()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+class IdempotencyMemo:
+    def __init__(self, ttl: float = 600.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._done: "OrderedDict[str, Tuple[float, Response]]" = OrderedDict()
+        self._inflight: Dict[str, threading.Lock] = {}
+        self.hits = 0
+
+    def run(self, key: str, call: Callable[[], Response]) -> Tuple[Response, bool]:
+        """(response, replayed). Only 2xx responses are remembered; failures may be retried."""
+        while True:
+            with self._lock:
+                hit = self._get(key)
+                if hit is not None:
+                    self.hits += 1
+                    return hit, True
+                gate = self._inflight.get(key)
+                if gate is None:
+                    gate = self._inflight[key] = threading.Lock()
+                    gate.acquire()
+                    break
+            with gate:  # another caller is making this call; wait, then look again
+                pass
+        try:
+            resp = call()
+            if resp.ok:
+                with self._lock:
+                    self._done[key] = (time.monotonic(), resp)
+                    while len(self._done) > self.max_entries:
+                        self._done.popitem(last=False)
+            return resp, False
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            gate.release()
+
+    def _get(self, key: str) -> Optional[Response]:
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._done[key]
+            return None
+        return entry[1]
+
+
+_clients: Dict[str, HTTPClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client(name: str, base_url: str, **kw: Any) -> HTTPClient:
+    """Process-wide client for an integration, created on first use; later calls reuse it."""
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = HTTPClient(base_url, name=name, **kw)
+        return _clients[name]
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    with _clients_lock:
+        clients = dict(_clients)
+    return {name: c.stats() for name, c in clients.items()}
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None  # HTTP-date form: fall back to our own backoff
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+jobs.py
+Postgres-backed background job queue.
+
+- enqueue() inserts a row into `jobs` (migration v4); the web tier answers 202 with the job id
+- workers claim with SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker processes can
+  poll the same table without handing one job to two workers
+- handlers report progress (0-100 + message) which /v1/jobs/<id> and /render/status expose
+- failures are retried with exponential backoff up to max_attempts; ValueError (bad input,
+  missing rows) fails immediately
+- a running job whose heartbeat is older than JOB_STALE_SEC (worker crashed) is re-queued
+
+Worker:
+    python jobs.py worker                 # poll forever
+    python jobs.py worker --once          # drain what is queued now, then exit
+    python jobs.py worker --kinds storyboard,export --concurrency 2
+"""
+
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import db
+
+log = logging.getLogger("pf.jobs")
+
+JOB_POLL_INTERVAL_SEC = float(os.getenv("JOB_POLL_INTERVAL_SEC", "1.0"))
+JOB_STALE_SEC = int(os.getenv("JOB_STALE_SEC", "300"))
+JOB_RETRY_BASE_SEC = float(os.getenv("JOB_RETRY_BASE_SEC", "5"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+_PUBLIC_COLUMNS = ("id", "kind", "project_id", "status", "progress", "message", "result", "error",
+                   "attempts", "max_attempts", "created_at", "updated_at", "finished_at")
+
+# ---------------------------------------------------------------------------
+# Handler registry
+# ---------------------------------------------------------------------------
+HANDLERS: Dict[str, Callable[["JobContext", Dict[str, Any]], Optional[Dict[str, Any]]]] = {}
+
+def handler(kind: str):
+    """Register fn(ctx, payload) -> result dict as the handler for `kind`."""
+    def deco(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+# ---------------------------------------------------------------------------
+# Queue operations (each commits; callers pass a pooled connection)
+# ---------------------------------------------------------------------------
+def enqueue(conn, kind: str, payload: Optional[Dict[str, Any]] = None, project_id: Optional[str] = None,
+            user_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS) -> str:
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO jobs (kind, project_id, user_id, payload, max_attempts)
+            VALUES (%s, %s, %s, %s::jsonb, %s)
+            RETURNING id
+            """,
+            (kind, db.as_uuid(project_id) if project_id else None, user_id, json.dumps(payload or {}), max_attempts),
+        )
+        job_id = str(cur.fetchone()[0])
+        conn.commit()
+        return job_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def claim(conn, worker_id: str, kinds: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+    """Atomically move the oldest runnable job to 'running' and return it (None when idle)."""
+    kinds = list(kinds or [])
+    kind_filter = "AND kind = ANY(%s)" if kinds else ""
+    params: List[Any] = [worker_id] + ([kinds] if kinds else [])
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, locked_by = %s,
+                heartbeat_at = NOW(), updated_at = NOW(), error = NULL
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status = 'queued' AND run_after <= NOW() {kind_filter}
+                ORDER BY run_after, created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, kind, project_id, user_id, payload, attempts, max_attempts
+            """,
+            params,
+        )
+        row = cur.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if not row:
+        return None
+    payload = row[4]
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    return {
+        "id": str(row[0]), "kind": row[1], "project_id": str(row[2]) if row[2] else None,
+        "user_id": row[3], "payload": payload or {}, "attempts": row[5], "max_attempts": row[6],
+    }
+
+def report_progress(conn, job_id: str, progress: int, message: Optional[str] = None) -> None:
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE jobs SET progress = %s, message = COALESCE(%s, message), heartbeat_at = NOW(), updated_at = NOW()
+            WHERE id = %s AND status = 'running'
+            """,
+            (max(0, min(100, int(progress))), message, db.as_uuid(job_id)),
+        )
+        conn.commit()
+    finally:
+        cur.close()
+
+def complete(conn, job_id: str, result: Optional[Dict[str, Any]] = None, artifact: Optional[bytes] = None) -> None:
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = 'succeeded', progress = 100, message = 'done', result = %s::jsonb, artifact = %s,
+                locked_by = NULL, updated_at = NOW(), finished_at = NOW()
+            WHERE id = %s
+            """,
+            (json.dumps(result) if result is not None else None, artifact, db.as_uuid(job_id)),
+        )
+        conn.commit()
+    finally:
+        cur.close()
+
+def fail(conn, job_id: str, error: str, retry: bool = True) -> str:
+    """Re-queue with backoff while attempts remain (and retry is allowed); otherwise mark failed."""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN %s AND attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                run_after = NOW() + make_interval(secs => %s * power(2, GREATEST(attempts - 1, 0))),
+                error = %s, locked_by = NULL, updated_at = NOW(),
+                finished_at = CASE WHEN %s AND attempts < max_attempts THEN NULL ELSE NOW() END
+            WHERE id = %s
+            RETURNING status
+            """,
+            (retry, JOB_RETRY_BASE_SEC, (error or "")[:2000], retry, db.as_uuid(job_id)),
+        )
+        row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else "failed"
+    finally:
+        cur.close()
+
+def requeue_stale(conn, stale_after: int = JOB_STALE_SEC) -> int:
+    """Give jobs of crashed workers back to the queue (or fail them when out of attempts)."""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                error = 'worker heartbeat lost', locked_by = NULL, updated_at = NOW(),
+                finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE NOW() END
+            WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s)
+            """,
+            (stale_after,),
+        )
+        n = cur.rowcount
+        conn.commit()
+        return n
+    finally:
+        cur.close()
+
+def _row_to_job(cols: List[str], row) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for k, v in zip(cols, row):
+        if hasattr(v, "isoformat"):
+            v = v.isoformat()
+        elif k in ("id", "project_id") and v is not None:
+            v = str(v)
+        out[k] = v
+    return out
+
+def get_job(conn, job_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Public view of a job (no payload/artifact). Restricted to `user_id` when given."""
+    jid = db.as_uuid(job_id)
+    if jid is None:
+        return None
+    sql = f"SELECT {', '.join(_PUBLIC_COLUMNS)}, artifact IS NOT NULL FROM jobs WHERE id = %s"
+    params: List[Any] = [jid]
+    if user_id is not None:
+        sql += " AND user_id = %s"
+        params.append(user_id)
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if not row:
+        return None
+    job = _row_to_job(list(_PUBLIC_COLUMNS), row[:-1])
+    job["has_artifact"] = bool(row[-1])
+    return job
+
+def list_project_jobs(conn, project_id: str, kinds: Optional[Iterable[str]] = None, user_id: Optional[str] = None,
+                      limit: int = 20) -> List[Dict[str, Any]]:
+    kinds = list(kinds or [])
+    sql = f"SELECT {', '.join(_PUBLIC_COLUMNS)} FROM jobs WHERE project_id = %s"
+    params: List[Any] = [db.as_uuid(project_id)]
+    if user_id is not None:
+        sql += " AND user_id = %s"
+        params.append(user_id)
+    if kinds:
+        sql += " AND kind = ANY(%s)"
+        params.append(kinds)
+    sql += " ORDER BY created_at DESC LIMIT %s"
+    params.append(limit)
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        return [_row_to_job(list(_PUBLIC_COLUMNS), r) for r in cur.fetchall()]
+    finally:
+        cur.close()
+
+def get_artifact(conn, job_id: str, user_id: Optional[str] = None) -> Optional[bytes]:
+    sql = "SELECT artifact FROM jobs WHERE id = %s AND status = 'succeeded'"
+    params: List[Any] = [db.as_uuid(job_id)]
+    if user_id is not None:
+        sql += " AND user_id = %s"
+        params.append(user_id)
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, params)
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    return bytes(row[0]) if row and row[0] is not None else None
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+class JobContext:
+    """What a handler sees: the claimed job, short-lived DB access and progress reporting."""
+
+    def __init__(self, pool: "db.ConnectionPool", job: Dict[str, Any]):
+        self.pool = pool
+        self.job = job
+        self.id = job["id"]
+        self.project_id = job.get("project_id")
+        self.user_id = job.get("user_id")
+        self.artifact: Optional[bytes] = None
+
+    def connection(self):
+        """Borrow a pooled connection; keep it only around DB work, never around LLM calls."""
+        return self.pool.connection()
+
+    def progress(self, pct: int, message: Optional[str] = None) -> None:
+        try:
+            with self.pool.connection() as conn:
+                report_progress(conn, self.id, pct, message)
+        except Exception as e:
+            log.warning("job %s: progress update failed: %s", self.id, e)
+
+class Worker:
+    def __init__(self, pool: "db.ConnectionPool", worker_id: Optional[str] = None,
+                 kinds: Optional[Iterable[str]] = None, poll_interval: float = JOB_POLL_INTERVAL_SEC):
+        self.pool = pool
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.kinds = list(kinds or [])
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._last_reap = 0.0
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run_once(self) -> bool:
+        """Claim and execute one job. Returns False when nothing was runnable."""
+        with self.pool.connection() as conn:
+            if time.monotonic() - self._last_reap > max(self.poll_interval * 10, 10):
+                self._last_reap = time.monotonic()
+                n = requeue_stale(conn)
+                if n:
+                    log.warning("re-queued %s stale job(s)", n)
+            job = claim(conn, self.worker_id, self.kinds)
+        if not job:
+            return False
+        self.execute(job)
+        return True
+
+    def execute(self, job: Dict[str, Any]) -> None:
+        ctx = JobContext(self.pool, job)
+        fn = HANDLERS.get(job["kind"])
+        t0 = time.perf_counter()
+        try:
+            if fn is None:
+                raise ValueError(f"No handler registered for job kind '{job['kind']}'")
+            result = fn(ctx, job["payload"])
+            with self.pool.connection() as conn:
+                complete(conn, job["id"], result, ctx.artifact)
+            log.info("job %s (%s) succeeded in %.0fms", job["id"], job["kind"], (time.perf_counter() - t0) * 1000)
+        except Exception as e:
+            retry = not isinstance(e, ValueError)
+            log.exception("job %s (%s) attempt %s failed", job["id"], job["kind"], job["attempts"])
+            try:
+                with self.pool.connection() as conn:
+                    fail(conn, job["id"], f"{type(e).__name__}: {e}", retry=retry)
+            except Exception:
+                log.exception("job %s: could not record failure", job["id"])
+
+    def run_forever(self) -> None:
+        log.info("worker %s polling (kinds=%s)", self.worker_id, self.kinds or "all")
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                log.exception("worker %s poll failed", self.worker_id)
+            self._stop.wait(self.poll_interval)
+
+    def drain(self) -> int:
+        n = 0
+        while self.run_once():
+            n += 1
+        return n
+
+def start_background_workers(pool: "db.ConnectionPool", count: int, kinds: Optional[Iterable[str]] = None) -> List[Worker]:
+    """Run `count` workers as daemon threads in this process (JOBS_INLINE_WORKERS on the web tier)."""
+    workers = []
+    for i in range(max(0, count)):
+        w = Worker(pool, worker_id=f"{socket.gethostname()}:{os.getpid()}:inline{i}", kinds=kinds)
+        threading.Thread(target=w.run_forever, name=f"job-worker-{i}", daemon=True).start()
+        workers.append(w)
+    return workers
+
+# ---------------------------------------------------------------------------
+# Handlers
+# ---------------------------------------------------------------------------
+@handler("storyboard")
+def _handle_storyboard(ctx: JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    import services
+    import qa_critic
+    project_id, creative_id = ctx.project_id, payload["creative_id"]
+    with ctx.connection() as conn:
+        creative = services.load_creative(conn, project_id, creative_id)
+    ctx.progress(10, "generating storyboard")
+    storyboard, prompt_version = services.generate_storyboard(project_id, creative)
+    ctx.progress(80, "saving storyboard")
+    review = qa_critic.critic.start(storyboard, creative)
+    with ctx.connection() as conn:
+        storyboard_id = services.persist_storyboard(conn, project_id, creative_id, storyboard, review=review,
+                                                    prompt_version=prompt_version)
+    review.write_back(storyboard_id, ctx.connection)
+    # The job is already asynchronous for the client, so its result waits for the verdict
+    qa = review.summary(wait=True)
+    return {
+        "storyboard_id": storyboard_id,
+        "storyboard": storyboard,
+        "qa_feedback": qa["feedback"] or review.persisted["qa_feedback"],
+        "qa": qa,
+        "veo3_prompt": json.dumps({"scenes": storyboard.get("scenes") or []}, ensure_ascii=False),
+    }
+
+@handler("finalize")
+def _handle_finalize(ctx: JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    import services
+    ctx.progress(10, "building blueprints")
+    with ctx.connection() as conn:
+        return services.release_gate_finalize(conn, ctx.project_id)
+
+@handler("export")
+def _handle_export(ctx: JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    import services
+    ctx.progress(10, "packaging export")
+    with ctx.connection() as conn:
+        ctx.artifact = services.build_export_zip(conn, ctx.project_id)
+    return {"filename": f"pf-package-{ctx.project_id}.zip", "size": len(ctx.artifact)}
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+def main(argv: Optional[List[str]] = None) -> int:
+    import migrations
+
+    parser = argparse.ArgumentParser(prog="jobs.py")
+    sub = parser.add_subparsers(dest="cmd")
+    w = sub.add_parser("worker", help="run a job worker")
+    w.add_argument("--once", action="store_true", help="drain runnable jobs and exit")
+    w.add_argument("--kinds", default="", help="comma-separated job kinds (default: all)")
+    w.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args(argv)
+    if args.cmd != "worker":
+        parser.print_usage(sys.stderr)
+        return 2
+
+    dsn = migrations._dsn_from_env()
+    if not dsn:
+        print("Database configuration is incomplete (set DATABASE_URL or DB_* env vars).", file=sys.stderr)
+        return 1
+    pool = db.ConnectionPool(dsn=dsn, maxconn=max(2, args.concurrency * 2))
+    import llm_cache
+    import prompts
+    import qa_critic
+    if llm_cache.LLM_CACHE_POSTGRES:
+        llm_cache.cache.add_backend(llm_cache.PostgresBackend(pool.connection))
+    prompts.registry.attach(pool.connection)  # render the versions activated through /admin/prompts
+    qa_critic.critic.attach(pool.connection)  # qa_hash verdict lookups and write-backs
+    with pool.connection() as conn:
+        migrations.ensure_migrated(conn)
+    kinds = [k.strip() for k in args.kinds.split(",") if k.strip()]
+    try:
+        if args.once:
+            n = Worker(pool, kinds=kinds).drain()
+            print(f"processed {n} job(s)")
+            return 0
+        workers = [Worker(pool, worker_id=f"{socket.gethostname()}:{os.getpid()}:{i}", kinds=kinds)
+                   for i in range(max(1, args.concurrency))]
+        threads = [threading.Thread(target=wk.run_forever, daemon=True) for wk in workers]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for wk in workers:
+                wk.stop()
+        return 0
+    finally:
+        pool.closeall()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
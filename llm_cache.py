@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+llm_cache.py
+Content-addressed cache for Gemini responses.
+
+- key = sha256 over (model, system instruction, generation config, prompt); identical requests
+  (re-submits, refreshes, retries) map to the same entry
+- backends are tiered: MemoryBackend (per-process LRU capped by bytes) first, then optionally
+  PostgresBackend (`llm_cache` table, migration v5) shared by every instance; a lower-tier hit
+  is copied into the tiers above it
+- every entry carries its own TTL; expired entries are never served
+- concurrent misses on the same key are collapsed: one caller computes, the others wait for it
+- get_or_compute(..., bypass=True) skips the lookup and the store for that call
+- backend failures are logged and counted, never raised; the cache must not break a request
+- stats() (hits per tier / misses / stores / evictions / errors) is reported by /healthz/gemini
+
+Env: LLM_CACHE_ENABLED (1), LLM_CACHE_TTL_SEC (86400), LLM_CACHE_MAX_BYTES (32 MiB),
+LLM_CACHE_POSTGRES (0; when 1, main.py attaches the Postgres tier to the DB pool).
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("pf.llm_cache")
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL_SEC = int(os.getenv("LLM_CACHE_TTL_SEC", "86400"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_POSTGRES = os.getenv("LLM_CACHE_POSTGRES", "0") == "1"
+
+MISSING = object()
+
+
+def cache_key(model: str, system_instruction: Optional[str], generation_config: Optional[Dict[str, Any]], prompt: str) -> str:
+    material = json.dumps(
+        [model, system_instruction or "", generation_config or {}, prompt],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+# ---------------------------------------------------------------------------
+# Backends: get(key) -> JSON text or None; set(key, text, ttl)
+# ---------------------------------------------------------------------------
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, text = entry
+            if expires_at <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def set(self, key: str, text: str, ttl: int) -> None:
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.time() + ttl, text)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        _, text = self._entries.pop(key)
+        self._bytes -= len(text.encode("utf-8"))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "evictions": self.evictions}
+
+
+class PostgresBackend:
+    """Shared tier. `connection` is a context-manager factory, e.g. db.ConnectionPool.connection."""
+    name = "postgres"
+
+    # Expired rows are deleted every PURGE_EVERY stores (lookups already ignore them)
+    PURGE_EVERY = 500
+
+    def __init__(self, connection: Callable[[], Any]):
+        self._connection = connection
+        self.evictions = 0
+        self._stores = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT value FROM llm_cache WHERE key = %s AND expires_at > NOW()", (key,))
+                row = cur.fetchone()
+                conn.commit()
+            finally:
+                cur.close()
+        return row[0] if row else None
+
+    def set(self, key: str, text: str, ttl: int) -> None:
+        with self._connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    """
+                    INSERT INTO llm_cache (key, value, expires_at)
+                    VALUES (%s, %s, NOW() + make_interval(secs => %s))
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                    """,
+                    (key, text, ttl),
+                )
+                conn.commit()
+            finally:
+                cur.close()
+        self._stores += 1
+        if self._stores % self.PURGE_EVERY == 0:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        with self._connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("DELETE FROM llm_cache WHERE expires_at <= NOW()")
+                n = cur.rowcount
+                conn.commit()
+            finally:
+                cur.close()
+        self.evictions += n
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        return {"evictions": self.evictions}
+
+# ---------------------------------------------------------------------------
+# Tiered cache
+# ---------------------------------------------------------------------------
+class LLMCache:
+    def __init__(self, backends: Optional[List[Any]] = None, ttl: int = LLM_CACHE_TTL_SEC, enabled: bool = LLM_CACHE_ENABLED):
+        self.backends: List[Any] = list(backends) if backends is not None else [MemoryBackend()]
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._counters: Dict[str, int] = {"misses": 0, "stores": 0, "bypassed": 0, "errors": 0}
+        self._hits: Dict[str, int] = {}
+
+    def add_backend(self, backend: Any) -> None:
+        with self._lock:
+            if all(b.name != backend.name for b in self.backends):
+                self.backends.append(backend)
+
+    def get(self, key: str) -> Any:
+        """Cached value or MISSING."""
+        for i, backend in enumerate(self.backends):
+            try:
+                text = backend.get(key)
+            except Exception as e:
+                self._count("errors")
+                log.warning("llm_cache %s get failed: %s", backend.name, e)
+                continue
+            if text is None:
+                continue
+            with self._lock:
+                self._hits[backend.name] = self._hits.get(backend.name, 0) + 1
+            for upper in self.backends[:i]:
+                self._store(upper, key, text, self.ttl)
+            return json.loads(text)
+        return MISSING
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+        text = json.dumps(value, ensure_ascii=False, default=str)
+        for backend in self.backends:
+            self._store(backend, key, text, self.ttl if ttl is None else ttl)
+        self._count("stores")
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any], ttl: Optional[int] = None, bypass: bool = False) -> Any:
+        if bypass or not self.enabled:
+            if bypass:
+                self._count("bypassed")
+            return compute()
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        with self._lock:
+            gate = self._inflight.setdefault(key, threading.Lock())
+        with gate:
+            # Another caller may have filled it while we waited
+            value = self.get(key)
+            if value is not MISSING:
+                return value
+            self._count("misses")
+            try:
+                value = compute()
+                self.set(key, value, ttl)
+                return value
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+    def clear(self) -> None:
+        for backend in self.backends:
+            if hasattr(backend, "clear"):
+                backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = {"enabled": self.enabled, "ttl_sec": self.ttl, "hits": dict(self._hits),
+                                   **self._counters}
+        out["backends"] = {b.name: b.stats() for b in self.backends}
+        return out
+
+    def _store(self, backend: Any, key: str, text: str, ttl: int) -> None:
+        try:
+            backend.set(key, text, ttl)
+        except Exception as e:
+            self._count("errors")
+            log.warning("llm_cache %s set failed: %s", backend.name, e)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+cache = LLMCache()
+
+
+def get_or_compute(key: str, compute: Callable[[], Any], ttl: Optional[int] = None, bypass: bool = False) -> Any:
+    return cache.get_or_compute(key, compute, ttl=ttl, bypass=bypass)
+
+
+def stats() -> Dict[str, Any]:
+    return cache.stats()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+llm_engine.py
+Bounded execution engine for blocking LLM calls.
+
+Gemini calls take seconds; running them inline pins a gunicorn thread *and* a pooled DB
+connection for the whole generation. Routes instead hand the call to this engine, which:
+- runs at most LLM_MAX_WORKERS generations at once (extra calls queue, they never spawn threads)
+- lets callers fan out independent prompts concurrently (gather)
+- enforces a per-call deadline (DeadlineExceeded) and supports cancellation of queued work
+- relays streaming generators (stream) chunk by chunk while the producer runs on a worker slot
+
+Calls that overrun their deadline cannot be interrupted inside the SDK; their result is
+abandoned and the worker slot frees itself when the SDK returns.
+"""
+
+from __future__ import annotations
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("pf.llm")
+
+_END = object()
+
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "4"))
+LLM_DEADLINE_SEC = float(os.getenv("LLM_DEADLINE_SEC", "90"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """The LLM call did not finish before its deadline."""
+
+
+class LLMCall:
+    """Handle for one submitted call: result(), cancel(), done()."""
+
+    def __init__(self, future: Future, deadline: float, label: str):
+        self.future = future
+        self.deadline = deadline
+        self.label = label
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> bool:
+        """Cancel if still queued; a running call is abandoned (its result is ignored)."""
+        return self.future.cancel()
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        wait = self.remaining() if timeout is None else min(timeout, self.remaining())
+        try:
+            return self.future.result(timeout=wait)
+        except FutureTimeout:
+            self.future.cancel()
+            raise DeadlineExceeded(f"LLM call '{self.label}' exceeded its deadline")
+
+
+class LLMEngine:
+    def __init__(self, max_workers: int = LLM_MAX_WORKERS, default_deadline: float = LLM_DEADLINE_SEC):
+        self.max_workers = max(1, int(max_workers))
+        self.default_deadline = float(default_deadline)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "deadline_exceeded": 0, "cancelled": 0}
+        self._running = 0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="llm")
+        return self._executor
+
+    def submit(self, fn: Callable[..., Any], *args: Any, deadline: Optional[float] = None,
+               label: Optional[str] = None, **kwargs: Any) -> LLMCall:
+        budget = self.default_deadline if deadline is None else float(deadline)
+
+        def run():
+            with self._lock:
+                self._running += 1
+            try:
+                out = fn(*args, **kwargs)
+                self._count("completed")
+                return out
+            except Exception:
+                self._count("failed")
+                raise
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        self._count("submitted")
+        future = self._pool().submit(run)
+        return LLMCall(future, time.monotonic() + budget, label or getattr(fn, "__name__", "llm"))
+
+    def run(self, fn: Callable[..., Any], *args: Any, deadline: Optional[float] = None, **kwargs: Any) -> Any:
+        """Submit and wait; raises DeadlineExceeded or the call's own exception."""
+        call = self.submit(fn, *args, deadline=deadline, **kwargs)
+        try:
+            return call.result()
+        except DeadlineExceeded:
+            self._count("deadline_exceeded")
+            raise
+
+    def gather(self, calls: Sequence[Tuple[Callable[..., Any], tuple]], deadline: Optional[float] = None,
+               return_exceptions: bool = True) -> List[Any]:
+        """
+        Run independent calls concurrently, sharing one deadline. Results keep input order;
+        with return_exceptions a failed or late call yields its exception instead of raising.
+        """
+        handles = [self.submit(fn, *args, deadline=deadline) for fn, args in calls]
+        out: List[Any] = []
+        for h in handles:
+            try:
+                out.append(h.result())
+            except DeadlineExceeded as e:
+                self._count("deadline_exceeded")
+                if not return_exceptions:
+                    self.cancel_all(handles)
+                    raise
+                out.append(e)
+            except Exception as e:
+                if not return_exceptions:
+                    self.cancel_all(handles)
+                    raise
+                out.append(e)
+        return out
+
+    def stream(self, fn: Callable[..., Iterator[Any]], *args: Any, deadline: Optional[float] = None,
+               label: Optional[str] = None, **kwargs: Any) -> Iterator[Any]:
+        """
+        Iterate a generator function on a worker slot and relay its items as they arrive.
+        The deadline covers the whole stream; closing the iterator early (client went away)
+        tells the producer to stop at its next item.
+        """
+        chunks: "queue.Queue[Tuple[bool, Any]]" = queue.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    chunks.put((True, item))
+                chunks.put((True, _END))
+            except BaseException as e:
+                chunks.put((False, e))
+                raise
+
+        call = self.submit(produce, deadline=deadline, label=label or getattr(fn, "__name__", "llm-stream"))
+        try:
+            while True:
+                try:
+                    ok, item = chunks.get(timeout=call.remaining())
+                except queue.Empty:
+                    self._count("deadline_exceeded")
+                    raise DeadlineExceeded(f"LLM stream '{call.label}' exceeded its deadline")
+                if not ok:
+                    raise item
+                if item is _END:
+                    return
+                yield item
+        finally:
+            stop.set()
+            call.cancel()
+
+    def cancel_all(self, handles: Sequence[LLMCall]) -> None:
+        for h in handles:
+            if h.cancel():
+                self._count("cancelled")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"max_workers": self.max_workers, "running": self._running, **self._counters}
+
+    def shutdown(self, wait: bool = False) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counters[key] += 1
+
+
+engine = LLMEngine()
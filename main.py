@@ -17,23 +17,43 @@ import base64
 import hashlib
 import logging
 import re
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
 import datetime
-import urllib.request
-import urllib.error
 from urllib.parse import urlencode
 import uuid  # ★ for session_id canonicalization
 
 # Pillow              (      )
 from PIL import Image  # noqa: F401
 
-from flask import Flask, request, jsonify, Response, redirect
+from flask import Flask, request, jsonify, Response, redirect, send_file, stream_with_context, g
 import psycopg2
-import psycopg2.pool
-import jwt
-from werkzeug.security import generate_password_hash, check_password_hash
 
 #      
 import services
+import schemas
+import migrations
+import db
+import gemini_client
+import llm_engine
+import llm_cache
+import streaming
+import jobs
+import activity_writer
+import activity_partitions
+import auth
+import entitlements
+import passwords
+import http_client
+import slot_extractor
+import zipstream
+import export_store
+import blueprint
+import appendix
+import prompts
+import qa_critic
 from pydantic import ValidationError
 from typing import Any, Dict, List, Optional
 
@@ -76,10 +96,33 @@ BILLPLZ_COLLECTION_ID = os.getenv("BILLPLZ_COLLECTION_ID", "")
 BILLPLZ_X_SIGNATURE_KEY = os.getenv("BILLPLZ_X_SIGNATURE_KEY", "")
 #      :       (   ,      KEY    )
 BILLPLZ_X_SIGNATURE_LEGACY = os.getenv("BILLPLZ_X_SIGNATURE", "")
+# Outbound Billplz calls go through a pooled keep-alive client (http_client.py)
+BILLPLZ_API_BASE = (os.getenv("BILLPLZ_API_BASE") or "https://www.billplz.com/api/v3").rstrip("/")
+BILLPLZ_TIMEOUT_SEC = float(os.getenv("BILLPLZ_TIMEOUT_SEC", "10"))
+BILLPLZ_RETRIES = int(os.getenv("BILLPLZ_RETRIES", "2"))
+BILLPLZ_BREAKER_THRESHOLD = int(os.getenv("BILLPLZ_BREAKER_THRESHOLD", "5"))
+BILLPLZ_BREAKER_RESET_SEC = float(os.getenv("BILLPLZ_BREAKER_RESET_SEC", "30"))
+# A checkout re-sent with the same Idempotency-Key within this window returns the same bill
+BILLPLZ_IDEMPOTENCY_WINDOW_SEC = int(os.getenv("BILLPLZ_IDEMPOTENCY_WINDOW_SEC", "600"))
 
 # Gemini( )
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 
+# Schema migrations: run pending steps once per process on first DB use.
+# Set PF_AUTO_MIGRATE=0 when migrations are applied out-of-band (`python migrations.py upgrade`).
+AUTO_MIGRATE = (os.getenv("PF_AUTO_MIGRATE", "1") == "1")
+
+# DB pool sizing (gunicorn runs 8 threads per worker; keep DB_POOL_MAX >= threads)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_VALIDATE_AFTER = float(os.getenv("DB_POOL_VALIDATE_AFTER", "30"))
+
+# Background jobs (jobs.py). Normally a separate `python jobs.py worker` deployment drains the
+# queue; JOBS_INLINE_WORKERS > 0 also runs that many worker threads inside the web process.
+JOBS_INLINE_WORKERS = int(os.getenv("JOBS_INLINE_WORKERS", "0"))
+
 # ----------------------------------------------------------------------------
 # Secret self-check
 # ----------------------------------------------------------------------------
@@ -164,6 +207,7 @@ def _admin_guard():
 # DB Pool
 # ----------------------------------------------------------------------------
 db_pool = None
+_db_pool_lock = threading.Lock()
 
 def _db_dsn():
     if not (DB_USER and DB_PASSWORD and DB_NAME and INSTANCE_CONNECTION_NAME):
@@ -175,19 +219,50 @@ def init_db_pool():
     global db_pool
     if db_pool is not None:
         return
-    dsn = _db_dsn()
-    if not dsn:
-        log.error("Database configuration is incomplete.")
-        return
-    db_pool = psycopg2.pool.SimpleConnectionPool(1, 10, dsn=dsn)
-    log.info("DB connection pool created.")
+    with _db_pool_lock:
+        if db_pool is not None:
+            return
+        dsn = _db_dsn()
+        if not dsn:
+            log.error("Database configuration is incomplete.")
+            return
+        db_pool = db.ConnectionPool(
+            dsn=dsn,
+            minconn=DB_POOL_MIN,
+            maxconn=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            validate_after=DB_POOL_VALIDATE_AFTER,
+        )
+        log.info("DB connection pool created (max=%s, timeout=%ss).", DB_POOL_MAX, DB_POOL_TIMEOUT)
+        activity_writer.start(db_pool.connection)
+        activity_partitions.start(db_pool.connection)
+        authenticator.attach(db_pool.connection)
+        prompts.registry.attach(db_pool.connection)
+        qa_critic.critic.attach(db_pool.connection)
+        entitlements.start_listener(db_pool.dedicated)
+        if llm_cache.LLM_CACHE_POSTGRES:
+            llm_cache.cache.add_backend(llm_cache.PostgresBackend(db_pool.connection))
+        if JOBS_INLINE_WORKERS > 0:
+            if AUTO_MIGRATE:
+                with db_pool.connection() as conn:
+                    migrations.ensure_migrated(conn)
+            jobs.start_background_workers(db_pool, JOBS_INLINE_WORKERS)
+            log.info("Started %s inline job worker(s).", JOBS_INLINE_WORKERS)
 
 def get_conn():
     if db_pool is None:
         init_db_pool()
     if db_pool is None:
         raise RuntimeError("DB not available")
-    return db_pool.getconn()
+    conn = db_pool.getconn()
+    if AUTO_MIGRATE and not migrations.is_migrated():
+        try:
+            migrations.ensure_migrated(conn)
+        except Exception:
+            put_conn(conn)
+            raise
+    return conn
 
 def put_conn(conn):
     try:
@@ -196,6 +271,53 @@ def put_conn(conn):
     except Exception as e:
         log.error("put_conn error: %s", e)
 
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection for the duration of a `with` block; always returned."""
+    conn = get_conn()
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        put_conn(conn)
+
+@app.teardown_request
+def _reclaim_leaked_conns(exc=None):
+    # Safety net: anything a route forgot to put_conn() goes back to the pool here
+    if db_pool is not None:
+        db_pool.reclaim_thread()
+
+def _wants_async(body: Optional[Dict[str, Any]] = None) -> bool:
+    """Enqueue-and-poll opt-in: `?async=1`, `"async": true` in the body or `Prefer: respond-async`."""
+    if (request.args.get("async") or "").lower() in ("1", "true", "yes"):
+        return True
+    if isinstance(body, dict) and body.get("async") is True:
+        return True
+    return "respond-async" in (request.headers.get("Prefer") or "").lower()
+
+def _wants_qa(body: Optional[Dict[str, Any]] = None) -> bool:
+    """Wait for the QA critic's verdict before answering: `?qa=wait` or `"wait_qa": true` in the body."""
+    if (request.args.get("qa") or "").lower() == "wait":
+        return True
+    return isinstance(body, dict) and body.get("wait_qa") is True
+
+def _job_accepted(job_id: str) -> Response:
+    return json_response({"job_id": job_id, "status": "queued", "status_url": f"/v1/jobs/{job_id}"}, 202)
+
+def _stream_response(fmt: str, endpoint: str, events, started: float) -> Response:
+    """SSE / NDJSON response for an iterator of (event, data); timings land in streaming.stats()."""
+    return Response(
+        stream_with_context(streaming.instrument(fmt, endpoint, events, started=started)),
+        status=200,
+        mimetype=streaming.MIMETYPES[fmt],
+        headers=streaming.STREAM_HEADERS,
+    )
+
 # ----------------------------------------------------------------------------
 # ★ Session ID canonicalization (accept any string, map to stable UUIDv5)
 # ----------------------------------------------------------------------------
@@ -218,9 +340,13 @@ def _canon_session_uuid(s: str) -> str:
 DIRECTOR_REQUIRED_SLOTS = ["goal","audience","platform","duration_sec","key_message","cta"]
 
 def _director_get_session(conn, session_id: str):
+    sid = db.as_uuid(session_id)
+    if sid is None:
+        return None
     cur = conn.cursor()
-    cur.execute("SELECT id, user_id, state, selections, step, project_id FROM sessions WHERE id::text = %s", (session_id,))
+    cur.execute("SELECT id, user_id, state, selections, step, project_id FROM sessions WHERE id = %s", (sid,))
     row = cur.fetchone()
+    cur.close()
     if not row:
         return None
     return {
@@ -232,36 +358,22 @@ def _director_get_session(conn, session_id: str):
         "project_id": str(row[5]) if row[5] else None
     }
 
-def _director_create_session(conn, session_id: str, user_id: str):
+def _director_create_session(conn, session_id: Optional[str], user_id: str) -> Dict[str, Any]:
+    """Insert a fresh session (random id when none is given). Caller commits."""
+    sid = session_id or str(uuid.uuid4())
     cur = conn.cursor()
-    try:
-        # try inserting with provided (already canonicalized) uuid string
-        cur.execute("""
-            INSERT INTO sessions (id, user_id, state, selections, step)
-            VALUES (%s, %s, %s, %s::jsonb, %s)
-            ON CONFLICT (id) DO NOTHING
-        """, (session_id, user_id, 'G1', json.dumps({}), 1))
-    except Exception as e:
-        # fallback: let DB generate default UUID if type casting fails
-        cur.execute("""
-            INSERT INTO sessions (user_id, state, selections, step)
-            VALUES (%s, %s, %s::jsonb, %s)
-            ON CONFLICT DO NOTHING
-        """, (user_id, 'G1', json.dumps({}), 1))
-    conn.commit()
+    cur.execute("""
+        INSERT INTO sessions (id, user_id, state, selections, step)
+        VALUES (%s, %s, %s, %s::jsonb, %s)
+        ON CONFLICT (id) DO NOTHING
+    """, (sid, user_id, 'G1', json.dumps({}), 1))
+    cur.close()
+    return {"id": sid, "user_id": user_id, "state": "G1", "selections": {}, "step": 1, "project_id": None}
 
 def _director_update_session(conn, session_id: str, selections_delta: Dict[str, Any] = None, state: Optional[str] = None, step: Optional[int] = None, project_id: Optional[str] = None):
-    sels_sql = json.dumps(selections_delta or {})
-    cur = conn.cursor()
-    cur.execute("SELECT selections FROM sessions WHERE id::text = %s", (session_id,))
-    row = cur.fetchone()
-    if not row:
-        raise ValueError("Session not found")
-    current = row[0] or {}
-    merged = current.copy()
-    merged.update(selections_delta or {})
-    fields = ["selections=%s::jsonb"]
-    params = [json.dumps(merged)]
+    """One UPDATE; selections are merged server-side (jsonb ||) instead of SELECT-then-UPDATE. Caller commits."""
+    fields = ["selections = selections || %s::jsonb"]
+    params: List[Any] = [json.dumps(selections_delta or {})]
     if state:
         fields.append("state=%s")
         params.append(state)
@@ -269,12 +381,31 @@ def _director_update_session(conn, session_id: str, selections_delta: Dict[str,
         fields.append("step=%s")
         params.append(step)
     if project_id is not None:
-        fields.append("project_id=%s::uuid")
-        params.append(project_id)
-    params.append(session_id)
-    sql = "UPDATE sessions SET " + ", ".join(fields) + ", updated_at=NOW() WHERE id::text=%s"
-    cur.execute(sql, params)
-    conn.commit()
+        fields.append("project_id=%s")
+        params.append(db.as_uuid(project_id))
+    sid = db.as_uuid(session_id)
+    if sid is None:
+        raise ValueError("Session not found")
+    params.append(sid)
+    cur = conn.cursor()
+    cur.execute("UPDATE sessions SET " + ", ".join(fields) + ", updated_at=NOW() WHERE id=%s", params)
+    found = cur.rowcount
+    cur.close()
+    if not found:
+        raise ValueError("Session not found")
+
+def _director_upsert_session(uow: "db.UnitOfWork", session_id: str, user_id: str, selections: Dict[str, Any]):
+    """Queue the turn's session write: creates the row if new, otherwise merges selections."""
+    uow.defer("""
+        INSERT INTO sessions (id, user_id, state, selections, step)
+        VALUES (%s, %s, 'G1', %s::jsonb, 1)
+        ON CONFLICT (id) DO UPDATE
+        SET selections = sessions.selections || EXCLUDED.selections, updated_at = NOW()
+    """, (session_id, user_id, json.dumps(selections or {})))
+
+def _director_queue_message(uow: "db.UnitOfWork", session_id: str, role: str, text: str):
+    """Queue a chat message; all messages of a turn are written with one multi-row INSERT."""
+    uow.add_rows("director_messages", ("session_id", "speaker", "content"), (session_id, role, text or ""))
 
 def _slots_ready(slots: Dict[str, Any]) -> bool:
     for k in DIRECTOR_REQUIRED_SLOTS:
@@ -287,68 +418,30 @@ def _slots_ready(slots: Dict[str, Any]) -> bool:
         return False
     return True
 
-PLATFORM_ALIASES = {
-    "tiktok": "TikTok",
-    "douyin": "TikTok",
-    "reels": "Instagram Reels",
-    "instagram": "Instagram Reels",
-    "youtube": "YouTube Shorts",
-    "shorts": "YouTube Shorts",
-    "facebook": "Facebook",
-    "fb": "Facebook"
-}
-
-TONE_VOCAB = {"playful","fun","energetic","heartwarming","dramatic","epic","serious","inspirational","whimsical"}
-STYLE_VOCAB = {"cinematic","ugc","asmr","documentary","vlog","retro","surreal","minimal","luxury"}
+_CTA_RE = re.compile(r'(cta|call to action)\s*[:\-]\s*([^\n]+)')
 
 def _parse_slots_from_text(text: str, current: Dict[str, Any]) -> Dict[str, Any]:
     text_l = (text or "").lower()
+    found = slot_extractor.default().extract(text_l)
     upd: Dict[str, Any] = {}
 
-    # duration
-    m = re.search(r'(\d+)\s*(s|sec|secs|second|seconds)\b', text_l)
-    if m:
-        try:
-            upd["duration_sec"] = int(m.group(1))
-        except Exception:
-            pass
-    m = re.search(r'(\d+)\s*(m|min|mins|minute|minutes)\b', text_l)
-    if m:
-        try:
-            upd["duration_sec"] = int(m.group(1)) * 60
-        except Exception:
-            pass
-    # common quick durations
-    for d in (15, 20, 30, 45, 60):
-        if re.search(rf'\b{d}\s*(s|sec|seconds)?\b', text_l):
-            upd.setdefault("duration_sec", d)
-
-    # platform
-    for key, norm in PLATFORM_ALIASES.items():
-        if re.search(rf'\b{re.escape(key)}\b', text_l):
-            upd["platform"] = norm
-            break
-
+    for key in ("duration_sec", "platform"):
+        if key in found:
+            upd[key] = found[key]
     # tone & style
-    found_tone = [w for w in TONE_VOCAB if re.search(rf'\\b{re.escape(w)}\\b', text_l)]
-    if found_tone:
-        upd["tone"] = ", ".join(sorted(set(found_tone)))
-    found_style = [w for w in STYLE_VOCAB if re.search(rf'\\b{re.escape(w)}\\b', text_l)]
-    if found_style:
-        upd["style"] = ", ".join(sorted(set(found_style)))
+    if found.get("tones"):
+        upd["tone"] = ", ".join(sorted(found["tones"]))
+    if found.get("styles"):
+        upd["style"] = ", ".join(sorted(found["styles"]))
 
     # naive CTA and message cues
-    if "cta" in text_l or "call to action" in text_l:
-        # extract after colon if present
-        m = re.search(r'(cta|call to action)\s*[:\-]\s*([^\n]+)', text_l)
-        if m:
-            upd["cta"] = m.group(2).strip()
+    m = _CTA_RE.search(text_l)
+    if m:
+        upd["cta"] = m.group(2).strip()
 
     # goal shortcut words
-    if "awareness" in text_l and not current.get("goal"):
-        upd["goal"] = "Brand awareness"
-    if "conversion" in text_l and not current.get("goal"):
-        upd["goal"] = "Drive conversions"
+    if found.get("goal") and not current.get("goal"):
+        upd["goal"] = found["goal"]
 
     return upd
 
@@ -419,114 +512,26 @@ def _ready_flags(slots: Dict[str, Any], project_id: Optional[str]) -> Dict[str,
         "can_export": bool(project_id),
     }
 
-def ensure_schema(cur):
-    # users
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            created_at TIMESTAMPTZ,
-            subscription_expires_at TIMESTAMPTZ,
-            active_token TEXT
-        )
-    """)
-    # activity logs
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS activity_logs (
-            id SERIAL PRIMARY KEY,
-            ts TIMESTAMPTZ DEFAULT NOW(),
-            actor TEXT,
-            action TEXT,
-            details JSONB,
-            ip TEXT,
-            user_agent TEXT
-        )
-    """)
-    # prompt versions
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS prompt_versions (
-            id SERIAL PRIMARY KEY,
-            is_active BOOLEAN NOT NULL DEFAULT FALSE,
-            prompt_content JSONB NOT NULL
-        )
-    """)
-
-    #    
-    try:
-        cur.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto;")  # gen_random_uuid()
-    except Exception:
-        pass
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS projects (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            user_id TEXT NOT NULL,
-            project_title TEXT NOT NULL,
-            user_input JSONB NOT NULL,
-            video_length_sec INT NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS creative_options (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
-            option_index INT NOT NULL,
-            title TEXT NOT NULL,
-            logline TEXT NOT NULL,
-            why_it_works TEXT NOT NULL,
-            is_selected BOOLEAN DEFAULT FALSE
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS storyboards (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
-            creative_option_id UUID REFERENCES creative_options(id) ON DELETE SET NULL,
-            scenes JSONB NOT NULL,
-            qa_status TEXT CHECK (qa_status IN ('passed','failed')) NOT NULL,
-            qa_feedback TEXT,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            user_id TEXT NOT NULL,
-            state TEXT NOT NULL DEFAULT 'init',
-            selections JSONB NOT NULL DEFAULT '{}'::jsonb,
-            step INT NOT NULL DEFAULT 1,
-            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            updated_at TIMESTAMPTZ DEFAULT NOW()
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS blueprints (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
-            storyboard_id UUID REFERENCES storyboards(id) ON DELETE CASCADE,
-            scene_number INT NOT NULL,
-            content_json JSONB NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-    """)
-
 # ----------------------------------------------------------------------------
 # Activity log helper
 # ----------------------------------------------------------------------------
-def _log_activity(cur, actor, action, details, req):
+def _log_activity(cur, actor, action, details, req, sync=False):
+    """
+    Record an activity event. By default it is handed to the batched background writer
+    (activity_writer) and the request never waits on the INSERT; sync=True writes on `cur`
+    inside the caller's transaction (audit events that must commit or roll back with it).
+    """
+    ua = req.headers.get("User-Agent", "")
+    ip = req.headers.get("X-Forwarded-For", req.remote_addr or "")
+    event = activity_writer.make_event(actor, action, details, ip, ua)
+    if not sync and activity_writer.writer is not None:
+        activity_writer.writer.submit(event)
+        return
     try:
-        ua = req.headers.get("User-Agent", "")
-        ip = req.headers.get("X-Forwarded-For", req.remote_addr or "")
         cur.execute(
             "INSERT INTO activity_logs (ts, actor, action, details, ip, user_agent)"
-            " VALUES (NOW(), %s, %s, %s::jsonb, %s, %s)",
-            (actor or "system", action or "event", json.dumps(details or {}), ip, ua),
+            " VALUES (%s, %s, %s, %s::jsonb, %s, %s)",
+            event,
         )
     except Exception as e:
         log.error("log_activity failed: %s", e)
@@ -534,26 +539,16 @@ def _log_activity(cur, actor, action, details, req):
 # ----------------------------------------------------------------------------
 # JWT helpers
 # ----------------------------------------------------------------------------
-def _jwt_create(username):
-    now = datetime.datetime.now(datetime.timezone.utc)
-    payload = {
-        "username": username,
-        "iat": int(now.timestamp()),
-        "exp": int((now + datetime.timedelta(days=30)).timestamp()),
-    }
-    tok = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
-    return tok.decode() if isinstance(tok, bytes) else tok
+# Verification, token cache and revocation live in auth.py; routes use @auth.require_auth
+authenticator = auth.configure(JWT_SECRET)
+# Built export packages (export_store.py); None unless EXPORT_STORE is set
+export_store.configure(JWT_SECRET)
+
+def _jwt_create(username, version=0, claims=None):
+    return authenticator.issue(username, version, claims)
 
 def _jwt_decode(req):
-    ah = req.headers.get("Authorization", "")
-    if not ah.startswith("Bearer "):
-        return None
-    token = ah.split(" ", 1)[1]
-    try:
-        return jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-    except Exception as e:
-        log.warning("jwt decode failed: %s", e)
-        return None
+    return authenticator.verify_request(req)
 
 # ----------------------------------------------------------------------------
 # Gemini helpers(legacy)
@@ -561,21 +556,25 @@ def _jwt_decode(req):
 def gemini_available():
     return _GEM_ENABLED and bool(GEMINI_API_KEY)
 
-def call_gemini(prompt, system_instruction=None):
+CHAT_GENERATION_CONFIG = {"temperature": 0.8, "max_output_tokens": 2048}
+
+GEMINI_CHAT_MODELS = ["models/gemini-1.5-pro", "models/gemini-1.5-flash"]
+
+def call_gemini(prompt, system_instruction=None, cache=True):
+    """Text reply from the first model that answers; cached per (models, instruction, config, prompt) unless cache=False."""
     if not gemini_available():
         raise RuntimeError("Gemini not configured")
-    import google.generativeai as genai  #              
-    genai.configure(api_key=GEMINI_API_KEY)
-    model_names = ["models/gemini-1.5-pro", "models/gemini-1.5-flash"]
+    key = llm_cache.cache_key("|".join(GEMINI_CHAT_MODELS), system_instruction, CHAT_GENERATION_CONFIG, prompt)
+    return llm_cache.get_or_compute(key, lambda: _call_gemini_uncached(prompt, system_instruction), bypass=not cache)
+
+def _call_gemini_uncached(prompt, system_instruction=None):
+    model_names = GEMINI_CHAT_MODELS
     last_err = None
     for name in model_names:
         try:
-            model = genai.GenerativeModel(name, system_instruction=system_instruction)
-            resp = model.generate_content(
-                prompt,
-                safety_settings=None,
-                generation_config={"temperature": 0.8, "max_output_tokens": 2048},
-            )
+            # SDK configured once; model objects reused across requests (gemini_client registry)
+            model = gemini_client.get_model(name, system_instruction, CHAT_GENERATION_CONFIG)
+            resp = model.generate_content(prompt, safety_settings=None)
             if hasattr(resp, "text") and resp.text:
                 return resp.text
             try:
@@ -615,12 +614,12 @@ def healthz():
 @app.route("/healthz/gemini", methods=["GET"])
 def healthz_gemini():
     if not gemini_available():
-        return json_response({"ok": False, "reason": "no_api_key_or_sdk"}, 503)
+        return json_response({"ok": False, "reason": "no_api_key_or_sdk", "registry": gemini_client.stats(), "engine": llm_engine.engine.stats(), "cache": llm_cache.stats()}, 503)
     try:
-        out = call_gemini("Say OK.")
-        return json_response({"ok": True, "sample": (out or "")[:80]})
+        out = call_gemini("Say OK.", cache=False)
+        return json_response({"ok": True, "sample": (out or "")[:80], "registry": gemini_client.stats(), "engine": llm_engine.engine.stats(), "cache": llm_cache.stats()})
     except Exception as e:
-        return json_response({"ok": False, "reason": "call_failed", "error": str(e)}, 502)
+        return json_response({"ok": False, "reason": "call_failed", "error": str(e), "registry": gemini_client.stats(), "engine": llm_engine.engine.stats(), "cache": llm_cache.stats()}, 502)
 
 @app.route("/healthz/db", methods=["GET"])
 def healthz_db():
@@ -628,11 +627,15 @@ def healthz_db():
     try:
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
-        cur.execute("SELECT 1")
-        cur.fetchone()
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        version = cur.fetchone()[0]
         conn.commit()
-        return json_response({"ok": True})
+        return json_response({
+            "ok": True,
+            "schema_version": version,
+            "latest_version": migrations.LATEST_VERSION,
+            "pool": db_pool.stats() if db_pool else None,
+        })
     except Exception as e:
         log.exception("healthz_db error")
         return json_response({"ok": False, "error": str(e)}, 500)
@@ -644,6 +647,38 @@ def healthz_db():
             pass
         put_conn(conn)
 
+@app.route("/healthz/db/pool", methods=["GET"])
+def healthz_db_pool():
+    # Pool counters only; never touches the database
+    if db_pool is None:
+        return json_response({"ok": False, "reason": "pool_not_initialized"}, 503)
+    return json_response({"ok": True, "pool": db_pool.stats(), "activity_writer": activity_writer.stats(),
+                          "activity_maintenance": activity_partitions.stats()})
+
+@app.route("/healthz/auth", methods=["GET"])
+def healthz_auth():
+    # Token cache hit/miss/revoked counters, revocation snapshot size, entitlement lookup sources
+    return json_response({"ok": True, "auth": authenticator.stats(), "entitlements": entitlements.stats(),
+                          "passwords": passwords.stats()})
+
+@app.route("/healthz/outbound", methods=["GET"])
+def healthz_outbound():
+    # Per-integration connection reuse, TLS resumptions, retries, circuit-breaker state; export store hits
+    return json_response({"ok": True, "clients": http_client.stats(), "billplz_replayed": _billplz_bills.hits,
+                          "export_store": export_store.stats()})
+
+@app.route("/healthz/director", methods=["GET"])
+def healthz_director():
+    # Blueprint memo hits/misses (one hit per repeated blueprint request for an unchanged brief); library version and reloads;
+    # prompt template versions being served; QA critic reviews, verdict cache hits and write-backs
+    return json_response({"ok": True, "blueprints": blueprint.stats(), "library": appendix.stats(),
+                          "prompts": prompts.stats(), "qa_critic": qa_critic.stats()})
+
+@app.route("/healthz/streaming", methods=["GET"])
+def healthz_streaming():
+    # Time-to-first-byte / first-scene / total (ms) of recent SSE/NDJSON responses, per endpoint
+    return json_response({"ok": True, "streams": streaming.stats()})
+
 # ----------------------------------------------------------------------------
 # Admin password verify
 # ----------------------------------------------------------------------------
@@ -658,13 +693,15 @@ def admin_verify():
 # ----------------------------------------------------------------------------
 # Auth & Users
 # ----------------------------------------------------------------------------
+def _hasher_busy():
+    resp = json_response({"error": "Server busy, please retry"}, 503)
+    resp.headers["Retry-After"] = "1"
+    return resp
+
 @app.route("/register", methods=["POST"])
 def register():
     conn = cur = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
         data = request.get_json(silent=True) or {}
         username = (data.get("username") or "").strip()
         password = (data.get("password") or "").strip()
@@ -672,18 +709,22 @@ def register():
             return json_response({"error": "Username and password required"}, 400)
         if len(password) < 6:
             return json_response({"error": "Password must be at least 6 characters long"}, 400)
-        cur.execute("SELECT 1 FROM users WHERE username=%s", (username,))
-        if cur.fetchone():
-            return json_response({"error": "User already exists"}, 409)
+        # Hash before borrowing a connection; the KDF runs in the password pool
+        hashed_password = passwords.hash_password(password)
         now = datetime.datetime.now(datetime.timezone.utc)
-        hashed_password = generate_password_hash(password)
+        conn = get_conn()
+        cur = conn.cursor()
         cur.execute(
-            "INSERT INTO users (username, password, created_at) VALUES (%s, %s, %s)",
+            "INSERT INTO users (username, password, created_at) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING",
             (username, hashed_password, now),
         )
+        if cur.rowcount == 0:
+            return json_response({"error": "User already exists"}, 409)
         _log_activity(cur, username, "register_success", {}, request)
         conn.commit()
         return json_response({"success": True}, 201)
+    except passwords.HasherBusy:
+        return _hasher_busy()
     except Exception as e:
         log.exception("register error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
@@ -700,75 +741,91 @@ def login():
     # Log request details for debugging CORS and authentication flow
     log.info(f"--- LOGIN REQUEST --- Method: {request.method}, Origin: {request.headers.get('Origin', 'N/A')}, User-Agent: {request.headers.get('User-Agent', 'N/A')[:100]}")
     
-    conn = cur = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
         data = request.get_json(silent=True) or {}
         username = (data.get("username") or "").strip()
         password = (data.get("password") or "").strip()
         
         log.info(f"--- LOGIN ATTEMPT --- Username: {username}, Password length: {len(password)}")
         
-        cur.execute("SELECT password FROM users WHERE username=%s", (username,))
-        row = cur.fetchone()
-        if not row or not check_password_hash(row[0], password):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT password, token_version, subscription_expires_at FROM users WHERE username=%s", (username,))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+        # Verify with the connection back in the pool
+        ok, rehash = passwords.verify_password(row[0], password) if row else (False, False)
+        if not ok:
             log.info(f"--- LOGIN FAILED --- Invalid credentials for user: {username}")
             return json_response({"error": "Invalid credentials"}, 401)
+        new_hash = passwords.hash_password(password) if rehash else None
         
-        token = _jwt_create(username)
-        cur.execute("UPDATE users SET active_token=%s WHERE username=%s", (token, username))
-        _log_activity(cur, username, "login_success", {}, request)
-        conn.commit()
+        token = _jwt_create(username, row[1], {"sub_exp": entitlements.to_claim(row[2])})
+        with db_connection() as conn:
+            cur = conn.cursor()
+            if new_hash:
+                # Hash parameters changed since this one was stored; skip if the password changed meanwhile
+                cur.execute("UPDATE users SET password=%s WHERE username=%s AND password=%s", (new_hash, username, row[0]))
+            _log_activity(cur, username, "login_success", {"rehashed": True} if new_hash else {}, request)
+            conn.commit()
+            cur.close()
         
         log.info(f"--- LOGIN SUCCESS --- User: {username}, Token generated")
         return json_response({"success": True, "token": token})
+    except passwords.HasherBusy:
+        return _hasher_busy()
     except Exception as e:
         log.exception("login error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        try:
-            if cur:
-                cur.close()
-        except Exception:
-            pass
-        put_conn(conn)
+
+@app.route("/logout", methods=["POST"])
+@auth.require_auth
+def logout():
+    """Revoke the presented token (by jti); other sessions of the user stay signed in."""
+    payload = g.jwt
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            revoked = authenticator.revoke(cur, payload)
+            _log_activity(cur, payload.get("username"), "logout", {"revoked": revoked}, request)
+            conn.commit()
+            cur.close()
+        return json_response({"success": True, "revoked": revoked})
+    except Exception as e:
+        log.exception("logout error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+
+def _load_entitlement(username):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT subscription_expires_at FROM users WHERE username=%s", (username,))
+        r = cur.fetchone()
+        cur.close()
+    return (r is not None, r[0] if r else None)
 
 @app.route("/get-user-status", methods=["GET"])
+@auth.require_auth
 def get_user_status():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    # Polled by the dashboard: served from the entitlement cache or the token's sub_exp claim when
+    # possible (entitlements.py); subscription writers NOTIFY so a payment shows up within seconds
+    payload = g.jwt
     username = payload.get("username")
-    conn = cur = None
     try:
-        log.info(f"--- DASHBOARD LOG --- Checking status for user: {username}")
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
-        cur.execute("SELECT username, subscription_expires_at FROM users WHERE username=%s", (username,))
-        r = cur.fetchone()
-        log.info(f"--- DASHBOARD LOG --- DB result for {username}: {r}")
-        if not r:
+        (found, expires_at), source = entitlements.cache.lookup(username, payload, _load_entitlement)
+        log.debug("get-user-status %s served from %s", username, source)
+        if not found:
             return json_response({"error": "User not found"}, 404)
         now = datetime.datetime.now(datetime.timezone.utc)
-        is_subscribed = r[1] is not None and r[1] > now
+        is_subscribed = expires_at is not None and expires_at > now
         return json_response({
-            "username": r[0],
-            "subscription_expires_at": r[1].isoformat() if r[1] else None,
+            "username": username,
+            "subscription_expires_at": expires_at.isoformat() if expires_at else None,
             "is_subscribed": is_subscribed
         })
     except Exception as e:
         log.exception("get-user-status error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        try:
-            if cur:
-                cur.close()
-        except Exception:
-            pass
-        put_conn(conn)
 
 # ----------------------------------------------------------------------------
 # Admin APIs
@@ -781,7 +838,6 @@ def admin_users():
     try:
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
         sort = (request.args.get("sort") or "").lower()
         order_sql = "ASC" if sort == "asc" else "DESC"
         cur.execute(f"SELECT username, password, created_at, subscription_expires_at FROM users ORDER BY created_at {order_sql} NULLS LAST")
@@ -816,21 +872,21 @@ def admin_add_user():
         return json_response({"error": "Username and password required"}, 400)
     conn = cur = None
     try:
+        hashed_password = passwords.hash_password(password)
+        now = datetime.datetime.now(datetime.timezone.utc)
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
-        cur.execute("SELECT 1 FROM users WHERE username=%s", (username,))
-        if cur.fetchone():
-            return json_response({"error": "User already exists"}, 409)
-        now = datetime.datetime.now(datetime.timezone.utc)
-        hashed_password = generate_password_hash(password)
         cur.execute(
-            "INSERT INTO users (username, password, created_at) VALUES (%s, %s, %s)",
+            "INSERT INTO users (username, password, created_at) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING",
             (username, hashed_password, now),
         )
-        _log_activity(cur, "admin", "add_user", {"username": username}, request)
+        if cur.rowcount == 0:
+            return json_response({"error": "User already exists"}, 409)
+        _log_activity(cur, "admin", "add_user", {"username": username}, request, sync=True)
         conn.commit()
         return json_response({"success": True}, 201)
+    except passwords.HasherBusy:
+        return _hasher_busy()
     except Exception as e:
         log.exception("admin_add_user error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
@@ -854,12 +910,13 @@ def admin_delete_user():
     try:
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
         cur.execute("DELETE FROM users WHERE username=%s", (username,))
         if cur.rowcount == 0:
             return json_response({"success": False, "message": "User not found"}, 404)
-        _log_activity(cur, "admin", "delete_user", {"username": username}, request)
+        entitlements.notify(cur, username)
+        _log_activity(cur, "admin", "delete_user", {"username": username}, request, sync=True)
         conn.commit()
+        entitlements.cache.invalidate(username)
         return json_response({"success": True})
     except Exception as e:
         log.exception("admin_delete_user error")
@@ -883,16 +940,19 @@ def admin_update_user():
         return json_response({"error": "Username and new password required"}, 400)
     conn = cur = None
     try:
+        hashed_password = passwords.hash_password(password)
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
-        hashed_password = generate_password_hash(password)
         cur.execute("UPDATE users SET password=%s WHERE username=%s", (hashed_password, username))
         if cur.rowcount == 0:
             return json_response({"success": False, "message": "User not found"}, 404)
-        _log_activity(cur, "admin", "update_user_password", {"username": username}, request)
+        # A password reset signs the user out everywhere
+        authenticator.revoke_all(cur, username)
+        _log_activity(cur, "admin", "update_user_password", {"username": username}, request, sync=True)
         conn.commit()
         return json_response({"success": True})
+    except passwords.HasherBusy:
+        return _hasher_busy()
     except Exception as e:
         log.exception("admin_update_user error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
@@ -904,6 +964,36 @@ def admin_update_user():
             pass
         put_conn(conn)
 
+@app.route("/admin/revoke-tokens", methods=["POST"])
+def admin_revoke_tokens():
+    """Invalidate every token issued to a user so far (bumps users.token_version)."""
+    g = _admin_guard()
+    if g: return g
+    data = request.get_json(silent=True) or {}
+    username = (data.get("username") or "").strip()
+    if not username:
+        return json_response({"error": "Username required"}, 400)
+    conn = cur = None
+    try:
+        conn = get_conn()
+        cur = conn.cursor()
+        version = authenticator.revoke_all(cur, username)
+        if version is None:
+            return json_response({"success": False, "message": "User not found"}, 404)
+        _log_activity(cur, "admin", "revoke_tokens", {"username": username, "token_version": version}, request, sync=True)
+        conn.commit()
+        return json_response({"success": True, "token_version": version})
+    except Exception as e:
+        log.exception("admin_revoke_tokens error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+    finally:
+        try:
+            if cur:
+                cur.close()
+        except Exception:
+            pass
+        put_conn(conn)
+
 @app.route("/admin/add-subscription-time", methods=["PUT"])
 def admin_add_sub_time():
     g = _admin_guard()
@@ -921,7 +1011,6 @@ def admin_add_sub_time():
     try:
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
         cur.execute("SELECT subscription_expires_at FROM users WHERE username=%s", (username,))
         r = cur.fetchone()
         now = datetime.datetime.now(datetime.timezone.utc)
@@ -930,8 +1019,10 @@ def admin_add_sub_time():
         cur.execute("UPDATE users SET subscription_expires_at=%s WHERE username=%s", (new_expiry, username))
         if cur.rowcount == 0:
             return json_response({"success": False, "message": "User not found"}, 404)
-        _log_activity(cur, "admin", "adjust_subscription", {"username": username, "days": days_to_add}, request)
+        entitlements.notify(cur, username)
+        _log_activity(cur, "admin", "adjust_subscription", {"username": username, "days": days_to_add}, request, sync=True)
         conn.commit()
+        entitlements.cache.invalidate(username)
         return json_response({"success": True, "message": "Subscription adjusted"})
     except Exception as e:
         log.exception("admin_add_sub_time error")
@@ -944,15 +1035,133 @@ def admin_add_sub_time():
             pass
         put_conn(conn)
 
+# ----------------------------------------------------------------------------
+# Prompt template versions (prompts.py): list, add, activate without a redeploy
+# ----------------------------------------------------------------------------
+_PROMPT_VERSION_RE = re.compile(r"^v\d+(?:\.\d+)*$")
+
+@app.route("/admin/prompts", methods=["GET"])
+def admin_prompts():
+    g = _admin_guard()
+    if g: return g
+    try:
+        # Resolving the served versions also records the shipped file versions on first use
+        serving = {name: prompts.registry.version(name) for name in prompts.registry.names()}
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT name, version, is_active, created_by, created_at, prompt_content->>'source' "
+                "FROM prompt_versions WHERE name IS NOT NULL ORDER BY name, created_at DESC, version DESC"
+            )
+            rows = cur.fetchall()
+            conn.commit()
+        versions = [{"name": r[0], "version": r[1], "is_active": r[2], "created_by": r[3],
+                     "created_at": r[4].isoformat() if r[4] else None, "source": r[5]} for r in rows]
+        return json_response({"versions": versions, "serving": serving})
+    except Exception as e:
+        log.exception("admin_prompts error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+
+@app.route("/admin/prompts", methods=["POST"])
+def admin_add_prompt():
+    g = _admin_guard()
+    if g: return g
+    data = request.get_json(silent=True) or {}
+    name = (data.get("name") or "").strip()
+    version = (data.get("version") or "").strip()
+    template = data.get("template") or ""
+    if name not in prompts.registry.names():
+        return json_response({"error": f"Unknown prompt name; expected one of {prompts.registry.names()}"}, 400)
+    if not _PROMPT_VERSION_RE.match(version) or not template.strip():
+        return json_response({"error": "version (e.g. v1.1) and template required"}, 400)
+    # The code supplies exactly the variables of the current version: a dropped one loses input, an
+    # added one makes every render raise KeyError once this version is active
+    supplied, used = prompts.get(name).variables, prompts.Template(name, version, template).variables
+    if supplied != used:
+        return json_response({"error": "Template variables must match the ones the code supplies",
+                              "missing": sorted(supplied - used), "unknown": sorted(used - supplied)}, 400)
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                prompts.registry.add_version(cur, name, version, template, created_by="admin")
+            except ValueError as e:
+                conn.rollback()
+                return json_response({"error": str(e)}, 409)
+            if data.get("activate"):
+                prompts.registry.activate(cur, name, version)
+            _log_activity(cur, "admin", "add_prompt_version",
+                          {"name": name, "version": version, "activate": bool(data.get("activate"))}, request, sync=True)
+            conn.commit()
+        prompts.registry.invalidate()
+        return json_response({"success": True, "name": name, "version": version}, 201)
+    except Exception as e:
+        log.exception("admin_add_prompt error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+
+@app.route("/admin/prompts/activate", methods=["POST"])
+def admin_activate_prompt():
+    g = _admin_guard()
+    if g: return g
+    data = request.get_json(silent=True) or {}
+    name = (data.get("name") or "").strip()
+    version = (data.get("version") or "").strip()
+    if not name or not version:
+        return json_response({"error": "name and version required"}, 400)
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            if not prompts.registry.activate(cur, name, version):
+                conn.rollback()
+                return json_response({"error": "Prompt version not found"}, 404)
+            _log_activity(cur, "admin", "activate_prompt_version", {"name": name, "version": version}, request, sync=True)
+            conn.commit()
+        prompts.registry.invalidate()
+        return json_response({"success": True, "name": name, "version": version})
+    except Exception as e:
+        log.exception("admin_activate_prompt error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+
+# Unfiltered totals come from planner statistics; filtered totals are counted up to this cap
+ACTIVITY_COUNT_CAP = int(os.getenv("ACTIVITY_COUNT_CAP", "10000"))
+ACTIVITY_MAX_LIMIT = 500
+
+def _encode_activity_cursor(ts, row_id: int, direction: str) -> str:
+    raw = json.dumps({"ts": ts.isoformat(), "id": row_id, "dir": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_activity_cursor(token: str) -> Dict[str, Any]:
+    """Opaque cursor -> {"ts", "id", "dir"}; ValueError when it was not produced by us."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        c = json.loads(raw)
+        return {"ts": datetime.datetime.fromisoformat(c["ts"]), "id": int(c["id"]),
+                "dir": "prev" if c.get("dir") == "prev" else "next"}
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _activity_estimated_total(cur) -> Optional[int]:
+    # reltuples of the table (and of its partitions, if any); -1/0 until the table is first analyzed
+    cur.execute("""
+        SELECT COALESCE(SUM(c.reltuples) FILTER (WHERE c.reltuples > 0), 0)::bigint, BOOL_OR(c.reltuples >= 0)
+        FROM pg_class c
+        WHERE c.oid = 'activity_logs'::regclass
+           OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'activity_logs'::regclass)
+    """)
+    est, analyzed = cur.fetchone()
+    return int(est) if analyzed else None
+
 @app.route("/admin/activity", methods=["GET"])
 def admin_activity():
+    """
+    Keyset pagination over (ts, id): pass back `next_cursor` / `prev_cursor` as `cursor` to page in
+    constant time at any depth. `total` is computed on the first page only (estimated when unfiltered,
+    capped at ACTIVITY_COUNT_CAP when filtered). Legacy `offset` paging still works without a cursor.
+    """
     g = _admin_guard()
     if g: return g
     conn = cur = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
         qp = request.args or {}
         actor = qp.get("actor")
         action = qp.get("action")
@@ -960,10 +1169,15 @@ def admin_activity():
         until = qp.get("until")
         sort = (qp.get("sort") or "desc").lower()
         try:
-            limit = int(qp.get("limit") or 50)
-            offset = int(qp.get("offset") or 0)
+            limit = max(1, min(int(qp.get("limit") or 50), ACTIVITY_MAX_LIMIT))
+            offset = max(0, int(qp.get("offset") or 0))
         except Exception:
             limit, offset = 50, 0
+        try:
+            cursor = _decode_activity_cursor(qp["cursor"]) if qp.get("cursor") else None
+        except ValueError as ve:
+            return json_response({"error": str(ve)}, 400)
+
         where = []
         params = []
         if actor:
@@ -974,19 +1188,54 @@ def admin_activity():
             where.append("ts >= %s"); params.append(since)
         if until:
             where.append("ts <= %s"); params.append(until)
+        filter_where, filter_params = list(where), list(params)
+
+        descending = sort != "asc"
+        backwards = bool(cursor) and cursor["dir"] == "prev"
+        # Walking backwards = scanning the opposite order from the cursor, then flipping the page
+        scan_desc = descending != backwards
+        if cursor:
+            # The plain ts bound lets the planner prune partitions; the row comparison does not
+            where.append("ts <= %s AND (ts, id) < (%s, %s)" if scan_desc else "ts >= %s AND (ts, id) > (%s, %s)")
+            params += [cursor["ts"], cursor["ts"], cursor["id"]]
         where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-        order_sql = "ASC" if sort == "asc" else "DESC"
+        order_sql = "DESC" if scan_desc else "ASC"
+
+        conn = get_conn()
+        cur = conn.cursor()
         cur.execute(
             f"SELECT id, ts, actor, action, details, ip, user_agent FROM activity_logs {where_sql} "
-            f"ORDER BY ts {order_sql} LIMIT %s OFFSET %s",
-            params + [limit, offset],
+            f"ORDER BY ts {order_sql}, id {order_sql} LIMIT %s OFFSET %s",
+            params + [limit + 1, 0 if cursor else offset],
         )
         rows = cur.fetchall()
-        if where:
-            cur.execute(f"SELECT COUNT(1) FROM activity_logs {where_sql}", params)
-        else:
-            cur.execute("SELECT COUNT(1) FROM activity_logs")
-        total = cur.fetchone()[0]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+
+        total = None
+        total_is_estimate = False
+        if not cursor and qp.get("count", "1") != "0":
+            if not filter_where:
+                total = _activity_estimated_total(cur)
+                total_is_estimate = total is not None
+            if total is None:
+                filter_sql = ("WHERE " + " AND ".join(filter_where)) if filter_where else ""
+                cur.execute(f"SELECT COUNT(1) FROM (SELECT 1 FROM activity_logs {filter_sql} LIMIT %s) t",
+                            filter_params + [ACTIVITY_COUNT_CAP + 1])
+                total = cur.fetchone()[0]
+                if total > ACTIVITY_COUNT_CAP:
+                    total, total_is_estimate = ACTIVITY_COUNT_CAP, True
+
+        next_cursor = prev_cursor = None
+        if rows:
+            first, last = rows[0], rows[-1]
+            if has_more or backwards:
+                next_cursor = _encode_activity_cursor(last[1], last[0], "next")
+            if (has_more if backwards else (cursor is not None or offset > 0)):
+                prev_cursor = _encode_activity_cursor(first[1], first[0], "prev")
+
         items = []
         for r in rows:
             items.append({
@@ -998,7 +1247,14 @@ def admin_activity():
                 "ip": r[5],
                 "user_agent": r[6],
             })
-        return json_response({"ok": True, "items": items, "total": total})
+        return json_response({
+            "ok": True,
+            "items": items,
+            "total": total,
+            "total_is_estimate": total_is_estimate,
+            "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor,
+        })
     except Exception as e:
         log.exception("admin_activity error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
@@ -1010,32 +1266,175 @@ def admin_activity():
             pass
         put_conn(conn)
 
+ACTIVITY_SUMMARY_TABLES = {"hour": "activity_rollup_hourly", "day": "activity_rollup_daily"}
+ACTIVITY_SUMMARY_DEFAULT_WINDOW = {"hour": datetime.timedelta(hours=48), "day": datetime.timedelta(days=30)}
+ACTIVITY_SUMMARY_GROUPS = {"action": ["action"], "actor": ["actor"], "actor,action": ["actor", "action"], "none": []}
+ACTIVITY_SUMMARY_MAX_ROWS = 5000
+
+@app.route("/admin/activity/summary", methods=["GET"])
+def admin_activity_summary():
+    """
+    Event counts per hour/day from the rollup tables (activity_partitions.refresh_rollups), never
+    from raw rows. Query: granularity=hour|day, group_by=action|actor|actor,action|none, since, until,
+    actor, action. Counts lag by at most one maintenance interval; `rolled_through` says how far.
+    """
+    g = _admin_guard()
+    if g: return g
+    conn = cur = None
+    try:
+        qp = request.args or {}
+        granularity = (qp.get("granularity") or "day").lower()
+        group_by = (qp.get("group_by") or "action").lower()
+        if granularity not in ACTIVITY_SUMMARY_TABLES:
+            return json_response({"error": "granularity must be 'hour' or 'day'"}, 400)
+        if group_by not in ACTIVITY_SUMMARY_GROUPS:
+            return json_response({"error": f"group_by must be one of {sorted(ACTIVITY_SUMMARY_GROUPS)}"}, 400)
+        until = qp.get("until") or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        since = qp.get("since") or (datetime.datetime.now(datetime.timezone.utc)
+                                    - ACTIVITY_SUMMARY_DEFAULT_WINDOW[granularity]).isoformat()
+        where = ["bucket >= %s", "bucket <= %s"]
+        params: List[Any] = [since, until]
+        if qp.get("actor"):
+            where.append("actor=%s"); params.append(qp["actor"])
+        if qp.get("action"):
+            where.append("action=%s"); params.append(qp["action"])
+        cols = ACTIVITY_SUMMARY_GROUPS[group_by]
+        select_cols = ", ".join(["bucket"] + cols)
+
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT {select_cols}, SUM(events)::bigint FROM {ACTIVITY_SUMMARY_TABLES[granularity]} "
+            f"WHERE {' AND '.join(where)} GROUP BY {select_cols} ORDER BY {select_cols} LIMIT %s",
+            params + [ACTIVITY_SUMMARY_MAX_ROWS + 1],
+        )
+        rows = cur.fetchall()
+        truncated = len(rows) > ACTIVITY_SUMMARY_MAX_ROWS
+        buckets = []
+        for r in rows[:ACTIVITY_SUMMARY_MAX_ROWS]:
+            item = {"bucket": r[0].isoformat()}
+            item.update(zip(cols, r[1:-1]))
+            item["events"] = int(r[-1])
+            buckets.append(item)
+        through = activity_partitions.rolled_through(cur)
+        return json_response({
+            "ok": True,
+            "granularity": granularity,
+            "group_by": group_by,
+            "since": since,
+            "until": until,
+            "rolled_through": through.isoformat() if through else None,
+            "total": sum(b["events"] for b in buckets),
+            "truncated": truncated,
+            "buckets": buckets,
+        })
+    except Exception as e:
+        log.exception("admin_activity_summary error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+    finally:
+        try:
+            if cur:
+                cur.close()
+        except Exception:
+            pass
+        put_conn(conn)
+
 # ----------------------------------------------------------------------------
 # Public Activity ingest
 # ----------------------------------------------------------------------------
 @app.route("/activity/log", methods=["POST"])
 def activity_log():
-    conn = cur = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
         data = request.get_json(silent=True) or {}
         actor = (data.get("actor") or "system").strip()
         action = (data.get("action") or "event").strip()
         details = data.get("details") or {}
-        _log_activity(cur, actor, action, details, request)
-        conn.commit()
+        if db_pool is None:
+            init_db_pool()
+        if activity_writer.writer is not None:
+            # Buffered: no pooled connection is taken per browser event
+            _log_activity(None, actor, action, details, request)
+            return json_response({"ok": True})
+        with db_connection() as conn:
+            cur = conn.cursor()
+            _log_activity(cur, actor, action, details, request)
+            conn.commit()
+            cur.close()
         return json_response({"ok": True})
     except Exception as e:
         log.exception("activity_log error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
+
+def _parse_activity_batch(raw: bytes):
+    """JSON array, {"events": [...]} or NDJSON (one event per line) -> list of raw items."""
+    text = (raw or b"").decode("utf-8", errors="replace").strip()
+    if not text:
+        return []
+    if text[0] in "[{":
         try:
-            if cur:
+            body = json.loads(text)
+            if isinstance(body, list):
+                return body
+            if isinstance(body, dict) and isinstance(body.get("events"), list):
+                return body["events"]
+            if isinstance(body, dict):
+                return [body]
+        except ValueError:
+            if text[0] == "[":
+                raise
+    items = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            items.append(e)  # reported per item
+    return items
+
+@app.route("/activity/log/batch", methods=["POST"])
+def activity_log_batch():
+    """
+    Batch ingest for client events (fetch keepalive / navigator.sendBeacon). Accepts a JSON array,
+    {"events": [...]} or NDJSON regardless of Content-Type (sendBeacon posts text/plain).
+    Valid items are written with one multi-row INSERT; the response reports status per item.
+    """
+    try:
+        try:
+            items = _parse_activity_batch(request.get_data(cache=False))
+        except ValueError as e:
+            return json_response({"error": "Malformed batch", "detail": str(e)}, 400)
+        if len(items) > schemas.ACTIVITY_BATCH_MAX:
+            return json_response({"error": f"Too many events (max {schemas.ACTIVITY_BATCH_MAX})"}, 413)
+
+        ua = request.headers.get("User-Agent", "")
+        ip = request.headers.get("X-Forwarded-For", request.remote_addr or "")
+        results, events = [], []
+        for i, item in enumerate(items):
+            if isinstance(item, Exception):
+                results.append({"index": i, "ok": False, "error": f"invalid JSON: {item}"})
+                continue
+            try:
+                ev = schemas.ActivityEvent.model_validate(item)
+            except ValidationError as e:
+                results.append({"index": i, "ok": False, "error": "; ".join(
+                    f"{'.'.join(str(p) for p in err['loc']) or 'event'}: {err['msg']}" for err in e.errors())})
+                continue
+            events.append(activity_writer.make_event(ev.actor.strip(), ev.action.strip(), ev.details, ip, ua))
+            results.append({"index": i, "ok": True})
+
+        if events:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                activity_writer.insert_events(cur, events)
+                conn.commit()
                 cur.close()
-        except Exception:
-            pass
+        rejected = len(results) - len(events)
+        return json_response({"ok": rejected == 0, "accepted": len(events), "rejected": rejected, "results": results})
+    except Exception as e:
+        log.exception("activity_log_batch error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
 
 # ----------------------------------------------------------------------------
 # Billplz Helpers & APIs
@@ -1045,6 +1444,25 @@ def _billplz_basic_auth_header():
     b64 = base64.b64encode(token.encode("utf-8")).decode("utf-8")
     return f"Basic {b64}"
 
+_billplz_bills = http_client.IdempotencyMemo(ttl=BILLPLZ_IDEMPOTENCY_WINDOW_SEC)
+
+def _billplz():
+    # Billplz ignores Idempotency-Key, so POST /bills is retried only when it never reached Billplz (or got a 429)
+    return http_client.client(
+        "billplz", BILLPLZ_API_BASE,
+        read_timeout=BILLPLZ_TIMEOUT_SEC, retries=BILLPLZ_RETRIES,
+        failure_threshold=BILLPLZ_BREAKER_THRESHOLD, reset_timeout=BILLPLZ_BREAKER_RESET_SEC,
+        honours_idempotency_key=False,
+    )
+
+def _bill_idempotency_key(username: str, plan_id: str, amount: str) -> Optional[str]:
+    """The checkout's Idempotency-Key header bound to user, plan and amount; None when the client sent none."""
+    client_key = (request.headers.get("Idempotency-Key") or "").strip()[:128]
+    if not client_key:
+        return None
+    basis = f"{username}|{plan_id}|{amount}|{client_key}"
+    return "bill-" + hashlib.sha256(basis.encode("utf-8")).hexdigest()[:32]
+
 
 # ---------------------------------------------------------------------
 # Plans catalog (server-side source of truth)
@@ -1078,54 +1496,81 @@ def _normalize_form_for_hmac(form_dict: dict) -> bytes:
     items.sort(key=lambda kv: kv[0])
     return urlencode(items, doseq=False).encode("utf-8")
 
-def verify_billplz_signature(req, key_plain: str) -> bool:
+# Variant that matched most recently; tried first so a steady stream of callbacks costs one HMAC
+_billplz_sig_preferred = "A"
+BILLPLZ_SIGNATURE_VARIANTS = ("A", "B", "C")
+
+def _billplz_signed_bytes(req, variant: str):
+    if variant == "A":
+        return req.get_data(cache=True, as_text=False) or b""
+    if variant == "B":
+        return _normalize_form_for_hmac(req.form.to_dict(flat=True))
+    subset = {}
+    for k, v in req.form.items():
+        lk = k.lower()
+        if lk.startswith("billplz.") or lk.startswith("billplz["):
+            if lk != "x_signature":
+                subset[k] = v
+    return _normalize_form_for_hmac(subset) if subset else None
+
+def billplz_signature_variant(req, key_plain: str):
     """
-       X Signature Key   HMAC-SHA256   .      ,      :
-    A)    body(bytes)
-    B)        (   x_signature,  key   )
-    C)    billplz.* / billplz[xxx]      
+    Which signing variant the X Signature (HMAC-SHA256) matches, or None:
+    A) raw body bytes
+    B) full form, sorted by key, without x_signature
+    C) only the billplz.* / billplz[...] fields
+    The last matching variant is tried first.
     """
+    global _billplz_sig_preferred
     if not key_plain:
-        return False
+        return None
 
     key = key_plain.encode("utf-8")
     provided = (req.form.get("x_signature") or req.headers.get("X-Signature") or "").strip().lower()
     if not provided:
-        return False
+        return None
 
-    # A: raw body
-    raw_body = req.get_data(cache=True, as_text=False) or b""
-    cand = hmac.new(key, raw_body, hashlib.sha256).hexdigest().lower()
-    if hmac.compare_digest(cand, provided):
-        return True
+    preferred = _billplz_sig_preferred
+    for variant in (preferred,) + tuple(v for v in BILLPLZ_SIGNATURE_VARIANTS if v != preferred):
+        signed = _billplz_signed_bytes(req, variant)
+        if signed is None:
+            continue
+        cand = hmac.new(key, signed, hashlib.sha256).hexdigest().lower()
+        if hmac.compare_digest(cand, provided):
+            if variant != preferred:
+                log.info("Billplz signature variant %s matched; trying it first from now on", variant)
+                _billplz_sig_preferred = variant
+            return variant
 
-    # B: normalized full form
-    norm = _normalize_form_for_hmac(req.form.to_dict(flat=True))
-    cand = hmac.new(key, norm, hashlib.sha256).hexdigest().lower()
-    if hmac.compare_digest(cand, provided):
-        return True
+    log.warning("Billplz HMAC not matched. provided=%s...", provided[:10])
+    return None
 
-    # C: subset billplz.* / billplz[...]
-    subset = {}
-    for k, v in req.form.items():
-        lk = k.lower()
-        if lk.startswith("billplz.") or lk.startswith("billplz["):
-            if lk != "x_signature":
-                subset[k] = v
-    if subset:
-        norm2 = _normalize_form_for_hmac(subset)
-        cand = hmac.new(key, norm2, hashlib.sha256).hexdigest().lower()
-        if hmac.compare_digest(cand, provided):
+def verify_billplz_signature(req, key_plain: str) -> bool:
+    return billplz_signature_variant(req, key_plain) is not None
+
+# Bill ids this process has already recorded; a redelivery is answered without touching the DB
+_billplz_seen_bills: "OrderedDict[str, bool]" = OrderedDict()
+_billplz_seen_lock = threading.Lock()
+BILLPLZ_SEEN_BILLS_MAX = 10000
+
+def _billplz_bill_seen(bill_id: str) -> bool:
+    with _billplz_seen_lock:
+        if bill_id in _billplz_seen_bills:
+            _billplz_seen_bills.move_to_end(bill_id)
             return True
+        return False
 
-    log.warning("Billplz HMAC not matched. provided=%s...", provided[:10])
-    return False
+def _billplz_mark_seen(bill_id: str) -> None:
+    with _billplz_seen_lock:
+        _billplz_seen_bills[bill_id] = True
+        _billplz_seen_bills.move_to_end(bill_id)
+        while len(_billplz_seen_bills) > BILLPLZ_SEEN_BILLS_MAX:
+            _billplz_seen_bills.popitem(last=False)
 
 @app.route("/create-bill", methods=["POST"])
+@auth.require_auth
 def create_bill():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     # ★ username 兼容 user_id
     username = (payload.get("username") or payload.get("user_id") or "guest")
 
@@ -1175,36 +1620,46 @@ def create_bill():
             "detail": "BILLPLZ_API_KEY or BILLPLZ_COLLECTION_ID is missing"
         }, 400)
 
-    headers = {"Content-Type": "application/json", "Authorization": _billplz_basic_auth_header()}
+    key = _bill_idempotency_key(username, plan_id, amount)
+    headers = {"Authorization": _billplz_basic_auth_header()}
+    client = _billplz()
 
     try:
-        req = urllib.request.Request(
-            "https://www.billplz.com/api/v3/bills", method="POST",
-            data=json.dumps(billplz_payload).encode("utf-8"), headers=headers,
-        )
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            body = json.loads(resp.read().decode("utf-8"))
-            url = body.get("url")
-            bill_id = str(body.get("id"))
-            return json_response({"url": url, "bill_id": bill_id})
-    except urllib.error.HTTPError as e:
-        try:
-            err_body = e.read().decode("utf-8")
-        except Exception:
-            err_body = ""
-        log.error("Billplz rejected: %s %s", e, err_body)
-        return json_response({"error": "Payment service rejected", "detail": err_body}, 502)
+        if key:
+            resp, replayed = _billplz_bills.run(key, lambda: client.post(
+                "/bills", json_body=billplz_payload, headers=headers, idempotency_key=key))
+        else:
+            resp, replayed = client.post("/bills", json_body=billplz_payload, headers=headers), False
+    except http_client.CircuitOpen:
+        log.warning("Billplz circuit open; create-bill rejected fast")
+        out = json_response({"error": "Payment service unavailable, please retry shortly"}, 503)
+        out.headers["Retry-After"] = str(int(BILLPLZ_BREAKER_RESET_SEC))
+        return out
     except Exception as e:
         log.exception("Billplz create-bill failed")
         return json_response({"error": "Payment service error", "detail": str(e)}, 502)
 
+    if not resp.ok:
+        err_body = resp.text()
+        log.error("Billplz rejected: %s %s", resp.status, err_body)
+        return json_response({"error": "Payment service rejected", "detail": err_body}, 502)
+    try:
+        body = resp.json()
+    except ValueError as e:
+        log.error("Billplz returned non-JSON: %s", resp.text()[:200])
+        return json_response({"error": "Payment service error", "detail": str(e)}, 502)
+    if replayed:
+        log.info("create-bill replayed for %s (key=%s)", username, key)
+    return json_response({"url": body.get("url"), "bill_id": str(body.get("id"))})
+
 @app.route("/webhook-billplz", methods=["POST"])
 def webhook_billplz():
-    conn = cur = None
     try:
         #   :HMAC   
+        variant = None
         if BILLPLZ_X_SIGNATURE_KEY:
-            if not verify_billplz_signature(request, BILLPLZ_X_SIGNATURE_KEY):
+            variant = billplz_signature_variant(request, BILLPLZ_X_SIGNATURE_KEY)
+            if variant is None:
                 log.warning("Billplz webhook invalid HMAC signature")
                 return json_response({"error": "Invalid signature"}, 401)
         else:
@@ -1213,90 +1668,116 @@ def webhook_billplz():
             if not (sig and BILLPLZ_X_SIGNATURE_LEGACY and sig == BILLPLZ_X_SIGNATURE_LEGACY):
                 log.warning("Billplz webhook rejected (no key configured and legacy check failed)")
                 return json_response({"error": "Invalid signature (legacy)"}, 401)
+            variant = "legacy"
 
         data = request.form
+        bill_id = (data.get("id") or "").strip()
         paid = str(data.get("paid")).lower() in ("true",)
         username = (data.get("reference_1") or "").strip()
         plan_id = (data.get("reference_2") or "").strip()
-        if not (paid and username):
+        if not (paid and username and bill_id):
             log.warning("Billplz webhook invalid payload: %s", dict(data))
             return json_response({"error": "invalid webhook"}, 400)
 
+        # Billplz retries until it gets a 200; a bill we already applied is acknowledged as-is
+        if _billplz_bill_seen(bill_id):
+            return json_response({"success": True, "duplicate": True})
+
         #       (         )
         days = 30
         # Map plan to days using catalog
         p = resolve_plan(plan_id) if plan_id else None
         if p:
             days = int(p['days'])
+        try:
+            amount_cents = int(data.get("paid_amount") or data.get("amount") or "")
+        except ValueError:
+            amount_cents = None
 
-        conn = get_conn()
-        cur = conn.cursor()
-        ensure_schema(cur)
-        cur.execute("SELECT subscription_expires_at FROM users WHERE username=%s", (username,))
-        r = cur.fetchone()
-        now = datetime.datetime.now(datetime.timezone.utc)
-        current = r[0] if (r and r[0] and r[0] > now) else now
-        new_expiry = current + datetime.timedelta(days=days)
-        cur.execute("UPDATE users SET subscription_expires_at=%s WHERE username=%s", (new_expiry, username))
-        if cur.rowcount == 0:
-            _log_activity(cur, "system", "webhook_user_not_found", {"username": username, "plan": plan_id}, request)
-        else:
-            _log_activity(cur, "system", "webhook_paid", {"username": username, "days": days, "plan": plan_id}, request)
-        conn.commit()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # Dedup gate: only the first delivery of a bill gets a row (and extends the subscription)
+            cur.execute(
+                """
+                INSERT INTO payments (bill_id, username, plan_id, amount_cents, days, signature_variant)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (bill_id) DO NOTHING
+                """,
+                (bill_id, username, plan_id or None, amount_cents, days, variant),
+            )
+            if cur.rowcount == 0:
+                conn.commit()
+                cur.close()
+                _billplz_mark_seen(bill_id)
+                log.info("Billplz webhook duplicate for bill %s", bill_id)
+                return json_response({"success": True, "duplicate": True})
+
+            # Row lock so two different bills for one user extend one after the other
+            cur.execute("SELECT subscription_expires_at FROM users WHERE username=%s FOR UPDATE", (username,))
+            r = cur.fetchone()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            current = r[0] if (r and r[0] and r[0] > now) else now
+            new_expiry = current + datetime.timedelta(days=days)
+            cur.execute("UPDATE users SET subscription_expires_at=%s WHERE username=%s", (new_expiry, username))
+            if cur.rowcount == 0:
+                _log_activity(cur, "system", "webhook_user_not_found", {"username": username, "plan": plan_id, "bill_id": bill_id}, request, sync=True)
+            else:
+                cur.execute("UPDATE payments SET expires_at=%s WHERE bill_id=%s", (new_expiry, bill_id))
+                entitlements.notify(cur, username)
+                _log_activity(cur, "system", "webhook_paid", {"username": username, "days": days, "plan": plan_id, "bill_id": bill_id}, request, sync=True)
+            conn.commit()
+            cur.close()
+        _billplz_mark_seen(bill_id)
+        entitlements.cache.invalidate(username)
         return json_response({"success": True})
     except Exception as e:
         log.exception("webhook_billplz error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        try:
-            if cur:
-                cur.close()
-        except Exception:
-            pass
 
 # ----------------------------------------------------------------------------
 # V1 - Multi-Agent Script Generation Workflow
 # ----------------------------------------------------------------------------
 @app.route("/v1/projects", methods=["POST", "OPTIONS"])
-
+@auth.require_auth
 def create_project():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     username = payload.get("username")
 
     user_input = request.get_json(silent=True)
     if not user_input or "project_title" not in user_input or "video_length_sec" not in user_input:
         return json_response({"error": "Missing required fields: project_title, video_length_sec"}, 400)
 
-    conn = None
     try:
-        conn = get_conn()
-        project_id, creative_options = services.create_project_and_generate_creatives(
-            db_conn=conn,
-            user_id=username,
-            user_input=user_input
-        )
+        # Generate first: no pooled connection is held while Gemini runs
+        opts, prompt_version = services.generate_creative_options(user_input)
+        with db_connection() as conn:
+            project_id, creative_options = services.persist_project_and_creatives(
+                db_conn=conn,
+                user_id=username,
+                user_input=user_input,
+                opts=opts,
+                prompt_version=prompt_version,
+            )
+        services.speculate_storyboards(project_id, creative_options)
         return json_response({"project_id": project_id, "creative_options": creative_options}, 201)
     except ImportError as e:
         log.warning("AI unavailable in /v1/projects: %s", e)
         return json_response({"error": "AI unavailable", "detail": str(e)}, 503)
+    except llm_engine.DeadlineExceeded as e:
+        log.warning("LLM deadline exceeded in /v1/projects: %s", e)
+        return json_response({"error": "AI timed out", "detail": str(e)}, 504)
     except (ValidationError, json.JSONDecodeError) as e:
         log.warning(f"Validation Error from Gemini: {e}")
         return json_response({"error": "AI response validation failed", "detail": str(e)}, 502)
     except Exception as e:
         log.exception("create_project error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        put_conn(conn)
 
 # ★ 新增：Dashboard 用的「最近项目列表」
 @app.route("/v1/projects", methods=["GET", "OPTIONS"])
-
+@auth.require_auth
 def list_projects():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     username = payload.get("username")
     recent = request.args.get("recent", default=6, type=int)
 
@@ -1304,7 +1785,6 @@ def list_projects():
     try:
         conn = get_conn()
         cur = conn.cursor()
-        ensure_schema(cur)
         cur.execute("""
             SELECT id, project_title, video_length_sec, created_at
             FROM projects
@@ -1332,44 +1812,50 @@ def list_projects():
         put_conn(conn)
 
 @app.route("/v1/projects/<uuid:project_id>/select-creative", methods=["POST", "OPTIONS"])
-
+@auth.require_auth
 def select_creative(project_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
 
     data = request.get_json(silent=True) or {}
     creative_id = data.get("creative_id")
     if not creative_id:
         return json_response({"error": "creative_id is required"}, 400)
 
-    conn = None
     try:
-        conn = get_conn()
-        storyboard, qa_critique = services.select_creative_and_generate_storyboard(
-            db_conn=conn,
-            project_id=str(project_id),
-            selected_creative_id=creative_id
-        )
-        return json_response({"storyboard": storyboard, "qa_critique": qa_critique})
+        with db_connection() as conn:
+            creative = services.load_creative(conn, str(project_id), creative_id)
+            if _wants_async(data):
+                job_id = jobs.enqueue(conn, "storyboard", {"creative_id": creative["id"]},
+                                      project_id=str(project_id), user_id=payload.get("username"))
+                return _job_accepted(job_id)
+        storyboard, prompt_version = services.generate_storyboard(str(project_id), creative)
+        # The critic scores while the storyboard is written; its verdict lands on the row when it returns
+        review = qa_critic.critic.start(storyboard, creative)
+        with db_connection() as conn:
+            storyboard_id = services.persist_storyboard(conn, str(project_id), creative_id, storyboard, review=review,
+                                                        prompt_version=prompt_version)
+        review.write_back(storyboard_id)
+        return json_response({"storyboard": storyboard, "qa_critique": review.persisted["qa_feedback"],
+                              "qa": review.summary(wait=_wants_qa(data))})
     except ImportError as e:
         log.warning("AI unavailable in select-creative: %s", e)
         return json_response({"error": "AI unavailable", "detail": str(e)}, 503)
+    except llm_engine.DeadlineExceeded as e:
+        log.warning("LLM deadline exceeded in select-creative for project %s: %s", project_id, e)
+        return json_response({"error": "AI timed out", "detail": str(e)}, 504)
     except (ValidationError, json.JSONDecodeError) as e:
         log.warning(f"Validation Error from Gemini for project {project_id}: {e}")
         return json_response({"error": "AI response validation failed", "detail": str(e)}, 502)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 404)
     except Exception as e:
         log.exception(f"select_creative error for project {project_id}")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        put_conn(conn)
 
 @app.route("/v1/sessions", methods=["POST", "OPTIONS"])
-
+@auth.require_auth
 def create_session_route():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     username = payload.get("username")
 
     data = request.get_json(silent=True) or {}
@@ -1400,12 +1886,8 @@ def create_session_route():
         put_conn(conn)
 
 @app.route("/v1/sessions/<uuid:session_id>/next", methods=["POST", "OPTIONS"])
-
+@auth.require_auth
 def advance_session_route(session_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
-
     data = request.get_json(silent=True) or {}
     user_choice = data.get("choice") or {}
 
@@ -1425,15 +1907,15 @@ def advance_session_route(session_id):
         put_conn(conn)
 
 @app.route("/v1/projects/<uuid:project_id>/finalize", methods=["POST", "OPTIONS"])
-
+@auth.require_auth
 def finalize_project(project_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
 
     conn = None
     try:
         conn = get_conn()
+        if _wants_async():
+            return _job_accepted(jobs.enqueue(conn, "finalize", project_id=str(project_id), user_id=payload.get("username")))
         result = services.release_gate_finalize(
             db_conn=conn,
             project_id=str(project_id)
@@ -1448,48 +1930,156 @@ def finalize_project(project_id):
     finally:
         put_conn(conn)
 
-# Render/Status(  )
-@app.route("/v1/projects/<uuid:project_id>/render", methods=["POST", "OPTIONS"])
+# Render/Status: the render pipeline runs as background jobs; status reports per-job progress
+RENDER_PIPELINE = ("finalize", "export")
 
+@app.route("/v1/projects/<uuid:project_id>/render", methods=["POST", "OPTIONS"])
+@auth.require_auth
 def render_project(project_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
-    return json_response({"success": True, "total": 0})
+    payload = g.jwt
+    username = payload.get("username")
+    try:
+        with db_connection() as conn:
+            job_ids = [jobs.enqueue(conn, kind, project_id=str(project_id), user_id=username)
+                       for kind in RENDER_PIPELINE]
+        return json_response({"success": True, "total": len(job_ids), "jobs": job_ids}, 202)
+    except Exception as e:
+        log.exception("render_project error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
 
 @app.route("/v1/projects/<uuid:project_id>/render/status", methods=["GET", "OPTIONS"])
-
+@auth.require_auth
 def render_status(project_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
-    return json_response({"success": True, "items": []})
-
-#   
-@app.route("/v1/projects/<uuid:project_id>/export", methods=["GET", "OPTIONS"])
+    payload = g.jwt
+    try:
+        with db_connection() as conn:
+            items = jobs.list_project_jobs(conn, str(project_id), user_id=payload.get("username"))
+        done = sum(1 for j in items if j["status"] in jobs.TERMINAL_STATUSES)
+        progress = int(sum(j["progress"] for j in items) / len(items)) if items else 0
+        return json_response({"success": True, "total": len(items), "done": done, "progress": progress, "items": items})
+    except Exception as e:
+        log.exception("render_status error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
 
-def export_project(project_id):
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+@app.route("/v1/jobs/<uuid:job_id>", methods=["GET", "OPTIONS"])
+@auth.require_auth
+def job_status(job_id):
+    payload = g.jwt
+    try:
+        with db_connection() as conn:
+            job = jobs.get_job(conn, str(job_id), user_id=payload.get("username"))
+        if not job:
+            return json_response({"error": "Job not found"}, 404)
+        if job["has_artifact"]:
+            job["artifact_url"] = f"/v1/jobs/{job_id}/artifact"
+        return json_response(job)
+    except Exception as e:
+        log.exception("job_status error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
 
-    conn = None
+@app.route("/v1/jobs/<uuid:job_id>/artifact", methods=["GET", "OPTIONS"])
+@auth.require_auth
+def job_artifact(job_id):
+    payload = g.jwt
     try:
-        conn = get_conn()
-        zip_bytes = services.build_export_zip(conn, str(project_id))
+        with db_connection() as conn:
+            job = jobs.get_job(conn, str(job_id), user_id=payload.get("username"))
+            data = jobs.get_artifact(conn, str(job_id), user_id=payload.get("username")) if job else None
+        if data is None:
+            return json_response({"error": "Artifact not available"}, 404)
+        filename = (job.get("result") or {}).get("filename") or f"pf-package-{job['project_id']}.zip"
         headers = {
             "Content-Type": "application/zip",
-            "Content-Disposition": f'attachment; filename="pf-package-{project_id}.zip"',
+            "Content-Disposition": f'attachment; filename="{filename}"',
             "Cache-Control": "no-store",
         }
-        return Response(zip_bytes, status=200, headers=headers)
+        return Response(data, status=200, headers=headers)
+    except Exception as e:
+        log.exception("job_artifact error")
+        return json_response({"error": "Internal error", "detail": str(e)}, 500)
+
+def _zip_download(stream: "zipstream.ZipStream", filename: str, body=None):
+    """
+    Stream a ZipStream as a download: 304 on a matching If-None-Match, 206 for a single byte
+    range (resume; honours If-Range), otherwise 200 with the archive generated as it is sent
+    (`body`, when given, is the chunk iterator to send instead, e.g. an export_store tee).
+    """
+    headers = {
+        "Content-Type": "application/zip",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "private, no-cache",
+        "ETag": f'"{stream.etag}"',
+        "Accept-Ranges": "bytes",
+    }
+    if request.if_none_match.contains(stream.etag):
+        return Response(status=304, headers=headers)
+
+    rng = request.range
+    if_range = request.if_range  # no Last-Modified here, so only an ETag If-Range can match
+    if rng is not None and (if_range.etag is None and if_range.date is None or if_range.etag == stream.etag):
+        total = stream.size()
+        bounds = rng.range_for_length(total) if len(rng.ranges) == 1 else None
+        if bounds is None:
+            headers["Content-Range"] = f"bytes */{total}"
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total}"
+        headers["Content-Length"] = str(stop - start)
+        return Response(stream.iter_range(start, stop), status=206, headers=headers, direct_passthrough=True)
+
+    total = zipstream.known_size(stream.etag)
+    if total is not None:
+        headers["Content-Length"] = str(total)
+    return Response(body or stream.chunks(), status=200, headers=headers, direct_passthrough=True)
+
+@app.route("/exports/<path:key>", methods=["GET"])
+def export_download(key):
+    # Local export store only (EXPORT_STORE=local); the signed query string is the authorization
+    store = export_store.store()
+    if not isinstance(store, export_store.LocalStore):
+        return json_response({"error": "Not found"}, 404)
+    filename = request.args.get("name") or "export.zip"
+    if not store.verify(key, request.args.get("exp"), filename, request.args.get("sig")):
+        return json_response({"error": "Invalid or expired link"}, 403)
+    path = store.path(key)
+    if not path or not os.path.isfile(path):
+        return json_response({"error": "Not found"}, 404)
+    # conditional=True: ETag / Range / 304 handled by Werkzeug; immutable because keys are content hashes
+    resp = send_file(path, mimetype="application/zip", as_attachment=True, download_name=filename,
+                     conditional=True, max_age=31536000)
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
+
+#   
+@app.route("/v1/projects/<uuid:project_id>/export", methods=["GET", "OPTIONS"])
+@auth.require_auth
+def export_project(project_id):
+    payload = g.jwt
+    try:
+        # The connection is only held to read the project; the archive streams after it is returned
+        with db_connection() as conn:
+            if _wants_async():
+                return _job_accepted(jobs.enqueue(conn, "export", project_id=str(project_id), user_id=payload.get("username")))
+            stream = services.build_export_stream(conn, str(project_id))
+            conn.commit()
+        filename = f"pf-package-{project_id}.zip"
+        store = export_store.store()
+        if store is None:
+            return _zip_download(stream, filename)
+        key = export_store.key_for(str(project_id), stream.etag)
+        if store.exists(key):
+            # Already built for this storyboard: the bytes come from storage, not from this worker
+            resp = redirect(store.url(key, filename), 302)
+            resp.headers["Cache-Control"] = "no-store"
+            return resp
+        if request.range is not None:
+            return _zip_download(stream, filename)
+        return _zip_download(stream, filename, store.tee(key, filename, stream.chunks()))
     except ValueError as ve:
         return json_response({"error": str(ve)}, 404)
     except Exception as e:
         log.exception("export_project error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        put_conn(conn)
 
 # ----------------------------------------------------------------------------
 # Main execution
@@ -1513,48 +2103,25 @@ def v1_plans():
 
 
 # ===== Appendix Library Loader =====
-_APPENDIX_CACHE = None
+# appendix.py keeps a versioned snapshot (serialized body, ETag, indexes), reloaded on file
+# change or SIGHUP; this returns its data dict (treat it as read-only)
+DIRECTOR_LIBRARY_MAX_AGE_SEC = int(os.getenv("DIRECTOR_LIBRARY_MAX_AGE_SEC", "60"))
+appendix.install_sighup()
 
 def _load_appendix_library():
-    """Load appendix_library.json once and cache it. Fallback to defaults if missing."""
-    global _APPENDIX_CACHE
-    if _APPENDIX_CACHE is not None:
-        return _APPENDIX_CACHE
-    import os, json
-    search_paths = [
-        os.path.join(os.getcwd(), "appendix_library.json"),
-        os.path.join(os.path.dirname(__file__), "appendix_library.json"),
-        "/workspace/appendix_library.json",
-    ]
-    for pth in search_paths:
-        if os.path.exists(pth):
-            with open(pth, "r", encoding="utf-8") as f:
-                _APPENDIX_CACHE = json.load(f)
-                break
-    if _APPENDIX_CACHE is None:
-        _APPENDIX_CACHE = {
-            "goals": [{"id":"awareness","label":"Brand awareness"},{"id":"conversions","label":"Drive conversions"}],
-            "tones": ["playful","energetic"],
-            "styles": ["cinematic","ugc"],
-            "platforms": [{"id":"tiktok","label":"TikTok","durations_sec":[15,30,60],"aspect_ratio":"9:16"}],
-            "comedy_substyles": ["slapstick","situational"],
-            "camera_moves": ["push-in","dolly"],
-            "narrative_templates": [{"id":"hook-build-payoff","label":"Hook → Build → Payoff","beats":[{"name":"Hook"},{"name":"Build"},{"name":"Payoff"}]}],
-            "veo_blueprint_rules": {"text_free": True, "language": "English", "negative_prompt": ["no on-screen text"]}
-        }
-    return _APPENDIX_CACHE
+    return appendix.current().data
 
 
 
 
 
 def _next_prompt_v2(slots: Dict[str, Any]) -> Dict[str, Any]:
-    lib = _load_appendix_library()
+    lib = appendix.current()
     if not slots.get("goal"):
         return {
             "step_label": "Step 1: Goal (1/8)",
             "assistant_message": "What is your goal for this video?",
-            "options": [g["label"] for g in lib.get("goals", [])] or ["Brand awareness","Drive conversions","Event promo","App installs"],
+            "options": list(lib.goal_labels) or ["Brand awareness","Drive conversions","Event promo","App installs"],
             "directors_recommendation": "Pick one goal only to keep the edit tight. For 'viral', choose Brand awareness.",
         }
     if not slots.get("audience"):
@@ -1565,16 +2132,11 @@ def _next_prompt_v2(slots: Dict[str, Any]) -> Dict[str, Any]:
             "directors_recommendation": "Name one concrete group (age + interest + location).",
         }
     if not slots.get("platform") or not slots.get("duration_sec"):
-        durs = []
-        plat_opts = []
-        for p in lib.get("platforms", []):
-            plat_opts.append(p["label"])
-            durs.extend(p.get("durations_sec", []))
-        durs = sorted(set(durs))[:6] or [15,30,45,60]
+        durs = list(lib.durations[:6]) or [15,30,45,60]
         return {
             "step_label": "Step 3: Platform & Duration (3/8)",
             "assistant_message": "Which platform and duration do you want?",
-            "options": [f"{plat} · {d}s" for plat in plat_opts for d in durs][:12],
+            "options": [f"{plat} · {d}s" for plat in lib.platform_labels for d in durs][:12],
             "directors_recommendation": "For fast comedy on TikTok, 20–40s works well.",
         }
     if not slots.get("key_message"):
@@ -1595,7 +2157,7 @@ def _next_prompt_v2(slots: Dict[str, Any]) -> Dict[str, Any]:
         return {
             "step_label": "Step 6: Tone & Style (6/8)",
             "assistant_message": "Any preferred tone and style?",
-            "options": [f"Tone: {t}" for t in lib.get("tones", [])] + [f"Style: {s}" for s in lib.get("styles", [])],
+            "options": [f"Tone: {t}" for t in lib.tones] + [f"Style: {s}" for s in lib.styles],
             "directors_recommendation": "For comedy UGC on TikTok, try Tone: playful + Style: UGC.",
         }
     if not slots.get("assets"):
@@ -1629,22 +2191,27 @@ def director_library():
     if request.method == "OPTIONS":
         return ("", 204)
     try:
-        return json_response(_load_appendix_library())
+        lib = appendix.current()
     except Exception as e:
         return json_response({"error":"Failed to load library","detail":str(e)}, 500)
+    headers = {
+        "ETag": f'"{lib.etag}"',
+        "Cache-Control": f"public, max-age={DIRECTOR_LIBRARY_MAX_AGE_SEC}, must-revalidate",
+        "X-Library-Version": lib.version,
+    }
+    if request.if_none_match.contains(lib.etag):
+        return Response(status=304, headers=headers)
+    return Response(lib.body, status=200, headers=headers, mimetype="application/json")
 
 
 
 
 
 @app.route("/v1/director/blueprint", methods=["POST","OPTIONS"])
-
+@auth.require_auth
 def director_blueprint():
     if request.method == "OPTIONS":
         return ("", 204)
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
     body = request.get_json(silent=True) or {}
     raw_session_id = (body.get("session_id") or "").strip()
     if not raw_session_id:
@@ -1656,35 +2223,8 @@ def director_blueprint():
         sess = _director_get_session(conn, session_id)
         if not sess:
             return json_response({"error":"Session not found"}, 404)
-        slots = sess["selections"] or {}
-        lib = _load_appendix_library()
-        goal = slots.get("goal") or "Brand awareness"
-        platform = slots.get("platform") or "tiktok"
-        try:
-            duration = int(slots.get("duration_sec") or 30)
-        except Exception:
-            duration = 30
-        tone = slots.get("tone") or "playful"
-        style = slots.get("style") or "ugc"
-        key_msg = slots.get("key_message") or "Strong hook in first 2s"
-        cta = slots.get("cta") or "DM us"
-        rules = lib.get("veo_blueprint_rules", {})
-        beats = lib.get("narrative_templates",[{}])[0].get("beats", [{"name":"Hook"},{"name":"Build"},{"name":"Payoff"}])
-        total = max(duration, 15)
-        hook_sec = max(int(total*0.2), 3)
-        payoff_sec = max(int(total*0.2), 3)
-        build_sec = max(total - hook_sec - payoff_sec, 6)
-        blueprint = {
-            "meta": {"platform": platform, "duration_sec": total, "tone": tone, "style": style, "text_free": bool(rules.get("text_free", True))},
-            "overview": f"Goal: {goal}. Key message: {key_msg}. CTA: {cta}. Text-free policy enforced.",
-            "beats": [
-                {"name": beats[0].get("name","Hook"), "secs": hook_sec, "direction": "Grab attention visually in 2s; no on-screen text."},
-                {"name": beats[1].get("name","Build"), "secs": build_sec, "direction": "Escalate the premise; include product claim or gag."},
-                {"name": beats[2].get("name","Payoff"), "secs": payoff_sec, "direction": f"Punchline + CTA ('{cta}')."},
-            ],
-            "negative_prompt": rules.get("negative_prompt", []),
-        }
-        return json_response({"blueprint": blueprint})
+        bp = blueprint.build(sess["selections"] or {}, _load_appendix_library(), body.get("template_id"))
+        return json_response({"blueprint": bp.to_dict()})
     except Exception as e:
         log.exception("director_blueprint error")
         return json_response({"error":"Internal error","detail":str(e)}, 500)
@@ -1700,12 +2240,10 @@ def director_blueprint():
 
 
 
+@auth.require_auth
 def director_session_get():
     if request.method == "OPTIONS":
         return ("", 204)
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
     session_id = request.args.get("session_id","").strip()
     if not session_id:
         return json_response({"error":"Missing session_id"}, 400)
@@ -1728,13 +2266,11 @@ def director_session_get():
 
 
 @app.route("/v1/director/reset", methods=["POST","OPTIONS"])
-
+@auth.require_auth
 def director_session_reset():
     if request.method == "OPTIONS":
         return ("", 204)
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     body = request.get_json(silent=True) or {}
     sid = (body.get("session_id") or "").strip()
     conn = None
@@ -1743,10 +2279,10 @@ def director_session_reset():
         if sid:
             cur = conn.cursor()
             cur.execute("UPDATE sessions SET archived=TRUE WHERE id=%s", (_canon_session_uuid(sid),))
-            conn.commit()
             cur.close()
         username = (payload.get("username") or payload.get("user_id") or "guest")
         new_sess = _director_create_session(conn, None, user_id=username)
+        conn.commit()
         return json_response({"session_id": new_sess["id"]})
     except Exception as e:
         log.exception("director_session_reset error")
@@ -1762,116 +2298,104 @@ if __name__ == '__main__':
 # Director endpoints (non-breaking addition; front-end uses /v1/director/*)
 # ----------------------------------------------------------------------------
 
-@app.route("/v1/director/chat", methods=["POST", "OPTIONS"])
-
-
-def director_chat():
-    if request.method == "OPTIONS":
-        return ("", 204)
-
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
-
-    body = request.get_json(silent=True) or {}
-    raw_session_id = (body.get("session_id") or "").strip()
-    user_text = (body.get("user_text") or "").strip()
-
-    conn = None
-    try:
-        conn = get_conn()
-        _ensure_director_tables(conn)
-        cur = conn.cursor()
-        ensure_schema(cur)
-        cur.close()
-
-        username = (payload.get("username") or payload.get("user_id") or "guest")
-        sess = _director_get_or_create_active_session(conn, user_id=username, session_id=_canon_session_uuid(raw_session_id) if raw_session_id else None)
-        session_id = sess["id"]
+def _director_chat_turn(conn, username: str, raw_session_id: str, user_text: str) -> Dict[str, Any]:
+    """One chat turn: resolve session, parse slots, build the reply; persisted as one unit of work."""
+    # One transaction per turn: 1 read, then all writes flushed in one round-trip + COMMIT
+    with db.UnitOfWork(conn) as uow:
+        sess = _director_resolve_session(conn, user_id=username, session_id=_canon_session_uuid(raw_session_id) if raw_session_id else None)
+        session_id = str(sess["id"])
 
         if user_text:
-            _director_append_message(conn, session_id, "user", user_text)
+            _director_queue_message(uow, session_id, "user", user_text)
 
         slots = dict((sess.get("selections") or {}))
 
         parsed = _parse_slots_from_text(user_text, slots) if user_text else {}
         if parsed:
             slots.update(parsed)
+        _director_upsert_session(uow, session_id, username, slots)
 
         lowered = user_text.lower()
         if lowered in ("blueprint", "generate blueprint") or "generate the blueprint" in lowered:
-            lib = _load_appendix_library()
-            goal = slots.get("goal") or "Brand awareness"
-            platform = slots.get("platform") or "tiktok"
-            try:
-                duration = int(slots.get("duration_sec") or 30)
-            except Exception:
-                duration = 30
-            tone = slots.get("tone") or "playful"
-            style = slots.get("style") or "ugc"
-            key_msg = slots.get("key_message") or "Strong hook in first 2s"
-            cta = slots.get("cta") or "DM us"
-            rules = lib.get("veo_blueprint_rules", {})
-            beats = lib.get("narrative_templates",[{}])[0].get("beats", [{"name":"Hook"},{"name":"Build"},{"name":"Payoff"}])
-            total = max(duration, 15)
-            hook_sec = max(int(total*0.2), 3)
-            payoff_sec = max(int(total*0.2), 3)
-            build_sec = max(total - hook_sec - payoff_sec, 6)
-            blueprint = {
-                "meta": {"platform": platform, "duration_sec": total, "tone": tone, "style": style, "text_free": bool(rules.get("text_free", True))},
-                "overview": f"Goal: {goal}. Key message: {key_msg}. CTA: {cta}. Text-free policy enforced.",
-                "beats": [
-                    {"name": beats[0].get("name","Hook"), "secs": hook_sec, "direction": "Grab attention visually in 2s; no on-screen text."},
-                    {"name": beats[1].get("name","Build"), "secs": build_sec, "direction": "Escalate the premise; include product claim or gag."},
-                    {"name": beats[2].get("name","Payoff"), "secs": payoff_sec, "direction": f"Punchline + CTA ('{cta}')."},
-                ],
-                "negative_prompt": rules.get("negative_prompt", []),
-            }
-            _director_update_session(conn, session_id, {"selections": slots})
+            bp = blueprint.build(slots, _load_appendix_library())
             assistant_message = "Blueprint generated from your current brief."
-            _director_append_message(conn, session_id, "assistant", assistant_message)
-            return json_response({
+            _director_queue_message(uow, session_id, "assistant", assistant_message)
+            result = {
                 "session_id": session_id,
                 "assistant_message": assistant_message,
-                "blueprint": blueprint
-            })
+                "blueprint": bp.to_dict()
+            }
+        else:
+            prompt = _next_prompt_v2(slots)
+
+            confirmations = []
+            for k in ["goal","platform","duration_sec","tone","style","audience","key_message","cta"]:
+                if k in parsed:
+                    val = parsed[k]
+                    confirmations.append(f"{k.replace('_',' ').title()} = {val if not isinstance(val, dict) else json.dumps(val)}")
+            confirm_line = f"Noted. {'; '.join(confirmations)}" if confirmations else ""
+
+            assistant_message = prompt.get("assistant_message") or "Let's continue."
+            if confirm_line:
+                assistant_message = f"{confirm_line}\n\n{assistant_message}"
+
+            _director_queue_message(uow, session_id, "assistant", assistant_message)
+            result = {
+                "session_id": session_id,
+                "assistant_message": assistant_message,
+                "step_label": prompt.get("step_label"),
+                "options": prompt.get("options", []),
+                "directors_recommendation": prompt.get("directors_recommendation"),
+                "selections": slots,
+            }
 
-        _director_update_session(conn, session_id, {"selections": slots})
+    return result
 
-        prompt = _next_prompt_v2(slots)
+@app.route("/v1/director/chat", methods=["POST", "OPTIONS"])
 
-        confirmations = []
-        for k in ["goal","platform","duration_sec","tone","style","audience","key_message","cta"]:
-            if k in parsed:
-                val = parsed[k]
-                confirmations.append(f"{k.replace('_',' ').title()} = {val if not isinstance(val, dict) else json.dumps(val)}")
-        confirm_line = f"Noted. {'; '.join(confirmations)}" if confirmations else ""
 
-        assistant_message = prompt.get("assistant_message") or "Let's continue."
-        if confirm_line:
-            assistant_message = f"{confirm_line}\n\n{assistant_message}"
+@auth.require_auth
+def director_chat():
+    if request.method == "OPTIONS":
+        return ("", 204)
 
-        _director_append_message(conn, session_id, "assistant", assistant_message)
+    payload = g.jwt
 
-        return json_response({
-            "session_id": session_id,
-            "assistant_message": assistant_message,
-            "step_label": prompt.get("step_label"),
-            "options": prompt.get("options", []),
-            "directors_recommendation": prompt.get("directors_recommendation"),
-            "selections": slots,
-        })
+    body = request.get_json(silent=True) or {}
+    raw_session_id = (body.get("session_id") or "").strip()
+    user_text = (body.get("user_text") or "").strip()
+    username = (payload.get("username") or payload.get("user_id") or "guest")
+
+    fmt = streaming.negotiate(request.args, request.headers.get("Accept"))
+    if fmt:
+        started = time.perf_counter()
+
+        def events():
+            yield "open", {"session_id": raw_session_id or None}
+            try:
+                with db_connection() as conn:
+                    result = _director_chat_turn(conn, username, raw_session_id, user_text)
+                yield "message", {"session_id": result["session_id"], "text": result["assistant_message"]}
+                yield "done", result
+            except Exception as e:
+                log.exception("director_chat stream error")
+                yield "error", {"error": "Internal error", "detail": str(e)}
+
+        return _stream_response(fmt, "director_chat", events(), started)
 
+    conn = None
+    try:
+        conn = get_conn()
+        return json_response(_director_chat_turn(conn, username, raw_session_id, user_text))
     except Exception as e:
         log.exception("director_chat error")
         return json_response({"error":"Internal error","detail":str(e)}, 500)
     finally:
         put_conn(conn)
 
+@auth.require_auth
 def director_commit_brief():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     username = (payload.get("username") or payload.get("user_id") or "guest")  # ★
 
     body = request.get_json(silent=True) or {}
@@ -1881,14 +2405,10 @@ def director_commit_brief():
         return json_response({"error": "Missing session_id"}, 400)
     session_id = _canon_session_uuid(raw_session_id)  # ★
 
-    conn = None
     try:
-        conn = get_conn()
-        sess = _director_get_session(conn, session_id)
-        if not sess:
-            _director_create_session(conn, session_id, username)
+        with db_connection() as conn:
             sess = _director_get_session(conn, session_id)
-        merged = sess["selections"].copy()
+        merged = (sess["selections"] if sess else {}).copy()
         merged.update(slots)
 
         if not _slots_ready(merged):
@@ -1901,29 +2421,76 @@ def director_commit_brief():
             "video_length_sec": video_length_sec,
             "brief": merged,
         }
-        conn.autocommit = False
-        pid, creative_options = services.create_project_and_generate_creatives(
-            db_conn=conn, user_id=username, user_input=user_input
-        )
-        _director_update_session(conn, session_id, selections_delta=merged, state="G9", step=10, project_id=pid)
+        opts, prompt_version = services.generate_creative_options(user_input)
+
+        with db_connection() as conn:
+            pid, creative_options = services.persist_project_and_creatives(
+                db_conn=conn, user_id=username, user_input=user_input, opts=opts, prompt_version=prompt_version
+            )
+            if not sess:
+                _director_create_session(conn, session_id, username)
+            _director_update_session(conn, session_id, selections_delta=merged, state="G9", step=10, project_id=pid)
+            conn.commit()
+        services.speculate_storyboards(pid, creative_options)
         flags = _ready_flags(merged, pid)
-        conn.commit()
         return json_response({"project_id": pid, "creative_options": creative_options, "next_state": "G9", "ready_flags": flags})
+    except llm_engine.DeadlineExceeded as e:
+        log.warning("LLM deadline exceeded in director_commit_brief: %s", e)
+        return json_response({"error": "AI timed out", "detail": str(e)}, 504)
     except Exception as e:
         log.exception("director_commit_brief error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        put_conn(conn)
 
 
-@app.route("/v1/director/storyboard", methods=["POST", "OPTIONS"])
+def _director_storyboard_events(project_id: str, creative_id: str, creative: Dict[str, Any],
+                                session_id: Optional[str], with_tokens: bool = True, wait_qa: bool = False):
+    """Event stream for /v1/director/storyboard: open → token* / scene* → done (persisted ids) | error."""
+    yield "open", {"project_id": project_id, "creative_id": creative_id, "session_id": session_id}
+    try:
+        storyboard = prompt_version = None
+        for event, data in services.stream_storyboard(project_id, creative):
+            if event == "storyboard":
+                storyboard = data
+            elif event == "prompt_version":
+                prompt_version = data
+            elif event != "token" or with_tokens:
+                yield event, data
+        review = qa_critic.critic.start(storyboard, creative)
+        with db_connection() as conn:
+            storyboard_id = services.persist_storyboard(conn, project_id, creative_id, storyboard, review=review,
+                                                        prompt_version=prompt_version)
+            if session_id:
+                try:
+                    _director_update_session(conn, session_id, state="G11", step=12, project_id=project_id)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+        review.write_back(storyboard_id)
+        yield "done", {
+            "project_id": project_id,
+            "creative_id": creative_id,
+            "storyboard_id": storyboard_id,
+            "session_id": session_id,
+            "qa_feedback": review.persisted["qa_feedback"],
+            "qa": review.summary(wait=wait_qa),
+            "veo3_prompt": json.dumps({"scenes": storyboard.get("scenes") or []}, ensure_ascii=False),
+            "storyboard": storyboard,
+        }
+    except llm_engine.DeadlineExceeded as e:
+        log.warning("LLM deadline exceeded in director_storyboard stream: %s", e)
+        yield "error", {"error": "AI timed out", "detail": str(e)}
+    except ImportError as e:
+        yield "error", {"error": "AI unavailable", "detail": str(e)}
+    except Exception as e:
+        log.exception("director_storyboard stream error")
+        yield "error", {"error": "Internal error", "detail": str(e)}
 
+@app.route("/v1/director/storyboard", methods=["POST", "OPTIONS"])
+@auth.require_auth
 def director_storyboard():
     if request.method == "OPTIONS":
         return ("", 204)
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
+    payload = g.jwt
     username = (payload.get("username") or payload.get("user_id") or "guest")
 
     data = request.get_json(silent=True) or {}
@@ -1936,66 +2503,78 @@ def director_storyboard():
         return json_response({"error": "Missing project_id"}, 400)
 
     session_id = _canon_session_uuid(raw_session_id) if raw_session_id else None
+    fmt = streaming.negotiate(request.args, request.headers.get("Accept"))
+    started = time.perf_counter()
 
-    conn = None
     try:
-        conn = get_conn()
-        _ensure_director_tables(conn)
-
-        # 如果没给 creative_id，就用 index → id 的映射（默认 0）
-        if not selected_creative_id:
-            if selected_option_index is None:
-                selected_option_index = 0
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT id FROM creative_options
-                WHERE project_id=%s AND option_index=%s
-                ORDER BY created_at ASC
-                LIMIT 1
-            """, (project_id, int(selected_option_index)))
-            r = cur.fetchone()
-            cur.close()
-            if not r:
-                return json_response({"error": "Selected creative option not found for this project"}, 404)
-            selected_creative_id = str(r[0])
-
-        # 按 services 的签名调用： (db_conn, project_id, selected_creative_id)
-        storyboard_json, qa_feedback = services.select_creative_and_generate_storyboard(
-            db_conn=conn,
-            project_id=project_id,
-            selected_creative_id=selected_creative_id
-        )
-
-        # 可选：更新会话状态
-        if session_id:
-            try:
-                _director_update_session(conn, session_id, state="G11", step=12, project_id=project_id)
-            except Exception:
-                pass
-
-        # 统一返回：直接把 VEO-3 Prompt 放在 veo3_prompt 字段
-        # 如果 services 已经把 scenes 存到 storyboards，我们再读一次以构造稳定的 VEO-3 JSON
-        cur = conn.cursor()
-        cur.execute("SELECT scenes FROM storyboards WHERE project_id=%s ORDER BY created_at DESC LIMIT 1", (project_id,))
-        r = cur.fetchone()
-        cur.close()
-        if not r:
-            return json_response({"error":"Storyboard not found after generation"}, 500)
-        scenes_obj = r[0]
-        scenes = scenes_obj.get("scenes") if isinstance(scenes_obj, dict) else scenes_obj
-        prompt_json = {"scenes": scenes}
+        with db_connection() as conn:
+            # 如果没给 creative_id，就用 index → id 的映射（默认 0）
+            if not selected_creative_id:
+                if selected_option_index is None:
+                    selected_option_index = 0
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT id FROM creative_options
+                    WHERE project_id=%s AND option_index=%s
+                    LIMIT 1
+                """, (db.as_uuid(project_id), int(selected_option_index)))
+                r = cur.fetchone()
+                cur.close()
+                if not r:
+                    return json_response({"error": "Selected creative option not found for this project"}, 404)
+                selected_creative_id = str(r[0])
+            creative = services.load_creative(conn, project_id, selected_creative_id)
+            if _wants_async(data):
+                job_id = jobs.enqueue(conn, "storyboard", {"creative_id": selected_creative_id},
+                                      project_id=project_id, user_id=username)
+                if session_id:
+                    try:
+                        _director_update_session(conn, session_id, state="G11", step=12, project_id=project_id)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                return _job_accepted(job_id)
+
+        if fmt:
+            return _stream_response(fmt, "director_storyboard", _director_storyboard_events(
+                project_id, selected_creative_id, creative, session_id, with_tokens=request.args.get("tokens") != "0",
+                wait_qa=_wants_qa(data),
+            ), started)
+
+        # Gemini runs without holding a pooled connection
+        storyboard_json, prompt_version = services.generate_storyboard(project_id, creative)
+        review = qa_critic.critic.start(storyboard_json, creative)
+
+        with db_connection() as conn:
+            storyboard_id = services.persist_storyboard(conn, project_id, selected_creative_id, storyboard_json,
+                                                        review=review, prompt_version=prompt_version)
+            # 可选：更新会话状态
+            if session_id:
+                try:
+                    _director_update_session(conn, session_id, state="G11", step=12, project_id=project_id)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+        review.write_back(storyboard_id)
+
+        # 统一返回：直接把 VEO-3 Prompt 放在 veo3_prompt 字段（直接用刚生成的 scenes，无需回读）
+        prompt_json = {"scenes": storyboard_json.get("scenes") or []}
 
         return json_response({
             "veo3_prompt": json.dumps(prompt_json, ensure_ascii=False),
             "storyboard": storyboard_json,
-            "qa_feedback": qa_feedback
+            "qa_feedback": review.persisted["qa_feedback"],
+            "qa": review.summary(wait=_wants_qa(data)),
         }, 200)
 
+    except llm_engine.DeadlineExceeded as e:
+        log.warning("LLM deadline exceeded in director_storyboard: %s", e)
+        return json_response({"error": "AI timed out", "detail": str(e)}, 504)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 404)
     except Exception as e:
         log.exception("director_storyboard error")
         return json_response({"error": "Internal error", "detail": str(e)}, 500)
-    finally:
-        put_conn(conn)
 
 
 @app.route("/v1/director/veo-3-prompt", methods=["GET", "POST", "OPTIONS"])
@@ -2008,12 +2587,8 @@ def director_veo3_prompt_compat():
     return director_veo3_prompt()
 
 @app.route("/v1/director/veo3-prompt", methods=["GET", "POST", "OPTIONS"])
-
+@auth.require_auth
 def director_veo3_prompt():
-    payload = _jwt_decode(request)
-    if not payload:
-        return json_response({"error": "Invalid token"}, 401)
-
     project_id = (request.args.get("project_id") or "").strip()
     if not project_id:
         return json_response({"error": "Missing project_id"}, 400)
@@ -2023,23 +2598,16 @@ def director_veo3_prompt():
         conn = get_conn()
         cur = conn.cursor()
         
-        # Convert project_id to UUID format if it's not already
-        try:
-            # Try to convert to UUID format
-            if not project_id.startswith('proj_'):
-                # If it's already a UUID, use it directly
-                uuid.UUID(project_id)
-                uuid_project_id = project_id
-            else:
-                # If it's in proj_ format, convert to UUID
-                # Use the canonical UUID mapping function
-                uuid_project_id = _canon_session_uuid(project_id)
-        except ValueError:
-            # If conversion fails, use the original project_id
-            uuid_project_id = project_id
-        
-        # fetch storyboard scenes with proper UUID handling
-        cur.execute("SELECT scenes FROM storyboards WHERE project_id::text = %s ORDER BY created_at DESC LIMIT 1", (uuid_project_id,))
+        # Bind a real UUID so the (project_id, created_at) index is used;
+        # legacy "proj_*" ids map through the canonical UUIDv5 helper
+        if project_id.startswith('proj_'):
+            uuid_project_id = db.as_uuid(_canon_session_uuid(project_id))
+        else:
+            uuid_project_id = db.as_uuid(project_id)
+        if uuid_project_id is None:
+            return json_response({"error": "Storyboard not found for project"}, 404)
+
+        cur.execute("SELECT scenes FROM storyboards WHERE project_id = %s ORDER BY created_at DESC LIMIT 1", (uuid_project_id,))
         row = cur.fetchone()
         if not row:
             return json_response({"error": "Storyboard not found for project"}, 404)
@@ -2058,7 +2626,7 @@ def director_veo3_prompt():
 
 
 
-# ===== Conversation Memory (safer schema) =====
+# ===== Conversation Memory (schema lives in migrations.py) =====
 def _sql_table_has_columns(conn, table, cols):
     try:
         cur = conn.cursor()
@@ -2072,65 +2640,8 @@ def _sql_table_has_columns(conn, table, cols):
     except Exception:
         return False
 
-def _ensure_director_tables(conn):
-    cur = conn.cursor()
-    # 1) 会话消息表（新的字段名 speaker/content）
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS director_messages (
-            id BIGSERIAL PRIMARY KEY,
-            session_id UUID NOT NULL,
-            speaker TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP NOT NULL DEFAULT NOW()
-        )
-    """)
-
-    # 2) 尝试把任何遗留的 director_sessions 重命名为 sessions（存在则忽略错误）
-    try:
-        cur.execute("ALTER TABLE director_sessions RENAME TO sessions")
-    except Exception:
-        pass
-
-    # 3) 确保 sessions 表存在（与 ensure_schema 同步）
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            user_id TEXT NOT NULL,
-            state TEXT NOT NULL DEFAULT 'init',
-            selections JSONB NOT NULL DEFAULT '{}'::jsonb,
-            step INT NOT NULL DEFAULT 1,
-            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            updated_at TIMESTAMPTZ DEFAULT NOW()
-        )
-    """)
-
-    # 4) 给 sessions 增加 archived 字段（如果没有）
-    try:
-        cur.execute("ALTER TABLE sessions ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT FALSE")
-    except Exception:
-        pass
-
-    conn.commit()
-    cur.close()
-
-def _director_append_message(conn, session_id, role, text):
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "INSERT INTO director_messages (session_id, speaker, content) VALUES (%s,%s,%s)",
-            (session_id, role, text or "")
-        )
-    except Exception:
-        # Fallback to legacy columns if table is old, quoting reserved names
-        cur.execute(
-            'INSERT INTO director_messages (session_id, "role", "text") VALUES (%s,%s,%s)',
-            (session_id, role, text or "")
-        )
-    conn.commit()
-    cur.close()
-
 def _director_get_recent_messages(conn, session_id, limit=20):
+    session_id = db.as_uuid(session_id)
     cur = conn.cursor()
     try:
         cur.execute("SELECT speaker, content, created_at FROM director_messages WHERE session_id=%s ORDER BY id DESC LIMIT %s", (session_id, limit))
@@ -2141,26 +2652,29 @@ def _director_get_recent_messages(conn, session_id, limit=20):
     cur.close()
     return [{"role": r[0], "text": r[1], "created_at": r[2].isoformat()} for r in rows]
 
-def _director_get_or_create_active_session(conn, user_id, session_id=None):
-    """Reuse 24h active session if none provided; otherwise create/fetch by id."""
+def _director_resolve_session(conn, user_id, session_id=None):
+    """
+    Find the session a chat turn continues: by id when given, else the user's 24h active one.
+    Nothing is inserted here; a new session (fresh id) is created by the turn's upsert on commit.
+    """
     if session_id:
         sess = _director_get_session(conn, session_id)
         if not sess:
-            sess = _director_create_session(conn, session_id, user_id=user_id)
+            sess = {"id": session_id, "user_id": user_id, "selections": {}}
         return sess
     cur = conn.cursor()
     cur.execute("""
         SELECT id, selections, created_at, updated_at, archived
         FROM sessions
-        WHERE user_id = %s AND archived = FALSE AND (NOW() - COALESCE(updated_at, created_at)) <= INTERVAL '24 hours'
-        ORDER BY COALESCE(updated_at, created_at) DESC
+        WHERE user_id = %s AND archived = FALSE AND updated_at >= NOW() - INTERVAL '24 hours'
+        ORDER BY updated_at DESC
         LIMIT 1
     """, (user_id,))
     row = cur.fetchone()
     cur.close()
     if row:
-        return {"id": row[0], "selections": row[1], "created_at": row[2], "updated_at": row[3], "archived": row[4]}
-    return _director_create_session(conn, None, user_id=user_id)
+        return {"id": str(row[0]), "selections": row[1], "created_at": row[2], "updated_at": row[3], "archived": row[4]}
+    return {"id": str(uuid.uuid4()), "user_id": user_id, "selections": {}}
 
 
 
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+migrations.py
+Versioned schema migrations for the PF System API.
+
+- MIGRATIONS is an ordered list of (version, name, [sql, ...]); versions never change once shipped
+- Applied versions are recorded in schema_migrations, so every step runs exactly once per database
+- apply_migrations() holds a transaction-scoped advisory lock, so concurrent runners
+  (gunicorn threads, several Cloud Run instances, the CLI) serialise instead of racing on DDL
+- ensure_migrated() is the startup-once hook used by main.py; after the first successful run
+  in a process it is a single boolean check
+
+CLI:
+    python migrations.py status     # list applied / pending versions
+    python migrations.py upgrade    # apply all pending versions
+"""
+
+from __future__ import annotations
+import os
+import sys
+import logging
+import threading
+from typing import Any, List, Optional, Set, Tuple
+
+log = logging.getLogger("pf.migrations")
+
+# Arbitrary but fixed key for pg_advisory_xact_lock ("PF" + "MIGR")
+ADVISORY_LOCK_KEY = 0x5046_4D49
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+"""
+
+# ---------------------------------------------------------------------------
+# Migration steps (append-only; never edit a shipped version)
+# ---------------------------------------------------------------------------
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "baseline", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            created_at TIMESTAMPTZ,
+            subscription_expires_at TIMESTAMPTZ,
+            active_token TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS activity_logs (
+            id SERIAL PRIMARY KEY,
+            ts TIMESTAMPTZ DEFAULT NOW(),
+            actor TEXT,
+            action TEXT,
+            details JSONB,
+            ip TEXT,
+            user_agent TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS prompt_versions (
+            id SERIAL PRIMARY KEY,
+            is_active BOOLEAN NOT NULL DEFAULT FALSE,
+            prompt_content JSONB NOT NULL
+        )
+        """,
+        # gen_random_uuid(); built in from PG13, the extension may be unavailable to the app role
+        """
+        DO $$ BEGIN
+            CREATE EXTENSION IF NOT EXISTS pgcrypto;
+        EXCEPTION WHEN OTHERS THEN NULL;
+        END $$
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS projects (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            user_id TEXT NOT NULL,
+            project_title TEXT NOT NULL,
+            user_input JSONB NOT NULL,
+            video_length_sec INT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS creative_options (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
+            option_index INT NOT NULL,
+            title TEXT NOT NULL,
+            logline TEXT NOT NULL,
+            why_it_works TEXT NOT NULL,
+            is_selected BOOLEAN DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS storyboards (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
+            creative_option_id UUID REFERENCES creative_options(id) ON DELETE SET NULL,
+            scenes JSONB NOT NULL,
+            qa_status TEXT CHECK (qa_status IN ('passed','failed')) NOT NULL,
+            qa_feedback TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        # Legacy deployments kept director sessions under another name
+        """
+        DO $$ BEGIN
+            IF to_regclass('director_sessions') IS NOT NULL AND to_regclass('sessions') IS NULL THEN
+                ALTER TABLE director_sessions RENAME TO sessions;
+            END IF;
+        END $$
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            user_id TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'init',
+            selections JSONB NOT NULL DEFAULT '{}'::jsonb,
+            step INT NOT NULL DEFAULT 1,
+            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS blueprints (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
+            storyboard_id UUID REFERENCES storyboards(id) ON DELETE CASCADE,
+            scene_number INT NOT NULL,
+            content_json JSONB NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+    ]),
+    (2, "director_conversation_memory", [
+        """
+        CREATE TABLE IF NOT EXISTS director_messages (
+            id BIGSERIAL PRIMARY KEY,
+            session_id UUID NOT NULL,
+            speaker TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+        "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT FALSE",
+    ]),
+    (3, "hot_path_indexes", [
+        "CREATE INDEX IF NOT EXISTS storyboards_project_created_idx ON storyboards (project_id, created_at DESC)",
+        # Also backs ON CONFLICT (project_id, option_index) in services.create_project_and_generate_creatives
+        "CREATE UNIQUE INDEX IF NOT EXISTS creative_options_project_option_idx ON creative_options (project_id, option_index)",
+        "CREATE INDEX IF NOT EXISTS director_messages_session_id_idx ON director_messages (session_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS sessions_user_active_idx ON sessions (user_id, archived, updated_at DESC)",
+        "CREATE INDEX IF NOT EXISTS projects_user_created_idx ON projects (user_id, created_at DESC NULLS LAST)",
+    ]),
+    (4, "job_queue", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            kind TEXT NOT NULL,
+            project_id UUID REFERENCES projects(id) ON DELETE CASCADE,
+            user_id TEXT,
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status TEXT NOT NULL DEFAULT 'queued'
+                CHECK (status IN ('queued','running','succeeded','failed','cancelled')),
+            progress INT NOT NULL DEFAULT 0,
+            message TEXT,
+            result JSONB,
+            artifact BYTEA,
+            error TEXT,
+            attempts INT NOT NULL DEFAULT 0,
+            max_attempts INT NOT NULL DEFAULT 3,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_by TEXT,
+            heartbeat_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        )
+        """,
+        # Claim path: only queued rows are indexed, so the index stays small as jobs pile up
+        "CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_after, created_at) WHERE status = 'queued'",
+        "CREATE INDEX IF NOT EXISTS jobs_running_heartbeat_idx ON jobs (heartbeat_at) WHERE status = 'running'",
+        "CREATE INDEX IF NOT EXISTS jobs_project_created_idx ON jobs (project_id, created_at DESC)",
+    ]),
+    (5, "llm_response_cache", [
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS llm_cache_expires_idx ON llm_cache (expires_at)",
+    ]),
+    (6, "activity_keyset_pagination", [
+        # Keyset pagination compares (ts, id) row values; a NULL ts would drop out of every page
+        "UPDATE activity_logs SET ts = to_timestamp(0) WHERE ts IS NULL",
+        "ALTER TABLE activity_logs ALTER COLUMN ts SET DEFAULT NOW()",
+        "ALTER TABLE activity_logs ALTER COLUMN ts SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS activity_logs_ts_id_idx ON activity_logs (ts, id)",
+        "CREATE INDEX IF NOT EXISTS activity_logs_actor_ts_idx ON activity_logs (actor, ts, id)",
+        "CREATE INDEX IF NOT EXISTS activity_logs_action_ts_idx ON activity_logs (action, ts, id)",
+    ]),
+    (7, "activity_logs_monthly_partitions", [
+        # Rebuild activity_logs as a RANGE (ts) partitioned table with one partition per UTC month
+        # (activity_logs_pYYYYMM, managed by activity_partitions.py) and a DEFAULT catch-all.
+        # The partition key must be part of the primary key, hence PK (id, ts).
+        "ALTER TABLE activity_logs RENAME TO activity_logs_legacy",
+        "ALTER INDEX IF EXISTS activity_logs_pkey RENAME TO activity_logs_legacy_pkey",
+        "DROP INDEX IF EXISTS activity_logs_ts_id_idx",
+        "DROP INDEX IF EXISTS activity_logs_actor_ts_idx",
+        "DROP INDEX IF EXISTS activity_logs_action_ts_idx",
+        "ALTER SEQUENCE activity_logs_id_seq AS BIGINT",
+        """
+        CREATE TABLE activity_logs (
+            id BIGINT NOT NULL DEFAULT nextval('activity_logs_id_seq'),
+            ts TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            actor TEXT,
+            action TEXT,
+            details JSONB,
+            ip TEXT,
+            user_agent TEXT
+        ) PARTITION BY RANGE (ts)
+        """,
+        "CREATE TABLE activity_logs_default PARTITION OF activity_logs DEFAULT",
+        # One partition per month that already holds rows, plus the current and next month
+        """
+        DO $$
+        DECLARE m TIMESTAMP;
+        BEGIN
+            FOR m IN
+                SELECT DISTINCT date_trunc('month', ts AT TIME ZONE 'UTC') FROM activity_logs_legacy
+                UNION
+                SELECT date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => g)
+                FROM generate_series(0, 1) g
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF activity_logs FOR VALUES FROM (%L) TO (%L)',
+                    'activity_logs_p' || to_char(m, 'YYYYMM'),
+                    m AT TIME ZONE 'UTC', (m + INTERVAL '1 month') AT TIME ZONE 'UTC'
+                );
+            END LOOP;
+        END $$
+        """,
+        """
+        INSERT INTO activity_logs (id, ts, actor, action, details, ip, user_agent)
+        SELECT id, ts, actor, action, details, ip, user_agent FROM activity_logs_legacy
+        """,
+        "ALTER SEQUENCE activity_logs_id_seq OWNED BY activity_logs.id",
+        "DROP TABLE activity_logs_legacy",
+        "ALTER TABLE activity_logs ADD PRIMARY KEY (id, ts)",
+        "CREATE INDEX activity_logs_ts_id_idx ON activity_logs (ts, id)",
+        "CREATE INDEX activity_logs_actor_ts_idx ON activity_logs (actor, ts, id)",
+        "CREATE INDEX activity_logs_action_ts_idx ON activity_logs (action, ts, id)",
+        # Event counts per UTC hour / day; /admin/activity/summary reads these instead of raw rows
+        """
+        CREATE TABLE IF NOT EXISTS activity_rollup_hourly (
+            bucket TIMESTAMPTZ NOT NULL,
+            actor TEXT NOT NULL,
+            action TEXT NOT NULL,
+            events BIGINT NOT NULL,
+            PRIMARY KEY (bucket, actor, action)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS activity_rollup_daily (
+            bucket TIMESTAMPTZ NOT NULL,
+            actor TEXT NOT NULL,
+            action TEXT NOT NULL,
+            events BIGINT NOT NULL,
+            PRIMARY KEY (bucket, actor, action)
+        )
+        """,
+    ]),
+    (8, "token_revocation", [
+        # Bumping token_version invalidates every token issued with a lower `ver` claim (auth.py)
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INT NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            revoked_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS revoked_tokens_expires_idx ON revoked_tokens (expires_at)",
+        # active_token was written on every login and never read; stop keeping live tokens at rest
+        "UPDATE users SET active_token = NULL WHERE active_token IS NOT NULL",
+    ]),
+    (9, "payments_ledger", [
+        # One row per Billplz bill; the webhook's INSERT ... ON CONFLICT DO NOTHING is the dedup gate
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            bill_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            plan_id TEXT,
+            amount_cents INT,
+            days INT NOT NULL,
+            signature_variant TEXT,
+            expires_at TIMESTAMPTZ,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS payments_username_idx ON payments (username, received_at DESC)",
+    ]),
+    (10, "prompt_registry", [
+        # Named, versioned prompt templates (prompts.py); legacy rows without a name are left alone
+        "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS name TEXT",
+        "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS version TEXT",
+        "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS created_by TEXT",
+        "ALTER TABLE prompt_versions ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()",
+        "CREATE UNIQUE INDEX IF NOT EXISTS prompt_versions_name_version_uq ON prompt_versions (name, version) WHERE name IS NOT NULL",
+        # At most one active version per template
+        "CREATE UNIQUE INDEX IF NOT EXISTS prompt_versions_active_uq ON prompt_versions (name) WHERE is_active AND name IS NOT NULL",
+        # Template versions that produced the project's creatives / storyboard, e.g. {"creative": "v1.0"}
+        "ALTER TABLE projects ADD COLUMN IF NOT EXISTS prompt_versions JSONB NOT NULL DEFAULT '{}'::jsonb",
+    ]),
+    (11, "storyboard_qa_critic", [
+        # qa_critic.py inserts storyboards as 'pending' and writes the verdict back when it arrives
+        """
+        DO $$ DECLARE c TEXT; BEGIN
+            FOR c IN SELECT conname FROM pg_constraint
+                     WHERE conrelid = 'storyboards'::regclass AND contype = 'c'
+                       AND pg_get_constraintdef(oid) LIKE '%qa_status%' LOOP
+                EXECUTE format('ALTER TABLE storyboards DROP CONSTRAINT %I', c);
+            END LOOP;
+        END $$
+        """,
+        "ALTER TABLE storyboards ADD CONSTRAINT storyboards_qa_status_check CHECK (qa_status IN ('pending','passed','failed'))",
+        "ALTER TABLE storyboards ADD COLUMN IF NOT EXISTS qa_score REAL",
+        "ALTER TABLE storyboards ADD COLUMN IF NOT EXISTS qa_hash TEXT",
+        "ALTER TABLE storyboards ADD COLUMN IF NOT EXISTS qa_reviewed_at TIMESTAMPTZ",
+        # Verdict reuse across instances: an identical storyboard is never scored twice
+        "CREATE INDEX IF NOT EXISTS storyboards_qa_hash_idx ON storyboards (qa_hash) WHERE qa_hash IS NOT NULL",
+    ]),
+]
+
+LATEST_VERSION = max(v for v, _, _ in MIGRATIONS)
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+def applied_versions(cur) -> Set[int]:
+    cur.execute(SCHEMA_MIGRATIONS_DDL)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {int(r[0]) for r in cur.fetchall()}
+
+def apply_migrations(conn, target: Optional[int] = None) -> List[int]:
+    """
+    Apply every pending migration up to `target` (default: latest) in one transaction.
+    Returns the list of versions applied by this call (empty when already up to date).
+    """
+    cur = conn.cursor()
+    try:
+        # Released automatically on COMMIT/ROLLBACK
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ADVISORY_LOCK_KEY,))
+        done = applied_versions(cur)
+        applied: List[int] = []
+        for version, name, statements in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in done or (target is not None and version > target):
+                continue
+            log.info("Applying migration %s (%s)", version, name)
+            for sql in statements:
+                cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name),
+            )
+            applied.append(version)
+        conn.commit()
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+# ---------------------------------------------------------------------------
+# Startup-once hook
+# ---------------------------------------------------------------------------
+_MIGRATED = False
+_MIGRATE_LOCK = threading.Lock()
+
+def is_migrated() -> bool:
+    return _MIGRATED
+
+def ensure_migrated(conn) -> None:
+    """Run pending migrations once per process. Cheap no-op afterwards."""
+    global _MIGRATED
+    if _MIGRATED:
+        return
+    with _MIGRATE_LOCK:
+        if _MIGRATED:
+            return
+        applied = apply_migrations(conn)
+        if applied:
+            log.info("Schema migrated to version %s (applied %s)", LATEST_VERSION, applied)
+        _MIGRATED = True
+
+def _reset_for_tests() -> None:
+    global _MIGRATED
+    _MIGRATED = False
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+def _dsn_from_env() -> Optional[str]:
+    if os.getenv("DATABASE_URL"):
+        return os.getenv("DATABASE_URL")
+    user, password, name = os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_NAME")
+    instance = os.getenv("INSTANCE_CONNECTION_NAME")
+    if not (user and password and name and instance):
+        return None
+    return f"user={user} password={password} dbname={name} host=/cloudsql/{instance}"
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    cmd = argv[0] if argv else "status"
+    if cmd not in ("status", "upgrade"):
+        print("usage: python migrations.py [status|upgrade]", file=sys.stderr)
+        return 2
+    dsn = _dsn_from_env()
+    if not dsn:
+        print("Database configuration is incomplete (set DATABASE_URL or DB_* env vars).", file=sys.stderr)
+        return 1
+
+    import psycopg2
+    conn: Any = psycopg2.connect(dsn)
+    try:
+        if cmd == "upgrade":
+            applied = apply_migrations(conn)
+            print(f"applied: {applied or 'nothing (up to date)'}")
+            return 0
+        cur = conn.cursor()
+        done = applied_versions(cur)
+        conn.rollback()
+        cur.close()
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {name}")
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark: password verification throughput (the CPU cost of /login).
+
+For each method, verifies the same password on one core inline, then through a PasswordHasher
+process pool driven by 8 threads (the gunicorn thread count), and reports logins/sec overall
+and per core. No database needed.
+
+Usage:
+    python ops/bench_passwords.py [seconds] [workers] [method ...]
+    python ops/bench_passwords.py 3 2 scrypt pbkdf2:sha256:600000
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords  # noqa: E402
+
+THREADS = 8
+
+
+def _inline(method, seconds):
+    stored = passwords._hash("correct horse", method)
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        assert passwords._check(stored, "correct horse")
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+
+def _pooled(method, seconds, workers):
+    hasher = passwords.PasswordHasher(method=method, workers=workers, max_pending=THREADS)
+    stored = hasher.hash("correct horse")  # also warms the pool up
+    count = [0]
+    lock = threading.Lock()
+    stop = time.perf_counter() + seconds
+
+    def run():
+        while time.perf_counter() < stop:
+            ok, _ = hasher.verify(stored, "correct horse")
+            assert ok
+            with lock:
+                count[0] += 1
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    hasher.shutdown()
+    return count[0] / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else passwords.PASSWORD_HASH_WORKERS
+    methods = sys.argv[3:] or [passwords.PASSWORD_HASH_METHOD]
+    print(f"cpu_count={os.cpu_count()} threads={THREADS} pool_workers={workers} seconds={seconds}")
+    print(f"{'method':<26} {'inline/s':>10} {'pool/s':>10} {'pool/s/core':>12}")
+    for method in methods:
+        params = passwords.hash_params(passwords._hash("probe", method))
+        inline = _inline(method, seconds)
+        pooled = _pooled(method, seconds, workers) if workers > 0 else inline
+        print(f"{params:<26} {inline:>10.1f} {pooled:>10.1f} {pooled / max(1, min(workers, os.cpu_count() or 1)):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark: director-chat slot extraction.
+
+Runs the golden corpus (tests/slot_corpus.jsonl) through the previous parsers (main.py's
+per-word re.search loop and services.py's substring scan, copied below as they were) and
+through slot_extractor, and reports recall over the expected slot values and microseconds per
+message. No database needed.
+
+Usage:
+    python ops/bench_slot_extractor.py [iterations]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import slot_extractor  # noqa: E402
+
+# ---- previous main.py parser ------------------------------------------------
+_MAIN_PLATFORMS = {"tiktok": "TikTok", "douyin": "TikTok", "reels": "Instagram Reels", "instagram": "Instagram Reels",
+                   "youtube": "YouTube Shorts", "shorts": "YouTube Shorts", "facebook": "Facebook", "fb": "Facebook"}
+_MAIN_TONES = {"playful", "fun", "energetic", "heartwarming", "dramatic", "epic", "serious", "inspirational", "whimsical"}
+_MAIN_STYLES = {"cinematic", "ugc", "asmr", "documentary", "vlog", "retro", "surreal", "minimal", "luxury"}
+
+
+def legacy_main(text):
+    t = text.lower()
+    out = {}
+    m = re.search(r'(\d+)\s*(s|sec|secs|second|seconds)\b', t)
+    if m:
+        out["duration_sec"] = int(m.group(1))
+    m = re.search(r'(\d+)\s*(m|min|mins|minute|minutes)\b', t)
+    if m:
+        out["duration_sec"] = int(m.group(1)) * 60
+    for d in (15, 20, 30, 45, 60):
+        if re.search(rf'\b{d}\s*(s|sec|seconds)?\b', t):
+            out.setdefault("duration_sec", d)
+    for key, norm in _MAIN_PLATFORMS.items():
+        if re.search(rf'\b{re.escape(key)}\b', t):
+            out["platform"] = norm
+            break
+    tones = [w for w in _MAIN_TONES if re.search(rf'\\b{re.escape(w)}\\b', t)]
+    if tones:
+        out["tones"] = sorted(set(tones))
+    styles = [w for w in _MAIN_STYLES if re.search(rf'\\b{re.escape(w)}\\b', t)]
+    if styles:
+        out["styles"] = sorted(set(styles))
+    if "awareness" in t:
+        out["goal"] = "Brand awareness"
+    if "conversion" in t:
+        out["goal"] = "Drive conversions"
+    return out
+
+# ---- previous services.py parser -------------------------------------------
+_SVC_PLATFORMS = {"tiktok": ["tiktok", "douyin", "抖音"], "instagram reels": ["instagram reels", "ig reels", "insta reels", "reels"],
+                  "youtube shorts": ["youtube shorts", "shorts", "yt shorts"], "facebook reels": ["facebook reels", "fb reels"],
+                  "wechat channels": ["wechat channels", "weixin video", "video accounts"]}
+_SVC_DURATION = re.compile(r"(\\b(\\d+)\\s*(s|sec|secs|second|seconds)\\b)|(\\b(\\d+)\\s*(m|min|mins|minute|minutes)\\b)")
+_SVC_TONES = {"playful", "fun", "warm", "heartwarming", "epic", "dramatic", "casual", "professional",
+              "authentic", "inspiring", "quirky", "edgy", "aspirational", "minimal"}
+_SVC_STYLES = {"cinematic", "ugc", "asmr", "vlog", "tutorial", "comedy", "interview", "montage",
+               "stop-motion", "retro", "surreal", "documentary"}
+_SVC_URL = re.compile(r"https?://[^\\s]+", re.I)
+
+
+def legacy_services(text):
+    t = text.lower()
+    out = {}
+    for k, aliases in _SVC_PLATFORMS.items():
+        if any(a in t for a in aliases):
+            out["platform"] = k
+            break
+    m = _SVC_DURATION.search(t)
+    if m and m.group(2):
+        out["duration_sec"] = int(m.group(2))
+    elif m and m.group(5):
+        out["duration_sec"] = int(m.group(5)) * 60
+    else:
+        m2 = re.search(r"\\b(\\d+)(s|m)\\b", t)
+        if m2:
+            out["duration_sec"] = int(m2.group(1)) * (1 if m2.group(2) == "s" else 60)
+    tone = next((w for w in _SVC_TONES if w in t), None)
+    style = next((w for w in _SVC_STYLES if w in t), None)
+    if tone:
+        out["tones"] = [tone]
+    if style:
+        out["styles"] = [style]
+    urls = _SVC_URL.findall(text)
+    if urls:
+        out["urls"] = urls
+    return out
+
+
+def _norm(slot, value):
+    return value.lower() if slot == "platform" else value
+
+
+def recall(parse, corpus):
+    """Share of expected slot values (each tone/style/url counted separately) the parser found."""
+    want = got = 0
+    for case in corpus:
+        found = parse(case["text"])
+        for slot, value in case["expected"].items():
+            if isinstance(value, list):
+                have = found.get(slot) or []
+                want += len(value)
+                got += sum(1 for v in value if v in have)
+            else:
+                want += 1
+                got += _norm(slot, found.get(slot) or "") == _norm(slot, value)
+    return got / want if want else 1.0
+
+
+def timed(parse, corpus, iterations):
+    texts = [c["text"] for c in corpus]
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for t in texts:
+            parse(t)
+    return (time.perf_counter() - t0) / (iterations * len(texts)) * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with open(os.path.join(ROOT, "tests", "slot_corpus.jsonl"), encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    ex = slot_extractor.default()
+    parsers = [("main (before)", legacy_main), ("services (before)", legacy_services), ("slot_extractor", ex.extract)]
+    print(f"messages={len(corpus)} iterations={iterations}")
+    print(f"{'parser':<20} {'recall':>8} {'us/msg':>8}")
+    for name, parse in parsers:
+        print(f"{name:<20} {recall(parse, corpus):>8.2f} {timed(parse, corpus, iterations):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+passwords.py
+Password hashing off the request threads.
+
+- PASSWORD_HASH_METHOD is any Werkzeug method spec ("scrypt", "scrypt:65536:8:1",
+  "pbkdf2:sha256:1000000", ...); it is normalised once to the parameter prefix Werkzeug stores in
+  front of the salt, so verify() can tell when a stored hash was made with other parameters and
+  the caller should rehash it (login does, transparently)
+- hashing / verification runs in a small process pool (PASSWORD_HASH_WORKERS, spawn context), so a
+  login burst costs at most that many cores while the GIL stays free for the other routes;
+  PASSWORD_HASH_WORKERS=0 runs inline
+- at most PASSWORD_HASH_MAX_PENDING operations wait for the pool; beyond that HasherBusy is raised
+  and the route answers 503 instead of parking more gunicorn threads behind the KDF
+- callers hash / verify before taking a DB connection, never while holding one
+
+Bench: python ops/bench_passwords.py
+"""
+
+from __future__ import annotations
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+log = logging.getLogger("pf.passwords")
+
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+PASSWORD_HASH_TIMEOUT_SEC = float(os.getenv("PASSWORD_HASH_TIMEOUT_SEC", "10"))
+
+
+class HasherBusy(RuntimeError):
+    """Too many hash operations are already waiting for the pool."""
+
+
+def hash_params(stored: str) -> str:
+    """Parameter prefix of a Werkzeug hash ("scrypt:32768:8:1$salt$hex" -> "scrypt:32768:8:1")."""
+    return (stored or "").split("$", 1)[0]
+
+
+# Module-level so the spawned workers can import them
+def _hash(password: str, method: str) -> str:
+    return generate_password_hash(password, method=method)
+
+
+def _check(stored: str, password: str) -> bool:
+    return check_password_hash(stored, password)
+
+
+class PasswordHasher:
+    def __init__(self, method: str = PASSWORD_HASH_METHOD, workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_MAX_PENDING, timeout: float = PASSWORD_HASH_TIMEOUT_SEC):
+        self.method = method
+        self.params = hash_params(_hash("probe", method))  # also rejects an invalid method early
+        self.workers = max(0, workers)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._counters = {"hashed": 0, "verified": 0, "rehash_needed": 0, "busy": 0, "pool_failures": 0}
+        self._total_ms = 0.0
+
+    def hash(self, password: str) -> str:
+        out = self._run(_hash, password, self.method)
+        self._count("hashed")
+        return out
+
+    def verify(self, stored: str, password: str) -> Tuple[bool, bool]:
+        """(password matches, stored hash should be replaced with hash(password))."""
+        ok = bool(stored) and self._run(_check, stored, password)
+        self._count("verified")
+        rehash = ok and self.needs_rehash(stored)
+        if rehash:
+            self._count("rehash_needed")
+        return ok, rehash
+
+    def needs_rehash(self, stored: str) -> bool:
+        return hash_params(stored) != self.params
+
+    def shutdown(self) -> None:
+        with self._lock:
+            ex, self._executor = self._executor, None
+        if ex is not None:
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            done = self._counters["hashed"] + self._counters["verified"]
+            return {**self._counters, "method": self.params, "workers": self.workers,
+                    "avg_ms": round(self._total_ms / done, 2) if done else 0.0}
+
+    # ------------------------------------------------------------------
+    def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count("busy")
+            raise HasherBusy("password hashing is saturated")
+        t0 = time.perf_counter()
+        try:
+            if self.workers == 0:
+                return fn(*args)
+            try:
+                return self._pool().submit(fn, *args).result(timeout=self.timeout)
+            except BrokenProcessPool as e:
+                # A worker died (OOM, killed); start a fresh pool next time and finish this one inline
+                self._count("pool_failures")
+                log.warning("password hash pool broken, running inline: %s", e)
+                self.shutdown()
+                return fn(*args)
+        finally:
+            with self._lock:
+                self._total_ms += (time.perf_counter() - t0) * 1000.0
+            self._slots.release()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a multi-threaded gunicorn worker is unsafe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+_hasher: Optional[PasswordHasher] = None
+_hasher_lock = threading.Lock()
+
+
+def hasher() -> PasswordHasher:
+    """Process-wide hasher, created on first use."""
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                _hasher = PasswordHasher()
+    return _hasher
+
+
+def hash_password(password: str) -> str:
+    return hasher().hash(password)
+
+
+def verify_password(stored: str, password: str) -> Tuple[bool, bool]:
+    return hasher().verify(stored, password)
+
+
+def stats() -> Optional[Dict[str, Any]]:
+    return _hasher.stats() if _hasher is not None else None
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+prompts.py
+Registry of the LLM prompt templates (prompt_<name>.v<version>.txt), versioned in prompt_versions.
+
+- Templates use {{VARIABLE}} placeholders. Each one is compiled once into a substitution plan (the
+  literal pieces plus the positions the variables go into), so render() is a single join over
+  the plan. Non-string values are JSON-encoded (dicts, lists, numbers).
+- The template files next to this module are loaded at import. After attach(connection), the
+  first refresh records each file version in prompt_versions (name, version, prompt_content->>'template'; inactive unless
+  nothing is active yet for that name), so the table lists every version that ever shipped.
+- The active version per name is the prompt_versions row with is_active; versions added through
+  the admin API exist only in the table and are compiled on first use. The active map is cached
+  for PROMPT_ACTIVE_TTL_SEC and refreshed by whichever call finds it stale (others keep the
+  previous map meanwhile); activate() on this instance takes effect immediately, other instances
+  follow within the TTL. Without a database the newest file version of each name is active.
+- services.py renders through registry.render(), which also returns the version it used, and
+  records that version in projects.prompt_versions when the creatives / storyboard are persisted.
+  A fan-out pins the version of its first render (version=...), so all its calls use one template.
+
+    text, version = prompts.registry.render("storyboard", SELECTED_CREATIVE_CONCEPT=creative,
+                                            NUMBER_OF_SCENES=10, VIDEO_LENGTH_IN_SECONDS=30)
+
+Env: PROMPT_DIR (this directory), PROMPT_ACTIVE_TTL_SEC (30).
+"""
+
+from __future__ import annotations
+import os
+import re
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+log = logging.getLogger("pf.prompts")
+
+PROMPT_DIR = os.getenv("PROMPT_DIR", os.path.dirname(os.path.abspath(__file__)))
+PROMPT_ACTIVE_TTL_SEC = float(os.getenv("PROMPT_ACTIVE_TTL_SEC", "30"))
+
+_FILE_RE = re.compile(r"^prompt_(?P<name>[a-z0-9_]+)\.v(?P<version>\d+(?:\.\d+)*)\.txt$")
+_VAR_RE = re.compile(r"\{\{\s*([A-Za-z0-9_]+)\s*\}\}")
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    return tuple(int(p) if p.isdigit() else 0 for p in version.lstrip("v").split("."))
+
+
+class Template:
+    __slots__ = ("name", "version", "source", "variables", "_parts", "_slots")
+
+    def __init__(self, name: str, version: str, source: str):
+        self.name = name
+        self.version = version
+        self.source = source
+        pieces = _VAR_RE.split(source)  # literal, var, literal, var, ..., literal
+        self._parts: List[str] = pieces
+        self._slots: Tuple[Tuple[int, str], ...] = tuple((i, pieces[i]) for i in range(1, len(pieces), 2))
+        self.variables = frozenset(v for _, v in self._slots)
+
+    @property
+    def ref(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    def render(self, values: Optional[Mapping[str, Any]] = None, **kw: Any) -> str:
+        """The template with every {{VARIABLE}} replaced; KeyError when a variable has no value."""
+        if values:
+            kw = {**values, **kw}
+        parts = list(self._parts)
+        for i, var in self._slots:
+            try:
+                value = kw[var]
+            except KeyError:
+                raise KeyError(f"{self.ref}: no value for {{{{{var}}}}}") from None
+            parts[i] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        return "".join(parts)
+
+
+def load_files(directory: str = PROMPT_DIR) -> Dict[Tuple[str, str], Template]:
+    out: Dict[Tuple[str, str], Template] = {}
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError as e:
+        log.warning("prompt directory %s unreadable: %s", directory, e)
+        return out
+    for fn in names:
+        m = _FILE_RE.match(fn)
+        if not m:
+            continue
+        with open(os.path.join(directory, fn), "r", encoding="utf-8") as f:
+            version = "v" + m.group("version")
+            out[(m.group("name"), version)] = Template(m.group("name"), version, f.read())
+    return out
+
+
+class Registry:
+    def __init__(self, directory: str = PROMPT_DIR, ttl: float = PROMPT_ACTIVE_TTL_SEC):
+        self.ttl = ttl
+        self._templates: Dict[Tuple[str, str], Template] = load_files(directory)
+        self._file_versions = {k for k in self._templates}
+        self._active: Dict[str, str] = {}
+        self._connection: Optional[Callable[[], Any]] = None
+        self._synced = False
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._counters = {"refreshes": 0, "errors": 0, "renders": 0}
+
+    # -- database ---------------------------------------------------------
+    def attach(self, connection: Callable[[], Any]) -> None:
+        """Use prompt_versions via `connection` (a context manager yielding a DB connection); no I/O until first use."""
+        self._connection = connection
+        self._synced = False
+        self._loaded_at = 0.0
+
+    def sync_files(self) -> int:
+        """Record the shipped file versions in prompt_versions; returns how many rows were added."""
+        added = 0
+        with self._connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Newest first: a name seen for the first time starts on its newest file version
+                for name, version in sorted(self._file_versions, key=lambda k: (k[0], _version_key(k[1])), reverse=True):
+                    tpl = self._templates[(name, version)]
+                    cur.execute(
+                        """
+                        INSERT INTO prompt_versions (name, version, prompt_content, is_active)
+                        SELECT %s, %s, %s::jsonb,
+                               NOT EXISTS (SELECT 1 FROM prompt_versions WHERE name=%s AND is_active)
+                        ON CONFLICT (name, version) WHERE name IS NOT NULL DO NOTHING
+                        """,
+                        (name, version, json.dumps({"template": tpl.source, "source": "file"}), name),
+                    )
+                    added += cur.rowcount
+                conn.commit()
+            finally:
+                cur.close()
+        return added
+
+    def _load_active(self) -> Dict[str, str]:
+        with self._connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT name, version FROM prompt_versions WHERE is_active AND name IS NOT NULL")
+                active = {r[0]: r[1] for r in cur.fetchall()}
+                missing = [(n, v) for n, v in active.items() if (n, v) not in self._templates]
+                for name, version in missing:
+                    cur.execute("SELECT prompt_content->>'template' FROM prompt_versions WHERE name=%s AND version=%s",
+                                (name, version))
+                    row = cur.fetchone()
+                    if row and row[0]:
+                        with self._lock:
+                            self._templates[(name, version)] = Template(name, version, row[0])
+                conn.commit()
+            finally:
+                cur.close()
+        return active
+
+    def refresh(self, blocking: bool = True) -> None:
+        if self._connection is None:
+            return
+        if not self._refreshing.acquire(blocking=blocking):
+            return  # another caller is refreshing; use the current map
+        try:
+            if not self._synced:
+                self.sync_files()
+                self._synced = True
+            active = self._load_active()
+            with self._lock:
+                self._active = active
+            self._count("refreshes")
+        except Exception as e:
+            self._count("errors")
+            log.warning("prompt_versions refresh failed (keeping previous versions): %s", e)
+        finally:
+            self._loaded_at = time.monotonic()
+            self._refreshing.release()
+
+    def invalidate(self) -> None:
+        self._loaded_at = 0.0
+
+    def add_version(self, cur, name: str, version: str, source: str, created_by: str = "") -> Template:
+        """Insert a new (inactive) version with `cur`; ValueError when it exists. Caller commits."""
+        tpl = Template(name, version, source)
+        cur.execute(
+            """
+            INSERT INTO prompt_versions (name, version, prompt_content, is_active, created_by)
+            VALUES (%s, %s, %s::jsonb, FALSE, %s)
+            ON CONFLICT (name, version) WHERE name IS NOT NULL DO NOTHING
+            """,
+            (name, version, json.dumps({"template": source, "source": "admin"}), created_by or None),
+        )
+        if cur.rowcount == 0:
+            raise ValueError(f"{name}@{version} already exists")
+        return tpl
+
+    def activate(self, cur, name: str, version: str) -> bool:
+        """Make `version` the active one for `name` with `cur`; False when it does not exist. Caller commits, then invalidate()."""
+        cur.execute("SELECT version FROM prompt_versions WHERE name=%s FOR UPDATE", (name,))
+        if version not in {r[0] for r in cur.fetchall()}:
+            return False
+        cur.execute("UPDATE prompt_versions SET is_active = FALSE WHERE name=%s AND is_active AND version <> %s",
+                    (name, version))
+        cur.execute("UPDATE prompt_versions SET is_active = TRUE WHERE name=%s AND version=%s", (name, version))
+        return True
+
+    # -- lookup -----------------------------------------------------------
+    def version(self, name: str) -> Optional[str]:
+        """The active version for `name`."""
+        if self._connection is not None and time.monotonic() - self._loaded_at >= self.ttl:
+            self.refresh(blocking=self._loaded_at == 0.0)
+        with self._lock:
+            return self._effective(name)
+
+    def _effective(self, name: str) -> Optional[str]:
+        active = self._active.get(name)
+        if active is not None and (name, active) in self._templates:
+            return active
+        files = [v for (n, v) in self._file_versions if n == name]
+        return max(files, key=_version_key) if files else None
+
+    def get(self, name: str) -> Template:
+        version = self.version(name)
+        if version is None:
+            raise KeyError(f"no prompt template named {name!r}")
+        with self._lock:
+            return self._templates[(name, version)]
+
+    def render(self, name: str, values: Optional[Mapping[str, Any]] = None, version: Optional[str] = None,
+               **kw: Any) -> Tuple[str, str]:
+        """(prompt text, version) for the active version of `name`, or for `version` when given."""
+        if version is None:
+            tpl = self.get(name)
+        else:
+            with self._lock:
+                tpl = self._templates.get((name, version))
+            if tpl is None:
+                raise KeyError(f"no prompt template {name}@{version}")
+        self._count("renders")
+        return tpl.render(values, **kw), tpl.version
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return sorted({n for n, _ in self._templates})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = {n: self._effective(n) for n in sorted({n for n, _ in self._templates})}
+            return {**self._counters, "compiled": len(self._templates), "active": active,
+                    "attached": self._connection is not None}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+registry = Registry()
+
+
+def get(name: str) -> Template:
+    return registry.get(name)
+
+
+def stats() -> Dict[str, Any]:
+    return registry.stats()
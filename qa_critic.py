@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+qa_critic.py
+LLM critic stage for storyboards, scored with the prompt_qa_critic template (prompts.py).
+
+    review = qa_critic.critic.start(storyboard, creative)      # scoring starts on the llm_engine pool
+    with db_connection() as conn:
+        sb_id = services.persist_storyboard(conn, ..., review=review)   # meanwhile: qa_status 'pending'
+    review.write_back(sb_id)                                    # qa_status / qa_feedback when it returns
+    verdict = review.verdict(timeout)                           # only when the client asked to wait
+
+- the critic answers {overall_score 0-10, is_approved, feedback}; a score below PASS_SCORE is
+  never approved, whatever the model says
+- verdicts are cached by storyboard hash (scenes + concept + target length + template version):
+  in process, then storyboards.qa_hash in the database, so re-scoring an identical storyboard on
+  any instance costs no LLM call; a cached verdict is known before the row is written
+- write-backs run on one small thread, not on the LLM workers, and only touch a row that is still
+  'pending'
+- when the critic is disabled or its call fails, the verdict falls back to the light duration /
+  scene-count check (services.storyboard_light_qa), so no row stays 'pending' while the process lives
+
+Env: QA_CRITIC (1), QA_CRITIC_PASS_SCORE (7.0), QA_CRITIC_DEADLINE_SEC (90), QA_CRITIC_WAIT_SEC (60),
+QA_CRITIC_CACHE_SIZE (2048).
+"""
+
+from __future__ import annotations
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional
+
+import llm_engine
+import prompts
+
+log = logging.getLogger("pf.qa")
+
+QA_CRITIC = os.getenv("QA_CRITIC", "1") == "1"
+QA_CRITIC_PASS_SCORE = float(os.getenv("QA_CRITIC_PASS_SCORE", "7.0"))
+QA_CRITIC_DEADLINE_SEC = float(os.getenv("QA_CRITIC_DEADLINE_SEC", "90"))
+QA_CRITIC_WAIT_SEC = float(os.getenv("QA_CRITIC_WAIT_SEC", "60"))
+QA_CRITIC_CACHE_SIZE = int(os.getenv("QA_CRITIC_CACHE_SIZE", "2048"))
+
+PROMPT_NAME = "qa_critic"
+DEFAULT_VIDEO_LENGTH_SEC = 30
+
+
+class Verdict(NamedTuple):
+    status: str               # passed | failed
+    score: Optional[float]    # 0-10; None for the light check
+    feedback: str
+    source: str               # critic | cache | light
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"status": self.status, "score": self.score, "feedback": self.feedback, "source": self.source}
+
+
+def _light_verdict(storyboard: Mapping[str, Any], length: int) -> Verdict:
+    import services
+    ok, feedback = services.storyboard_light_qa(storyboard, length)
+    return Verdict("passed" if ok else "failed", None, feedback, "light")
+
+
+def _gemini_json(prompt: str) -> Any:
+    import services
+    return services._call_gemini_for_json(prompt)
+
+
+def parse_verdict(data: Any, pass_score: float = QA_CRITIC_PASS_SCORE) -> Verdict:
+    """Critic JSON -> Verdict; ValueError when it does not follow the template's output schema."""
+    if not isinstance(data, dict):
+        raise ValueError("critic output is not a JSON object")
+    try:
+        score = float(data["overall_score"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("critic output has no numeric overall_score") from None
+    score = min(max(score, 0.0), 10.0)
+    approved = data.get("is_approved") is True and score >= pass_score
+    return Verdict("passed" if approved else "failed", round(score, 1), str(data.get("feedback") or "").strip(), "critic")
+
+
+class Review:
+    """One storyboard under review: the verdict may be known already (cache) or still being scored."""
+
+    def __init__(self, critic: "Critic", key: str, storyboard: Mapping[str, Any], length: int = DEFAULT_VIDEO_LENGTH_SEC,
+                 future: Optional[Future] = None, verdict: Optional[Verdict] = None):
+        self.critic = critic
+        self.key = key
+        self.storyboard = storyboard
+        self.length = length
+        self.future = future
+        self._verdict = verdict
+        self.persisted: Optional[Dict[str, Any]] = None  # the qa_* values the row was inserted with
+
+    def ready(self) -> Optional[Verdict]:
+        """The verdict if it is already known; never blocks."""
+        f = self.future
+        if self._verdict is None and f is not None and f.done() and not f.cancelled() and f.exception() is None:
+            self._verdict = f.result()
+        return self._verdict
+
+    def initial(self) -> Dict[str, Any]:
+        """Column values for the storyboard insert: the final verdict when known, 'pending' otherwise."""
+        v = self.ready()
+        if v is not None:
+            self.persisted = {"qa_status": v.status, "qa_feedback": v.feedback, "qa_score": v.score, "qa_hash": self.key}
+        else:
+            light = _light_verdict(self.storyboard, self.length)
+            self.persisted = {"qa_status": "pending", "qa_feedback": light.feedback, "qa_score": None, "qa_hash": self.key}
+        return self.persisted
+
+    def verdict(self, timeout: Optional[float] = QA_CRITIC_WAIT_SEC) -> Optional[Verdict]:
+        """Wait up to `timeout` seconds; None when the critic is still running (it keeps running)."""
+        if self.ready() is not None or self.future is None:
+            return self._verdict
+        try:
+            self._verdict = self.future.result(timeout=timeout)
+        except FutureTimeout:
+            return None
+        except Exception as e:  # cancelled
+            log.warning("qa review %s unavailable: %s", self.key[:12], e)
+            return None
+        return self._verdict
+
+    def write_back(self, storyboard_id: str, connection: Optional[Callable[[], Any]] = None) -> None:
+        """Store the verdict on the storyboard row once it is known (no-op when it was persisted already)."""
+        if self.persisted is not None and self.persisted["qa_status"] != "pending":
+            return
+        if self.future is None:
+            self.critic.submit_write(storyboard_id, self._verdict or _light_verdict(self.storyboard, self.length), connection)
+            return
+
+        def done(f: Future) -> None:
+            v = f.result() if not f.cancelled() and f.exception() is None else _light_verdict(self.storyboard, self.length)
+            self.critic.submit_write(storyboard_id, v, connection)
+
+        self.future.add_done_callback(done)
+
+    def summary(self, wait: bool = False, timeout: Optional[float] = QA_CRITIC_WAIT_SEC) -> Dict[str, Any]:
+        """What a response reports: the verdict, or {"status": "pending"} unless the caller waits."""
+        v = self.verdict(timeout) if wait else self.ready()
+        return v.to_dict() if v is not None else {"status": "pending", "score": None, "feedback": None, "source": None}
+
+    def cancel(self) -> None:
+        if self.future is not None:
+            self.future.cancel()
+
+
+class Critic:
+    def __init__(self, llm: Callable[[str], Any] = _gemini_json, engine: Optional[llm_engine.LLMEngine] = None,
+                 enabled: bool = QA_CRITIC, max_entries: int = QA_CRITIC_CACHE_SIZE):
+        self.llm = llm
+        self.engine = engine or llm_engine.engine
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self._connection: Optional[Callable[[], Any]] = None
+        self._memo: "OrderedDict[str, Verdict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._counters = {"reviews": 0, "scored": 0, "cache_hits": 0, "db_hits": 0, "fallbacks": 0,
+                          "written": 0, "write_errors": 0}
+
+    def attach(self, connection: Callable[[], Any]) -> None:
+        """Database access (context manager yielding a connection) for the qa_hash lookup and write-backs."""
+        self._connection = connection
+
+    # -- keys and cache ---------------------------------------------------
+    @staticmethod
+    def key_for(storyboard: Mapping[str, Any], concept: Mapping[str, Any], length: int, version: str) -> str:
+        canon = json.dumps({"scenes": storyboard.get("scenes") or [], "concept": concept, "length": length,
+                            "prompt": version}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+    def cached(self, key: str) -> Optional[Verdict]:
+        with self._lock:
+            v = self._memo.get(key)
+            if v is not None:
+                self._memo.move_to_end(key)
+                self._counters["cache_hits"] += 1
+        return v._replace(source="cache") if v is not None else None
+
+    def _remember(self, key: str, verdict: Verdict) -> None:
+        with self._lock:
+            self._memo[key] = verdict
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+
+    def _lookup_db(self, key: str) -> Optional[Verdict]:
+        if self._connection is None:
+            return None
+        try:
+            with self._connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute(
+                        "SELECT qa_status, qa_score, qa_feedback FROM storyboards "
+                        "WHERE qa_hash=%s AND qa_status <> 'pending' AND qa_score IS NOT NULL LIMIT 1", (key,))
+                    row = cur.fetchone()
+                    conn.commit()
+                finally:
+                    cur.close()
+        except Exception as e:
+            log.warning("qa verdict lookup failed: %s", e)
+            return None
+        if row is None:
+            return None
+        self._count("db_hits")
+        return Verdict(row[0], float(row[1]), row[2] or "", "cache")
+
+    # -- scoring ----------------------------------------------------------
+    def start(self, storyboard: Mapping[str, Any], creative: Mapping[str, Any],
+              video_length_sec: Optional[int] = None) -> Review:
+        """Begin reviewing `storyboard`; returns at once (with the verdict when it is cached)."""
+        self._count("reviews")
+        length = int(video_length_sec or creative.get("video_length_sec") or DEFAULT_VIDEO_LENGTH_SEC)
+        concept = {k: creative.get(k) for k in ("title", "logline", "why_it_works")}
+        prompt, version = prompts.registry.render(PROMPT_NAME, STORYBOARD_SCENES_JSON=storyboard.get("scenes") or [],
+                                                  SELECTED_CREATIVE_CONCEPT=concept, VIDEO_LENGTH_IN_SECONDS=length)
+        key = self.key_for(storyboard, concept, length, version)
+        hit = self.cached(key)
+        if hit is not None:
+            return Review(self, key, storyboard, length, verdict=hit)
+        if not self.enabled:
+            return Review(self, key, storyboard, length, verdict=_light_verdict(storyboard, length))
+        call = self.engine.submit(self._score, key, prompt, storyboard, length, deadline=QA_CRITIC_DEADLINE_SEC,
+                                  label="qa-critic")
+        return Review(self, key, storyboard, length, future=call.future)
+
+    def _score(self, key: str, prompt: str, storyboard: Mapping[str, Any], length: int) -> Verdict:
+        verdict = self._lookup_db(key)
+        if verdict is None:
+            try:
+                verdict = parse_verdict(self.llm(prompt))
+                self._count("scored")
+            except Exception as e:
+                log.warning("qa critic unavailable, using the light check: %s", e)
+                self._count("fallbacks")
+                return _light_verdict(storyboard, length)  # not cached: the critic may work next time
+        self._remember(key, verdict)
+        return verdict
+
+    # -- persistence ------------------------------------------------------
+    def submit_write(self, storyboard_id: str, verdict: Verdict, connection: Optional[Callable[[], Any]] = None) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qa-writeback")
+        self._writer.submit(self.write, storyboard_id, verdict, connection)
+
+    def write(self, storyboard_id: str, verdict: Verdict, connection: Optional[Callable[[], Any]] = None) -> bool:
+        connection = connection or self._connection
+        if connection is None:
+            log.warning("qa verdict for storyboard %s dropped: no database attached", storyboard_id)
+            return False
+        try:
+            with connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute(
+                        "UPDATE storyboards SET qa_status=%s, qa_score=%s, qa_feedback=%s, qa_reviewed_at=NOW() "
+                        "WHERE id=%s AND qa_status='pending'",
+                        (verdict.status, verdict.score, verdict.feedback, storyboard_id))
+                    conn.commit()
+                finally:
+                    cur.close()
+            self._count("written")
+            return True
+        except Exception as e:
+            self._count("write_errors")
+            log.warning("qa verdict write-back failed for storyboard %s: %s", storyboard_id, e)
+            return False
+
+    def drain(self, timeout: Optional[float] = None) -> None:
+        """Wait for queued write-backs (tests, shutdown)."""
+        with self._lock:
+            writer = self._writer
+        if writer is not None:
+            writer.submit(lambda: None).result(timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "cached": len(self._memo), "enabled": self.enabled}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+critic = Critic()
+
+
+def stats() -> Dict[str, Any]:
+    return critic.stats()
@@ -116,4 +116,13 @@ class SessionState(BaseModel):
     history: Optional[List[Dict[str, Any]]] = None  # optional transcript storage
     # Optional progress hints for UI
     step: Optional[int] = None
-    selections: Optional[Dict[str, Any]] = None
\ No newline at end of file
+    selections: Optional[Dict[str, Any]] = None
+# ---------------------------- Activity Ingest ---------------------------
+
+ACTIVITY_BATCH_MAX = 500
+
+class ActivityEvent(BaseModel):
+    """One client event for POST /activity/log/batch (ip/user agent/ts are taken server-side)."""
+    actor: str = Field(default="web", min_length=1, max_length=128)
+    action: str = Field(..., min_length=1, max_length=128)
+    details: Dict[str, Any] = Field(default_factory=dict)
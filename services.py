@@ -17,14 +17,21 @@ services.py
 
 from __future__ import annotations
 import os
-import io
 import json
 import uuid
-import zipfile
 import logging
-from typing import Any, Dict, List, Tuple, Optional
+import threading
+from typing import Any, Dict, Iterator, List, Tuple, Optional, Union
 
-from pydantic import BaseModel, Field, ValidationError, field_validator
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+
+import gemini_client
+import llm_cache
+import llm_engine
+import prompts
+import qa_critic
+import streaming
+import zipstream
 
 # ---------------------------------------------------------------------------
 # Pydantic models (to validate AI output)
@@ -37,6 +44,14 @@ class CreativeOption(BaseModel):
 class CreativeOptionsPayload(BaseModel):
     options: List[CreativeOption]
 
+    @model_validator(mode="before")
+    @classmethod
+    def from_template_schema(cls, data):
+        # prompt_creative templates answer {"creative_options": [...]}
+        if isinstance(data, dict) and "options" not in data and "creative_options" in data:
+            data = {**data, "options": data["creative_options"]}
+        return data
+
     @field_validator("options")
     @classmethod
     def at_least_one(cls, v):
@@ -50,7 +65,28 @@ class StoryboardScene(BaseModel):
     description: str = Field(..., min_length=1)
     visuals: Optional[str] = ""
     voiceover: Optional[str] = ""
-    duration_sec: Optional[int] = Field(5, ge=1)
+    duration_sec: Optional[Union[int, float]] = Field(5, gt=0)
+
+    @model_validator(mode="before")
+    @classmethod
+    def from_template_schema(cls, data):
+        # prompt_storyboard templates answer scene_number / act / visual_description / camera_shot / pacing_seconds.
+        # Fractional pacing is kept (6 x 2.5 s must still add up to 15 s); whole seconds stay ints.
+        if isinstance(data, dict) and "number" not in data and "scene_number" in data:
+            try:
+                secs = round(float(data.get("pacing_seconds") or 5), 2)
+                secs = int(secs) if secs.is_integer() else secs
+            except (TypeError, ValueError):
+                secs = 5
+            data = {
+                "number": data["scene_number"],
+                "title": str(data.get("act") or f"Scene {data['scene_number']}").title(),
+                "description": data.get("visual_description") or "",
+                "visuals": data.get("camera_shot") or "",
+                "voiceover": "",
+                "duration_sec": secs,
+            }
+        return data
 
 class StoryboardPayload(BaseModel):
     scenes: List[StoryboardScene]
@@ -72,35 +108,24 @@ log = logging.getLogger("pf.services")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "").strip()
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-1.5-pro")
 
-def _require_genai():
-    """
-         Gemini SDK.         API Key,  ImportError.
-    """
-    if not GEMINI_API_KEY:
-        raise ImportError("Gemini SDK/API key is not configured")
-    try:
-        import google.generativeai as genai  # type: ignore
-    except Exception as e:
-        raise ImportError(f"google.generativeai not available: {e}")
-    genai.configure(api_key=GEMINI_API_KEY)
-    return genai
-
+JSON_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 2048,
+    "response_mime_type": "application/json",
+}
 
-def _call_gemini_for_json(prompt: str, system_instruction: Optional[str] = None) -> Any:
+def _call_gemini_for_json(prompt: str, system_instruction: Optional[str] = None, cache: bool = True) -> Any:
     """
     Call Gemini and expect JSON. Prefer response.text, otherwise inspect candidates/parts and to_dict().
     Force JSON by setting response_mime_type. If nothing parsable is found, raise ValueError so caller can fallback.
+    The model object comes from the process-wide registry (gemini_client), not rebuilt per call.
+    Parsed payloads are cached by (model, system instruction, config, prompt); cache=False bypasses.
     """
-    genai = _require_genai()
-    model = genai.GenerativeModel(
-        DEFAULT_MODEL,
-        system_instruction=system_instruction,
-        generation_config={
-            "temperature": 0.7,
-            "max_output_tokens": 2048,
-            "response_mime_type": "application/json",
-        },
-    )
+    key = llm_cache.cache_key(DEFAULT_MODEL, system_instruction, JSON_GENERATION_CONFIG, prompt)
+    return llm_cache.get_or_compute(key, lambda: _generate_json(prompt, system_instruction), bypass=not cache)
+
+def _generate_json(prompt: str, system_instruction: Optional[str] = None) -> Any:
+    model = gemini_client.get_model(DEFAULT_MODEL, system_instruction, JSON_GENERATION_CONFIG)
     resp = model.generate_content(prompt)
 
     texts = []
@@ -176,63 +201,109 @@ def _fetchall_dicts(cur) -> List[Dict[str, Any]]:
 # ---------------------------------------------------------------------------
 #     
 # ---------------------------------------------------------------------------
-
-def create_project_and_generate_creatives(
-    db_conn, user_id: str, user_input: Dict[str, Any]
+# Generation (LLM, no DB) and persistence (DB, no LLM) are separate steps so routes borrow a
+# pooled connection only to read inputs and persist results. Gemini calls run on the bounded
+# llm_engine worker pool with a deadline. The combined helpers remain for callers that
+# already hold a connection (create_session / advance_session).
+
+# One Gemini call per creative option (3 concurrent calls) instead of one call for all three
+CREATIVE_FANOUT = os.getenv("LLM_CREATIVE_FANOUT", "0") == "1"
+# Draft storyboards for every creative option right after the options are generated
+SPECULATIVE_STORYBOARDS = os.getenv("LLM_SPECULATIVE_STORYBOARDS", "0") == "1"
+SPECULATIVE_MAX_ENTRIES = 64
+
+CREATIVE_ANGLES = [
+    "an emotional, story-driven angle",
+    "a bold, humorous or unexpected angle",
+    "a direct, benefit- and CTA-focused angle",
+]
+
+def _creatives_prompt(project_title: str, video_length_sec: int, user_input: Dict[str, Any], angle: Optional[str] = None,
+                      version: Optional[str] = None) -> Tuple[str, str]:
+    # (prompt, version) from prompt_creative (prompts.py); the fan-out keeps the first concept of each call
+    brief = {**user_input, "project_title": project_title, "video_length_sec": video_length_sec}
+    if angle:
+        brief["creative_angle"] = angle
+    return prompts.registry.render("creative", version=version, USER_INPUT_JSON=brief)
+
+def _fallback_creatives(project_title: str) -> List[CreativeOption]:
+    base = (project_title or "Your Project").strip()
+    return [
+        CreativeOption(title=f"Concept A: {base}", logline="A concise logline based on the project objective.", why_it_works="Clear message with a strong hook."),
+        CreativeOption(title=f"Concept B: {base}", logline="An alternative angle with contrasting tone/mood.", why_it_works="Provides variety for comparison."),
+        CreativeOption(title=f"Concept C: {base}", logline="CTA-oriented angle highlighting the key benefit.", why_it_works="Direct and conversion-focused."),
+    ]
+
+def generate_creative_options(user_input: Dict[str, Any], deadline: Optional[float] = None) -> Tuple[List[CreativeOption], str]:
+    """
+    Generate exactly 3 creative options. Returns (options, prompt_creative version they were asked with).
+    No DB access; safe to call before borrowing a connection.
+    Any Gemini/validation failure falls back to placeholder concepts.
+    """
+    project_title = user_input.get("project_title") or "Untitled Project"
+    video_length_sec = int(user_input.get("video_length_sec") or 30)
+    opts: List[CreativeOption] = []
+
+    if CREATIVE_FANOUT:
+        first, version = _creatives_prompt(project_title, video_length_sec, user_input, CREATIVE_ANGLES[0])
+        texts = [first] + [_creatives_prompt(project_title, video_length_sec, user_input, angle, version)[0]
+                           for angle in CREATIVE_ANGLES[1:]]
+        calls = [(_call_gemini_for_json, (text,)) for text in texts]
+        for data in llm_engine.engine.gather(calls, deadline=deadline):
+            if isinstance(data, Exception):
+                log.warning("Gemini creative fan-out call failed: %s", data)
+                continue
+            try:
+                payload = data if isinstance(data, dict) and "options" in data else {"options": [data]}
+                opts.append(CreativeOptionsPayload.model_validate(payload).options[0])
+            except Exception as e:
+                log.warning("Gemini JSON parse/validation failed (creative fan-out): %s", e)
+        if not opts:
+            opts = _fallback_creatives(project_title)
+    else:
+        prompt, version = _creatives_prompt(project_title, video_length_sec, user_input)
+        try:
+            data = llm_engine.engine.run(_call_gemini_for_json, prompt, deadline=deadline)
+            opts = list(CreativeOptionsPayload.model_validate(data).options or [])
+        except Exception as e:
+            log.warning("Gemini JSON parse/validation failed (creative options), falling back: %s", e)
+            opts = _fallback_creatives(project_title)
+
+    # Normalize to exactly 3 options (English-only comments).
+    if len(opts) > 3:
+        opts = opts[:3]
+    while len(opts) < 3:
+        idx_pad = len(opts) + 1
+        opts.append(CreativeOption(
+            title=f"Option {idx_pad}",
+            logline="(to be refined)",
+            why_it_works="Provides variety among concepts."
+        ))
+    return opts, version
+
+def persist_project_and_creatives(
+    db_conn, user_id: str, user_input: Dict[str, Any], opts: List[CreativeOption], prompt_version: Optional[str] = None,
 ) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    Create a project and generate 3 creative options.
-    Returns: (project_id, creative_options)
+    Insert the project and its creative options in one transaction. Returns (project_id, creative_options).
+    prompt_version is the prompt_creative version from generate_creative_options, recorded in projects.prompt_versions.
     """
     cur = db_conn.cursor()
     try:
         project_title = user_input.get("project_title") or "Untitled Project"
         video_length_sec = int(user_input.get("video_length_sec") or 30)
 
-        # 1)     
         cur.execute(
             """
-            INSERT INTO projects (user_id, project_title, user_input, video_length_sec)
-            VALUES (%s, %s, %s::jsonb, %s)
+            INSERT INTO projects (user_id, project_title, user_input, video_length_sec, prompt_versions)
+            VALUES (%s, %s, %s::jsonb, %s, %s::jsonb)
             RETURNING id
             """,
-            (user_id, project_title, json.dumps(user_input), video_length_sec),
+            (user_id, project_title, json.dumps(user_input), video_length_sec,
+             json.dumps({"creative": prompt_version} if prompt_version else {})),
         )
         pid = str(cur.fetchone()[0])
 
-        # 2)   AI       (   ImportError      )
-        prompt = f"""
-You are an advertising creative director. Based on the following project information, generate 3 distinctly different creative concepts for a 30-second commercial video.
-For each option, output: title, logline, why_it_works. Return strictly JSON: {{"options":[...]}}
-Project title: {project_title}
-Duration (sec): {video_length_sec}
-User input (JSON): {json.dumps(user_input, ensure_ascii=False)}
-""".replace('{"options":[...]}', '{{"options":[...]}}').strip()
-
-        try:
-            data = _call_gemini_for_json(prompt)
-            parsed = CreativeOptionsPayload.model_validate(data)
-            opts = list(parsed.options or [])
-        except Exception as e:
-            log.warning("Gemini JSON parse/validation failed (creative options), falling back: %s", e)
-            base = (project_title or "Your Project").strip()
-            opts = [
-                CreativeOption(title=f"Concept A: {base}", logline="A concise logline based on the project objective.", why_it_works="Clear message with a strong hook."),
-                CreativeOption(title=f"Concept B: {base}", logline="An alternative angle with contrasting tone/mood.", why_it_works="Provides variety for comparison."),
-                CreativeOption(title=f"Concept C: {base}", logline="CTA-oriented angle highlighting the key benefit.", why_it_works="Direct and conversion-focused."),
-            ]
-
-        # 2b) Normalize to exactly 3 options (English-only comments).
-        if len(opts) > 3:
-            opts = opts[:3]
-        while len(opts) < 3:
-            idx_pad = len(opts) + 1
-            opts.append(CreativeOption(
-                title=f"Option {idx_pad}",
-                logline="(to be refined)",
-                why_it_works="Provides variety among concepts."
-            ))
-        # 3)    creative_options
         options_out = []
         for idx, opt in enumerate(opts):  # 0-based to satisfy DB CHECK (0,1,2)
             cur.execute(
@@ -264,84 +335,250 @@ User input (JSON): {json.dumps(user_input, ensure_ascii=False)}
     finally:
         cur.close()
 
-def select_creative_and_generate_storyboard(
-    db_conn, project_id: str, selected_creative_id: str
-) -> Tuple[Dict[str, Any], str]:
+def create_project_and_generate_creatives(
+    db_conn, user_id: str, user_input: Dict[str, Any]
+) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    Mark a creative as selected, and generate a storyboard based on it(Storyboard) +    QA.
-      : (storyboard_json, qa_critique_text)
+    Create a project and generate 3 creative options.
+    Returns: (project_id, creative_options)
     """
+    opts, prompt_version = generate_creative_options(user_input)
+    return persist_project_and_creatives(db_conn, user_id, user_input, opts, prompt_version)
+
+def load_creative(db_conn, project_id: str, creative_id: str) -> Dict[str, Any]:
+    """Fetch the selected creative option; ValueError when it does not belong to the project."""
     cur = db_conn.cursor()
     try:
-        # 1)          ;      
-        cur.execute("SELECT id, title, logline, why_it_works FROM creative_options WHERE id=%s AND project_id=%s",
-                    (selected_creative_id, project_id))
+        cur.execute(
+            "SELECT co.id, co.title, co.logline, co.why_it_works, p.video_length_sec "
+            "FROM creative_options co JOIN projects p ON p.id = co.project_id WHERE co.id=%s AND co.project_id=%s",
+            (creative_id, project_id))
         co = cur.fetchone()
-        if not co:
-            raise ValueError("Selected creative option not found for this project")
+    finally:
+        cur.close()
+    if not co:
+        raise ValueError("Selected creative option not found for this project")
+    return {"id": str(co[0]), "title": co[1], "logline": co[2], "why_it_works": co[3], "video_length_sec": co[4]}
+
+STORYBOARD_SECONDS_PER_SCENE = 3
+LIGHT_QA_DURATION_TOLERANCE = 0.2  # the storyboard total may be 20% off the target length
+
+def _storyboard_prompt(project_id: str, creative: Dict[str, Any]) -> Tuple[str, str]:
+    # (prompt, version) from prompt_storyboard (prompts.py); about 3 s per scene keeps 6-12 scenes for light QA
+    length = int(creative.get("video_length_sec") or 30)
+    return prompts.registry.render(
+        "storyboard",
+        SELECTED_CREATIVE_CONCEPT={k: creative.get(k) for k in ("title", "logline", "why_it_works")},
+        NUMBER_OF_SCENES=max(6, min(12, round(length / STORYBOARD_SECONDS_PER_SCENE))),
+        VIDEO_LENGTH_IN_SECONDS=length,
+    )
 
-        cur.execute("UPDATE creative_options SET is_selected = (id = %s) WHERE project_id=%s",
-                    (selected_creative_id, project_id))
+def _fallback_storyboard() -> Dict[str, Any]:
+    storyboard: Dict[str, Any] = {"scenes": []}
+    for i in range(1, 11):
+        storyboard["scenes"].append({
+            "number": i,
+            "title": f"Shot {i}",
+            "description": "Placeholder scene generated as a fallback.",
+            "visuals": "Key subject appears, simple motion.",
+            "voiceover": "N/A",
+            "duration_sec": 3
+        })
+    return storyboard
+
+def _generate_storyboard_payload(project_id: str, creative: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    prompt, version = _storyboard_prompt(project_id, creative)
+    data = _call_gemini_for_json(prompt)
+    try:
+        return StoryboardPayload.model_validate(data).model_dump(), version
+    except ValidationError as e:
+        log.warning("Validation Error from Gemini (storyboard): %s", e)
+        return _fallback_storyboard(), version
+
+_SPECULATIVE: Dict[Tuple[str, str], "llm_engine.LLMCall"] = {}
+_SPECULATIVE_LOCK = threading.Lock()
+
+def speculate_storyboards(project_id: str, creative_options: List[Dict[str, Any]]) -> int:
+    """
+    Start storyboard drafts for every creative option in the background (LLM_SPECULATIVE_STORYBOARDS=1).
+    The draft for the option the user picks is reused by generate_storyboard; the others are dropped.
+    """
+    if not SPECULATIVE_STORYBOARDS:
+        return 0
+    started = 0
+    with _SPECULATIVE_LOCK:
+        for co in creative_options:
+            key = (str(project_id), str(co["id"]))
+            if key in _SPECULATIVE:
+                continue
+            while len(_SPECULATIVE) >= SPECULATIVE_MAX_ENTRIES:
+                _SPECULATIVE.pop(next(iter(_SPECULATIVE))).cancel()
+            _SPECULATIVE[key] = llm_engine.engine.submit(_generate_storyboard_payload, str(project_id), co, label="storyboard-draft")
+            started += 1
+    return started
+
+def _take_speculative(project_id: str, creative_id: str) -> Optional["llm_engine.LLMCall"]:
+    with _SPECULATIVE_LOCK:
+        hit = _SPECULATIVE.pop((str(project_id), str(creative_id)), None)
+        for key in [k for k in _SPECULATIVE if k[0] == str(project_id)]:
+            _SPECULATIVE.pop(key).cancel()
+    return hit
+
+def generate_storyboard(project_id: str, creative: Dict[str, Any], deadline: Optional[float] = None) -> Tuple[Dict[str, Any], str]:
+    """Generate (or pick up the speculative draft of) a storyboard: (storyboard, prompt_storyboard version). No DB access."""
+    draft = _take_speculative(project_id, creative["id"])
+    if draft is not None:
+        try:
+            return draft.result()
+        except Exception as e:
+            log.warning("Speculative storyboard draft unusable, regenerating: %s", e)
+    return llm_engine.engine.run(_generate_storyboard_payload, project_id, creative, deadline=deadline)
+
+def _stream_gemini_text(prompt: str, system_instruction: Optional[str] = None) -> Iterator[str]:
+    """Yield text deltas from Gemini's streaming API (JSON mode)."""
+    model = gemini_client.get_model(DEFAULT_MODEL, system_instruction, JSON_GENERATION_CONFIG)
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except Exception:  # chunk without text parts (safety/finish metadata)
+            text = ""
+        if text:
+            yield text
 
-        # 2)   Prompt     
-        co_title, co_logline, co_reason = co[1], co[2], co[3]
-        prompt = f"""
-You are a senior storyboard director. Using the selected creative, generate a storyboard for approximately 30 seconds consisting of 8-12 shots.
-For each scene, output: number (sequence), title, description (shot content), visuals (key visuals), voiceover (narration/subtitle suggestions), duration_sec.
-Return strictly JSON: {{"scenes":[...]}}.
-Creative title: {co_title}
-Logline: {co_logline}
-Why it works: {co_reason}
-Project ID: {project_id}
-""".replace('{"scenes":[...]}', '{{"scenes":[...]}}').strip()
-
-        data = _call_gemini_for_json(prompt)
+def stream_storyboard(project_id: str, creative: Dict[str, Any], deadline: Optional[float] = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Streaming variant of generate_storyboard. Yields ("token", {"text"}) for each Gemini delta and
+    ("scene", scene) as soon as a scene has been parsed and validated against StoryboardScene,
+    then ("prompt_version", version) and ("storyboard", full_storyboard) last. Invalid scenes are skipped; when none validate the
+    placeholder storyboard is used (same fallback as the non-streaming path).
+    """
+    draft = _take_speculative(project_id, creative["id"])
+    if draft is not None:
         try:
-            storyboard = StoryboardPayload.model_validate(data).model_dump()
-        except ValidationError as e:
-            log.warning("Validation Error from Gemini (storyboard): %s", e)
-            storyboard = {"scenes": []}
-            for i in range(1, 11):
-                storyboard["scenes"].append({
-                    "number": i,
-                    "title": f"Shot {i}",
-                    "description": "Placeholder scene generated as a fallback.",
-                    "visuals": "Key subject appears, simple motion.",
-                    "voiceover": "N/A",
-                    "duration_sec": 3
-                })
-
-        # 3)  light QA (example: total duration / scene count)
-        scenes = storyboard["scenes"]
-        total_dur = sum(int(s.get("duration_sec") or 0) for s in scenes)
-        qa_pass = 15 <= total_dur <= 45 and 6 <= len(scenes) <= 16
-        qa_critique = f"Total duration ~{total_dur}s; Scenes={len(scenes)}; " \
-                      f"{'OK' if qa_pass else 'Consider adjusting duration/scene count'}"
-
-        # 4)    storyboards
+            storyboard, version = draft.result()
+            for scene in storyboard["scenes"]:
+                yield "scene", scene
+            yield "prompt_version", version
+            yield "storyboard", storyboard
+            return
+        except Exception as e:
+            log.warning("Speculative storyboard draft unusable, streaming a new one: %s", e)
+
+    prompt, version = _storyboard_prompt(project_id, creative)
+    key = llm_cache.cache_key(DEFAULT_MODEL, None, JSON_GENERATION_CONFIG, prompt)
+    cached = llm_cache.cache.get(key) if llm_cache.cache.enabled else llm_cache.MISSING
+    if cached is not llm_cache.MISSING:
+        try:
+            storyboard = StoryboardPayload.model_validate(cached).model_dump()
+            for scene in storyboard["scenes"]:
+                yield "scene", scene
+            yield "prompt_version", version
+            yield "storyboard", storyboard
+            return
+        except ValidationError:
+            pass
+
+    parser = streaming.SceneStreamParser()
+    scenes: List[Dict[str, Any]] = []
+    raw: List[str] = []
+    for text in llm_engine.engine.stream(_stream_gemini_text, prompt, deadline=deadline, label="storyboard-stream"):
+        raw.append(text)
+        yield "token", {"text": text}
+        for obj in parser.feed(text):
+            try:
+                scene = StoryboardScene.model_validate(obj).model_dump()
+            except ValidationError as e:
+                log.warning("Streamed scene failed validation, skipped: %s", e)
+                continue
+            scenes.append(scene)
+            yield "scene", scene
+
+    try:
+        # Same key as the non-streaming call, so either path can serve the other's result
+        llm_cache.cache.set(key, json.loads("".join(raw)))
+    except ValueError:
+        pass
+    if scenes:
+        storyboard = {"scenes": scenes}
+    else:
+        try:
+            storyboard = StoryboardPayload.model_validate(json.loads("".join(raw))).model_dump()
+        except (ValidationError, ValueError) as e:
+            log.warning("Validation Error from Gemini (streamed storyboard): %s", e)
+            storyboard = _fallback_storyboard()
+        for scene in storyboard["scenes"]:
+            yield "scene", scene
+    yield "prompt_version", version
+    yield "storyboard", storyboard
+
+def storyboard_light_qa(storyboard: Dict[str, Any], video_length_sec: Optional[int] = None) -> Tuple[bool, str]:
+    """Light QA: total duration within LIGHT_QA_DURATION_TOLERANCE of the target length, and the scene count."""
+    scenes = storyboard["scenes"]
+    target = int(video_length_sec or 30)
+    total_dur = round(sum(float(s.get("duration_sec") or 0) for s in scenes), 1)
+    slack = target * LIGHT_QA_DURATION_TOLERANCE
+    qa_pass = target - slack <= total_dur <= target + slack and 6 <= len(scenes) <= 16
+    qa_critique = f"Total duration ~{total_dur:g}s of {target}s; Scenes={len(scenes)}; " \
+                  f"{'OK' if qa_pass else 'Consider adjusting duration/scene count'}"
+    return qa_pass, qa_critique
+
+def persist_storyboard(
+    db_conn, project_id: str, selected_creative_id: str, storyboard: Dict[str, Any],
+    qa_pass: Optional[bool] = None, qa_critique: str = "", review: Optional["qa_critic.Review"] = None,
+    prompt_version: Optional[str] = None,
+) -> str:
+    """
+    Mark the creative as selected and insert the storyboard in one transaction. Returns the storyboard id.
+    prompt_version (from generate_storyboard) is recorded in projects.prompt_versions.
+    With a qa_critic review the row starts 'pending' unless the verdict is already known;
+    call review.write_back(storyboard_id) afterwards.
+    """
+    if review is not None:
+        qa = review.initial()
+    else:
+        qa = {"qa_status": "passed" if qa_pass else "failed", "qa_feedback": qa_critique, "qa_score": None, "qa_hash": None}
+    cur = db_conn.cursor()
+    try:
+        cur.execute("UPDATE creative_options SET is_selected = (id = %s) WHERE project_id=%s",
+                    (selected_creative_id, project_id))
         cur.execute(
             """
-            INSERT INTO storyboards (project_id, creative_option_id, scenes, qa_status, qa_feedback)
-            VALUES (%s, %s, %s::jsonb, %s, %s)
+            INSERT INTO storyboards (project_id, creative_option_id, scenes, qa_status, qa_feedback, qa_score, qa_hash)
+            VALUES (%s, %s, %s::jsonb, %s, %s, %s, %s)
             RETURNING id
             """,
-            (project_id, selected_creative_id, json.dumps(storyboard), 'passed' if qa_pass else 'failed', qa_critique),
+            (project_id, selected_creative_id, json.dumps(storyboard),
+             qa["qa_status"], qa["qa_feedback"], qa["qa_score"], qa["qa_hash"]),
         )
         sb_id = str(cur.fetchone()[0])
-
+        if prompt_version:
+            cur.execute("UPDATE projects SET prompt_versions = prompt_versions || jsonb_build_object('storyboard', %s::text) WHERE id=%s",
+                        (prompt_version, project_id))
         db_conn.commit()
-        return storyboard, qa_critique
-
-    except ValidationError:
-        db_conn.rollback()
-        #       (main.py    502)
-        raise
+        return sb_id
     except Exception:
         db_conn.rollback()
+        if review is not None:
+            review.cancel()
         raise
     finally:
         cur.close()
 
+def select_creative_and_generate_storyboard(
+    db_conn, project_id: str, selected_creative_id: str
+) -> Tuple[Dict[str, Any], str]:
+    """
+    Mark a creative as selected, and generate a storyboard based on it(Storyboard) +    QA.
+      : (storyboard_json, qa_critique_text)
+    """
+    creative = load_creative(db_conn, project_id, selected_creative_id)
+    storyboard, prompt_version = generate_storyboard(project_id, creative)
+    review = qa_critic.critic.start(storyboard, creative)
+    sb_id = persist_storyboard(db_conn, project_id, selected_creative_id, storyboard, review=review,
+                               prompt_version=prompt_version)
+    review.write_back(sb_id)
+    return storyboard, review.persisted["qa_feedback"]
+
 # ---------------------------------------------------------------------------
 # Onboarding conversation flow (minimal viable)
 # ---------------------------------------------------------------------------
@@ -489,12 +726,13 @@ def release_gate_finalize(db_conn, project_id: str) -> Dict[str, Any]:
 #    
 # ---------------------------------------------------------------------------
 
-def build_export_zip(db_conn, project_id: str) -> bytes:
+def build_export_stream(db_conn, project_id: str) -> zipstream.ZipStream:
     """
-         +      ,    zip:
+    Export package for a project's latest storyboard, as a ZipStream:
     - project.json
-    - storyboard.json  (  :{"scenes":[...]})
+    - storyboard.json  ({"scenes":[...]}, encoded while it is written into the archive)
     - readme.txt
+    Reads everything it needs up front; streaming the archive does not touch the DB.
     """
     cur = db_conn.cursor()
     try:
@@ -509,44 +747,49 @@ def build_export_zip(db_conn, project_id: str) -> bytes:
         sb = _fetchone_dict(cur)
         if not sb:
             raise ValueError("Storyboard not found for export")
-
-        scenes = None
-        sb_scenes = sb.get("scenes")
-        #    JSONB   str/dict/list     
-        if isinstance(sb_scenes, str):
-            try:
-                sb_scenes = json.loads(sb_scenes)
-            except Exception:
-                sb_scenes = {}
-        if isinstance(sb_scenes, dict):
-            scenes = sb_scenes.get("scenes")
-        elif isinstance(sb_scenes, list):
-            scenes = sb_scenes
-        if scenes is None:
-            scenes = []
-
-        #       {"scenes":[...]}
-        storyboard_out = {"scenes": scenes}
-
-        #   
-        bio = io.BytesIO()
-        with zipfile.ZipFile(bio, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr("project.json", json.dumps(proj, ensure_ascii=False, indent=2))
-            zf.writestr("storyboard.json", json.dumps(storyboard_out, ensure_ascii=False, indent=2))
-            readme = (
-                "PF Creative Studio Export\n"
-                f"Project: {proj.get('project_title')}\n"
-                f"Project ID: {project_id}\n"
-                f"Storyboard Scenes: {len(scenes)}\n"
-                f"QA: {sb.get('qa_status')} - {sb.get('qa_feedback')}\n"
-            )
-            zf.writestr("readme.txt", readme)
-
-        return bio.getvalue()
-
     finally:
         cur.close()
 
+    scenes = None
+    sb_scenes = sb.get("scenes")
+    #    JSONB   str/dict/list     
+    if isinstance(sb_scenes, str):
+        try:
+            sb_scenes = json.loads(sb_scenes)
+        except Exception:
+            sb_scenes = {}
+    if isinstance(sb_scenes, dict):
+        scenes = sb_scenes.get("scenes")
+    elif isinstance(sb_scenes, list):
+        scenes = sb_scenes
+    if scenes is None:
+        scenes = []
+
+    #       {"scenes":[...]}
+    storyboard_out = {"scenes": scenes}
+    readme = (
+        "PF Creative Studio Export\n"
+        f"Project: {proj.get('project_title')}\n"
+        f"Project ID: {project_id}\n"
+        f"Storyboard Scenes: {len(scenes)}\n"
+        f"QA: {sb.get('qa_status')} - {sb.get('qa_feedback')}\n"
+    )
+    encoder = json.JSONEncoder(ensure_ascii=False, indent=2, default=str)
+    created = sb.get("created_at")
+    # Storyboard rows are never rewritten, so id + created_at identify the scenes
+    entries = [
+        zipstream.Entry("project.json", encoder.encode(proj)),
+        zipstream.Entry("storyboard.json", lambda: encoder.iterencode(storyboard_out),
+                        fingerprint=f"storyboard:{sb.get('id')}:{created}"),
+        zipstream.Entry("readme.txt", readme),
+    ]
+    date_time = created.timetuple()[:6] if hasattr(created, "timetuple") else zipstream.DEFAULT_DATE_TIME
+    return zipstream.ZipStream(entries, date_time=date_time)
+
+def build_export_zip(db_conn, project_id: str) -> bytes:
+    """The whole export package in memory (background export jobs store it as an artifact)."""
+    return build_export_stream(db_conn, project_id).getvalue()
+
 # PF Director 2.0 — Orchestrator & Builders (APPEND-ONLY ADD-ON)
 # This is an append-only add-on. It does not modify existing functions.
 # All code/comments are in English. Safe to include in production.
@@ -554,18 +797,12 @@ def build_export_zip(db_conn, project_id: str) -> bytes:
 import json, re
 from typing import Any, Dict, List, Optional, Tuple
 
+import slot_extractor
+
 # ---------------------------- Director Steps ----------------------------
 STEP_ORDER: List[str] = ["G0","G1","G2","G3","G4","G5","G6","G7","G8","G9","G10","G11","G12","G13"]
 REQUIRED_SLOTS: List[str] = ["goal","audience","platform","duration_sec","key_message","cta"]
 
-PLATFORM_ALIASES: Dict[str, List[str]] = {
-    "tiktok": ["tiktok", "douyin", "抖音"],
-    "instagram reels": ["instagram reels", "ig reels", "insta reels", "reels"],
-    "youtube shorts": ["youtube shorts", "shorts", "yt shorts"],
-    "facebook reels": ["facebook reels", "fb reels"],
-    "wechat channels": ["wechat channels", "weixin video", "video accounts"],
-}
-
 RECOMMENDATIONS: Dict[str, str] = {
     "G1": "State one outcome, e.g., 'Drive store visits' or 'Launch a new product'.",
     "G2": "Think demographic + intent, e.g., 'Gen-Z in KL who love snacks'.",
@@ -583,49 +820,6 @@ RECOMMENDATIONS: Dict[str, str] = {
 }
 
 # ---------------------------- Slot Parsing ------------------------------
-_DURATION_RE = re.compile(r"(\\b(\\d+)\\s*(s|sec|secs|second|seconds)\\b)|(\\b(\\d+)\\s*(m|min|mins|minute|minutes)\\b)")
-_TONE_WORDS = {
-    "playful","fun","warm","heartwarming","epic","dramatic","casual","professional",
-    "authentic","inspiring","quirky","edgy","aspirational","minimal"
-}
-_STYLE_WORDS = {
-    "cinematic","ugc","asmr","vlog","tutorial","comedy","interview","montage",
-    "stop-motion","retro","surreal","documentary"
-}
-_URL_RE = re.compile(r"https?://[^\\s]+", re.I)
-
-def _detect_platform(text: str) -> Optional[str]:
-    t = (text or "").lower()
-    for k, aliases in PLATFORM_ALIASES.items():
-        for a in aliases:
-            if a in t:
-                return k
-    return None
-
-def _detect_duration_sec(text: str) -> Optional[int]:
-    t = (text or "").lower()
-    m = _DURATION_RE.search(t)
-    if not m:
-        m2 = re.search(r"\\b(\\d+)(s|m)\\b", t)
-        if m2:
-            val = int(m2.group(1)); unit = m2.group(2)
-            return val if unit == "s" else val * 60
-        return None
-    if m.group(2) and m.group(3):
-        return int(m.group(2))  # seconds
-    if m.group(5) and m.group(6):
-        return int(m.group(5)) * 60  # minutes
-    return None
-
-def _detect_tone_style(text: str) -> Tuple[Optional[str], Optional[str]]:
-    t = (text or "").lower()
-    tone = next((w for w in _TONE_WORDS if w in t), None)
-    style = next((w for w in _STYLE_WORDS if w in t), None)
-    return tone, style
-
-def _detect_references(text: str) -> List[str]:
-    return _URL_RE.findall(text or "")
-
 def normalize_slots(partial: Dict[str, Any]) -> Dict[str, Any]:
     out: Dict[str, Any] = {}
     if partial.get("platform"):
@@ -746,14 +940,12 @@ def director_orchestrator_chat(session_state: Dict[str, Any], user_text: str) ->
 
     # Extract from free text
     extracted: Dict[str, Any] = {}
-    p = _detect_platform(text)
-    if p: extracted["platform"] = p
-    d = _detect_duration_sec(text)
-    if d: extracted["duration_sec"] = d
-    tone, style = _detect_tone_style(text)
-    if tone and not slots.get("tone"): extracted["tone"] = tone
-    if style and not slots.get("style"): extracted["style"] = style
-    refs = _detect_references(text)
+    found = slot_extractor.default().extract(text, duration_hints=False)
+    if found.get("platform"): extracted["platform"] = found["platform"]
+    if found.get("duration_sec"): extracted["duration_sec"] = found["duration_sec"]
+    if found.get("tones") and not slots.get("tone"): extracted["tone"] = found["tones"][0]
+    if found.get("styles") and not slots.get("style"): extracted["style"] = found["styles"][0]
+    refs = found.get("urls")
     if refs:
         existing = set(slots.get("assets") or [])
         extracted["assets"] = list(existing.union(refs))
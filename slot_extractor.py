@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+slot_extractor.py
+Single-pass slot extraction for the director chat (main.py and services.py share it).
+
+The vocabulary comes from appendix_library.json (platforms with their labels, tones, styles,
+goals) plus the aliases both chat parsers used to carry (douyin, ig reels, ugc, quirky, ...).
+All of it is compiled into one regular expression per library version: URLs, durations with a unit, bare
+"quick" durations (the platforms' durations_sec) and every vocabulary term, longest alternative
+first so "instagram reels" wins over "reels". scan() walks the text once with finditer and
+returns every hit with its span; extract() folds the hits into slot values.
+
+    ex = slot_extractor.default()
+    ex.scan("TikTok 30s, playful and cinematic")
+    -> [Hit("platform", "TikTok", 0, 6), Hit("duration_sec", 30, 7, 10), Hit("tone", "playful", ...), ...]
+
+default() follows appendix.current(): a reloaded library recompiles the extractor once.
+
+Bench: python ops/bench_slot_extractor.py
+"""
+
+from __future__ import annotations
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+import appendix
+
+# Aliases not in the appendix library, keyed by the canonical label they map to
+EXTRA_PLATFORM_ALIASES: Dict[str, List[str]] = {
+    "TikTok": ["tiktok", "tik tok", "douyin", "抖音"],
+    "Instagram Reels": ["instagram reels", "instagram", "ig reels", "insta reels", "reels"],
+    "YouTube Shorts": ["youtube shorts", "youtube", "yt shorts", "shorts"],
+    "Facebook": ["facebook", "fb"],
+    "Facebook Reels": ["facebook reels", "fb reels"],
+    "WeChat Channels": ["wechat channels", "weixin video", "video accounts"],
+}
+EXTRA_TONES = ["fun", "warm", "casual", "professional", "authentic", "inspiring", "quirky", "edgy", "aspirational"]
+EXTRA_STYLES = ["tutorial", "comedy", "interview", "montage", "stop-motion"]
+# Words that name a goal on their own, keyed by goal id
+GOAL_CUES: Dict[str, List[str]] = {
+    "awareness": ["awareness"],
+    "conversions": ["conversion", "conversions"],
+    "app_installs": ["app install", "app installs"],
+    "event_promo": ["event promo", "event promotion"],
+    "lead_gen": ["lead gen", "lead generation"],
+}
+DEFAULT_QUICK_DURATIONS = (15, 20, 30, 45, 60)
+
+_SECOND_UNITS = ("seconds", "second", "secs", "sec", "s", "秒")
+_MINUTE_UNITS = ("minutes", "minute", "mins", "min", "m", "分钟")
+
+
+class Hit(NamedTuple):
+    slot: str     # platform | duration_sec | duration_hint | tone | style | goal | url
+    value: Any    # canonical value (platform label, seconds, lower-case word, goal label, URL)
+    start: int
+    end: int
+
+
+def _alternation(words: Iterable[str]) -> str:
+    # Longest first: Python's alternation takes the first branch that matches at a position
+    return "|".join(re.escape(w) for w in sorted(set(words), key=lambda w: (-len(w), w)))
+
+
+def _bounded(words: Iterable[str]) -> str:
+    """Alternation that only matches whole words (CJK terms match anywhere: no spaces between words)."""
+    words = set(words)
+    latin = [w for w in words if w.isascii()]
+    other = [w for w in words if not w.isascii()]
+    parts = []
+    if latin:
+        parts.append(rf"(?<![\w-])(?:{_alternation(latin)})(?![\w-])")
+    if other:
+        parts.append(f"(?:{_alternation(other)})")
+    return "|".join(parts) or "(?!)"
+
+
+class SlotExtractor:
+    def __init__(self, library: Optional[Mapping[str, Any]] = None):
+        library = library or {}
+        self.terms: Dict[str, Tuple[str, str]] = {}  # lower-case term -> (slot, canonical value)
+
+        for label, aliases in EXTRA_PLATFORM_ALIASES.items():
+            for a in aliases:
+                self.terms[a] = ("platform", label)
+        quick = set()
+        for p in library.get("platforms") or []:
+            label = p.get("label") or p.get("id")
+            for a in (p.get("id", "").replace("_", " "), label):
+                if a:
+                    self.terms[a.lower()] = ("platform", label)
+            quick.update(int(d) for d in p.get("durations_sec") or [])
+        for w in EXTRA_TONES + list(library.get("tones") or []):
+            self.terms.setdefault(w.lower(), ("tone", w.lower()))
+        for w in EXTRA_STYLES + list(library.get("styles") or []):
+            self.terms[w.lower()] = ("style", w.lower())  # a style word beats a tone alias ("minimal")
+        goals = {g.get("id"): g.get("label") for g in library.get("goals") or [] if g.get("id")}
+        for gid, label in goals.items():
+            for cue in GOAL_CUES.get(gid, []) + [label]:
+                self.terms[cue.lower()] = ("goal", label)
+        self.quick_durations = tuple(sorted(quick or DEFAULT_QUICK_DURATIONS))
+
+        self.pattern = re.compile(
+            r"(?P<url>https?://[^\s<>\"')\]]+)"
+            # Latin-only boundaries around numbers, so "发30秒视频" still reads as 30 seconds
+            rf"|(?<![A-Za-z0-9_.])(?P<num>\d{{1,4}})\s*(?:(?P<sec>{_alternation(_SECOND_UNITS)})|(?P<min>{_alternation(_MINUTE_UNITS)}))(?![A-Za-z])"
+            rf"|(?<![A-Za-z0-9_.])(?P<quick>{_alternation(str(d) for d in self.quick_durations)})(?![A-Za-z0-9_.])"
+            rf"|(?P<term>{_bounded(self.terms)})",
+            re.IGNORECASE,
+        )
+
+    def scan(self, text: str) -> List[Hit]:
+        """Every slot hit in `text`, in order, with its span."""
+        hits: List[Hit] = []
+        for m in self.pattern.finditer(text or ""):
+            kind = m.lastgroup
+            if kind == "url":
+                hits.append(Hit("url", m.group("url").rstrip(".,;:!?"), m.start(), m.end()))
+            elif kind in ("sec", "min"):
+                n = int(m.group("num"))
+                hits.append(Hit("duration_sec", n * 60 if kind == "min" else n, m.start(), m.end()))
+            elif kind == "quick":
+                hits.append(Hit("duration_hint", int(m.group("quick")), m.start(), m.end()))
+            else:
+                slot, value = self.terms[m.group("term").lower()]
+                hits.append(Hit(slot, value, m.start(), m.end()))
+        return hits
+
+    def extract(self, text: str, duration_hints: bool = True) -> Dict[str, Any]:
+        """
+        Slot values from one message: platform / goal / duration_sec take the first hit (a duration
+        with a unit beats a bare quick number, which only counts with duration_hints), tone / style /
+        url keep every distinct hit in order under "tones" / "styles" / "urls".
+        """
+        out: Dict[str, Any] = {}
+        hint = None
+        for h in self.scan(text):
+            if h.slot in ("tone", "style", "url"):
+                seen = out.setdefault(h.slot + "s", [])
+                if h.value not in seen:
+                    seen.append(h.value)
+            elif h.slot == "duration_hint":
+                hint = h.value if hint is None else hint
+            else:
+                out.setdefault(h.slot, h.value)
+        if "duration_sec" not in out and hint is not None and duration_hints:
+            out["duration_sec"] = hint
+        return out
+
+
+_default: Optional[Tuple[str, SlotExtractor]] = None
+_default_lock = threading.Lock()
+
+
+def default() -> SlotExtractor:
+    """Process-wide extractor over the current appendix library, recompiled when its version changes."""
+    global _default
+    lib = appendix.current()
+    cached = _default
+    if cached is None or cached[0] != lib.version:
+        with _default_lock:
+            cached = _default
+            if cached is None or cached[0] != lib.version:
+                cached = _default = (lib.version, SlotExtractor(lib.data))
+    return cached[1]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+streaming.py
+Incremental responses for the director endpoints.
+
+- negotiate() picks the wire format: Server-Sent Events (`?stream=1`, `?stream=sse`,
+  `Accept: text/event-stream`) or chunked NDJSON (`?stream=ndjson`, `Accept: application/x-ndjson`)
+- encode() renders one (event, data) pair in that format
+- SceneStreamParser pulls complete scene objects out of a partial `{"scenes":[...]}` JSON text
+  as Gemini streams it, so each scene can be validated and sent before the rest exists
+- instrument() wraps an event iterator and records time-to-first-byte / time-to-first-scene
+  per endpoint; stats() feeds /healthz/streaming
+"""
+
+from __future__ import annotations
+import json
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+log = logging.getLogger("pf.stream")
+
+MIMETYPES = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+}
+
+# Sent with every streaming response; X-Accel-Buffering stops nginx-style proxies from buffering
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+def negotiate(args: Mapping[str, str], accept: Optional[str]) -> Optional[str]:
+    """Return "sse", "ndjson" or None (plain JSON response)."""
+    mode = (args.get("stream") or "").strip().lower()
+    if mode in ("ndjson", "jsonl"):
+        return "ndjson"
+    if mode in ("1", "true", "sse"):
+        return "sse"
+    accept = (accept or "").lower()
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return None
+
+def encode(fmt: str, event: str, data: Any) -> str:
+    if fmt == "ndjson":
+        return json.dumps({"event": event, "data": data}, ensure_ascii=False, default=str) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+# ---------------------------------------------------------------------------
+# Incremental scene extraction
+# ---------------------------------------------------------------------------
+class SceneStreamParser:
+    """
+    Feed raw JSON text chunks; get back each object that is a direct element of the first
+    array in the document (the `scenes` list, or a bare top-level array) once it is complete.
+    Tracks strings/escapes so braces inside text values do not confuse the depth count.
+    """
+
+    def __init__(self):
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._array_depth: Optional[int] = None
+        self._buf: List[str] = []
+        self._capturing = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for ch in text:
+            if self._capturing:
+                self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append(ch)
+                if ch == "[" and self._array_depth is None:
+                    self._array_depth = len(self._stack)
+                elif ch == "{" and self._array_depth is not None and len(self._stack) == self._array_depth + 1:
+                    self._capturing = True
+                    self._buf = ["{"]
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._capturing and len(self._stack) == self._array_depth:
+                    self._capturing = False
+                    try:
+                        obj = json.loads("".join(self._buf))
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        out.append(obj)
+                    self._buf = []
+                elif ch == "]" and self._array_depth is not None and len(self._stack) < self._array_depth:
+                    # first array closed: nothing after it is a scene
+                    self._array_depth = -1
+        return out
+
+# ---------------------------------------------------------------------------
+# Instrumentation
+# ---------------------------------------------------------------------------
+class StreamMetrics:
+    """Per-endpoint time-to-first-byte / time-to-first-scene / total duration (recent samples)."""
+
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples: Dict[str, Dict[str, Deque[float]]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def record(self, endpoint: str, **values_ms: Optional[float]) -> None:
+        with self._lock:
+            per = self._samples.setdefault(endpoint, {})
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            for k, v in values_ms.items():
+                if v is not None:
+                    per.setdefault(k, deque(maxlen=self._window)).append(v)
+
+    def stats(self) -> Dict[str, Any]:
+        def pct(vals: List[float], p: float) -> float:
+            return round(vals[min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))], 2)
+
+        with self._lock:
+            out: Dict[str, Any] = {}
+            for endpoint, per in self._samples.items():
+                entry: Dict[str, Any] = {"streams": self._counts.get(endpoint, 0)}
+                for k, dq in per.items():
+                    vals = sorted(dq)
+                    entry[k] = {"p50": pct(vals, 50), "p95": pct(vals, 95), "max": round(vals[-1], 2)}
+                out[endpoint] = entry
+            return out
+
+metrics = StreamMetrics()
+
+def instrument(fmt: str, endpoint: str, events: Iterable[Tuple[str, Any]],
+               started: Optional[float] = None) -> Iterator[str]:
+    """Encode events and record ttfb / first-scene / total timings for `endpoint`."""
+    t0 = started if started is not None else time.perf_counter()
+    ttfb = first_scene = None
+    n = 0
+    try:
+        for event, data in events:
+            chunk = encode(fmt, event, data)
+            now = time.perf_counter()
+            if ttfb is None:
+                ttfb = (now - t0) * 1000.0
+            if first_scene is None and event == "scene":
+                first_scene = (now - t0) * 1000.0
+            n += 1
+            yield chunk
+    finally:
+        total = (time.perf_counter() - t0) * 1000.0
+        metrics.record(endpoint, ttfb_ms=ttfb, first_scene_ms=first_scene, total_ms=total)
+        log.info("stream %s fmt=%s events=%s ttfb=%sms first_scene=%sms total=%.0fms", endpoint, fmt, n,
+                 None if ttfb is None else round(ttfb), None if first_scene is None else round(first_scene), total)
+
+def stats() -> Dict[str, Any]:
+    return metrics.stats()
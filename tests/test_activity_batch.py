@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeConn:
+    def __init__(self):
+        self.batches = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def ingest(monkeypatch):
+    conn = FakeConn()
+    monkeypatch.setattr(main, "get_conn", lambda: conn)
+    monkeypatch.setattr(main, "put_conn", lambda c: None)
+    monkeypatch.setattr(main.activity_writer, "insert_events", lambda cur, events: conn.batches.append(list(events)))
+    main.app.config["TESTING"] = True
+
+    def post(body, content_type="application/json"):
+        with main.app.test_client() as client:
+            return client.post("/activity/log/batch", data=body, headers={"Content-Type": content_type,
+                                                                          "User-Agent": "pytest"})
+    post.conn = conn
+    return post
+
+
+def test_json_array_is_inserted_in_one_statement(ingest):
+    res = ingest(json.dumps([
+        {"action": "page_view", "details": {"path": "/"}},
+        {"actor": "alice", "action": "click"},
+    ]))
+    body = res.get_json()
+    assert res.status_code == 200
+    assert body["ok"] is True and body["accepted"] == 2 and body["rejected"] == 0
+    assert len(ingest.conn.batches) == 1 and ingest.conn.commits == 1
+    actors = [e[1] for e in ingest.conn.batches[0]]
+    assert actors == ["web", "alice"]
+    assert json.loads(ingest.conn.batches[0][0][3]) == {"path": "/"}
+    assert ingest.conn.batches[0][0][5] == "pytest"
+
+
+def test_ndjson_beacon_reports_per_item_status(ingest):
+    lines = "\n".join([
+        json.dumps({"action": "ok_one"}),
+        "{not json",
+        json.dumps({"actor": "web"}),
+        json.dumps({"action": "ok_two", "details": "nope"}),
+        json.dumps({"action": "ok_three"}),
+    ])
+    res = ingest(lines, content_type="text/plain")
+    body = res.get_json()
+    assert res.status_code == 200
+    assert body["accepted"] == 2 and body["rejected"] == 3 and body["ok"] is False
+    assert [r["ok"] for r in body["results"]] == [True, False, False, False, True]
+    assert "invalid JSON" in body["results"][1]["error"]
+    assert "action" in body["results"][2]["error"]
+    assert [e[2] for e in ingest.conn.batches[0]] == ["ok_one", "ok_three"]
+
+
+def test_events_envelope_and_limits(ingest, monkeypatch):
+    res = ingest(json.dumps({"events": [{"action": "a"}]}))
+    assert res.get_json()["accepted"] == 1
+
+    assert ingest("[{").status_code == 400
+
+    monkeypatch.setattr(main.schemas, "ACTIVITY_BATCH_MAX", 2)
+    res = ingest(json.dumps([{"action": "a"}] * 3))
+    assert res.status_code == 413
+
+    ingest.conn.batches.clear()
+    res = ingest(json.dumps([{"action": ""}]))
+    assert res.get_json()["accepted"] == 0
+    assert ingest.conn.batches == []
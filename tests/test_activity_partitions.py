@@ -0,0 +1,178 @@
+"""
+Monthly activity_logs partitions, rollups and retention. The DB-backed tests run against a real
+PostgreSQL (PF_TEST_DATABASE_URL; skipped otherwise) in a throwaway schema.
+"""
+import datetime
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import activity_partitions as ap
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+needs_db = pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+
+UTC = datetime.timezone.utc
+NOW = datetime.datetime(2025, 6, 15, 12, 30, tzinfo=UTC)
+
+
+def test_month_arithmetic():
+    m = ap.month_start(datetime.datetime(2025, 12, 31, 23, 59, tzinfo=UTC))
+    assert m == datetime.datetime(2025, 12, 1, tzinfo=UTC)
+    assert ap.add_months(m, 1) == datetime.datetime(2026, 1, 1, tzinfo=UTC)
+    assert ap.add_months(m, -12) == datetime.datetime(2024, 12, 1, tzinfo=UTC)
+    assert ap.partition_name(m) == "activity_logs_p202512"
+
+
+@pytest.fixture
+def pool():
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_partitions_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    p = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    with p.connection() as conn:
+        migrations.apply_migrations(conn)
+    yield p
+    p.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+    admin.close()
+
+
+def _insert(conn, *rows):
+    cur = conn.cursor()
+    for ts, actor, action in rows:
+        cur.execute("INSERT INTO activity_logs (ts, actor, action, details) VALUES (%s, %s, %s, '{}')", (ts, actor, action))
+    conn.commit()
+
+
+def _where(conn, ts):
+    cur = conn.cursor()
+    cur.execute("SELECT tableoid::regclass::text FROM activity_logs WHERE ts = %s", (ts,))
+    return [r[0] for r in cur.fetchall()]
+
+
+@needs_db
+def test_new_partition_takes_over_rows_caught_by_default(pool):
+    early = datetime.datetime(2025, 5, 3, tzinfo=UTC)
+    with pool.connection() as conn:
+        _insert(conn, (early, "alice", "login"))
+        assert _where(conn, early) == ["activity_logs_default"]
+        report = ap.maintain(conn, now=NOW - datetime.timedelta(days=40))
+        assert "activity_logs_p202505" in report["created"]
+        assert _where(conn, early) == ["activity_logs_p202505"]
+        names = [n for n, _ in ap.list_partitions(conn.cursor())]
+        assert {"activity_logs_p202505", "activity_logs_p202506", "activity_logs_p202507"} <= set(names)
+
+
+@needs_db
+def test_rollups_recount_and_absorb_late_events(pool):
+    h = datetime.datetime(2025, 6, 15, 10, tzinfo=UTC)
+    with pool.connection() as conn:
+        ap.ensure_partitions(conn.cursor(), NOW)
+        _insert(conn, (h, "alice", "login"), (h + datetime.timedelta(minutes=5), "bob", "login"),
+                (h + datetime.timedelta(hours=1), "alice", "export"))
+        cur = conn.cursor()
+        ap.refresh_rollups(cur, NOW)
+        ap.refresh_rollups(cur, NOW)  # idempotent
+        _insert(conn, (h + datetime.timedelta(hours=1, minutes=30), "carol", "login"))  # late event
+        ap.refresh_rollups(cur, NOW)
+        conn.commit()
+        cur.execute("SELECT bucket, action, SUM(events) FROM activity_rollup_hourly GROUP BY 1, 2 ORDER BY 1, 2")
+        assert cur.fetchall() == [(h, "login", 2), (h + datetime.timedelta(hours=1), "export", 1),
+                                  (h + datetime.timedelta(hours=1), "login", 1)]
+        cur.execute("SELECT bucket, action, SUM(events) FROM activity_rollup_daily GROUP BY 1, 2 ORDER BY 2")
+        day = datetime.datetime(2025, 6, 15, tzinfo=UTC)
+        assert cur.fetchall() == [(day, "export", 1), (day, "login", 3)]
+
+
+@needs_db
+def test_daily_rollup_uses_utc_days_in_a_non_utc_session(pool):
+    early = datetime.datetime(2025, 6, 15, 1, tzinfo=UTC)
+    late = datetime.datetime(2025, 6, 15, 20, tzinfo=UTC)  # 04:00 on the 16th in Kuala Lumpur
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SET TIME ZONE 'Asia/Kuala_Lumpur'")
+        ap.ensure_partitions(cur, NOW)
+        conn.commit()
+        _insert(conn, (early, "alice", "login"), (late, "alice", "login"))
+        until = datetime.datetime(2025, 6, 15, 21, tzinfo=UTC)
+        ap.refresh_rollups(cur, until)
+        # `last` now comes back as a +08:00 timestamp; the recount must still cover the whole UTC day
+        ap.refresh_rollups(cur, until, lookback_hours=2)
+        conn.commit()
+        cur.execute("SELECT bucket, SUM(events) FROM activity_rollup_daily GROUP BY 1")
+        assert cur.fetchall() == [(datetime.datetime(2025, 6, 15, tzinfo=UTC), 2)]
+
+
+@needs_db
+@pytest.mark.parametrize("mode", ["drop", "detach"])
+def test_retention_removes_old_months_only(pool, mode):
+    old = datetime.datetime(2024, 3, 10, tzinfo=UTC)
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        ap.create_partition(cur, ap.month_start(old))
+        ap.ensure_partitions(cur, NOW)
+        conn.commit()
+        _insert(conn, (old, "alice", "login"), (NOW, "alice", "login"))
+        # Not rolled up past that month yet: nothing may go
+        assert ap.apply_retention(cur, NOW, months=12, mode=mode, rolled_through=old) == []
+        assert ap.apply_retention(cur, NOW, months=12, mode=mode, rolled_through=NOW) == ["activity_logs_p202403"]
+        conn.commit()
+        cur.execute("SELECT COUNT(*) FROM activity_logs")
+        assert cur.fetchone()[0] == 1
+        cur.execute("SELECT to_regclass('activity_logs_p202403') IS NOT NULL")
+        assert cur.fetchone()[0] == (mode == "detach")
+
+
+@needs_db
+def test_time_range_query_touches_one_partition(pool):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        ap.ensure_partitions(cur, NOW)
+        conn.commit()
+        cur.execute(
+            "EXPLAIN (FORMAT JSON) SELECT id FROM activity_logs "
+            "WHERE ts >= '2025-06-02' AND ts < '2025-06-09' ORDER BY ts DESC, id DESC LIMIT 50"
+        )
+        plan = json.dumps(cur.fetchone()[0])
+        assert "activity_logs_p202506" in plan
+        assert "activity_logs_p202507" not in plan and "activity_logs_default" not in plan
+
+
+@needs_db
+def test_summary_endpoint_reads_rollups(pool, monkeypatch):
+    import main
+
+    with pool.connection() as conn:
+        ap.ensure_partitions(conn.cursor(), NOW)
+        conn.commit()
+        _insert(conn, (NOW, "alice", "login"), (NOW, "bob", "login"), (NOW, "bob", "export"))
+        cur = conn.cursor()
+        ap.refresh_rollups(cur, NOW + datetime.timedelta(hours=1))
+        conn.commit()
+        cur.execute("DELETE FROM activity_logs")  # the summary must not depend on raw rows
+        conn.commit()
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "ADMIN_LOCKDOWN", False)
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as c:
+        res = c.get("/admin/activity/summary?granularity=day&since=2025-06-01&until=2025-07-01",
+                    headers={"X-Admin-Password": main.ADMIN_PASSWORD}).get_json()
+        assert res["total"] == 3
+        assert [(b["action"], b["events"]) for b in res["buckets"]] == [("export", 1), ("login", 2)]
+        res = c.get("/admin/activity/summary?granularity=hour&group_by=actor&since=2025-06-01&until=2025-07-01",
+                    headers={"X-Admin-Password": main.ADMIN_PASSWORD}).get_json()
+        assert [(b["actor"], b["events"]) for b in res["buckets"]] == [("alice", 1), ("bob", 2)]
+        assert c.get("/admin/activity/summary?granularity=week",
+                     headers={"X-Admin-Password": main.ADMIN_PASSWORD}).status_code == 400
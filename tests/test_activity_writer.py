@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import activity_writer  # noqa: E402
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+
+
+class Sink:
+    """Stands in for the pool: records every committed batch."""
+
+    def __init__(self, fail_times=0, delay=0.0):
+        self.batches = []
+        self.fail_times = fail_times
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def write(self, cur, events):
+        time.sleep(self.delay)
+        with self.lock:
+            if self.fail_times:
+                self.fail_times -= 1
+                raise RuntimeError("db down")
+            self.batches.append(list(events))
+
+
+def _writer(sink, **kw):
+    kw.setdefault("flush_ms", 20)
+    return activity_writer.ActivityWriter(sink.connection, writer=sink.write, **kw)
+
+
+def _ev(i):
+    return activity_writer.make_event("u", f"a{i}", {"i": i})
+
+
+def test_batches_by_size_and_interval():
+    sink = Sink()
+    w = _writer(sink, batch_size=10, flush_ms=50).start()
+    for i in range(25):
+        assert w.submit(_ev(i))
+    assert w.flush(2)
+    assert [len(b) for b in sink.batches][:2] == [10, 10]
+    assert sum(len(b) for b in sink.batches) == 25
+    assert w.stats()["written"] == 25
+    w.close()
+
+
+def test_drop_policy_counts_overflow():
+    sink = Sink()
+    w = _writer(sink, max_queue=5, policy="drop")  # not started: nothing drains
+    accepted = [w.submit(_ev(i)) for i in range(8)]
+    assert accepted.count(True) == 5
+    assert w.stats()["dropped"] == 3
+
+
+def test_sample_policy_thins_events_near_capacity():
+    sink = Sink()
+    w = _writer(sink, max_queue=100, policy="sample", sample_rate=1000)
+    accepted = sum(w.submit(_ev(i)) for i in range(200))
+    assert 80 <= accepted < 100
+    assert w.stats()["sampled_out"] > 0
+
+
+def test_block_policy_waits_for_space():
+    sink = Sink(delay=0.01)
+    w = _writer(sink, max_queue=2, batch_size=1, policy="block", block_timeout_ms=2000).start()
+    assert all(w.submit(_ev(i)) for i in range(10))
+    assert w.flush(2)
+    assert sum(len(b) for b in sink.batches) == 10
+    w.close()
+
+
+def test_close_flushes_pending_events_and_retries_a_failed_write():
+    sink = Sink(fail_times=1)
+    w = _writer(sink, batch_size=1000, flush_ms=10_000).start()
+    for i in range(7):
+        w.submit(_ev(i))
+    w.close()
+    assert sum(len(b) for b in sink.batches) == 7
+    assert w.stats()["write_errors"] == 1
+    assert not w.submit(_ev(99))
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        activity_writer.ActivityWriter(lambda: None, policy="explode")
+
+
+@pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+def test_multi_row_insert_against_postgres():
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_activity_w_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    try:
+        with pool.connection() as conn:
+            migrations.apply_migrations(conn)
+        w = activity_writer.ActivityWriter(pool.connection, batch_size=50, flush_ms=20).start()
+        for i in range(120):
+            w.submit(_ev(i))
+        w.close()
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT action) FROM activity_logs")
+            assert cur.fetchone() == (120, 120)
+        assert w.stats()["batches"] == 3
+    finally:
+        pool.closeall()
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.commit()
+        admin.close()
@@ -0,0 +1,99 @@
+import json
+import os
+import signal
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import appendix
+import main
+import slot_extractor
+
+LIBRARY = {
+    "goals": [{"id": "awareness", "label": "Brand awareness"}],
+    "tones": ["playful", "Calm"],
+    "styles": ["ugc"],
+    "platforms": [
+        {"id": "tiktok", "label": "TikTok", "durations_sec": [30, 15, 60]},
+        {"id": "youtube_shorts", "label": "YouTube Shorts", "durations_sec": [20, 60]},
+    ],
+    "narrative_templates": [{"id": "hook-build-payoff", "beats": [{"name": "Hook"}]}],
+}
+
+
+def _write(path, data):
+    path.write_text(json.dumps(data), encoding="utf-8")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))  # a distinct mtime even on coarse clocks
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    path = tmp_path / "appendix_library.json"
+    _write(path, LIBRARY)
+    service = appendix.LibraryService(paths=[str(path)], check_interval=0)
+    monkeypatch.setattr(appendix, "service", service)
+    return path, service
+
+
+def test_snapshot_precomputes_body_etag_and_indexes(library):
+    lib = appendix.current()
+    assert json.loads(lib.body) == LIBRARY
+    assert lib.platform("youtube_shorts") is lib.platform("YouTube shorts")
+    assert lib.durations_by_platform["tiktok"] == (15, 30, 60)
+    assert lib.durations == (15, 20, 30, 60)
+    assert lib.platform_labels == ("TikTok", "YouTube Shorts")
+    assert "calm" in lib.tone_set and lib.goal_labels == ("Brand awareness",)
+    assert appendix.current() is lib  # unchanged file: same snapshot
+
+
+def test_reloads_on_mtime_change_and_keeps_last_good_version(library):
+    path, service = library
+    first = appendix.current()
+    _write(path, dict(LIBRARY, tones=["moody"]))
+    second = appendix.current()
+    assert second.etag != first.etag and second.tones == ("moody",)
+    assert service.stats()["reloads"] == 1
+
+    path.write_text("{broken", encoding="utf-8")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 2_000_000))
+    assert appendix.current() is second
+    assert service.stats()["reload_errors"] == 1
+
+
+def test_sighup_forces_a_reload(library, monkeypatch):
+    path, service = library
+    service.check_interval = 3600
+    first = appendix.current()
+    _write(path, dict(LIBRARY, styles=["cinematic"]))
+    assert appendix.current() is first  # not due for a check yet
+
+    monkeypatch.setattr(signal, "getsignal", lambda s: signal.SIG_DFL)
+    installed = {}
+    monkeypatch.setattr(signal, "signal", lambda s, h: installed.setdefault(s, h))
+    assert appendix.install_sighup()
+    installed[signal.SIGHUP](signal.SIGHUP, None)
+    assert appendix.current().styles == ("cinematic",)
+
+
+def test_slot_extractor_follows_the_library_version(library):
+    path, _ = library
+    assert slot_extractor.default().extract("make it moody") == {}
+    _write(path, dict(LIBRARY, tones=["moody"]))
+    assert slot_extractor.default().extract("make it moody") == {"tones": ["moody"]}
+
+
+def test_library_route_serves_precomputed_body_with_etag(library):
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as c:
+        resp = c.get("/v1/director/library")
+        assert resp.status_code == 200 and resp.get_json() == LIBRARY
+        etag = resp.headers["ETag"]
+        assert "max-age=" in resp.headers["Cache-Control"]
+        assert resp.headers["X-Library-Version"] == appendix.current().version
+
+        assert c.get("/v1/director/library", headers={"If-None-Match": etag}).status_code == 304
+        _write(library[0], dict(LIBRARY, tones=["moody"]))
+        assert c.get("/v1/director/library", headers={"If-None-Match": etag}).status_code == 200
@@ -0,0 +1,148 @@
+import logging
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+
+
+def test_hot_token_is_served_from_cache():
+    a = auth.Authenticator("s3cret")
+    token = a.issue("alice", version=2)
+    first = a.verify(token)
+    assert first["username"] == "alice" and first["ver"] == 2 and first["jti"]
+    assert a.verify(token) == first
+    stats = a.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1 and stats["cached_tokens"] == 1
+
+
+def test_cache_honours_exp_and_size():
+    cache = auth.TokenCache(max_entries=2)
+    now = time.time()
+    cache.set(b"a", {"exp": now + 10})
+    assert cache.get(b"a", now) is not None
+    assert cache.get(b"a", now + 11) is None  # expired entries are never served
+    cache.set(b"b", {"exp": now + 10})
+    cache.set(b"c", {"exp": now + 10})
+    cache.set(b"d", {"exp": now + 10})
+    assert cache.get(b"b", now) is None and len(cache) == 2
+    cache.set(b"noexp", {"username": "x"})
+    assert cache.get(b"noexp", now) is None
+
+
+def test_invalid_tokens_are_rejected_quietly(caplog):
+    a = auth.Authenticator("s3cret")
+    forged = auth.Authenticator("other").issue("mallory")
+    with caplog.at_level(logging.WARNING, logger="pf.auth"):
+        assert a.verify(forged) is None
+        assert a.verify("not-a-jwt") is None
+    assert not caplog.records
+    assert a.stats()["invalid"] == 2
+
+
+def test_revocation_by_jti_and_version():
+    state = {"jtis": set(), "versions": {}}
+    a = auth.Authenticator("s3cret")
+    a.revocations = auth.RevocationCache(lambda: (set(state["jtis"]), dict(state["versions"])), ttl=3600)
+    one, two = a.issue("alice"), a.issue("alice")
+    assert a.verify(one) and a.verify(two)
+
+    a.revocations.add_jti(a.verify(one)["jti"])
+    assert a.verify(one) is None and a.verify(two)
+
+    a.revocations.set_version("alice", 1)
+    assert a.verify(two) is None
+    assert a.verify(a.issue("alice", version=1))
+    assert a.stats()["revoked"] == 2
+
+
+def test_revocation_snapshot_refreshes_after_ttl():
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return ({"gone"} if len(calls) > 1 else set()), {}
+
+    cache = auth.RevocationCache(loader, ttl=0.05)
+    assert not cache.is_revoked({"jti": "gone"})
+    assert not cache.is_revoked({"jti": "gone"})  # still within the TTL: no reload
+    assert len(calls) == 1
+    time.sleep(0.06)
+    assert cache.is_revoked({"jti": "gone"})
+    assert len(calls) == 2
+
+
+def test_require_auth_rejects_missing_token():
+    import main
+
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as client:
+        assert client.get("/get-user-status").status_code == 401
+        assert client.get("/get-user-status", headers={"Authorization": "Bearer junk"}).status_code == 401
+
+
+@pytest.fixture
+def db_client(monkeypatch):
+    import psycopg2
+    import db
+    import main
+    import migrations
+    from werkzeug.security import generate_password_hash
+
+    schema = "pf_auth_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    with pool.connection() as conn:
+        migrations.apply_migrations(conn)
+        conn.cursor().execute("INSERT INTO users (username, password) VALUES ('alice', %s)",
+                              (generate_password_hash("pw"),))
+        conn.commit()
+    a = auth.Authenticator(main.JWT_SECRET)
+    a.attach(pool.connection, ttl=3600)
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "authenticator", a)
+    monkeypatch.setattr(auth, "authenticator", a)
+    monkeypatch.setattr(main, "ADMIN_LOCKDOWN", False)
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as c:
+        yield c, main
+    pool.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+    admin.close()
+
+
+def _login(c):
+    return c.post("/login", json={"username": "alice", "password": "pw"}).get_json()["token"]
+
+
+@pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+def test_logout_and_admin_revocation(db_client):
+    c, main = db_client
+    t1, t2 = _login(c), _login(c)
+    hdr = lambda t: {"Authorization": f"Bearer {t}"}
+    assert c.get("/get-user-status", headers=hdr(t1)).status_code == 200
+
+    assert c.post("/logout", headers=hdr(t1)).get_json()["revoked"] is True
+    assert c.get("/get-user-status", headers=hdr(t1)).status_code == 401
+    assert c.get("/get-user-status", headers=hdr(t2)).status_code == 200
+
+    res = c.post("/admin/revoke-tokens", json={"username": "alice"}, headers={"X-Admin-Password": main.ADMIN_PASSWORD})
+    assert res.get_json()["token_version"] == 1
+    assert c.get("/get-user-status", headers=hdr(t2)).status_code == 401
+    t3 = _login(c)
+    assert c.get("/get-user-status", headers=hdr(t3)).status_code == 200
+
+    # A fresh process sees the same state from the database
+    fresh = auth.Authenticator(main.JWT_SECRET)
+    fresh.attach(main.db_pool.connection)
+    assert fresh.verify(t1) is None and fresh.verify(t2) is None and fresh.verify(t3)
@@ -0,0 +1,117 @@
+"""
+Billplz webhook: signature variants and the payments dedup gate (the DB part needs PF_TEST_DATABASE_URL).
+"""
+import hashlib
+import hmac
+import os
+import sys
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+KEY = "sig-key"
+
+
+def _signed_form(fields, variant="B"):
+    if variant == "A":
+        signed = urlencode(fields).encode("utf-8")
+    else:
+        signed = urlencode(sorted(fields.items())).encode("utf-8")
+    return {**fields, "x_signature": hmac.new(KEY.encode(), signed, hashlib.sha256).hexdigest()}
+
+
+def test_matching_variant_is_tried_first_next_time(monkeypatch):
+    monkeypatch.setattr(main, "_billplz_sig_preferred", "A")
+    form = _signed_form({"id": "b1", "paid": "true", "reference_1": "alice"}, variant="B")
+    with main.app.test_request_context("/webhook-billplz", method="POST", data=form):
+        assert main.billplz_signature_variant(main.request, KEY) == "B"
+    assert main._billplz_sig_preferred == "B"
+
+    calls = []
+    real = main._billplz_signed_bytes
+    monkeypatch.setattr(main, "_billplz_signed_bytes", lambda req, v: calls.append(v) or real(req, v))
+    with main.app.test_request_context("/webhook-billplz", method="POST", data=form):
+        assert main.verify_billplz_signature(main.request, KEY)
+        assert not main.verify_billplz_signature(main.request, "other-key")
+    assert calls[0] == "B" and calls.count("B") == 2
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    if not DSN:
+        pytest.skip("PF_TEST_DATABASE_URL not set")
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_payments_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    with pool.connection() as conn:
+        migrations.apply_migrations(conn)
+        conn.cursor().execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+        conn.commit()
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "BILLPLZ_X_SIGNATURE_KEY", KEY)
+    monkeypatch.setattr(main, "_billplz_seen_bills", OrderedDict())
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as c:
+        yield c, pool
+    pool.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+
+
+def _expiry(pool):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT subscription_expires_at FROM users WHERE username='alice'")
+        return cur.fetchone()[0]
+
+
+def test_redelivered_bill_extends_subscription_once(webhook, monkeypatch):
+    client, pool = webhook
+    form = _signed_form({"id": "bill-1", "paid": "true", "paid_amount": "9900",
+                         "reference_1": "alice", "reference_2": "p1m"})
+    assert client.post("/webhook-billplz", data=form).get_json() == {"success": True}
+    first = _expiry(pool)
+    assert first is not None
+
+    # Same process: answered from the seen-bills memo
+    assert client.post("/webhook-billplz", data=form).get_json() == {"success": True, "duplicate": True}
+    # Another instance (empty memo): stopped by the ledger's ON CONFLICT gate
+    monkeypatch.setattr(main, "_billplz_seen_bills", OrderedDict())
+    assert client.post("/webhook-billplz", data=form).get_json() == {"success": True, "duplicate": True}
+    assert _expiry(pool) == first
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT username, plan_id, amount_cents, days, signature_variant, expires_at FROM payments")
+        assert cur.fetchall() == [("alice", "p1m", 9900, 30, "B", first)]
+
+
+def test_each_bill_extends_subscription(webhook):
+    client, pool = webhook
+    for bill in ("bill-1", "bill-2"):
+        form = _signed_form({"id": bill, "paid": "true", "reference_1": "alice", "reference_2": "p1m"})
+        assert client.post("/webhook-billplz", data=form).status_code == 200
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(expires_at) - MIN(expires_at) FROM payments")
+        assert cur.fetchone()[0].days == 30
+
+
+def test_bad_signature_and_missing_bill_id_are_rejected(webhook):
+    client, _ = webhook
+    form = _signed_form({"id": "bill-1", "paid": "true", "reference_1": "alice"})
+    assert client.post("/webhook-billplz", data={**form, "x_signature": "0" * 64}).status_code == 401
+    assert client.post("/webhook-billplz", data=_signed_form({"paid": "true", "reference_1": "alice"})).status_code == 400
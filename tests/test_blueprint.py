@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blueprint
+import main
+
+with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "appendix_library.json"), encoding="utf-8") as f:
+    LIBRARY = json.load(f)
+
+
+def _legacy(slots, lib):
+    # The blueprint both routes used to build inline
+    goal = slots.get("goal") or "Brand awareness"
+    try:
+        duration = int(slots.get("duration_sec") or 30)
+    except Exception:
+        duration = 30
+    cta = slots.get("cta") or "DM us"
+    rules = lib.get("veo_blueprint_rules", {})
+    beats = lib["narrative_templates"][0]["beats"]
+    total = max(duration, 15)
+    hook = payoff = max(int(total * 0.2), 3)
+    build = max(total - hook - payoff, 6)
+    return {
+        "meta": {"platform": slots.get("platform") or "tiktok", "duration_sec": total,
+                 "tone": slots.get("tone") or "playful", "style": slots.get("style") or "ugc",
+                 "text_free": bool(rules.get("text_free", True))},
+        "overview": f"Goal: {goal}. Key message: {slots.get('key_message') or 'Strong hook in first 2s'}. CTA: {cta}. Text-free policy enforced.",
+        "beats": [
+            {"name": beats[0]["name"], "secs": hook, "direction": "Grab attention visually in 2s; no on-screen text."},
+            {"name": beats[1]["name"], "secs": build, "direction": "Escalate the premise; include product claim or gag."},
+            {"name": beats[2]["name"], "secs": payoff, "direction": f"Punchline + CTA ('{cta}')."},
+        ],
+        "negative_prompt": rules.get("negative_prompt", []),
+    }
+
+
+@pytest.mark.parametrize("slots", [
+    {},
+    {"platform": "TikTok", "duration_sec": 30, "tone": "playful", "cta": "Shop now"},
+    {"duration_sec": "45", "goal": "Drive conversions", "key_message": "Half price"},
+    {"duration_sec": "abc"},
+    {"duration_sec": 8},
+])
+def test_default_template_matches_the_old_inline_blueprint(slots):
+    got = blueprint.build(slots, LIBRARY).to_dict()
+    assert got["meta"].pop("template") == "hook-build-payoff"
+    assert got == _legacy(slots, LIBRARY)
+
+
+def test_split_keeps_edges_and_covers_the_runtime():
+    assert blueprint.split_seconds(30, 3) == [6, 18, 6]
+    assert blueprint.split_seconds(60, 5) == [12, 12, 12, 12, 12]
+    assert blueprint.split_seconds(31, 4) == [6, 10, 9, 6]
+    assert blueprint.split_seconds(20, 1) == [20]
+    assert blueprint.split_seconds(20, 2) == [4, 16]
+    for n in range(1, 9):
+        assert sum(blueprint.split_seconds(60, n)) == 60
+
+
+def test_any_template_and_beat_count():
+    lib = dict(LIBRARY, narrative_templates=LIBRARY["narrative_templates"] + [{
+        "id": "problem-solution",
+        "beats": [{"name": "Problem", "guideline": "Show the pain."},
+                  {"name": "Agitate", "guideline": "Make it worse."},
+                  {"name": "Solution", "guideline": "Product fixes it."},
+                  {"name": "Proof", "guideline": "Before/after."},
+                  {"name": "Close", "guideline": "Smile at camera."}],
+    }])
+    bp = blueprint.build({"duration_sec": 60, "cta": "Link in bio", "narrative_template": "problem-solution"}, lib)
+    assert bp.meta.template == "problem-solution"
+    assert [b.name for b in bp.beats] == ["Problem", "Agitate", "Solution", "Proof", "Close"]
+    assert sum(b.secs for b in bp.beats) == 60
+    assert bp.beats[0].direction == "Show the pain."
+    assert bp.beats[-1].direction == "Smile at camera. CTA ('Link in bio')."
+
+    # template_id overrides the slot; an unknown id falls back to the first template
+    assert blueprint.build({"narrative_template": "problem-solution"}, lib, "hook-build-payoff").meta.template == "hook-build-payoff"
+    assert blueprint.build({"narrative_template": "nope"}, lib).meta.template == "hook-build-payoff"
+
+
+def test_unchanged_brief_is_served_from_the_memo():
+    slots = {"platform": "TikTok", "duration_sec": 30, "tone": "calm", "audience": "students"}
+    first = blueprint.build(slots, LIBRARY)
+    before = blueprint.stats()
+    # Irrelevant slots and whitespace do not change the key
+    again = blueprint.build(dict(slots, audience="parents", tone=" calm "), LIBRARY)
+    assert again is first
+    assert blueprint.stats()["hits"] == before["hits"] + 1
+
+    changed = blueprint.build(dict(slots, duration_sec=45), LIBRARY)
+    assert changed is not first
+    edited = dict(LIBRARY, veo_blueprint_rules={"text_free": False, "negative_prompt": []})
+    assert blueprint.build(slots, edited).meta.text_free is False
+
+
+def test_blueprint_route_uses_the_session_slots(monkeypatch):
+    session = {"selections": {"platform": "TikTok", "duration_sec": 15, "cta": "Order today"}}
+    monkeypatch.setattr(main, "_director_get_session", lambda conn, sid: session)
+    monkeypatch.setattr(main, "get_conn", lambda: type("Conn", (), {"commit": lambda s: None, "rollback": lambda s: None})())
+    monkeypatch.setattr(main, "put_conn", lambda c: None)
+    main.app.config["TESTING"] = True
+    token = main._jwt_create("alice")
+    with main.app.test_client() as c:
+        resp = c.post("/v1/director/blueprint", headers={"Authorization": f"Bearer {token}"},
+                      json={"session_id": "chat-session-1"})
+    assert resp.status_code == 200
+    bp = resp.get_json()["blueprint"]
+    assert [b["secs"] for b in bp["beats"]] == [3, 9, 3]
+    assert bp["beats"][-1]["direction"] == "Punchline + CTA ('Order today')."
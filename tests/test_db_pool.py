@@ -0,0 +1,122 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        if self.conn.dead:
+            raise RuntimeError("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.rollbacks = 0
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+def make_pool(**kw):
+    kw.setdefault("minconn", 0)
+    kw.setdefault("maxconn", 2)
+    kw.setdefault("timeout", 0.2)
+    return db.ConnectionPool(connect=FakeConn, **kw)
+
+
+def test_waits_then_times_out_when_exhausted():
+    pool = make_pool(maxconn=1, timeout=0.05)
+    c1 = pool.getconn()
+    with pytest.raises(db.PoolTimeout):
+        pool.getconn()
+    pool.putconn(c1)
+    assert pool.getconn() is c1
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiter_is_woken_by_putconn():
+    pool = make_pool(maxconn=1, timeout=2)
+    c1 = pool.getconn()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.getconn()))
+    t.start()
+    time.sleep(0.05)
+    assert pool.stats()["waiters"] == 1
+    pool.putconn(c1)
+    t.join(1)
+    assert got == [c1]
+
+
+def test_concurrent_checkouts_never_exceed_max():
+    pool = make_pool(maxconn=3, timeout=5)
+    peak = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(50):
+            with pool.connection():
+                with lock:
+                    peak.append(pool.stats()["in_use"])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) <= 3
+    assert pool.stats()["in_use"] == 0
+
+
+def test_dead_and_expired_connections_are_replaced():
+    pool = make_pool(validate_after=0)
+    c1 = pool.getconn()
+    pool.putconn(c1)
+    c1.dead = True
+    c2 = pool.getconn()
+    assert c2 is not c1 and c1.closed
+    pool.putconn(c2)
+
+    pool.max_lifetime = 0.01
+    time.sleep(0.02)
+    c3 = pool.getconn()
+    assert c3 is not c2
+    stats = pool.stats()
+    assert stats["invalid"] == 1 and stats["recycled"] == 1
+
+
+def test_leaked_connections_are_reclaimed():
+    pool = make_pool(maxconn=1, timeout=0.5)
+    pool.getconn()  # leaked by this thread
+    assert pool.reclaim_thread() == 1
+    assert pool.stats()["in_use"] == 0
+
+    t = threading.Thread(target=pool.getconn)  # leaked by a thread that exits
+    t.start()
+    t.join()
+    assert pool.getconn() is not None
+    assert pool.stats()["reclaimed"] == 2
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 1
+
+    def mogrify(self, sql, params=None):
+        return (sql % tuple(repr(p) for p in (params or ()))).encode("utf-8")
+
+    def execute(self, sql, params=None):
+        self.conn.round_trips.append(sql.decode("utf-8") if isinstance(sql, bytes) else sql)
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class RecordingConn:
+    def __init__(self):
+        self.round_trips = []
+        self.commits = 0
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        self.round_trips.append("COMMIT")
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    conn = RecordingConn()
+    monkeypatch.setattr(main, "get_conn", lambda: conn)
+    monkeypatch.setattr(main, "put_conn", lambda c: None)
+    main.app.config["TESTING"] = True
+    token = main._jwt_create("chat-user")
+
+    def send(text):
+        with main.app.test_client() as client:
+            return client.post(
+                "/v1/director/chat",
+                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+                data=json.dumps({"session_id": "chat-session-1", "user_text": text}),
+            )
+    return conn, send
+
+
+def test_chat_turn_is_one_transaction_with_batched_writes(chat):
+    conn, send = chat
+    resp = send("TikTok 30s, playful cinematic")
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["selections"]["platform"] == "TikTok"
+
+    # session read, one flush of all writes, one COMMIT
+    assert len(conn.round_trips) <= 3
+    assert conn.commits == 1
+    flushed = conn.round_trips[-2]
+    assert flushed.count("INSERT INTO sessions") == 1
+    assert "ON CONFLICT (id) DO UPDATE" in flushed
+    assert flushed.count("INSERT INTO director_messages") == 1
+    assert "'user'" in flushed and "'assistant'" in flushed
+
+
+def test_slots_are_stored_top_level(chat):
+    conn, send = chat
+    send("TikTok 30s")
+    flushed = conn.round_trips[-2]
+    assert '"selections"' not in flushed
+
+
+def test_chat_stream_sends_open_before_the_turn_and_done_last(chat, monkeypatch):
+    conn, _ = chat
+    token = main._jwt_create("chat-user")
+    with main.app.test_client() as client:
+        resp = client.post(
+            "/v1/director/chat?stream=ndjson",
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+            data=json.dumps({"session_id": "chat-session-1", "user_text": "TikTok 30s"}),
+        )
+        assert resp.mimetype == "application/x-ndjson"
+        events = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [e["event"] for e in events] == ["open", "message", "done"]
+    assert events[-1]["data"]["selections"]["platform"] == "TikTok"
+    assert conn.commits == 1
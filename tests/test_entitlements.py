@@ -0,0 +1,111 @@
+import datetime
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import entitlements
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+UTC = datetime.timezone.utc
+EXPIRY = datetime.datetime(2030, 1, 1, tzinfo=UTC)
+
+
+def _listening_for_a_while(cache):
+    cache.listening(True)
+    cache._listening_since = time.time() - 60
+
+
+def test_db_result_is_cached_until_invalidated():
+    cache = entitlements.EntitlementCache(ttl=60)
+    loads = []
+    load = lambda u: loads.append(u) or (True, EXPIRY)
+    assert cache.lookup("alice", {}, load) == ((True, EXPIRY), "db")
+    assert cache.lookup("alice", {}, load) == ((True, EXPIRY), "cache")
+    cache.invalidate("alice")
+    assert cache.lookup("alice", {}, load)[1] == "db"
+    assert loads == ["alice", "alice"]
+
+
+def test_claim_is_trusted_only_while_listening_and_unchanged():
+    cache = entitlements.EntitlementCache(ttl=60)
+    load = lambda u: (True, None)
+    claims = {"iat": int(time.time()), "sub_exp": entitlements.to_claim(EXPIRY)}
+
+    # Not listening: a change could have been missed
+    assert cache.lookup("alice", claims, load)[1] == "db"
+    cache = entitlements.EntitlementCache(ttl=60)
+    _listening_for_a_while(cache)
+    assert cache.lookup("alice", claims, load) == ((True, EXPIRY), "token")
+
+    # Changed after the token was issued: the claim is stale
+    cache.invalidate("alice")
+    assert cache.lookup("alice", claims, load) == ((True, None), "db")
+
+    # Token issued before the listener connected
+    assert not cache.claim_trusted("bob", time.time() - 3600)
+    cache.listening(False)
+    assert not cache.claim_trusted("bob", time.time())
+
+
+def test_invalidation_during_load_is_not_cached_over():
+    cache = entitlements.EntitlementCache(ttl=60)
+
+    def racing_load(user):
+        cache.invalidate(user)  # the webhook commits while we read the old row
+        return (True, None)
+
+    assert cache.lookup("alice", {}, racing_load)[1] == "db"
+    assert cache.get("alice") is None
+
+
+def test_get_user_status_needs_no_db_for_a_trusted_claim(monkeypatch):
+    import main
+
+    cache = entitlements.EntitlementCache(ttl=60)
+    _listening_for_a_while(cache)
+    monkeypatch.setattr(entitlements, "cache", cache)
+
+    def no_db():
+        raise AssertionError("database touched")
+
+    monkeypatch.setattr(main, "get_conn", no_db)
+    token = main._jwt_create("alice", 0, {"sub_exp": entitlements.to_claim(EXPIRY)})
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as client:
+        body = client.get("/get-user-status", headers={"Authorization": f"Bearer {token}"}).get_json()
+    assert body == {"username": "alice", "subscription_expires_at": EXPIRY.isoformat(), "is_subscribed": True}
+
+
+@pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+def test_notify_reaches_listener_on_commit():
+    import psycopg2
+
+    cache = entitlements.EntitlementCache(ttl=60)
+    listener = entitlements.Listener(lambda: psycopg2.connect(DSN), cache, poll_timeout=0.1).start()
+    try:
+        deadline = time.time() + 5
+        while not cache.stats()["listening"] and time.time() < deadline:
+            time.sleep(0.02)
+        user = "user-" + uuid.uuid4().hex[:6]
+        cache.put(user, (True, None))
+
+        conn = psycopg2.connect(DSN)
+        cur = conn.cursor()
+        entitlements.notify(cur, user)
+        time.sleep(0.2)
+        assert cache.get(user) is not None  # not delivered before COMMIT
+        conn.commit()
+        conn.close()
+
+        deadline = time.time() + 5
+        while cache.get(user) is not None and time.time() < deadline:
+            time.sleep(0.02)
+        assert cache.get(user) is None
+        assert cache.stats()["invalidations"] == 1
+    finally:
+        listener.stop()
@@ -0,0 +1,140 @@
+import contextlib
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export_store
+import zipstream
+
+PROJECT = "6f1c2a4e-8d7b-4c1e-9a35-0f2b7d9e1c11"
+
+
+def _stream(scenes="[]"):
+    return zipstream.ZipStream([zipstream.Entry("storyboard.json", scenes), zipstream.Entry("readme.txt", "hi")])
+
+
+def test_tee_stores_only_complete_archives(tmp_path):
+    store = export_store.LocalStore(str(tmp_path), "secret")
+    s = _stream()
+    key = export_store.key_for(PROJECT, s.etag)
+
+    partial = store.tee(key, "a.zip", iter([b"part-1", b"part-2"]))
+    next(partial)
+    partial.close()  # client went away
+    assert not store.exists(key) and os.listdir(tmp_path / "exports" / PROJECT) == []
+
+    assert b"".join(store.tee(key, "a.zip", s.chunks())) == s.getvalue()
+    assert store.exists(key)
+    with open(store.path(key), "rb") as f:
+        assert f.read() == s.getvalue()
+    assert store.stats()["stored"] == 1 and store.stats()["aborted"] == 1
+
+
+def test_local_urls_are_signed_and_expire(tmp_path):
+    store = export_store.LocalStore(str(tmp_path), "secret")
+    url = store.url("exports/p/x.zip", "a.zip", ttl=60)
+    qs = dict(p.split("=", 1) for p in url.split("?", 1)[1].split("&"))
+    assert store.verify("exports/p/x.zip", qs["exp"], "a.zip", qs["sig"])
+    assert not store.verify("exports/p/y.zip", qs["exp"], "a.zip", qs["sig"])
+    assert not store.verify("exports/p/x.zip", int(qs["exp"]) + 1, "a.zip", qs["sig"])
+    assert not store.verify("exports/p/x.zip", "1", "a.zip", store._sign("exports/p/x.zip", 1, "a.zip"))
+    assert store.path("../../etc/passwd") is None
+
+
+def test_backend_missing_a_hook_fails_at_construction():
+    class NoURL(export_store.ExportStore):
+        def _exists(self, key):
+            return False
+
+        def writer(self, key, filename):
+            raise AssertionError("unreachable")
+
+    with pytest.raises(TypeError):
+        NoURL()
+
+
+def test_gcs_store_uploads_on_commit_and_signs_urls():
+    class Blob:
+        def __init__(self, bucket, name):
+            self.bucket, self.name = bucket, name
+
+        def exists(self):
+            return self.name in self.bucket.objects
+
+        def upload_from_file(self, f, content_type, if_generation_match):
+            assert content_type == "application/zip" and if_generation_match == 0
+            self.bucket.objects[self.name] = f.read()
+
+        def generate_signed_url(self, **kw):
+            assert kw["version"] == "v4" and kw["method"] == "GET"
+            return f"https://storage.example/{self.name}?sig=1"
+
+    class Bucket:
+        objects = {}
+
+        def blob(self, name):
+            return Blob(self, name)
+
+    class Client:
+        _credentials = type("Creds", (), {"sign_bytes": lambda self, b: b""})()
+
+        def bucket(self, name):
+            return Bucket()
+
+    store = export_store.GCSStore("bucket", client=Client())
+    s = _stream()
+    key = export_store.key_for(PROJECT, s.etag)
+    assert not store.exists(key)
+    out = store.tee(key, "a.zip", s.chunks())
+    next(out)
+    assert Bucket.objects == {}  # nothing is published mid-stream
+    list(out)
+    assert Bucket.objects[key] == s.getvalue()
+    assert store.exists(key)
+    assert store.url(key, "a.zip").startswith("https://storage.example/")
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    import main
+    import services
+
+    current = {"scenes": "[1]"}
+
+    @contextlib.contextmanager
+    def no_db():
+        yield type("Conn", (), {"commit": lambda self: None})()
+
+    monkeypatch.setattr(main, "db_connection", no_db)
+    monkeypatch.setattr(services, "build_export_stream", lambda conn, pid: _stream(current["scenes"]))
+    monkeypatch.setattr(export_store, "_store", export_store.LocalStore(str(tmp_path), "secret"))
+    token = main._jwt_create("alice")
+    main.app.config["TESTING"] = True
+    with main.app.test_client() as c:
+        yield c, {"Authorization": f"Bearer {token}"}, current
+
+
+def test_export_builds_once_then_redirects(client):
+    c, auth, current = client
+    url = f"/v1/projects/{PROJECT}/export"
+
+    first = c.get(url, headers=auth)
+    assert first.status_code == 200
+    data = first.get_data()
+    assert zipfile.ZipFile(io.BytesIO(data)).read("storyboard.json") == b"[1]"
+
+    again = c.get(url, headers=auth)
+    assert again.status_code == 302 and again.headers["Cache-Control"] == "no-store"
+    served = c.get(again.headers["Location"])
+    assert served.status_code == 200 and served.get_data() == data
+    assert "immutable" in served.headers["Cache-Control"]
+    assert c.get(again.headers["Location"].replace("sig=", "sig=0")).status_code == 403
+
+    current["scenes"] = "[1, 2]"  # new storyboard -> new content hash -> rebuilt
+    rebuilt = c.get(url, headers=auth)
+    assert rebuilt.status_code == 200 and rebuilt.get_data() != data
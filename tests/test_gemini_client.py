@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini_client
+
+
+class FakeGenAI:
+    def __init__(self):
+        self.configured = 0
+        self.built = 0
+
+    def configure(self, api_key):
+        self.configured += 1
+
+    def GenerativeModel(self, name, **kwargs):
+        self.built += 1
+        return (name, kwargs.get("system_instruction"), self.built)
+
+
+def test_models_are_reused_per_key_and_sdk_configured_once():
+    fake = FakeGenAI()
+    reg = gemini_client.ModelRegistry(api_key="k", loader=lambda: fake)
+    cfg = {"temperature": 0.7, "max_output_tokens": 2048}
+
+    m1 = reg.get_model("models/x", None, cfg)
+    m2 = reg.get_model("models/x", None, dict(reversed(list(cfg.items()))))
+    m3 = reg.get_model("models/x", "be terse", cfg)
+
+    assert m1 is m2 and m3 is not m1
+    assert fake.configured == 1 and fake.built == 2
+    assert reg.stats() == {"configured": True, "models": 2, "hits": 1, "misses": 2}
+
+
+def test_missing_api_key_raises_import_error():
+    reg = gemini_client.ModelRegistry(api_key="", loader=FakeGenAI)
+    with pytest.raises(ImportError):
+        reg.get_model("models/x")
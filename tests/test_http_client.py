@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client
+
+
+class StubServer:
+    """Local HTTP/1.1 keep-alive server answering from a script of (status, headers, body)."""
+
+    def __init__(self, script=(), tls_context=None):
+        self.script = list(script)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _answer(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                stub.requests.append({"method": self.command, "path": self.path, "port": self.client_address[1],
+                                      "headers": dict(self.headers), "body": body})
+                status, headers, out = stub.script.pop(0) if stub.script else (200, {}, b'{"ok": true}')
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST = _answer
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        if tls_context is not None:
+            self.httpd.socket = tls_context.wrap_socket(self.httpd.socket, server_side=True)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    slept = []
+    monkeypatch.setattr(http_client.time, "sleep", slept.append)
+    return slept
+
+
+def _client(server, **kw):
+    return http_client.HTTPClient(f"http://127.0.0.1:{server.port}/api/v3", name="stub", **kw)
+
+
+def test_connections_are_kept_alive_and_reused():
+    server = StubServer()
+    client = _client(server)
+    try:
+        for _ in range(5):
+            resp = client.get("/bills/1")
+            assert resp.ok and resp.json() == {"ok": True}
+        assert {r["path"] for r in server.requests} == {"/api/v3/bills/1"}
+        assert len({r["port"] for r in server.requests}) == 1
+        stats = client.stats()
+        assert stats["opened"] == 1 and stats["reused"] == 4 and stats["idle"] == 1
+    finally:
+        client.close()
+        server.close()
+
+
+def test_keyed_post_is_retried_on_503_when_upstream_honours_keys(no_sleep):
+    server = StubServer([(503, {}, b"down"), (502, {}, b"bad gateway"), (201, {}, b'{"id": "b1"}')])
+    client = _client(server, retries=2, honours_idempotency_key=True)
+    try:
+        resp = client.post("/bills", json_body={"amount": "100"}, idempotency_key="k1")
+        assert resp.status == 201 and resp.json() == {"id": "b1"}
+        assert len(server.requests) == 3 and len(no_sleep) == 2
+        assert all(r["headers"]["Idempotency-Key"] == "k1" for r in server.requests)
+        assert json.loads(server.requests[0]["body"]) == {"amount": "100"}
+        assert client.breaker.state == "closed"
+    finally:
+        client.close()
+        server.close()
+
+
+def test_post_is_not_retried_on_5xx_unless_upstream_honours_keys(no_sleep):
+    server = StubServer([(503, {}, b"down"), (502, {}, b"bad gateway"), (429, {}, b""), (201, {}, b"{}")])
+    client = _client(server, retries=2)
+    try:
+        assert client.post("/bills", json_body={}).status == 503
+        assert client.post("/bills", json_body={}, idempotency_key="k1").status == 502
+        assert len(server.requests) == 2 and no_sleep == []
+        assert client.post("/bills", json_body={}, idempotency_key="k2").status == 201  # 429 is always retried
+        assert len(no_sleep) == 1
+    finally:
+        client.close()
+        server.close()
+
+
+def test_retry_after_is_honoured_up_to_backoff_max(no_sleep):
+    server = StubServer([(429, {"Retry-After": "1"}, b""), (429, {"Retry-After": "120"}, b""), (200, {}, b"{}")])
+    client = _client(server, retries=2, backoff_max=5.0)
+    try:
+        assert client.get("/bills").ok
+        assert no_sleep[0] >= 1.0 and no_sleep[1] == 5.0
+    finally:
+        client.close()
+        server.close()
+
+
+def test_connect_failure_is_retried_then_raises(no_sleep):
+    server = StubServer()
+    port = server.port
+    server.close()  # nothing listens there any more
+    client = http_client.HTTPClient(f"http://127.0.0.1:{port}", retries=2, connect_timeout=0.5)
+    with pytest.raises(http_client.HTTPClientError):
+        client.post("/bills", json_body={})
+    assert len(no_sleep) == 2 and client.stats()["failures"] == 1
+
+
+def test_breaker_opens_fails_fast_and_recovers(monkeypatch, no_sleep):
+    server = StubServer([(500, {}, b"")] * 3)
+    client = _client(server, retries=0, failure_threshold=3, reset_timeout=30)
+    now = [1000.0]
+    monkeypatch.setattr(http_client.time, "monotonic", lambda: now[0])
+    try:
+        for _ in range(3):
+            assert client.get("/bills").status == 500
+        assert client.breaker.state == "open"
+        with pytest.raises(http_client.CircuitOpen):
+            client.get("/bills")
+        assert len(server.requests) == 3
+
+        now[0] += 31
+        assert client.breaker.state == "half_open"
+        assert client.get("/bills").ok  # the probe succeeds
+        assert client.breaker.state == "closed"
+        assert client.stats()["breaker_rejected"] == 1
+    finally:
+        client.close()
+        server.close()
+
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    breaker = http_client.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    now = [0.0]
+    monkeypatch.setattr(http_client.time, "monotonic", lambda: now[0])
+    breaker.failure()
+    breaker.failure()
+    assert not breaker.allow()
+    now[0] = 11
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe at a time
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_idempotency_memo_replays_success_only():
+    memo = http_client.IdempotencyMemo(ttl=60)
+    calls = []
+
+    def call(status):
+        def run():
+            calls.append(status)
+            return http_client.Response(status, {}, b"{}")
+        return run
+
+    assert memo.run("a", call(502))[1] is False
+    resp, replayed = memo.run("a", call(201))
+    assert resp.status == 201 and not replayed
+    resp, replayed = memo.run("a", call(201))
+    assert resp.status == 201 and replayed
+    assert calls == [502, 201]
+
+
+def test_idempotency_memo_concurrent_callers_share_one_call():
+    memo = http_client.IdempotencyMemo(ttl=60)
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return http_client.Response(200, {}, b"{}")
+
+    first = threading.Thread(target=lambda: results.append(memo.run("k", slow)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(memo.run("k", slow)))
+    second.start()
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert len(calls) == 1
+    assert sorted(r[1] for r in results) == [False, True]
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="openssl CLI not available")
+def test_tls_sessions_are_resumed_on_new_connections(tmp_path):
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                    "-keyout", str(key), "-out", str(cert)], check=True, capture_output=True)
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(cert, key)
+    server = StubServer([(200, {"Connection": "close"}, b"{}")] * 3, tls_context=server_ctx)
+    client_ctx = ssl.create_default_context(cafile=str(cert))
+    client = http_client.HTTPClient(f"https://localhost:{server.port}", ssl_context=client_ctx)
+    try:
+        for _ in range(3):
+            assert client.get("/").ok
+        stats = client.stats()
+        assert stats["opened"] == 3  # the server closes every connection
+        assert stats["tls_resumed"] == 2
+    finally:
+        client.close()
+        server.close()
+
+
+def test_create_bill_double_submit_makes_one_upstream_call(monkeypatch):
+    import main
+
+    server = StubServer([(200, {}, b'{"id": "bill-1", "url": "https://pay.example/bill-1"}')])
+    monkeypatch.setattr(main, "BILLPLZ_API_KEY", "key")
+    monkeypatch.setattr(main, "BILLPLZ_COLLECTION_ID", "col")
+    monkeypatch.setattr(main, "_billplz", lambda: _client(server))
+    monkeypatch.setattr(main, "_billplz_bills", http_client.IdempotencyMemo(ttl=60))
+    token = main._jwt_create("alice")
+    main.app.config["TESTING"] = True
+    try:
+        with main.app.test_client() as client:
+            def checkout(plan, key=None):
+                headers = {"Authorization": f"Bearer {token}"}
+                if key:
+                    headers["Idempotency-Key"] = key
+                return client.post("/create-bill", json={"planId": plan}, headers=headers).get_json()
+
+            bodies = [checkout("p1m", "checkout-1") for _ in range(2)]
+            assert bodies == [{"url": "https://pay.example/bill-1", "bill_id": "bill-1"}] * 2
+            assert len(server.requests) == 1
+            sent = server.requests[0]
+            assert sent["path"] == "/api/v3/bills" and sent["headers"]["Idempotency-Key"].startswith("bill-")
+            assert json.loads(sent["body"])["reference_2"] == "p1m"
+
+            # The same key for another plan, or no key at all, is a new bill
+            checkout("p6m", "checkout-1")
+            checkout("p1m")
+            checkout("p1m")
+        assert [json.loads(r["body"])["reference_2"] for r in server.requests] == ["p1m", "p6m", "p1m", "p1m"]
+        assert "Idempotency-Key" not in server.requests[-1]["headers"]
+    finally:
+        server.close()
@@ -0,0 +1,94 @@
+"""
+Job queue tests against a real PostgreSQL (PF_TEST_DATABASE_URL; skipped otherwise).
+Each run migrates a throwaway schema and drops it afterwards.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+
+
+@pytest.fixture
+def pool():
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_jobs_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    p = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=4)
+    with p.connection() as conn:
+        migrations.apply_migrations(conn)
+    yield p
+    p.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+    admin.close()
+
+
+def test_claim_skips_rows_locked_by_another_worker(pool):
+    import jobs
+
+    with pool.connection() as conn:
+        first = jobs.enqueue(conn, "noop")
+        second = jobs.enqueue(conn, "noop")
+    with pool.connection() as holder, pool.connection() as conn:
+        cur = holder.cursor()
+        cur.execute("SELECT id FROM jobs WHERE id = %s FOR UPDATE", (uuid.UUID(first),))
+        claimed = jobs.claim(conn, "w2")
+        assert claimed["id"] == second
+        assert jobs.claim(conn, "w2") is None
+        holder.rollback()
+        assert jobs.claim(conn, "w2")["id"] == first
+
+
+def test_worker_runs_handler_and_records_progress(pool, monkeypatch):
+    import jobs
+
+    def ok(ctx, payload):
+        ctx.progress(50, "half way")
+        ctx.artifact = b"zip-bytes"
+        return {"echo": payload["x"]}
+
+    monkeypatch.setitem(jobs.HANDLERS, "test-ok", ok)
+    with pool.connection() as conn:
+        job_id = jobs.enqueue(conn, "test-ok", {"x": 1}, user_id="alice")
+    assert jobs.Worker(pool, kinds=["test-ok"]).drain() == 1
+    with pool.connection() as conn:
+        job = jobs.get_job(conn, job_id, user_id="alice")
+        assert job["status"] == "succeeded" and job["progress"] == 100
+        assert job["result"] == {"echo": 1}
+        assert jobs.get_artifact(conn, job_id, user_id="alice") == b"zip-bytes"
+        assert jobs.get_job(conn, job_id, user_id="mallory") is None
+
+
+def test_failures_retry_with_backoff_then_fail(pool, monkeypatch):
+    import jobs
+
+    def boom(ctx, payload):
+        raise RuntimeError("transient")
+
+    def bad_input(ctx, payload):
+        raise ValueError("project not found")
+
+    monkeypatch.setitem(jobs.HANDLERS, "test-boom", boom)
+    monkeypatch.setitem(jobs.HANDLERS, "test-bad", bad_input)
+    monkeypatch.setattr(jobs, "JOB_RETRY_BASE_SEC", 0)
+    with pool.connection() as conn:
+        retried = jobs.enqueue(conn, "test-boom", max_attempts=2)
+        permanent = jobs.enqueue(conn, "test-bad", max_attempts=3)
+    jobs.Worker(pool).drain()
+    with pool.connection() as conn:
+        job = jobs.get_job(conn, retried)
+        assert job["status"] == "failed" and job["attempts"] == 2
+        assert "transient" in job["error"]
+        job = jobs.get_job(conn, permanent)
+        assert job["status"] == "failed" and job["attempts"] == 1
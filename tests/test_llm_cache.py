@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_cache  # noqa: E402
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+
+
+def test_key_covers_every_input_and_ignores_config_order():
+    base = llm_cache.cache_key("m", "sys", {"a": 1, "b": 2}, "p")
+    assert base == llm_cache.cache_key("m", "sys", {"b": 2, "a": 1}, "p")
+    assert base != llm_cache.cache_key("m2", "sys", {"a": 1, "b": 2}, "p")
+    assert base != llm_cache.cache_key("m", None, {"a": 1, "b": 2}, "p")
+    assert base != llm_cache.cache_key("m", "sys", {"a": 1}, "p")
+    assert base != llm_cache.cache_key("m", "sys", {"a": 1, "b": 2}, "p2")
+
+
+def test_memory_backend_evicts_least_recently_used_by_bytes():
+    mem = llm_cache.MemoryBackend(max_bytes=30)
+    mem.set("a", "x" * 10, 60)
+    mem.set("b", "y" * 10, 60)
+    assert mem.get("a")  # a is now most recent
+    mem.set("c", "z" * 15, 60)
+    assert mem.get("b") is None and mem.get("a") and mem.get("c")
+    assert mem.stats()["evictions"] == 1 and mem.stats()["bytes"] <= 30
+
+
+def test_ttl_expiry():
+    cache = llm_cache.LLMCache(backends=[llm_cache.MemoryBackend()], ttl=60)
+    cache.set("k", {"v": 1}, ttl=0)
+    calls = []
+    assert cache.get_or_compute("k", lambda: calls.append(1) or {"v": 2}) == {"v": 2}
+    assert calls == [1]
+
+
+def test_hit_miss_bypass_counters():
+    cache = llm_cache.LLMCache(backends=[llm_cache.MemoryBackend()], ttl=60, enabled=True)
+    calls = []
+    compute = lambda: calls.append(1) or ["ok"]  # noqa: E731
+    assert cache.get_or_compute("k", compute) == ["ok"]
+    assert cache.get_or_compute("k", compute) == ["ok"]
+    assert cache.get_or_compute("k", compute, bypass=True) == ["ok"]
+    assert len(calls) == 2
+    st = cache.stats()
+    assert st["misses"] == 1 and st["hits"] == {"memory": 1} and st["bypassed"] == 1
+
+
+def test_lower_tier_hit_is_promoted_and_failures_are_swallowed():
+    class Broken:
+        name = "broken"
+
+        def get(self, key):
+            raise RuntimeError("down")
+
+        def set(self, key, text, ttl):
+            raise RuntimeError("down")
+
+        def stats(self):
+            return {}
+
+    shared = llm_cache.MemoryBackend()
+    shared.name = "shared"
+    shared.set("k", '{"v": 1}', 60)
+    top = llm_cache.MemoryBackend()
+    cache = llm_cache.LLMCache(backends=[top, Broken(), shared], ttl=60)
+    assert cache.get_or_compute("k", lambda: pytest.fail("should hit")) == {"v": 1}
+    assert top.get("k") == '{"v": 1}'
+    assert cache.stats()["errors"] >= 2
+
+
+def test_concurrent_misses_compute_once():
+    cache = llm_cache.LLMCache(backends=[llm_cache.MemoryBackend()], ttl=60)
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return "v"
+
+    threads = [threading.Thread(target=cache.get_or_compute, args=("k", slow)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+
+
+@pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+def test_postgres_backend_roundtrip_and_ttl():
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_cache_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    try:
+        with pool.connection() as conn:
+            migrations.apply_migrations(conn)
+        pg = llm_cache.PostgresBackend(pool.connection)
+        pg.set("k", '{"v": 1}', 60)
+        pg.set("old", '{"v": 0}', 0)
+        assert pg.get("k") == '{"v": 1}'
+        assert pg.get("old") is None
+        assert pg.purge_expired() == 1
+    finally:
+        pool.closeall()
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.commit()
+        admin.close()
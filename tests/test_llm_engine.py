@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_engine  # noqa: E402
+import services  # noqa: E402
+
+
+@pytest.fixture
+def engine():
+    eng = llm_engine.LLMEngine(max_workers=2, default_deadline=5)
+    yield eng
+    eng.shutdown()
+
+
+def test_gather_runs_concurrently_and_keeps_order(engine):
+    def slow(v):
+        time.sleep(0.2)
+        return v
+
+    t0 = time.perf_counter()
+    out = engine.gather([(slow, (1,)), (slow, (2,))])
+    assert out == [1, 2]
+    assert time.perf_counter() - t0 < 0.35
+
+
+def test_concurrency_is_bounded(engine):
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+
+    engine.gather([(work, ()) for _ in range(6)])
+    assert max(peak) <= 2
+
+
+def test_deadline_exceeded(engine):
+    with pytest.raises(llm_engine.DeadlineExceeded):
+        engine.run(time.sleep, 0.5, deadline=0.05)
+    assert engine.stats()["deadline_exceeded"] == 1
+
+
+def test_gather_returns_exceptions_in_place(engine):
+    def boom():
+        raise RuntimeError("x")
+
+    out = engine.gather([(lambda: "ok", ()), (boom, ())])
+    assert out[0] == "ok"
+    assert isinstance(out[1], RuntimeError)
+
+
+def test_generate_creative_options_falls_back_without_gemini(monkeypatch):
+    def unavailable(*a, **kw):
+        raise ImportError("no sdk")
+
+    monkeypatch.setattr(services, "_call_gemini_for_json", unavailable)
+    opts, version = services.generate_creative_options({"project_title": "Kopi", "video_length_sec": 30})
+    assert len(opts) == 3 and version == "v1.0"
+    assert opts[0].title.endswith("Kopi")
@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(" ".join(sql.split()))
+        if sql.startswith("SELECT version FROM schema_migrations"):
+            self._rows = [(v,) for v in sorted(self.conn.applied)]
+        elif sql.startswith("INSERT INTO schema_migrations"):
+            self.conn.applied.add(params[0])
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    def __init__(self, applied=()):
+        self.applied = set(applied)
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def test_versions_are_unique_and_ordered():
+    versions = [v for v, _, _ in migrations.MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert migrations.LATEST_VERSION == versions[-1]
+
+
+def test_apply_takes_lock_first_and_skips_applied():
+    conn = FakeConn(applied={1})
+    applied = migrations.apply_migrations(conn)
+    assert conn.executed[0].startswith("SELECT pg_advisory_xact_lock")
+    assert 1 not in applied
+    assert applied == [v for v, _, _ in migrations.MIGRATIONS if v != 1]
+    assert conn.commits == 1
+    # second run is a no-op apart from the bookkeeping queries
+    assert migrations.apply_migrations(conn) == []
+
+
+def test_ensure_migrated_runs_once_per_process():
+    migrations._reset_for_tests()
+    conn = FakeConn()
+    migrations.ensure_migrated(conn)
+    first = len(conn.executed)
+    migrations.ensure_migrated(conn)
+    assert migrations.is_migrated()
+    assert len(conn.executed) == first
+    migrations._reset_for_tests()
@@ -0,0 +1,88 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+CHEAP = "pbkdf2:sha256:1000"
+
+
+def test_verify_flags_hashes_made_with_other_parameters():
+    old = passwords.PasswordHasher(method=CHEAP, workers=0)
+    new = passwords.PasswordHasher(method="pbkdf2:sha256:2000", workers=0)
+    stored = old.hash("hunter22")
+    assert old.verify(stored, "hunter22") == (True, False)
+    assert new.verify(stored, "hunter22") == (True, True)
+    assert new.verify(stored, "wrong") == (False, False)
+    assert new.verify("", "hunter22") == (False, False)
+    assert new.stats()["rehash_needed"] == 1
+
+
+def test_method_is_normalised_to_stored_prefix():
+    h = passwords.PasswordHasher(method="pbkdf2:sha256:1000", workers=0)
+    assert h.params == "pbkdf2:sha256:1000"
+    assert not h.needs_rehash(h.hash("x"))
+    with pytest.raises(ValueError):
+        passwords.PasswordHasher(method="rot13", workers=0)
+
+
+def test_process_pool_round_trip():
+    h = passwords.PasswordHasher(method=CHEAP, workers=1)
+    try:
+        stored = h.hash("pooled")
+        assert h.verify(stored, "pooled") == (True, False)
+    finally:
+        h.shutdown()
+
+
+def test_saturated_hasher_sheds_load():
+    h = passwords.PasswordHasher(method=CHEAP, workers=0, max_pending=1)
+    h._slots.acquire()
+    with pytest.raises(passwords.HasherBusy):
+        h.hash("x")
+    h._slots.release()
+    assert h.hash("x")
+    assert h.stats()["busy"] == 1
+
+
+@pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+def test_login_rehashes_with_current_parameters(monkeypatch):
+    import psycopg2
+    import db
+    import main
+    import migrations
+
+    schema = "pf_pw_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    try:
+        with pool.connection() as conn:
+            migrations.apply_migrations(conn)
+            conn.cursor().execute("INSERT INTO users (username, password) VALUES ('alice', %s)",
+                                  (passwords.PasswordHasher(method=CHEAP, workers=0).hash("pw123456"),))
+            conn.commit()
+        monkeypatch.setattr(main, "db_pool", pool)
+        monkeypatch.setattr(passwords, "_hasher", passwords.PasswordHasher(method="pbkdf2:sha256:2000", workers=0))
+        main.app.config["TESTING"] = True
+        with main.app.test_client() as c:
+            assert c.post("/login", json={"username": "alice", "password": "nope"}).status_code == 401
+            assert c.post("/login", json={"username": "alice", "password": "pw123456"}).status_code == 200
+            assert c.post("/login", json={"username": "alice", "password": "pw123456"}).status_code == 200
+            assert c.post("/register", json={"username": "alice", "password": "pw123456"}).status_code == 409
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT password FROM users WHERE username='alice'")
+            assert cur.fetchone()[0].startswith("pbkdf2:sha256:2000$")
+        assert passwords.stats()["rehash_needed"] == 1
+    finally:
+        pool.closeall()
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.commit()
+        admin.close()
@@ -0,0 +1,177 @@
+"""
+Prompt registry: template compilation and rendering; versions in prompt_versions (needs PF_TEST_DATABASE_URL).
+"""
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prompts
+import services
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+
+
+def test_file_templates_are_compiled_once():
+    names = prompts.registry.names()
+    assert {"creative", "storyboard", "technical", "qa_critic"} <= set(names)
+    tpl = prompts.get("storyboard")
+    assert tpl.version == "v1.0" and prompts.get("storyboard") is tpl
+    assert tpl.variables == {"SELECTED_CREATIVE_CONCEPT", "NUMBER_OF_SCENES", "VIDEO_LENGTH_IN_SECONDS"}
+
+
+def test_render_matches_naive_replacement():
+    tpl = prompts.get("qa_critic")
+    values = {"STORYBOARD_SCENES_JSON": [{"n": 1}], "SELECTED_CREATIVE_CONCEPT": "Cat café {{not a var}}",
+              "VIDEO_LENGTH_IN_SECONDS": 30}
+    want = tpl.source
+    for k, v in values.items():
+        want = want.replace("{{" + k + "}}", v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
+    assert tpl.render(values) == want
+    assert "{{" not in prompts.Template("t", "v1", "a {{ X }} b {{Y}}").render(X=1, Y="z")
+
+    with pytest.raises(KeyError):
+        tpl.render(VIDEO_LENGTH_IN_SECONDS=30)
+
+
+def test_services_build_prompts_from_the_templates():
+    text, version = services._storyboard_prompt("p1", {"id": "c1", "title": "Cat café", "logline": "L", "why_it_works": "W"})
+    assert text.startswith("ROLE") and "exactly 10 scenes" in text and '"title": "Cat café"' in text
+    assert version == "v1.0"
+    brief, _ = services._creatives_prompt("Demo", 30, {"audience": "students"}, angle="a bold angle")
+    assert '"creative_angle": "a bold angle"' in brief and '"audience": "students"' in brief
+
+
+def test_template_output_schemas_validate():
+    opts = services.CreativeOptionsPayload.model_validate(
+        {"creative_options": [{"title": "T", "logline": "L", "why_it_works": "W"}]})
+    assert opts.options[0].title == "T"
+    sb = services.StoryboardPayload.model_validate({"scenes": [
+        {"scene_number": 1, "act": "HOOK", "visual_description": "A cat stares.", "camera_shot": "CU", "pacing_seconds": 2.6},
+        {"number": 2, "title": "Payoff", "description": "Legacy shape", "duration_sec": 4},
+    ]}).model_dump()
+    assert sb["scenes"][0] == {"number": 1, "title": "Hook", "description": "A cat stares.", "visuals": "CU",
+                               "voiceover": "", "duration_sec": 2.6}
+    assert sb["scenes"][1]["title"] == "Payoff" and sb["scenes"][1]["duration_sec"] == 4
+
+
+def _paced(n, secs):
+    return services.StoryboardPayload.model_validate({"scenes": [
+        {"scene_number": i + 1, "act": "Beat", "visual_description": "d", "camera_shot": "MS", "pacing_seconds": secs}
+        for i in range(n)]}).model_dump()
+
+
+def test_light_qa_checks_the_target_length():
+    ok, feedback = services.storyboard_light_qa(_paced(6, 2.5), 15)
+    assert ok and "~15s of 15s" in feedback  # fractional pacing is not rounded away
+    assert services.storyboard_light_qa(_paced(12, 5), 60)[0]
+    assert not services.storyboard_light_qa(_paced(12, 5), 30)[0]
+    assert not services.storyboard_light_qa(_paced(6, 2), 30)[0]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    if not DSN:
+        pytest.skip("PF_TEST_DATABASE_URL not set")
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_prompts_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    with pool.connection() as conn:
+        migrations.apply_migrations(conn)
+    registry = prompts.Registry(ttl=3600)
+    registry.attach(pool.connection)
+    monkeypatch.setattr(prompts, "registry", registry)
+    yield pool
+    pool.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+    admin.close()
+
+
+def _rows(pool, sql, params=()):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+
+def test_file_versions_are_recorded_and_active(pool):
+    assert prompts.registry.version("creative") == "v1.0"
+    rows = _rows(pool, "SELECT name, version, is_active FROM prompt_versions ORDER BY name")
+    assert rows == [("creative", "v1.0", True), ("qa_critic", "v1.0", True),
+                    ("storyboard", "v1.0", True), ("technical", "v1.0", True)]
+    assert prompts.registry.sync_files() == 0  # idempotent across restarts / workers
+
+
+def test_activating_a_new_version_switches_rendering(pool):
+    reg = prompts.registry
+    assert reg.get("technical").version == "v1.0"
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        reg.add_version(cur, "technical", "v1.1", "Scene: {{SCENE_JSON}}")
+        with pytest.raises(ValueError):
+            reg.add_version(cur, "technical", "v1.1", "again")
+        conn.rollback()
+        reg.add_version(cur, "technical", "v1.1", "Scene: {{SCENE_JSON}}")
+        assert reg.activate(cur, "technical", "v1.1")
+        assert not reg.activate(cur, "technical", "v9")
+        conn.commit()
+    assert reg.get("technical").version == "v1.0"  # cached until invalidated or the TTL passes
+    reg.invalidate()
+    assert reg.render("technical", SCENE_JSON={"n": 1}) == ('Scene: {"n": 1}', "v1.1")
+    assert reg.render("technical", version="v1.0", SCENE_JSON={"n": 1})[1] == "v1.0"  # pinned
+    assert _rows(pool, "SELECT version FROM prompt_versions WHERE name='technical' AND is_active") == [("v1.1",)]
+
+
+def test_admin_rejects_templates_with_other_variables(pool, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "ADMIN_LOCKDOWN", False)
+    main.app.config["TESTING"] = True
+    headers = {"X-Admin-Password": main.ADMIN_PASSWORD}
+    base = "{{SELECTED_CREATIVE_CONCEPT}} {{NUMBER_OF_SCENES}} {{VIDEO_LENGTH_IN_SECONDS}}"
+    with main.app.test_client() as c:
+        resp = c.post("/admin/prompts", headers=headers,
+                      json={"name": "storyboard", "version": "v1.1", "template": base + " {{NEW_VAR}}"})
+        assert resp.status_code == 400 and resp.get_json()["unknown"] == ["NEW_VAR"]
+        resp = c.post("/admin/prompts", headers=headers,
+                      json={"name": "storyboard", "version": "v1.1", "template": "{{NUMBER_OF_SCENES}}"})
+        assert resp.status_code == 400 and resp.get_json()["missing"] == ["SELECTED_CREATIVE_CONCEPT", "VIDEO_LENGTH_IN_SECONDS"]
+        assert c.post("/admin/prompts", headers=headers,
+                      json={"name": "storyboard", "version": "v1.1", "template": base}).status_code < 300
+
+
+def test_projects_record_the_versions_that_rendered_their_prompts(pool, monkeypatch):
+    reg = prompts.registry
+    monkeypatch.setattr(services, "_call_gemini_for_json", lambda prompt: {"options": []})
+    opts, creative_version = services.generate_creative_options({"project_title": "Demo"})
+    _, storyboard_version = services._storyboard_prompt("p1", {"title": "T"})
+    assert reg.stats()["renders"] >= 2
+
+    # A version activated between generation and persistence does not change what the project records
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        reg.add_version(cur, "storyboard", "v2.0", "{{SELECTED_CREATIVE_CONCEPT}} {{NUMBER_OF_SCENES}} {{VIDEO_LENGTH_IN_SECONDS}}")
+        reg.activate(cur, "storyboard", "v2.0")
+        conn.commit()
+    reg.invalidate()
+    with pool.connection() as conn:
+        pid, options = services.persist_project_and_creatives(conn, "alice", {"project_title": "Demo"}, opts,
+                                                              creative_version)
+        services.persist_storyboard(conn, pid, options[0]["id"], {"scenes": []}, True, "ok",
+                                    prompt_version=storyboard_version)
+    assert _rows(pool, "SELECT prompt_versions FROM projects") == [({"creative": "v1.0", "storyboard": "v1.0"},)]
+    assert reg.version("storyboard") == "v2.0"
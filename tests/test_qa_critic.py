@@ -0,0 +1,149 @@
+"""
+QA critic: verdict parsing, hash cache, light fallback; pending rows and write-backs (needs PF_TEST_DATABASE_URL).
+"""
+import os
+import sys
+import threading
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_engine
+import qa_critic
+import services
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+
+CREATIVE = {"id": "c1", "title": "Cat café", "logline": "L", "why_it_works": "W", "video_length_sec": 30}
+STORYBOARD = {"scenes": [{"number": i + 1, "title": f"S{i + 1}", "description": "d", "visuals": "v",
+                          "voiceover": "", "duration_sec": 3} for i in range(10)]}
+
+
+class FakeCritic:
+    def __init__(self, answer=None, gate=None):
+        self.answer = answer or {"overall_score": 8.5, "is_approved": True, "feedback": "Strong hook."}
+        self.gate = gate
+        self.prompts = []
+
+    def __call__(self, prompt):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.prompts.append(prompt)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+def test_parse_verdict_enforces_the_pass_score():
+    assert qa_critic.parse_verdict({"overall_score": 6.9, "is_approved": True, "feedback": "meh"}).status == "failed"
+    v = qa_critic.parse_verdict({"overall_score": "7", "is_approved": True, "feedback": " ok "})
+    assert v == qa_critic.Verdict("passed", 7.0, "ok", "critic")
+    assert qa_critic.parse_verdict({"overall_score": 9, "is_approved": False}).status == "failed"
+    with pytest.raises(ValueError):
+        qa_critic.parse_verdict({"is_approved": True})
+
+
+def test_identical_storyboards_are_scored_once():
+    llm = FakeCritic()
+    critic = qa_critic.Critic(llm=llm, engine=llm_engine.LLMEngine(2))
+    first = critic.start(STORYBOARD, CREATIVE)
+    assert first.verdict(5) == qa_critic.Verdict("passed", 8.5, "Strong hook.", "critic")
+    assert '"title": "Cat café"' in llm.prompts[0] and "{{" not in llm.prompts[0]
+
+    second = critic.start(STORYBOARD, dict(CREATIVE, id="other"))
+    assert second.future is None and second.ready().source == "cache"
+    assert second.initial()["qa_status"] == "passed"
+    assert len(llm.prompts) == 1 and critic.stats()["cache_hits"] == 1
+
+    changed = critic.start({"scenes": STORYBOARD["scenes"][:9]}, CREATIVE)
+    assert changed.key != first.key and changed.verdict(5) is not None and len(llm.prompts) == 2
+
+
+def test_response_does_not_wait_unless_asked():
+    gate = threading.Event()
+    critic = qa_critic.Critic(llm=FakeCritic(gate=gate), engine=llm_engine.LLMEngine(2))
+    review = critic.start(STORYBOARD, CREATIVE)
+    assert review.summary()["status"] == "pending"
+    assert review.initial()["qa_status"] == "pending"
+    gate.set()
+    assert review.summary(wait=True, timeout=5)["score"] == 8.5
+
+
+def test_failed_or_disabled_critic_falls_back_to_the_light_check():
+    critic = qa_critic.Critic(llm=FakeCritic(answer=RuntimeError("quota")), engine=llm_engine.LLMEngine(2))
+    v = critic.start(STORYBOARD, CREATIVE).verdict(5)
+    assert (v.status, v.score, v.source) == ("passed", None, "light")
+    assert critic.stats()["fallbacks"] == 1 and critic.stats()["cached"] == 0
+
+    off = qa_critic.Critic(llm=FakeCritic(), enabled=False)
+    assert off.start({"scenes": []}, CREATIVE).ready().status == "failed"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    if not DSN:
+        pytest.skip("PF_TEST_DATABASE_URL not set")
+    import psycopg2
+    import db
+    import migrations
+
+    schema = "pf_qa_test_" + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(DSN)
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.commit()
+    pool = db.ConnectionPool(connect=lambda: psycopg2.connect(DSN, options=f"-c search_path={schema},public"), maxconn=2)
+    with pool.connection() as conn:
+        migrations.apply_migrations(conn)
+    yield pool
+    pool.closeall()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.commit()
+    admin.close()
+
+
+def _persist(pool, review):
+    opts = [services.CreativeOption(title=f"T{i}", logline="L", why_it_works="W") for i in range(3)]
+    with pool.connection() as conn:
+        pid, options = services.persist_project_and_creatives(conn, "alice", {"project_title": "Demo"}, opts)
+        return services.persist_storyboard(conn, pid, options[0]["id"], STORYBOARD, review=review)
+
+
+def _row(pool, sb_id):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT qa_status, qa_score, qa_feedback, qa_reviewed_at IS NOT NULL FROM storyboards WHERE id=%s",
+                    (sb_id,))
+        row = cur.fetchone()
+        conn.commit()
+        return row
+
+
+def test_verdict_is_written_back_and_reused_by_hash(pool):
+    gate = threading.Event()
+    llm = FakeCritic(answer={"overall_score": 5, "is_approved": True, "feedback": "Pacing drags."}, gate=gate)
+    critic = qa_critic.Critic(llm=llm, engine=llm_engine.LLMEngine(2))
+    critic.attach(pool.connection)
+
+    review = critic.start(STORYBOARD, CREATIVE)
+    sb_id = _persist(pool, review)
+    assert _row(pool, sb_id)[0] == "pending"
+    review.write_back(sb_id)
+    gate.set()
+    review.verdict(5)
+    critic.drain(5)
+    assert _row(pool, sb_id) == ("failed", 5.0, "Pacing drags.", True)
+
+    # Another instance (cold memo) finds the verdict through storyboards.qa_hash
+    other = qa_critic.Critic(llm=FakeCritic(), engine=llm_engine.LLMEngine(2))
+    other.attach(pool.connection)
+    assert other.start(STORYBOARD, CREATIVE).verdict(5) == qa_critic.Verdict("failed", 5.0, "Pacing drags.", "cache")
+    assert other.stats()["db_hits"] == 1 and other.stats()["scored"] == 0
+
+    # Already known at insert time: the row is final straight away and write_back is a no-op
+    again = critic.start(STORYBOARD, CREATIVE)
+    sb2 = _persist(pool, again)
+    again.write_back(sb2)
+    assert _row(pool, sb2)[:2] == ("failed", 5.0)
+    assert len(llm.prompts) == 1
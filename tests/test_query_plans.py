@@ -0,0 +1,96 @@
+"""
+EXPLAIN-based regression test: every hot query must be servable from an index.
+
+Runs against a real PostgreSQL when PF_TEST_DATABASE_URL is set (skipped otherwise). Migrations are
+applied into a throwaway schema; with enable_seqscan=off the planner only falls back to a Seq Scan
+when no usable index exists, so any Seq Scan node in the plan is a regression.
+"""
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DSN = os.getenv("PF_TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DSN, reason="PF_TEST_DATABASE_URL not set")
+
+SOME_ID = uuid.uuid4()
+
+HOT_QUERIES = {
+    "session_by_id": ("SELECT id, user_id, state, selections, step, project_id FROM sessions WHERE id = %s", (SOME_ID,)),
+    "active_session": (
+        "SELECT id, selections, created_at, updated_at, archived FROM sessions "
+        "WHERE user_id = %s AND archived = FALSE AND updated_at >= NOW() - INTERVAL '24 hours' "
+        "ORDER BY updated_at DESC LIMIT 1",
+        ("u",),
+    ),
+    "update_session": ("UPDATE sessions SET step=1, updated_at=NOW() WHERE id=%s", (SOME_ID,)),
+    "latest_storyboard": ("SELECT scenes FROM storyboards WHERE project_id = %s ORDER BY created_at DESC LIMIT 1", (SOME_ID,)),
+    "creative_by_index": ("SELECT id FROM creative_options WHERE project_id=%s AND option_index=%s LIMIT 1", (SOME_ID, 0)),
+    "recent_messages": ("SELECT speaker, content, created_at FROM director_messages WHERE session_id=%s ORDER BY id DESC LIMIT %s", (SOME_ID, 20)),
+    "recent_projects": (
+        "SELECT id, project_title, video_length_sec, created_at FROM projects WHERE user_id=%s "
+        "ORDER BY created_at DESC NULLS LAST LIMIT %s",
+        ("u", 6),
+    ),
+    "claim_job": (
+        "SELECT id FROM jobs WHERE status = 'queued' AND run_after <= NOW() "
+        "ORDER BY run_after, created_at FOR UPDATE SKIP LOCKED LIMIT 1",
+        (),
+    ),
+    "project_jobs": ("SELECT id, status, progress FROM jobs WHERE project_id = %s ORDER BY created_at DESC LIMIT 20", (SOME_ID,)),
+    "activity_page": (
+        "SELECT id FROM activity_logs WHERE (ts, id) < (NOW(), 100) ORDER BY ts DESC, id DESC LIMIT 51",
+        (),
+    ),
+    "activity_by_actor": (
+        "SELECT id FROM activity_logs WHERE actor = %s AND (ts, id) < (NOW(), 100) ORDER BY ts DESC, id DESC LIMIT 51",
+        ("u",),
+    ),
+    "activity_by_action": (
+        "SELECT id FROM activity_logs WHERE action = %s ORDER BY ts ASC, id ASC LIMIT 51",
+        ("login",),
+    ),
+    "user_by_name": ("SELECT password FROM users WHERE username=%s", ("u",)),
+}
+
+
+def _node_types(plan):
+    yield plan.get("Node Type")
+    for child in plan.get("Plans", []) or []:
+        yield from _node_types(child)
+
+
+@pytest.fixture(scope="module")
+def cur():
+    import psycopg2
+    import db  # noqa: F401  (registers the UUID adapter)
+    import migrations
+
+    schema = "pf_plan_test_" + uuid.uuid4().hex[:8]
+    conn = psycopg2.connect(DSN)
+    c = conn.cursor()
+    c.execute(f"CREATE SCHEMA {schema}")
+    c.execute(f"SET search_path TO {schema}, public")
+    conn.commit()
+    migrations.apply_migrations(conn)
+    c = conn.cursor()
+    c.execute("SET enable_seqscan = off")
+    yield c
+    conn.rollback()
+    c.execute(f"DROP SCHEMA {schema} CASCADE")
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(cur, name):
+    sql, params = HOT_QUERIES[name]
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    raw = cur.fetchone()[0]
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+    nodes = list(_node_types(plan))
+    assert "Seq Scan" not in nodes, f"{name} falls back to a sequential scan: {nodes}"
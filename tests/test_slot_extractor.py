@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slot_extractor
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slot_corpus.jsonl")
+
+
+def _corpus():
+    with open(CORPUS, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize("case", _corpus(), ids=lambda c: c["text"][:40])
+def test_golden_corpus(case):
+    found = slot_extractor.default().extract(case["text"])
+    for slot, value in case["expected"].items():
+        assert found.get(slot) == value, slot
+
+
+def test_hits_carry_spans_in_text_order():
+    text = "Instagram Reels 30s, playful"
+    hits = slot_extractor.default().scan(text)
+    assert [h.slot for h in hits] == ["platform", "duration_sec", "tone"]
+    assert [text[h.start:h.end] for h in hits] == ["Instagram Reels", "30s", "playful"]
+
+
+def test_whole_words_only():
+    # Substrings of other words are not slots ("fun" in "refund", "fb" in "fbi", "reels" in "reelsy")
+    assert slot_extractor.default().extract("refund via fbi reelsy warmth") == {}
+
+
+def test_unit_beats_bare_number_and_hints_are_optional():
+    ex = slot_extractor.default()
+    assert ex.extract("aged 20 to 30, make it 45 seconds")["duration_sec"] == 45
+    assert ex.extract("aged 20 to 30")["duration_sec"] == 20
+    assert "duration_sec" not in ex.extract("aged 20 to 30", duration_hints=False)
+
+
+def test_vocabulary_follows_the_library():
+    ex = slot_extractor.SlotExtractor({
+        "platforms": [{"id": "snack_video", "label": "Snack Video", "durations_sec": [25]}],
+        "tones": ["gritty"],
+        "styles": ["claymation"],
+    })
+    assert ex.extract("snack video 25, gritty claymation") == {
+        "platform": "Snack Video", "duration_sec": 25, "tones": ["gritty"], "styles": ["claymation"]}
+
+
+def test_main_parser_maps_hits_to_slots():
+    import main
+
+    upd = main._parse_slots_from_text("TikTok 30s, epic playful cinematic. CTA: Shop now", {})
+    assert upd == {"duration_sec": 30, "platform": "TikTok", "tone": "epic, playful",
+                   "style": "cinematic", "cta": "shop now"}
+    assert "goal" not in main._parse_slots_from_text("awareness", {"goal": "Drive conversions"})
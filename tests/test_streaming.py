@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_engine  # noqa: E402
+import services  # noqa: E402
+import streaming  # noqa: E402
+
+SCENES = [
+    {"number": 1, "title": "Hook {not a brace}", "description": "Close-up \"cup\" [steam]", "duration_sec": 3},
+    {"number": 2, "title": "Build", "description": "Barista pours", "visuals": "slow-mo", "duration_sec": 5},
+]
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 7, 1000])
+def test_parser_emits_each_scene_once_complete(size):
+    doc = json.dumps({"scenes": SCENES})
+    parser = streaming.SceneStreamParser()
+    seen = []
+    for part in _chunks(doc, size):
+        seen.extend(parser.feed(part))
+    assert seen == SCENES
+
+
+def test_parser_handles_bare_array_and_ignores_nested_objects():
+    doc = json.dumps([{"number": 1, "title": "A", "description": "d", "meta": {"x": [{"y": 1}]}}])
+    assert streaming.SceneStreamParser().feed(doc)[0]["meta"] == {"x": [{"y": 1}]}
+
+
+def test_negotiate_and_encode():
+    assert streaming.negotiate({"stream": "1"}, None) == "sse"
+    assert streaming.negotiate({}, "text/event-stream") == "sse"
+    assert streaming.negotiate({"stream": "ndjson"}, None) == "ndjson"
+    assert streaming.negotiate({}, "application/json") is None
+    assert streaming.encode("sse", "scene", {"a": 1}) == 'event: scene\ndata: {"a": 1}\n\n'
+
+
+def test_stream_storyboard_validates_scenes_incrementally(monkeypatch):
+    bad = {"number": 0, "title": "", "description": ""}
+    doc = json.dumps({"scenes": [SCENES[0], bad, SCENES[1]]})
+    monkeypatch.setattr(services.llm_cache, "cache", services.llm_cache.LLMCache(ttl=60))
+    monkeypatch.setattr(services, "_stream_gemini_text", lambda prompt, system_instruction=None: iter(_chunks(doc, 9)))
+    creative = {"id": "c1", "title": "t", "logline": "l", "why_it_works": "w"}
+    events = list(services.stream_storyboard("p1", creative))
+    scenes = [d for e, d in events if e == "scene"]
+    assert [s["number"] for s in scenes] == [1, 2]
+    assert events[-2:] == [("prompt_version", "v1.0"), ("storyboard", events[-1][1])]
+    assert events[-1][1]["scenes"] == scenes
+    assert events.index(("scene", scenes[0])) < len(events) - 3  # first scene precedes the tail tokens
+
+
+def test_engine_stream_enforces_deadline():
+    eng = llm_engine.LLMEngine(max_workers=1)
+
+    def slow():
+        yield "a"
+        time.sleep(0.5)
+        yield "b"
+
+    it = eng.stream(slow, deadline=0.1)
+    assert next(it) == "a"
+    with pytest.raises(llm_engine.DeadlineExceeded):
+        next(it)
+    eng.shutdown()
+
+
+def test_instrument_records_ttfb():
+    list(streaming.instrument("ndjson", "unit", iter([("open", {}), ("scene", {"n": 1})])))
+    st = streaming.stats()["unit"]
+    assert st["streams"] >= 1 and "ttfb_ms" in st and "first_scene_ms" in st
@@ -0,0 +1,101 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zipstream
+
+SCENES = {"scenes": [{"n": i, "visual": hashlib.sha256(str(i).encode()).hexdigest()} for i in range(20000)]}
+
+
+def _stream():
+    encoder = json.JSONEncoder()
+    return zipstream.ZipStream([
+        zipstream.Entry("project.json", json.dumps({"title": "Demo"})),
+        zipstream.Entry("storyboard.json", lambda: encoder.iterencode(SCENES), fingerprint="sb-1"),
+        zipstream.Entry("refs/cover.png", b"\x89PNG" + bytes(range(256)) * 8),
+    ], date_time=(2025, 1, 2, 3, 4, 5))
+
+
+def test_archive_is_valid_and_compressed_per_entry():
+    data = _stream().getvalue()
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    assert zf.testzip() is None
+    assert json.loads(zf.read("storyboard.json")) == SCENES
+    info = {i.filename: i for i in zf.infolist()}
+    assert info["storyboard.json"].compress_type == zipfile.ZIP_DEFLATED
+    assert info["storyboard.json"].compress_size < info["storyboard.json"].file_size / 2
+    assert info["refs/cover.png"].compress_type == zipfile.ZIP_STORED
+    assert info["project.json"].date_time == (2025, 1, 2, 3, 4, 4)  # DOS time has 2 s resolution
+
+
+def test_chunks_arrive_before_the_archive_is_complete():
+    chunks = _stream().chunks()
+    first = next(chunks)
+    assert first.startswith(b"PK\x03\x04") and len(first) >= zipstream.CHUNK_SIZE
+    assert sum(1 for _ in chunks) >= 1
+
+
+def test_output_and_etag_are_deterministic():
+    a, b = _stream(), _stream()
+    assert a.etag == b.etag and a.getvalue() == b.getvalue()
+    changed = zipstream.ZipStream(a.entries[:1] + [zipstream.Entry("storyboard.json", b"{}")])
+    assert changed.etag != a.etag
+
+
+def test_range_matches_slice_of_full_archive():
+    s = _stream()
+    data = s.getvalue()
+    assert s.size() == len(data)
+    for start, stop in ((0, 10), (100, 70000), (len(data) - 7, len(data))):
+        assert b"".join(s.iter_range(start, stop)) == data[start:stop]
+
+
+def test_streamed_entry_needs_a_fingerprint():
+    with pytest.raises(ValueError):
+        zipstream.Entry("storyboard.json", lambda: iter(["{}"]))
+
+
+@pytest.fixture
+def download(monkeypatch):
+    import main
+    import services
+
+    @contextlib.contextmanager
+    def no_db():
+        yield type("Conn", (), {"commit": lambda self: None})()
+
+    monkeypatch.setattr(main, "db_connection", no_db)
+    monkeypatch.setattr(services, "build_export_stream", lambda conn, pid: _stream())
+    token = main._jwt_create("alice")
+    main.app.config["TESTING"] = True
+    url = "/v1/projects/6f1c2a4e-8d7b-4c1e-9a35-0f2b7d9e1c11/export"
+    with main.app.test_client() as c:
+        yield lambda **headers: c.get(url, headers={"Authorization": f"Bearer {token}", **headers})
+
+
+def test_export_route_streams_with_etag_and_ranges(download):
+    full = download()
+    assert full.status_code == 200 and full.is_streamed
+    data = full.get_data()
+    etag = full.headers["ETag"]
+    assert full.headers["Accept-Ranges"] == "bytes"
+    assert zipfile.ZipFile(io.BytesIO(data)).testzip() is None
+
+    assert download(**{"If-None-Match": etag}).status_code == 304
+
+    part = download(Range="bytes=1000-", **{"If-Range": etag})
+    assert part.status_code == 206
+    assert part.headers["Content-Range"] == f"bytes 1000-{len(data) - 1}/{len(data)}"
+    assert part.get_data() == data[1000:]
+
+    stale = download(Range="bytes=1000-", **{"If-Range": '"other"'})
+    assert stale.status_code == 200 and stale.get_data() == data
+    assert download(Range=f"bytes={len(data) + 10}-").status_code == 416
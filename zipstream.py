@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+zipstream.py
+ZIP archives produced as a stream of chunks, for export downloads.
+
+- ZipStream(entries) writes the archive through zipfile into a non-seekable sink (local headers
+  plus data descriptors, so nothing is ever rewritten) and yields the bytes in CHUNK_SIZE pieces
+  as each entry is compressed; an entry's data may be bytes, str or a callable returning an
+  iterable of either (e.g. lambda: json.JSONEncoder().iterencode(obj)), so a large entry never has
+  to exist in memory in one piece and can be produced again for a range request
+- the compression method and level are chosen per entry: already-compressed media (png, jpg,
+  mp4, zip, ...) is stored, text is deflated (level_for())
+- output is deterministic for the same entries (fixed timestamps, fixed order), so the archive has
+  a strong ETag computed from the inputs alone and a byte range can be served by regenerating and
+  skipping: Range / If-Range resumes need no stored copy
+- size() runs the stream once without keeping it and remembers the total per ETag (also recorded
+  when a full download completes), so range requests and Content-Length cost at most one extra pass
+"""
+
+from __future__ import annotations
+import hashlib
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+CHUNK_SIZE = 64 * 1024
+# Bump when the archive layout changes, so old ETags stop matching
+FORMAT_VERSION = "1"
+DEFAULT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+DEFLATE_LEVEL = 6
+
+STORED_EXTENSIONS = frozenset({
+    "png", "jpg", "jpeg", "webp", "gif", "avif", "heic",
+    "mp4", "mov", "webm", "mp3", "m4a", "aac", "ogg",
+    "zip", "gz", "bz2", "xz", "7z", "pdf",
+})
+
+Data = Union[bytes, str, Callable[[], Iterable[Union[bytes, str]]]]
+
+
+def level_for(name: str) -> Optional[int]:
+    """Deflate level for an entry name, or None to store it (already compressed)."""
+    ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    return None if ext in STORED_EXTENSIONS else DEFLATE_LEVEL
+
+
+class Entry:
+    __slots__ = ("name", "data", "level", "fingerprint")
+
+    def __init__(self, name: str, data: Data, level: Any = "auto", fingerprint: Optional[str] = None):
+        """
+        level: "auto" (level_for(name)), None (stored) or a deflate level 0-9.
+        fingerprint: identifies the content for the ETag; required when data is a callable
+        (it only runs while streaming), computed from bytes / str otherwise.
+        """
+        self.name = name
+        self.data = data
+        self.level = level_for(name) if level == "auto" else level
+        if fingerprint is None:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            if not isinstance(data, bytes):
+                raise ValueError(f"{name}: a fingerprint is required for streamed entry data")
+            fingerprint = hashlib.sha256(data).hexdigest()
+        self.fingerprint = fingerprint
+
+
+class _Sink:
+    """Write target for zipfile. It has no seek(), so zipfile writes data descriptors instead of seeking back."""
+
+    def __init__(self):
+        self.buf: List[bytes] = []
+        self.pending = 0
+        self.pos = 0
+
+    def write(self, b) -> int:
+        n = len(b)
+        if n:
+            self.buf.append(bytes(b))
+            self.pending += n
+            self.pos += n
+        return n
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        out = b"".join(self.buf)
+        self.buf, self.pending = [], 0
+        return out
+
+
+def _pieces(data: Data) -> Iterator[bytes]:
+    data = (data,) if isinstance(data, (bytes, str)) else data()
+    batch: List[bytes] = []
+    size = 0
+    for piece in data:
+        if isinstance(piece, str):
+            piece = piece.encode("utf-8")
+        batch.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield b"".join(batch)
+            batch, size = [], 0
+    if batch:
+        yield b"".join(batch)
+
+
+class ZipStream:
+    def __init__(self, entries: Iterable[Entry], date_time: Tuple[int, int, int, int, int, int] = DEFAULT_DATE_TIME):
+        self.entries = list(entries)
+        self.date_time = tuple(date_time)
+        h = hashlib.sha256(f"zipstream/{FORMAT_VERSION}/{self.date_time}".encode())
+        for e in self.entries:
+            h.update(f"\0{e.name}\0{e.level}\0{e.fingerprint}".encode("utf-8"))
+        self.etag = h.hexdigest()[:32]
+
+    def chunks(self) -> Iterator[bytes]:
+        """The archive, in pieces of about CHUNK_SIZE bytes (the first one as soon as it is full)."""
+        sink = _Sink()
+        total = 0
+        with zipfile.ZipFile(sink, "w") as zf:
+            for e in self.entries:
+                info = zipfile.ZipInfo(e.name, date_time=self.date_time)
+                info.external_attr = 0o644 << 16
+                if e.level is None:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info._compresslevel = e.level
+                # Streamed entries have no size up front; allow them past 2 GiB
+                streamed = not isinstance(e.data, (bytes, str))
+                with zf.open(info, "w", force_zip64=streamed) as dest:
+                    for piece in _pieces(e.data):
+                        dest.write(piece)
+                        if sink.pending >= CHUNK_SIZE:
+                            out = sink.take()
+                            total += len(out)
+                            yield out
+        out = sink.take()  # central directory
+        total += len(out)
+        if out:
+            yield out
+        _remember_size(self.etag, total)
+
+    def size(self) -> int:
+        known = known_size(self.etag)
+        if known is None:
+            known = sum(len(c) for c in self.chunks())
+        return known
+
+    def iter_range(self, start: int, stop: int) -> Iterator[bytes]:
+        """Bytes [start, stop) of the archive."""
+        pos = 0
+        for chunk in self.chunks():
+            end = pos + len(chunk)
+            if end > start:
+                yield chunk[max(0, start - pos):min(len(chunk), stop - pos)]
+            pos = end
+            if pos >= stop:
+                return
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks())
+
+
+_sizes: "OrderedDict[str, int]" = OrderedDict()
+_sizes_lock = threading.Lock()
+SIZE_CACHE_ENTRIES = 512
+
+
+def _remember_size(etag: str, size: int) -> None:
+    with _sizes_lock:
+        _sizes[etag] = size
+        _sizes.move_to_end(etag)
+        while len(_sizes) > SIZE_CACHE_ENTRIES:
+            _sizes.popitem(last=False)
+
+
+def known_size(etag: str) -> Optional[int]:
+    with _sizes_lock:
+        return _sizes.get(etag)